@@ -1,16 +1,44 @@
+import hashlib
 import logging
-from typing import List, Tuple, Dict
+import os
+import re
+import socket
+from collections import OrderedDict
+from fnmatch import fnmatchcase
+from typing import List, Tuple, Dict, Optional, Any, Union
 from privex.pyrewall.RuleParser import RuleParser
+from privex.pyrewall.RuleBuilder import RuleBuilder
+from privex.pyrewall.emitters import Emitter, get_emitter
+from privex.pyrewall.blocklist import read_blocklist
+from privex.pyrewall.rangeset import read_rangeset
+from privex.pyrewall.nat import read_portmap
 from privex.pyrewall.core import find_file
 from privex.pyrewall import conf
-from privex.pyrewall.exceptions import UnknownKeyword
-from privex.pyrewall.types import IPVersionList
+from privex.pyrewall.exceptions import UnknownKeyword, RuleSyntaxError
+from privex.pyrewall.types import IPVersionList, TempSet, IPT_ACTION, IPT_TYPE, RuleSource
 
 log = logging.getLogger(__name__)
 
 
 EXTENSION_TYPES = conf.EXTENSION_TYPES
 
+_rgx_var = re.compile(r'\$(?:{(\w+)}|(\w+))')
+
+
+def var_value(value: Any) -> str:
+    """Convert a variable value (e.g. from a YAML hosts file) into a string - lists are joined with commas"""
+    if isinstance(value, (list, tuple, set)):
+        return ','.join(var_value(v) for v in value)
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return '' if value is None else str(value)
+
+
+def read_lines(path: str) -> Tuple[str, ...]:
+    """Read the lines of a Pyre file into an (immutable) tuple, so they can be kept in :py:attr:`.PyreParser.line_cache`"""
+    with open(path, 'r') as fh:
+        return tuple(fh.readlines())
+
 
 class PyreParser:
     """
@@ -51,30 +79,94 @@ class PyreParser:
     """Contains ``List[str]``'s of the currently generated iptables rules per IP version e.g. ``self.cache.v4`` """
     output: IPVersionList
     """Contains ``List[str]``'s of the final generated iptables rules per IP version e.g. ``self.output.v4`` """
+    origins: IPVersionList
+    """The :class:`.RuleSource` of each rule in :py:attr:`.cache` (same length and order)"""
+    output_origins: IPVersionList
+    """
+    The :class:`.RuleSource` of each line in :py:attr:`.output` (same length and order) - i.e. the Pyre file, line
+    number and line which generated it. ``None`` for generated lines such as the ``*table`` / chain headers.
+    """
+    location: Optional[RuleSource]
+    """The Pyre line currently being parsed"""
     committed: bool
+    files: List[str]
+    """Absolute paths of every file read while parsing - the file passed to :py:meth:`.parse_file` plus all imports"""
+    temp_sets: Dict[str, TempSet]
+    """
+    The ipsets backing temporary (``for 30m``) rules, keyed by set name. Temporary rules which share a set
+    are merged into one :class:`.TempSet`, and only the first of them outputs the rule matching the set.
+    """
+    blocklists: Dict[str, dict]
+    """
+    The ipsets of ``@blocklist``, ``@rangeset`` and ``@geoset`` directives, keyed by set name (see :py:attr:`.ipsets`
+    for the format)
+    """
+    line_cache: Optional[Dict[tuple, Tuple[List[str], List[str], List[TempSet]]]]
+    """
+    An optional cache of compiled Pyre rule lines, shared between parser instances to avoid re-compiling lines
+    which haven't changed (e.g. by the Pyre daemon between reloads). Keyed by the rule line plus the parser
+    state which affects its output (table, known chains, strict mode, backend).
+
+    Parsed ``@blocklist`` / ``@rangeset`` files are also cached here, keyed by their path, modification time and size.
+    """
+    search_dirs: List[str]
+    """The directories searched for files used by ``@import`` / ``@blocklist`` etc. (default: ``conf.SEARCH_DIRS``)"""
+    variables: Dict[str, str]
+    """
+    The variables available to ``$name`` / ``${name}`` substitution and ``@if`` blocks. ``host`` defaults to the
+    hostname of this machine. Variables passed to the constructor (e.g. per host by ``pyre build-fleet``) override
+    any ``@var`` directives for the same name, so ``@var`` can be used to set defaults in shared templates.
+    """
+    fixed_vars: set
+    """The names of the variables passed to the constructor, which ``@var`` won't override"""
+    conditions: List[List[bool]]
+    """A stack of ``[active, matched]`` for each ``@if`` block currently open"""
+    emitter: Emitter
+    """
+    The output backend (see :mod:`privex.pyrewall.emitters`) - ``iptables`` outputs iptables-restore rules per IP
+    version, while ``nft`` outputs a single nftables script as the IPv4 rules (the IPv6 rules are empty)
+    """
     rp: RuleParser
     strict: bool = False
     DEFAULT_CHAINS: Dict[str, dict] = conf.DEFAULT_CHAINS
     """Alias for :py:attr:`privex.pyrewall.conf.DEFAULT_CHAINS` """
 
-    def __init__(self, table='filter', chains: dict = None, **rp_args):
+    def __init__(self, table='filter', chains: dict = None, line_cache: dict = None, search_dirs: List[str] = None,
+                 variables: Dict[str, Any] = None, emitter: Union[str, Emitter] = None, **rp_args):
         """
         PyreParser - The highest level parser class - directly parses ``.pyre`` files and generates iptables compatible
         configuration lines.
 
         :param str   table: The default table to use if not specified in the rules file, e.g. ``filter`` or ``nat``
         :param dict chains: Optionally override the default chains used. Defaults to :py:attr:`.DEFAULT_CHAINS`
+        :param dict line_cache: Optionally pass a dict to use as :py:attr:`.line_cache` (shared compiled line cache)
+        :param list search_dirs: Override the directories searched for imported files (see :py:attr:`.search_dirs`)
+        :param dict variables: Variables for ``$name`` substitution / ``@if`` (see :py:attr:`.variables`)
+        :param emitter: The backend name (``iptables`` / ``nft``) or :class:`.Emitter` (default: ``conf.BACKEND``)
         :param     rp_args:
         """
         self.table = table
-        self.chains = dict(self.DEFAULT_CHAINS[self.table]) if not chains else chains
+        self.chains = self._default_chains(self.table) if not chains else chains
+        self.search_dirs = list(conf.SEARCH_DIRS if search_dirs is None else search_dirs)
         self.cache = IPVersionList(v4=[], v6=[])
         self.output = IPVersionList(v4=[], v6=[])
+        self.origins = IPVersionList(v4=[], v6=[])
+        self.output_origins = IPVersionList(v4=[], v6=[])
+        self.location = None
         self.committed = False
+        self.files = []
+        self.temp_sets = OrderedDict()
+        self.blocklists = OrderedDict()
+        self.line_cache = line_cache
+        variables = {} if variables is None else variables
+        self.fixed_vars = set(variables.keys())
+        self.variables = {'host': socket.gethostname(), **{k: var_value(v) for k, v in variables.items()}}
+        self.conditions = []
         if 'strict' in rp_args: self.strict = rp_args['strict']
-        self.rp = RuleParser(**rp_args)
+        self.emitter = get_emitter(emitter)
+        self.rp = RuleParser(emitter=self.emitter, **rp_args)
 
-    def parse_lines(self, lines: List[str]) -> Tuple[List[str], List[str]]:
+    def parse_lines(self, lines: List[str], path: str = None) -> Tuple[List[str], List[str]]:
         """
         Takes a ``List[str]`` of Pyre rules, and parses them into a list of IPv4 / IPv6 iptables-restore rules.
 
@@ -94,14 +186,29 @@ class PyreParser:
 
 
         :param List[str] lines: A ``List[str]`` of Pyre rules to parse
+        :param str path: The file the lines were read from, if any (for :py:attr:`.output_origins`)
         :return tuple rules: ``(v4_rules, v6_rules,)`` Each are iptables-restore compatible rules, as a ``List[str]``
         """
-        for _line in lines:
-            self._parse(_line)
+        self._parse_source(lines, path)
+        if len(self.conditions) > 0:
+            raise RuleSyntaxError(f'Missing @endif for {len(self.conditions)} @if block(s)')
         log.debug('Finished parsing lines. Committing.')
         self.commit()
         return self.output.v4, self.output.v6
 
+    def _parse_source(self, lines: List[str], path: str = None):
+        """Parse each line of a Pyre file / list of lines, keeping track of the current :py:attr:`.location`"""
+        for lineno, _line in enumerate(lines, start=1):
+            self.location = RuleSource(file=path, line=lineno, text=_line.strip())
+            self._parse(_line)
+
+    def _emit(self, v4_rules: List[str], v6_rules: List[str]):
+        """Add compiled rules to :py:attr:`.cache`, recording the current :py:attr:`.location` as their origin"""
+        self.cache.v4 += v4_rules
+        self.cache.v6 += v6_rules
+        self.origins.v4 += [self.location] * len(v4_rules)
+        self.origins.v6 += [self.location] * len(v6_rules)
+
     def _parse(self, line: str):
         """
         Parses an individual Pyre rule (``allow from x.x.x.x``) or control directive (``@table filter``) and fires
@@ -121,22 +228,97 @@ class PyreParser:
         if len(sline) == 0 or sline[0].strip()[0] == '#':
             log.debug('Skipping empty line')
             return [], []
+        if sline[0] in self.CONDITIONALS:
+            self.control_handlers[sline[0]](self, *sline[1:])
+            return [], []
+        if not self.active:
+            log.debug('Skipping line inside inactive @if block')
+            return [], []
+        if '$' in line:
+            line = self.substitute(line)
+            sline = line.split()
         if sline[0] in self.control_handlers:
             log.debug('Detected control keyword "%s" - passing to handler', sline[0])
             self.control_handlers[sline[0]](self, *sline[1:])
             return [], []
+        cache_key = None
+        if self.line_cache is not None:
+            cache_key = (' '.join(sline), self.table, tuple(self.rp.chains.keys()), self.strict, self.emitter.name)
+            if cache_key in self.line_cache:
+                v4_rules, v6_rules, temp_sets = self.line_cache[cache_key]
+                v4_rules, v6_rules = self._add_temp_sets(v4_rules, v6_rules, temp_sets)
+                self._emit(v4_rules, v6_rules)
+                return v4_rules, v6_rules
+
         log.debug('Passing line starting with "%s" to RuleParser', sline[0])
         v4_rules, v6_rules = self.rp.parse(line)
         if v4_rules is None or v6_rules is None:
             if self.strict:
                 raise UnknownKeyword('(strict mode) Unknown keyword detected in pyre line...')
             return None, None
+        if cache_key is not None:
+            self.line_cache[cache_key] = (v4_rules, v6_rules, self.rp.last_sets)
+        v4_rules, v6_rules = self._add_temp_sets(v4_rules, v6_rules, self.rp.last_sets)
+        self._emit(v4_rules, v6_rules)
 
-        self.cache.v4 += v4_rules
-        self.cache.v6 += v6_rules
+        return v4_rules, v6_rules
+
+    @property
+    def active(self) -> bool:
+        """``False`` while inside an ``@if`` / ``@elif`` / ``@else`` block whose condition didn't match"""
+        return all(c[0] for c in self.conditions)
+
+    def substitute(self, line: str) -> str:
+        """
+        Replace ``$name`` / ``${name}`` in ``line`` with the value of the variable from :py:attr:`.variables`
+
+            >>> PyreParser(variables=dict(admins=['10.0.0.1', '10.0.0.2'])).substitute('allow port 22 from $admins')
+            'allow port 22 from 10.0.0.1,10.0.0.2'
 
+        :raises RuleSyntaxError: When the line uses a variable which isn't defined
+        """
+        def _sub(m):
+            name = m.group(1) or m.group(2)
+            if name not in self.variables:
+                raise RuleSyntaxError(f'Undefined variable ${name} in line: {line.strip()}')
+            return self.variables[name]
+        return _rgx_var.sub(_sub, line)
+
+    def _add_temp_sets(self, v4_rules: List[str], v6_rules: List[str], temp_sets: List[TempSet]):
+        """
+        Merge the ipsets used by a temporary rule into :py:attr:`.temp_sets`. If a set is already known, its rule
+        has already been output, so the rule matching it is removed from ``v4_rules`` / ``v6_rules``.
+        """
+        for ts in temp_sets:
+            if ts.name not in self.temp_sets:
+                self.temp_sets[ts.name] = TempSet(name=ts.name, family=ts.family, entries=list(ts.entries))
+                continue
+            self.temp_sets[ts.name].entries.extend(ts.entries)
+            match = self.emitter.set_match(ts.name)
+            v4_rules, v6_rules = [r for r in v4_rules if match not in r], [r for r in v6_rules if match not in r]
         return v4_rules, v6_rules
 
+    @property
+    def ipsets(self) -> Optional[dict]:
+        """
+        The ipsets needed by the parsed rules, as a JSON serializable dict (``None`` if there aren't any) - for
+        passing to :func:`privex.pyrewall.ipsets.apply_ipsets`
+
+            >>> p = PyreParser()
+            >>> v4_rules, v6_rules = p.parse_lines(['drop from 1.2.3.4 for 30m', '@blocklist /etc/drop.netset'])
+            >>> p.ipsets
+            {'pyre-bl4-3dee3056': {'family': 'inet', 'type': 'blocklist', 'entries': '1.2.3.0/24\\n5.6.0.0/16',
+                                   'maxelem': 4194304},
+             'pyre-tmp4-45deea69': {'family': 'inet', 'entries': [['1.2.3.4', 1800]]}}
+
+        """
+        if len(self.temp_sets) == 0 and len(self.blocklists) == 0:
+            return None
+        return {
+            **self.blocklists,
+            **{ts.name: dict(family=ts.family, entries=[list(e) for e in ts.entries]) for ts in self.temp_sets.values()}
+        }
+
     def parse_file(self, path: str) -> Tuple[List[str], List[str]]:
         """
         Parse a given ``.pyre`` file (absolute path!) into IPTables rules.
@@ -153,19 +335,13 @@ class PyreParser:
         :param str path: The absolute path to the Pyre file, e.g. ``/etc/pyre/test.pyre``
         :return tuple rules: ``(v4_rules, v6_rules,)`` Each are iptables-restore compatible rules, as a ``List[str]``
         """
-        with open(path, 'r') as fh:
-            lines = fh.readlines()
-            return self.parse_lines(lines=lines)
+        self.files.append(path)
+        return self.parse_lines(lines=self._cached_read('@file', path, read_lines, validates=False), path=path)
 
     def _commit(self, ipver='v4'):
         """Internal function used by :py:meth:`.commit` to commit rule cache into output - see commit's PyDoc block."""
         log.debug('Committing IP%s cache to output', ipver)
-        header = [f'*{self.table}']
-        for cname, cdata in self.chains.items():
-            header += [f':{cname} {cdata[0]} {cdata[1]}']
-        merged = header + self.cache[ipver] + ['COMMIT', f'### End of table {self.table} ###']
-        self.output[ipver] += merged
-        self.cache[ipver] = []
+        self.emitter.commit(self, ipver)
 
     def commit(self, *args):
         """
@@ -184,7 +360,15 @@ class PyreParser:
         if len(self.cache.v6) > 0:
             self._commit('v6')
 
-        self.chains = self.DEFAULT_CHAINS.get(self.table, {})
+        self.chains = self._default_chains(self.table)
+
+    def _default_chains(self, table: str) -> Dict[str, List[str]]:
+        """
+        Returns a copy of the default chains for ``table`` from :py:attr:`.DEFAULT_CHAINS` - which must never be
+        modified directly, as it's shared by every parser (e.g. ``@chain INPUT DROP`` would change the defaults of
+        every parser in the process).
+        """
+        return {name: list(chain) for name, chain in self.DEFAULT_CHAINS.get(table, {}).items()}
 
     ###
     # Pyre Control Directive (e.g. ``@table``) handlers below.
@@ -201,7 +385,7 @@ class PyreParser:
         if not self.committed:
             self.commit()
         self.table = self.rp.table = table
-        self.chains = self.rp.chains = dict(self.DEFAULT_CHAINS.get(self.table, {}))
+        self.chains = self.rp.chains = self._default_chains(self.table)
 
     def set_chain(self, *args):
         """Handler for ``@chain [chain_name] (policy) (packets)`` directive in ``.pyre`` files."""
@@ -225,19 +409,281 @@ class PyreParser:
         else:
             raise AttributeError('import_file expects at least one argument')
 
-        path = find_file(filename=_path, paths=conf.SEARCH_DIRS, extensions=conf.SEARCH_EXTENSIONS)
+        path = find_file(filename=_path, paths=self.search_dirs, extensions=conf.SEARCH_EXTENSIONS)
         log.info('Importing %s file at %s ...', ftype, path)
-        with open(path, 'r') as fh:
-            lines = fh.readlines()
-            for l in lines:
-                if ftype == 'pyre': self._parse(l)
-                if ftype == 'ip4': self.cache.v4 += [l.strip()]
-                if ftype == 'ip6': self.cache.v6 += [l.strip()]
+        self.files.append(path)
+        location, lines = self.location, self._cached_read('@file', path, read_lines, validates=False)
+        if ftype == 'pyre':
+            self._parse_source(lines, path)
+        else:
+            for lineno, l in enumerate(lines, start=1):
+                self.location = RuleSource(file=path, line=lineno, text=l.strip())
+                self._emit([l.strip()] if ftype == 'ip4' else [], [l.strip()] if ftype == 'ip6' else [])
+        self.location = location
         log.info('Successfully imported "%s" ...', _path)
 
+    def _cached_read(self, kind: str, path: str, reader, *args, validates=True):
+        """
+        Call ``reader(path, *args, strict=self.strict)`` to read a large list file (e.g. :func:`.read_blocklist`),
+        using :py:attr:`.line_cache` if the file hasn't changed since it was last read. Pass ``validates=False`` for
+        readers which don't take ``strict`` (e.g. :func:`.read_lines`).
+        """
+        kwargs = dict(strict=self.strict) if validates else {}
+        if self.line_cache is None:
+            return reader(path, *args, **kwargs)
+        st = os.stat(path)
+        cache_key = (kind, path, args, st.st_mtime_ns, st.st_size, kwargs.get('strict'))
+        if cache_key not in self.line_cache:
+            # Only one version of each file is kept, so the cache doesn't grow every time the file changes
+            # (list() copies the keys atomically, so it's safe while other threads use a shared cache)
+            for k in [k for k in list(self.line_cache) if k[:3] == (kind, path, args)]:
+                self.line_cache.pop(k, None)
+            self.line_cache[cache_key] = reader(path, *args, **kwargs)
+        return self.line_cache[cache_key]
+
+    def _set_args(self, args: tuple) -> Tuple[str, IPT_ACTION, List[str]]:
+        """Parse the ``[file] (drop|reject|allow) (chains...)`` arguments of set directives such as ``@blocklist``"""
+        if len(args) == 0:
+            raise AttributeError('Set directives such as @blocklist expect at least one argument')
+        path = os.path.abspath(find_file(filename=args[0], paths=self.search_dirs, extensions=['']))
+        action = IPT_ACTION.DROP
+        if len(args) > 1 and args[1].lower() in ['drop', 'reject', 'allow', 'accept']:
+            action = dict(drop=IPT_ACTION.DROP, reject=IPT_ACTION.REJECT).get(args[1].lower(), IPT_ACTION.ALLOW)
+            args = args[1:]
+        chains = list(args[1:]) if len(args) > 1 else ['INPUT']
+        self.files.append(path)
+        return path, action, chains
+
+    def _add_set(self, prefix: str, key: str, v4: List[str], v6: List[str], action: IPT_ACTION, chains: List[str]):
+        """
+        Add the aggregated ``v4`` / ``v6`` subnets of a set directive to :py:attr:`.blocklists` as an ipset per IP
+        version named ``{prefix}{4|6}-{sha1(key)}``, and output a rule per chain matching each set.
+        """
+        key_hash = hashlib.sha1(key.encode()).hexdigest()[:8]
+        for ipver, family, subnets in [('v4', 'inet', v4), ('v6', 'inet6', v6)]:
+            if len(subnets) == 0:
+                continue
+            if len(subnets) > conf.BLOCKLIST_MAXELEM:
+                raise RuleSyntaxError(
+                    f"Set from {key} has {len(subnets)} IP{ipver} subnets after aggregation, which is more "
+                    f"than BLOCKLIST_MAXELEM ({conf.BLOCKLIST_MAXELEM})"
+                )
+            name = f'{prefix}{ipver[1]}-{key_hash}'
+            self.blocklists[name] = dict(
+                family=family, type='blocklist', entries='\n'.join(subnets), maxelem=conf.BLOCKLIST_MAXELEM
+            )
+            for chain in chains:
+                direction = 'dst' if chain.upper() in ['OUTPUT', 'POSTROUTING'] else 'src'
+                self._emit(*self.emitter.set_rule(chain, name, ipver, direction, action))
+
+    def add_blocklist(self, *args):
+        """
+        Handler for ``@blocklist [file] (drop|reject|allow) (chains...)`` directive in ``.pyre`` files.
+
+        Loads every address / subnet in a large plain text list (see :mod:`privex.pyrewall.blocklist`) into an
+        ipset per IP version, and outputs a single rule per chain matching the set - instead of one rule per
+        address. The action defaults to ``drop``, and the chain to ``INPUT``. Addresses are matched as the
+        source, except in the ``OUTPUT`` and ``POSTROUTING`` chains where they're matched as the destination.
+
+            >>> p = PyreParser()
+            >>> v4_rules, v6_rules = p.parse_lines(['@blocklist /etc/drop.netset reject INPUT FORWARD'])
+            >>> v4_rules[4:6]
+            ['-A INPUT -m set --match-set pyre-bl4-3dee3056 src -j REJECT',
+             '-A FORWARD -m set --match-set pyre-bl4-3dee3056 src -j REJECT']
+
+        """
+        path, action, chains = self._set_args(args)
+        log.info('Loading blocklist %s ...', path)
+        res = self._cached_read('@blocklist', path, read_blocklist)
+        self._add_set('pyre-bl', path, res.v4, res.v6, action, chains)
+        log.info('Loaded %d entries (%d IPv4 + %d IPv6 subnets after aggregation) from blocklist "%s"',
+                 res.entries, len(res.v4), len(res.v6), args[0])
+
+    def add_rangeset(self, *args, values: List[str] = None):
+        """
+        Handler for ``@rangeset [file] (drop|reject|allow) (chains...)`` directive in ``.pyre`` files.
+
+        Like ``@blocklist``, but loads the IP ranges from a CSV range database (see :mod:`privex.pyrewall.rangeset`),
+        converted into the smallest list of subnets covering them.
+        """
+        path, action, chains = self._set_args(args)
+        log.info('Loading range database %s ...', path)
+        values = None if values is None else tuple(values)
+        res = self._cached_read('@rangeset', path, read_rangeset, values)
+        self._add_set('pyre-rs', path if values is None else f"{path} {','.join(values)}", res.v4, res.v6, action, chains)
+        log.info('Matched %d of %d ranges (%d IPv4 + %d IPv6 subnets after aggregation) from range database "%s"',
+                 res.matched, res.rows, len(res.v4), len(res.v6), args[0])
+
+    def add_geoset(self, *args):
+        """
+        Handler for ``@geoset [file] [values] (drop|reject|allow) (chains...)`` directive in ``.pyre`` files.
+
+        Like ``@rangeset``, but only uses the rows of the range database matching one of the comma separated
+        ``values`` (e.g. country codes or ASNs) in any column after the range.
+
+            >>> p = PyreParser()
+            >>> v4_rules, v6_rules = p.parse_lines(['@geoset /etc/pyrewall/geo/dbip-country-lite.csv CN,RU drop'])
+
+        """
+        if len(args) < 2:
+            raise AttributeError('add_geoset expects at least two arguments (the file, and the values to match)')
+        values = [v.strip().upper() for v in args[1].split(',') if v.strip() != '']
+        return self.add_rangeset(args[0], *args[2:], values=values)
+
+    def add_offload(self, *args):
+        """
+        Handler for ``@offload (if) [interfaces] (hw)`` directive in ``.pyre`` files (nftables backend only).
+
+        Declares a flowtable on the comma separated ``interfaces``, and outputs a ``FORWARD`` rule adding established
+        TCP / UDP connections to it - so the following packets of those flows skip the rule chains entirely, in the
+        ingress hook. Put it before your other ``FORWARD`` rules. Add ``hw`` to offload flows into NIC hardware, if
+        the interface drivers support it.
+
+            >>> p = PyreParser(emitter='nft')
+            >>> script, _ = p.parse_lines(['@offload if eth0,eth1', 'allow forward if-in eth1 if-out eth0'])
+            >>> script[3]
+            '    flowtable pyre-ft-0f2b2d1e { hook ingress priority 0; devices = { eth0, eth1 }; }'
+            >>> [l.strip() for l in script if 'flow add' in l]
+            ['meta l4proto { tcp, udp } ct state established flow add @pyre-ft-0f2b2d1e']
+
+        """
+        args = list(args[1:]) if len(args) > 0 and args[0] in ['if', 'if-in', 'dev', 'devices'] else list(args)
+        devices = [] if len(args) == 0 else [d for d in args[0].split(',') if d != '']
+        if len(devices) == 0:
+            raise RuleSyntaxError('@offload expects a comma separated list of interfaces, e.g. "@offload if eth0,eth1"')
+        if self.table != 'filter':
+            raise RuleSyntaxError(f"@offload can only be used in the 'filter' table, not '{self.table}'")
+        hw = len(args) > 1 and args[1].lower() in ['hw', 'hardware']
+        name = f"pyre-ft-{hashlib.sha1(','.join(devices).encode()).hexdigest()[:8]}"
+        # Only TCP and UDP flows can be offloaded - the same established state match as 'state established'
+        rule = RuleBuilder(rule_type=IPT_TYPE.FORWARD.value, protocol='tcp', extra_protocols=['udp'], flowtable=name)
+        rule.match_rules.append('-m state --state ESTABLISHED')
+        self._emit(*self.emitter.offload(name, devices, hw, rule))
+
+    def add_portmap(self, *args):
+        """
+        Handler for ``@portmap [file] (tcp|udp|both) (if-in [interface])`` directive in ``.pyre`` files (``nat`` table).
+
+        Loads a list of port forwards (see :mod:`privex.pyrewall.nat`) into the ``PREROUTING`` chain. Instead of one
+        DNAT rule per mapping, the iptables backend splits large lists into a chain per bucket of consecutive ports,
+        and the nftables backend looks up the port in a map - so thousands of mappings don't slow down every packet.
+
+            >>> p = PyreParser(table='nat')
+            >>> v4_rules, _ = p.parse_lines(['@portmap /etc/pyrewall/portmap.txt both if-in eth0'])
+            >>> v4_rules[6:8]
+            ['-A PREROUTING -i eth0 -p tcp --dport 2201:2232 -j pyre-pm-4e1f0a2c-4t0',
+             '-A PREROUTING -i eth0 -p tcp --dport 2233:2264 -j pyre-pm-4e1f0a2c-4t1']
+
+        """
+        if len(args) == 0:
+            raise AttributeError('@portmap expects at least one argument (the port mapping list)')
+        if self.table != 'nat':
+            raise RuleSyntaxError(f"@portmap can only be used in the 'nat' table, not '{self.table}'")
+        path = os.path.abspath(find_file(filename=args[0], paths=self.search_dirs, extensions=['']))
+        args, protocols, iface = list(args[1:]), ['tcp'], None
+        if len(args) > 0 and args[0].lower() in ['tcp', 'udp', 'both']:
+            proto = args.pop(0).lower()
+            protocols = ['tcp', 'udp'] if proto == 'both' else [proto]
+        if len(args) > 1 and args[0] in ['if', 'if-in']:
+            iface = args[1]
+        elif len(args) > 0:
+            raise RuleSyntaxError(f"Unexpected @portmap arguments: {' '.join(args)}")
+
+        self.files.append(path)
+        log.info('Loading port mapping list %s ...', path)
+        mappings = self._cached_read('@portmap', path, read_portmap)
+        name = f"pyre-pm-{hashlib.sha1(f'{path} {protocols} {iface}'.encode()).hexdigest()[:8]}"
+        v4_rules, v6_rules, chains = self.emitter.port_map(name, 'PREROUTING', protocols, iface, mappings)
+        # A new dict, so the bucket chains aren't added to the chains known by rules (e.g. the 'all' keyword)
+        self.chains = {**self.chains, **{c: ['-', '[0:0]'] for c in chains}}
+        self._emit(v4_rules, v6_rules)
+        log.info('Loaded %d port mappings from "%s"', len(mappings), path)
+
+    def set_var(self, *args):
+        """
+        Handler for ``@var [name] [value...]`` directive in ``.pyre`` files. Sets the variable ``name`` for use as
+        ``$name`` in the following lines - unless it was passed to the constructor (see :py:attr:`.variables`).
+
+            >>> PyreParser(variables=dict(ssh_port=2222)).parse_lines(['@var ssh_port 22', 'allow port $ssh_port'])[0][4]
+            '-A INPUT -p tcp --dport 2222 -j ACCEPT'
+
+        """
+        if len(args) == 0 or not re.fullmatch(r'\w+', args[0]):
+            raise RuleSyntaxError(f"@var expects a variable name (letters, numbers and _), got: {' '.join(args)}")
+        if args[0] in self.fixed_vars:
+            log.debug('Not setting variable %s with @var, as it was passed to the parser', args[0])
+            return
+        self.variables[args[0]] = ' '.join(args[1:])
+
+    def _condition(self, args: tuple) -> bool:
+        """
+        Evaluate the condition of an ``@if`` / ``@elif`` - ``[!]name`` is true if the variable is set to a value other
+        than empty / ``false`` / ``no`` / ``0``, while ``[!]name [patterns...]`` is true if the variable matches any of
+        the space or comma separated glob patterns, e.g. ``@if host web-* db1``
+        """
+        if len(args) == 0:
+            raise RuleSyntaxError('@if / @elif expect a condition, e.g. "@if host web-*" or "@if role db"')
+        name, negate = args[0].lstrip('!'), args[0].startswith('!')
+        value = self.variables.get(name)
+        if len(args) == 1:
+            res = value is not None and value.lower() not in ['', 'false', 'no', '0']
+        else:
+            patterns = [p for a in args[1:] for p in a.split(',') if p != '']
+            res = value is not None and any(fnmatchcase(value, p) for p in patterns)
+        return res != negate
+
+    def start_if(self, *args):
+        """
+        Handler for ``@if [condition]`` directive in ``.pyre`` files (see :py:meth:`._condition`). The lines up to the
+        matching ``@elif`` / ``@else`` / ``@endif`` are only parsed if the condition is true. Blocks can be nested.
+
+            >>> lines = ['@if host web-*', 'allow port 80,443', '@elif role db', 'allow port 5432 from $app_net', '@endif']
+            >>> v4_rules, v6_rules = PyreParser(variables=dict(host='db1', role='db', app_net='10.1.0.0/16')).parse_lines(lines)
+            >>> v4_rules[4]
+            '-A INPUT -p tcp --dport 5432 -s 10.1.0.0/16 -j ACCEPT'
+
+        """
+        res = self.active and self._condition(args)
+        self.conditions.append([res, res])
+
+    def start_elif(self, *args):
+        """Handler for ``@elif [condition]`` directive in ``.pyre`` files (see :py:meth:`.start_if`)"""
+        if len(self.conditions) == 0:
+            raise RuleSyntaxError('@elif without a matching @if')
+        block = self.conditions.pop()
+        res = not block[1] and self.active and self._condition(args)
+        self.conditions.append([res, block[1] or res])
+
+    def start_else(self, *args):
+        """Handler for ``@else`` directive in ``.pyre`` files (see :py:meth:`.start_if`)"""
+        if len(self.conditions) == 0:
+            raise RuleSyntaxError('@else without a matching @if')
+        block = self.conditions.pop()
+        res = not block[1] and self.active
+        self.conditions.append([res, True])
+
+    def end_if(self, *args):
+        """Handler for ``@endif`` directive in ``.pyre`` files (see :py:meth:`.start_if`)"""
+        if len(self.conditions) == 0:
+            raise RuleSyntaxError('@endif without a matching @if')
+        self.conditions.pop()
+
     control_handlers = {
         '@table': set_table,
         '@chain': set_chain,
         '@import': import_file,
+        '@blocklist': add_blocklist,
+        '@rangeset': add_rangeset,
+        '@geoset': add_geoset,
+        '@offload': add_offload,
+        '@portmap': add_portmap,
+        '@var': set_var,
+        '@if': start_if,
+        '@elif': start_elif,
+        '@else': start_else,
+        '@endif': end_if,
     }
     """Maps each Pyre control directive such as ``@table`` to it's appropriate handling function"""
+
+    CONDITIONALS = ['@if', '@elif', '@else', '@endif']
+    """Control directives which are handled even inside an inactive ``@if`` block"""
@@ -1,12 +1,24 @@
+import hashlib
+import re
 from ipaddress import IPv4Network, IPv6Network
 from typing import List, Dict, Union, Optional, Tuple
 from privex.helpers import empty
-from privex.pyrewall.types import IPT_TYPE, IPT_ACTION
+from privex.pyrewall import conf
+from privex.pyrewall.cidr import NetworkList, summarise_keys
+from privex.pyrewall.exceptions import RuleSyntaxError
+from privex.pyrewall.nat import format_target
+from privex.pyrewall.types import IPT_TYPE, IPT_ACTION, TempSet, RateLimit, RecentMatch, LogAction, NatTarget, Balance
 import logging
 
 log = logging.getLogger(__name__)
 
 
+def _nft_set(items: List[Union[str, int]]) -> str:
+    """Format values for an nftables match - a single value as-is, or an anonymous set ``{ a, b }``"""
+    items = [str(i) for i in items]
+    return items[0] if len(items) == 1 else '{ ' + ', '.join(items) + ' }'
+
+
 class RuleBuilder:
     """
     RuleBuilder - A class for constructing iptables rules, with auto generation of related rules
@@ -40,8 +52,8 @@ class RuleBuilder:
     sports: List[str]
     match_rules: List[str]
 
-    from_cidr: Dict[str, List[Union[IPv4Network, IPv6Network]]]
-    to_cidr: Dict[str, List[Union[IPv4Network, IPv6Network]]]
+    from_cidr: Dict[str, NetworkList]
+    to_cidr: Dict[str, NetworkList]
     from_iface: List[str]
     to_iface: List[str]
 
@@ -49,9 +61,43 @@ class RuleBuilder:
 
     rule_comment: Dict[str, Optional[str]]
 
+    timeout: Optional[int]
+    """If set, this is a temporary rule - the addresses are added to an ipset, expiring after this many seconds"""
+    temp_sets: Dict[str, TempSet]
+    """The ipsets generated by :py:meth:`.build` for a temporary rule, per IP version"""
+    flowtable: Optional[str]
+    """If set, matching packets are added to this nftables flowtable (``flow add``) instead of using :py:attr:`.action`"""
+    mss: Optional[str]
+    """If set, the MSS of matching TCP SYN packets is set to this value (``pmtu`` = clamp to the path MTU)"""
+    limits: List[Union[RateLimit, RecentMatch]]
+    """Rate / connection limits and ``recent`` matches, checked after every other match of the rule"""
+    log: Optional[LogAction]
+    """If set, matching packets are logged by a rule before this one (see :py:attr:`.log_only`)"""
+    nat: Optional[NatTarget]
+    """The address translated to by a ``DNAT`` / ``SNAT`` :py:attr:`.action`"""
+    balance: Optional[Balance]
+    """If set, the rule is DNAT'ed to one of several backends (see :py:meth:`._build_balance`)"""
+
+    IPT_RAW_PROTOCOLS = ['ipt', 'iptables', 'ipt4', 'ip4tables', 'ipt6', 'ipt6tables']
+    NFT_VERDICTS = {
+        IPT_ACTION.ALLOW: 'accept', IPT_ACTION.DROP: 'drop', IPT_ACTION.REJECT: 'reject', IPT_ACTION.NOTRACK: 'notrack',
+        IPT_ACTION.MASQUERADE: 'masquerade',
+    }
+    rgx_nft_state = re.compile(r'^-m (?:state --state|conntrack --ctstate) (\S+)$')
+    rgx_nft_tcp_flags = re.compile(r'^--tcp-flags (\S+) (\S+)$')
+    RECENT_COMMANDS = {'set': '--set', 'remove': '--remove', 'check': '--rcheck', 'update': '--update'}
+    LIMIT_PREFIX = 'pyre-'
+    """The prefix of generated ``hashlimit`` table names and nftables meter names"""
+
+    TEMP_SET_PREFIX = 'pyre-tmp'
+    MAX_TIMEOUT = 2147483
+    """The maximum ipset entry timeout supported by the kernel (in seconds)"""
+
     def __init__(self, rule_type: str = IPT_TYPE.INPUT.value, **kwargs):
         self.rule_type = str(rule_type)
-        self.action, self.protocol, self.from_cidr, self.to_cidr = None, None, dict(v4=[], v6=[]), dict(v4=[], v6=[])
+        self.action, self.protocol = None, None
+        self.from_cidr = dict(v4=NetworkList(32), v6=NetworkList(128))
+        self.to_cidr = dict(v4=NetworkList(32), v6=NetworkList(128))
         self.from_iface, self.to_iface = [], []
         self.ports, self.sports, self.extra_protocols, self.match_rules, self.extra_types = [], [], [], [], []
         self.icmp_types = dict(v4=[], v6=[])
@@ -59,13 +105,22 @@ class RuleBuilder:
         self.rule_comment = dict(v4=None, v6=None)
         self.rule_raw = dict(v4=None, v6=None)
         self.raw_only = False
+        self.timeout, self.temp_sets = None, {}
+        self.flowtable, self.mss = None, None
+        self.limits, self.log, self.nat, self.balance = [], None, None, None
+        self._balance_match = None
 
         for k, v in kwargs.items():
             if hasattr(self, k):
                 setattr(self, k, v)
 
+    @property
+    def log_only(self) -> bool:
+        """True if the rule only logs packets (e.g. ``log port 23``), without a verdict rule after the log rule"""
+        return self.log is not None and self.action is None and self.mss is None and self.flowtable is None
+
     def _build(self, protocol=None, from_cidr=None, to_cidr=None, from_iface=None, to_iface=None,
-               ipver='v4', rule_type: str = None, **kwargs):
+               ipver='v4', rule_type: str = None, log=False, **kwargs):
         
         rule = ''
         action = self.default_action if self.action is None else self.action
@@ -103,10 +158,92 @@ class RuleBuilder:
         if not empty(from_iface): rule += f' -i {str(from_iface)}'
         if not empty(to_iface):   rule += f' -o {str(to_iface)}'
 
-        rule += f' -j {self.custom_action}' if action is IPT_ACTION.CUSTOM else f' {action.value}'
-        if self.rule_raw.get(ipver) is not None: rule += f" {self.rule_raw[ipver]}"
+        # Limits go after the other matches, so packets which don't match the rule don't use up its limit
+        for i, lim, salt in self._rule_limits(log):
+            above = self._limit_above(lim, action)
+            name = f"{self.LIMIT_PREFIX}{hashlib.sha1(f'{rule} {i} {lim} {above}{salt}'.encode()).hexdigest()[:8]}"
+            rule += ' ' + self._ipt_limit(lim, ipver, above, name)
+        if self._balance_match is not None:
+            rule += f' {self._balance_match}'
+
+        if log:
+            rule += ' ' + self._ipt_log(rule, ipver)
+        elif self.mss is not None:
+            rule += ' -j TCPMSS ' + ('--clamp-mss-to-pmtu' if self.mss == 'pmtu' else f'--set-mss {self.mss}')
+        elif action in [IPT_ACTION.DNAT, IPT_ACTION.SNAT]:
+            if self.nat.ipver != ipver:
+                raise RuleSyntaxError(f"The NAT target {self.nat.address} can't be used for IP{ipver} addresses")
+            to = 'destination' if action is IPT_ACTION.DNAT else 'source'
+            rule += f' {action.value} --to-{to} {format_target(self.nat)}'
+        else:
+            rule += f' -j {self.custom_action}' if action is IPT_ACTION.CUSTOM else f' {action.value}'
+        if self.rule_raw.get(ipver) is not None and not log: rule += f" {self.rule_raw[ipver]}"
         return rule
 
+    def _ipt_log(self, rule: str, ipver: str) -> str:
+        """The rate limit and LOG / NFLOG target of the log rule for ``rule`` (see :py:attr:`.log`)"""
+        lg = self.log
+        name = f"{self.LIMIT_PREFIX}{hashlib.sha1(f'{rule} {lg}'.encode()).hexdigest()[:8]}"
+        res = '' if lg.limit is None else self._ipt_limit(lg.limit, ipver, False, name) + ' '
+        if lg.group is None:
+            return res + '-j LOG' + ('' if lg.prefix is None else f' --log-prefix "{lg.prefix}"')
+        res += f'-j NFLOG --nflog-group {lg.group}'
+        res += '' if lg.prefix is None else f' --nflog-prefix "{lg.prefix}"'
+        return res + f' --nflog-threshold {lg.threshold}'
+
+    def _rule_limits(self, log=False) -> List[Tuple[int, Union[RateLimit, RecentMatch], str]]:
+        """
+        The ``(index, limit, name salt)`` of each entry of :py:attr:`.limits` for the rule being built. The log rule in
+        front of a verdict rule sees the same packets, so it gets its own hashlimit tables / meters (sharing them would
+        count every packet twice), and its ``recent`` matches only check the list - ``set`` is left out, and ``update``
+        / ``remove`` become ``check`` - so that only the verdict rule changes it.
+        """
+        if not log or self.log_only:
+            return [(i, lim, '') for i, lim in enumerate(self.limits)]
+        limits = []
+        for i, lim in enumerate(self.limits):
+            if isinstance(lim, RecentMatch):
+                if lim.command == 'set':
+                    continue
+                lim = lim._replace(command='check')
+            limits.append((i, lim, ' log'))
+        return limits
+
+    @staticmethod
+    def _limit_above(lim: Union[RateLimit, RecentMatch], action: IPT_ACTION) -> bool:
+        """Whether ``lim`` matches traffic over its limit - by default only for ``drop`` / ``reject`` rules"""
+        if isinstance(lim, RecentMatch):
+            return False
+        return action in [IPT_ACTION.DROP, IPT_ACTION.REJECT] if lim.above is None else lim.above
+
+    def _ipt_limit(self, lim: Union[RateLimit, RecentMatch], ipver: str, above: bool, name: str) -> str:
+        """
+        The iptables match for an entry of :py:attr:`.limits`. A ``limit`` shared by the whole rule uses ``-m limit``,
+        while per address limits (or shared limits matching traffic over the rate) use ``-m hashlimit`` with a
+        table named ``name``.
+        """
+        if isinstance(lim, RecentMatch):
+            m = f'-m recent --name {lim.name} {self.RECENT_COMMANDS[lim.command]}'
+            if lim.seconds is not None: m += f' --seconds {lim.seconds}'
+            if lim.hits is not None: m += f' --hitcount {lim.hits}'
+            return m + (' --rdest' if lim.per == 'dst' else '')
+
+        bits, mode = 32 if ipver == 'v4' else 128, 'above' if above else 'upto'
+        if lim.kind == 'connlimit':
+            m = f'-m connlimit --connlimit-{mode} {lim.value}'
+            mask = 0 if lim.per is None else lim.masks[ipver]
+            if mask != bits: m += f' --connlimit-mask {mask}'
+            return m + (' --connlimit-daddr' if lim.per == 'dst' else '')
+
+        if lim.per is None and not above:
+            return f'-m limit --limit {lim.value}' + ('' if lim.burst is None else f' --limit-burst {lim.burst}')
+        m = f'-m hashlimit --hashlimit-{mode} {lim.value}'
+        if lim.burst is not None: m += f' --hashlimit-burst {lim.burst}'
+        if lim.per is not None:
+            m += f' --hashlimit-mode {lim.per}ip'
+            if lim.masks[ipver] != bits: m += f' --hashlimit-{lim.per}mask {lim.masks[ipver]}'
+        return m + f' --hashlimit-name {name}'
+
     def build(self, ipver='v4') -> List[str]:
         if self.protocol in ['icmpv4', 'icmp4'] and ipver != 'v4':
             return []
@@ -116,12 +253,15 @@ class RuleBuilder:
             if self.rule_comment.get(ipver) is not None:
                 return [f"# {self.rule_comment.get(ipver)}"]
             return []
-        if self.raw_only or self.protocol in ['ipt', 'iptables', 'ipt4', 'ip4tables', 'ipt6', 'ipt6tables']:
+        if self.raw_only or self.protocol in self.IPT_RAW_PROTOCOLS:
             return [self.rule_raw.get(ipver)] if self.rule_raw.get(ipver) is not None else []
+        if self.timeout is not None:
+            return self._build_temp(ipver=ipver)
+        if self.balance is not None:
+            return self._build_balance(ipver=ipver)
+        if self.flowtable is not None:
+            raise RuleSyntaxError('Flowtable offload (@offload) is only supported by the nftables backend')
         
-        rules = [self._build(ipver=ipver)]
-        if self.rule_comment.get(ipver) is not None:
-            rules = [f"# {self.rule_comment.get(ipver)}"] + rules
         extra_rule_args = []
 
         def add_arg(pos, **data):
@@ -130,12 +270,13 @@ class RuleBuilder:
                 return
             extra_rule_args.append(data)
 
+        # The extra addresses are formatted in bulk, rather than creating an ipaddress object for each of them
         if len(self.from_cidr[ipver]) > 1:
-            for i, p in enumerate(self.from_cidr[ipver][1:]):
+            for i, p in enumerate(self.from_cidr[ipver][1:].cidrs()):
                 add_arg(i, from_cidr=p)
 
         if len(self.to_cidr[ipver]) > 1:
-            for i, p in enumerate(self.to_cidr[ipver][1:]):
+            for i, p in enumerate(self.to_cidr[ipver][1:].cidrs()):
                 add_arg(i, to_cidr=p)
 
         if len(self.from_iface) > 1:
@@ -168,15 +309,348 @@ class RuleBuilder:
             for i, r in enumerate(orig_extra_args):
                 extra_rule_args.append({**r, 'rule_type': p})
 
-        # Finally, we loop over all the extra rules and generate their IPTables line with _build()
-        for a in extra_rule_args:
-            rules.append(self._build(**a, ipver=ipver))
+        # Finally, we loop over the base rule and all the extra rules, and generate their IPTables line with _build()
+        # - with a log rule before each of them if the rule logs packets
+        rules = [] if self.rule_comment.get(ipver) is None else [f"# {self.rule_comment.get(ipver)}"]
+        for a in [{}] + extra_rule_args:
+            if self.log is not None:
+                rules.append(self._build(**a, ipver=ipver, log=True))
+            if not self.log_only:
+                rules.append(self._build(**a, ipver=ipver))
 
         return rules
 
-    def add_from_cidr(self, *args, ipver='v4'): self.from_cidr[ipver] += args
+    def _build_temp(self, ipver='v4') -> List[str]:
+        """
+        Lower a temporary rule (:py:attr:`.timeout` is set) into a single rule matching an ipset, instead of one rule
+        per address. The addresses are stored in :py:attr:`.temp_sets` to be added to the set with a timeout, so
+        the kernel expires them by itself.
+
+        The set's name is derived from the rest of the rule, so temporary rules which only differ by their
+        addresses (e.g. ``drop from 1.2.3.4 for 1h`` and ``drop from 5.6.7.8 for 30m``) share one set and rule.
+
+            >>> r = RuleBuilder(timeout=1800, action=IPT_ACTION.DROP)
+            >>> r.add_from_cidr(ip_network('1.2.3.4/32'))
+            >>> r.build()
+            ['-A INPUT -m set --match-set pyre-tmp4-45deea69 src -j DROP']
+            >>> r.temp_sets['v4']
+            TempSet(name='pyre-tmp4-45deea69', family='inet', entries=[('1.2.3.4', 1800)])
+
+        """
+        if self.timeout < 1 or self.timeout > self.MAX_TIMEOUT:
+            raise RuleSyntaxError(f'Temporary rule duration must be between 1 and {self.MAX_TIMEOUT} seconds')
+        if len(self.from_cidr[ipver]) > 0 and len(self.to_cidr[ipver]) > 0:
+            raise RuleSyntaxError("Temporary rules ('for') can match source ('from') OR destination ('to') addresses, not both")
+        direction, cidrs = ('src', self.from_cidr) if len(self.from_cidr[ipver]) > 0 else ('dst', self.to_cidr)
+        addresses = cidrs[ipver]
+        if len(addresses) == 0:
+            if not any(len(c[v]) > 0 for c in [self.from_cidr, self.to_cidr] for v in ['v4', 'v6']):
+                raise RuleSyntaxError("Temporary rules ('for') must match at least one 'from' or 'to' address")
+            return []
 
-    def add_to_cidr(self, *args, ipver='v4'): self.to_cidr[ipver] += args
+        match = f'-m set --match-set {{set}} {direction}'
+        timeout, self.timeout, cidrs[ipver] = self.timeout, None, NetworkList(addresses.bits)
+        self.match_rules.append(match)
+        try:
+            rules = self.build(ipver=ipver)
+        finally:
+            self.timeout, cidrs[ipver] = timeout, addresses
+            self.match_rules.remove(match)
+
+        name = f"{self.TEMP_SET_PREFIX}{ipver[1]}-{hashlib.sha1(' | '.join(rules).encode()).hexdigest()[:8]}"
+        entries = [(a, timeout) for a in addresses.entries()]
+        self.temp_sets[ipver] = TempSet(name=name, family='inet6' if ipver == 'v6' else 'inet', entries=entries)
+        return [r.replace('{set}', name) for r in rules]
+
+    def _balance_slots(self, ipver: str) -> List[Tuple[NatTarget, int, int]]:
+        """The ``(target, first_slot, last_slot)`` of each :py:attr:`.balance` backend for ``ipver``, by weight"""
+        slots, first = [], 0
+        for target, weight in zip(self.balance.targets, self.balance.weights):
+            if target.ipver == ipver:
+                slots.append((target, first, first + weight - 1))
+                first += weight
+        return slots
+
+    def _build_balance(self, ipver='v4') -> List[str]:
+        """
+        Lower a ``balance`` rule into a DNAT rule per backend, each with a match for its share of the connections,
+        placed after every other match (so other packets don't affect the ``nth`` counters):
+
+            - ``random`` - ``-m statistic --mode random``, where each rule's probability is its weight out of the
+              weights of itself and the rules after it (as the earlier rules already took their share). The last rule
+              has no match, taking whatever is left.
+            - ``nth`` - weighted round robin. Each backend has a rule per weight "slot", and the ``k``'th of ``n``
+              slots matches ``-m statistic --mode nth --every (n - k) --packet 0``.
+            - ``hash`` - an HMARK rule marks the connection with a hash of its source address (from
+              :attr:`.conf.BALANCE_MARK_OFFSET`), and each backend matches the marks of its slots - so a client
+              always reaches the same backend.
+
+            >>> r = RuleBuilder(rule_type='-A PREROUTING', protocol='tcp', ports=['443'], action=IPT_ACTION.DNAT)
+            >>> r.balance = Balance(targets=[parse_target('10.0.0.1'), parse_target('10.0.0.2')], weights=[3, 1],
+            ...                     mode='random')
+            >>> r.build()
+            ['-A PREROUTING -p tcp --dport 443 -m statistic --mode random --probability 0.75000000000 -j DNAT --to-destination 10.0.0.1',
+             '-A PREROUTING -p tcp --dport 443 -j DNAT --to-destination 10.0.0.2']
+
+        """
+        slots = self._balance_slots(ipver)
+        if len(slots) == 0:
+            return []
+        if self.log is not None:
+            raise RuleSyntaxError("'log' can't be used with 'balance' rules")
+        balance, comment, total = self.balance, self.rule_comment.get(ipver), slots[-1][2] + 1
+        # A single backend for this IP version is a plain DNAT, whatever the mode
+        mode = balance.mode if len(slots) > 1 else 'random'
+        rules = [] if comment is None else [f'# {comment}']
+        self.balance, self.rule_comment[ipver] = None, None
+        try:
+            if mode == 'hash':
+                self.action, self.custom_action = IPT_ACTION.CUSTOM, (
+                    f'HMARK --hmark-tuple src --hmark-mod {total} --hmark-offset {conf.BALANCE_MARK_OFFSET:#x}'
+                )
+                rules += self.build(ipver=ipver)
+                self.action = IPT_ACTION.DNAT
+
+            for i, (target, first, last) in enumerate(slots):
+                self.nat = target
+                if mode == 'random':
+                    remaining = total - first
+                    matches = [None] if i == len(slots) - 1 else [
+                        f'-m statistic --mode random --probability {(last - first + 1) / remaining:.11f}'
+                    ]
+                elif mode == 'nth':
+                    matches = [None if k == total - 1 else f'-m statistic --mode nth --every {total - k} --packet 0'
+                               for k in range(first, last + 1)]
+                else:
+                    matches = [f'-m mark --mark {conf.BALANCE_MARK_OFFSET + k:#x}' for k in range(first, last + 1)]
+                for m in matches:
+                    self._balance_match = m
+                    rules += self.build(ipver=ipver)
+        finally:
+            self.balance, self.rule_comment[ipver], self.nat, self._balance_match = balance, comment, None, None
+            self.action = IPT_ACTION.DNAT
+        return rules
+
+    def build_nft(self, has_v4=False, has_v6=False) -> List[str]:
+        """
+        Build the rule for the nftables backend (see :class:`.NFTEmitter`). Unlike :py:meth:`.build`, a single rule
+        covers multiple addresses / ports / interfaces / protocols using anonymous sets, and an IP version neutral
+        rule (e.g. ``allow port 22``) is one rule for both IP versions. Each rule is returned as
+        ``-A CHAIN [nft statement]``, leaving the table / chain layout to the emitter.
+
+            >>> r = RuleBuilder(action=IPT_ACTION.DROP, protocol='tcp')
+            >>> r.ports += ['80', '443', '8000:8080']
+            >>> r.add_from_cidr(ip_network('10.0.0.0/8'), ip_network('192.168.0.0/16'))
+            >>> r.build_nft(has_v4=True)
+            ['-A INPUT ip saddr { 10.0.0.0/8, 192.168.0.0/16 } tcp dport { 80, 443, 8000-8080 } drop']
+
+        :param bool has_v4: The rule contains IPv4 addresses / is IPv4 only
+        :param bool has_v6: The rule contains IPv6 addresses / is IPv6 only
+        :raises RuleSyntaxError: For raw iptables rules, and matches which can't be translated into nftables
+        """
+        chains = [self.rule_type.split()[-1]] + list(self.extra_types)
+        if self.protocol in ['comment', 'rem', 'rem4', 'rem6']:
+            comments = [c for c in dict.fromkeys(self.rule_comment.values()) if c is not None]
+            return [f'-A {chain} # {c}' for chain in chains for c in comments]
+        if self.raw_only or self.protocol in self.IPT_RAW_PROTOCOLS:
+            raise RuleSyntaxError("Raw iptables rules ('ipt' / 'ipt4' / 'ipt6') can't be used with the nftables backend")
+
+        if self.protocol in ['icmpv4', 'icmp4']:
+            families = ['v4']
+        elif self.protocol in ['icmpv6', 'icmp6', 'ipv6-icmp']:
+            families = ['v6']
+        elif has_v4 or has_v6:
+            families = [v for v, has in [('v4', has_v4), ('v6', has_v6)] if has]
+        else:
+            families = [None]
+        # Per address limits are kept in a meter keyed by the address, which needs a separate rule per IP version
+        limits = self.limits + ([] if self.log is None or self.log.limit is None else [self.log.limit])
+        if families == [None] and any(isinstance(l, RateLimit) and l.per is not None for l in limits):
+            families = ['v4', 'v6']
+
+        # The log rules of every IP version go first, as an IP version neutral verdict matches both versions
+        logs, rules = [], []
+        for ipver in families:
+            built = self._build_nft_rules(ipver) if self.timeout is None else self._build_nft_temp(ipver)
+            n_logs = 0 if self.log is None or len(built) == 0 else 1
+            for dest, part in [(logs, built[:n_logs]), (rules, built[n_logs:])]:
+                dest.extend(r for r in part if r not in dest)
+        rules = logs + rules
+        return [f'-A {chain} {rule}' for chain in chains for rule in rules]
+
+    def _build_nft_rules(self, ipver: Optional[str], set_match: str = None) -> List[str]:
+        """The nftables statements of the rule for ``ipver`` - the log rule (if :py:attr:`.log` is set) and the verdict"""
+        rules = [] if self.log is None else [self._build_nft(ipver, set_match=set_match, log=True)]
+        return rules if self.log_only else rules + [self._build_nft(ipver, set_match=set_match)]
+
+    def _build_nft(self, ipver: Optional[str], set_match: str = None, log=False) -> str:
+        """Build the nftables statement of the rule for ``ipver`` (``None`` = IP version neutral)"""
+        parts = []
+        if len(self.from_iface) > 0:
+            parts.append('iifname ' + _nft_set([f'"{i[:-1]}*"' if i.endswith('+') else f'"{i}"' for i in self.from_iface]))
+        if len(self.to_iface) > 0:
+            parts.append('oifname ' + _nft_set([f'"{i[:-1]}*"' if i.endswith('+') else f'"{i}"' for i in self.to_iface]))
+
+        fam = 'ip6' if ipver == 'v6' else 'ip'
+        if ipver is not None:
+            for direction, cidrs in [('saddr', self.from_cidr[ipver]), ('daddr', self.to_cidr[ipver])]:
+                # Anonymous sets can't contain overlapping intervals, so the networks are aggregated first
+                if len(cidrs) > 0:
+                    parts.append(f'{fam} {direction} {_nft_set(summarise_keys(list(cidrs.keys), cidrs.bits))}')
+        if set_match is not None:
+            parts.append(set_match)
+        elif (self.nat is not None or self.balance is not None) and ipver is not None and \
+                len(self.from_cidr[ipver]) + len(self.to_cidr[ipver]) == 0:
+            # NAT to an address of one IP version only applies to packets of that version
+            parts.append(f"meta nfproto {'ipv6' if ipver == 'v6' else 'ipv4'}")
+
+        protocols = [p for p in [self.protocol] + list(self.extra_protocols) if not empty(p)]
+        protocols = [('ipv6-icmp' if ipver == 'v6' else 'icmp') if p in self.ICMP_ALIASES else p for p in protocols]
+        icmp_types = self.icmp_types[ipver] if ipver is not None else []
+        if len(icmp_types) > 0:
+            parts.append(f"{'icmpv6' if ipver == 'v6' else 'icmp'} type {_nft_set(icmp_types)}")
+        elif len(self.ports) > 0 or len(self.sports) > 0:
+            # Multiple protocols are matched with the generic transport header ('th') port fields
+            header = protocols[0] if len(protocols) == 1 else 'th'
+            if len(protocols) > 1:
+                parts.append(f'meta l4proto {_nft_set(protocols)}')
+            if len(self.sports) > 0:
+                parts.append(f"{header} sport {_nft_set([p.replace(':', '-') for p in self.sports])}")
+            if len(self.ports) > 0:
+                parts.append(f"{header} dport {_nft_set([p.replace(':', '-') for p in self.ports])}")
+        elif len(protocols) > 0:
+            parts.append(f'meta l4proto {_nft_set(protocols)}')
+
+        for m in self.match_rules:
+            parts.append(self._nft_match(m))
+
+        action = self.default_action if self.action is None else self.action
+        for i, lim, salt in self._rule_limits(log):
+            above = self._limit_above(lim, action)
+            digest = hashlib.sha1(f"{' '.join(parts)} {i} {lim} {above}{salt}".encode()).hexdigest()[:8]
+            parts.append(self._nft_limit(lim, ipver, above, f"{self.LIMIT_PREFIX}m{ipver[1]}-{digest}" if ipver else None))
+
+        if log:
+            parts.append(self._nft_log(ipver, ' '.join(parts)))
+        elif self.flowtable is not None:
+            parts.append(f'flow add @{self.flowtable}')
+        elif self.mss is not None:
+            parts.append('tcp option maxseg size set ' + ('rt mtu' if self.mss == 'pmtu' else self.mss))
+        elif self.balance is not None:
+            parts.append(self._nft_balance(ipver))
+        elif action in [IPT_ACTION.DNAT, IPT_ACTION.SNAT]:
+            if ipver is not None and self.nat.ipver != ipver:
+                raise RuleSyntaxError(f"The NAT target {self.nat.address} can't be used for IP{ipver} addresses")
+            fam = 'ip6' if self.nat.ipver == 'v6' else 'ip'
+            parts.append(f"{'dnat' if action is IPT_ACTION.DNAT else 'snat'} {fam} to {format_target(self.nat)}")
+        elif action is IPT_ACTION.CUSTOM:
+            parts.append(f'jump {self.custom_action}')
+        else:
+            parts.append(self.NFT_VERDICTS[action])
+        comment = self.rule_comment.get('v4' if ipver is None else ipver)
+        if comment is not None:
+            parts.append('comment "' + comment.replace('"', "'") + '"')
+        return ' '.join(parts)
+
+    def _nft_match(self, match: str) -> str:
+        """Translate an iptables match from :py:attr:`.match_rules` into nftables"""
+        m = self.rgx_nft_state.match(match)
+        if m is not None:
+            return f"ct state {_nft_set(m.group(1).lower().split(','))}"
+        m = self.rgx_nft_tcp_flags.match(match)
+        if m is not None:
+            mask, comp = [' | '.join(f.lower() for f in g.split(',')) for g in m.groups()]
+            return f'tcp flags & ({mask}) == {comp}'
+        raise RuleSyntaxError(f"The match '{match}' isn't supported by the nftables backend")
+
+    @staticmethod
+    def _nft_limit(lim: Union[RateLimit, RecentMatch], ipver: Optional[str], above: bool, name: Optional[str]) -> str:
+        """The nftables version of :py:meth:`._ipt_limit` - per address limits use a meter named ``name``"""
+        if isinstance(lim, RecentMatch):
+            raise RuleSyntaxError("'recent' matches aren't supported by the nftables backend - use a 'limit' or "
+                                  "'connlimit' with 'per-source' instead")
+        over = 'over ' if above else ''
+        if lim.kind == 'connlimit':
+            stmt = f'ct count {over}{lim.value}'
+        else:
+            stmt = f'limit rate {over}{lim.value}' + ('' if lim.burst is None else f' burst {lim.burst} packets')
+        if lim.per is None:
+            return stmt
+        key, mask = f"{'ip6' if ipver == 'v6' else 'ip'} {lim.per[0]}addr", lim.masks[ipver]
+        if mask != (32 if ipver == 'v4' else 128):
+            net = IPv4Network(f'0.0.0.0/{mask}') if ipver == 'v4' else IPv6Network(f'::/{mask}')
+            key += f' and {net.netmask}'
+        return f'meter {name} {{ {key} {stmt} }}'
+
+    def _nft_log(self, ipver: Optional[str], rule: str) -> str:
+        """The nftables version of :py:meth:`._ipt_log`"""
+        lg = self.log
+        res = ''
+        if lg.limit is not None:
+            name = f"{self.LIMIT_PREFIX}m{ipver[1]}-{hashlib.sha1(f'{rule} {lg}'.encode()).hexdigest()[:8]}" if ipver else None
+            res = self._nft_limit(lg.limit, ipver, False, name) + ' '
+        res += 'log' + ('' if lg.prefix is None else f' prefix "{lg.prefix}"')
+        return res if lg.group is None else res + f' group {lg.group} queue-threshold {lg.threshold}'
+
+    def _nft_balance(self, ipver: str) -> str:
+        """
+        The nftables version of :py:meth:`._build_balance` - a single DNAT looking up the backend in a map, by the
+        slot picked with ``numgen random`` / ``numgen inc`` (round robin) or ``jhash`` of the source address
+        """
+        slots, fam = self._balance_slots(ipver), 'ip6' if ipver == 'v6' else 'ip'
+        if self.log is not None:
+            raise RuleSyntaxError("'log' can't be used with 'balance' rules")
+        if len(slots) == 0:
+            raise RuleSyntaxError(f"None of the 'balance' targets can be used for IP{ipver} addresses")
+        if len(slots) == 1:
+            return f'dnat {fam} to {format_target(slots[0][0])}'
+        if len(set(t.port is None for t, _, _ in slots)) > 1:
+            raise RuleSyntaxError("With the nftables backend, either all or none of the 'balance' backends need a port")
+        total, ported = slots[-1][2] + 1, slots[0][0].port is not None
+        gen = dict(random=f'numgen random mod {total}', nth=f'numgen inc mod {total}')
+        gen = gen.get(self.balance.mode, f'jhash {fam} saddr mod {total}')
+        elements = ', '.join(
+            f"{first if first == last else f'{first}-{last}'} : {t.address}" + (f' . {t.port}' if ported else '')
+            for t, first, last in slots
+        )
+        return f"dnat {fam}{' addr . port' if ported else ''} to {gen} map {{ {elements} }}"
+
+    def _build_nft_temp(self, ipver: Optional[str]) -> List[str]:
+        """
+        The nftables version of :py:meth:`._build_temp` - the addresses are matched with a named set (``@name``)
+        with a timeout, declared and filled by the emitter from :py:attr:`.temp_sets`.
+        """
+        if self.timeout < 1 or self.timeout > self.MAX_TIMEOUT:
+            raise RuleSyntaxError(f'Temporary rule duration must be between 1 and {self.MAX_TIMEOUT} seconds')
+        if ipver is None or not any(len(c[ipver]) > 0 for c in [self.from_cidr, self.to_cidr]):
+            if not any(len(c[v]) > 0 for c in [self.from_cidr, self.to_cidr] for v in ['v4', 'v6']):
+                raise RuleSyntaxError("Temporary rules ('for') must match at least one 'from' or 'to' address")
+            return []
+        if len(self.from_cidr[ipver]) > 0 and len(self.to_cidr[ipver]) > 0:
+            raise RuleSyntaxError("Temporary rules ('for') can match source ('from') OR destination ('to') addresses, not both")
+        direction, cidrs = ('saddr', self.from_cidr) if len(self.from_cidr[ipver]) > 0 else ('daddr', self.to_cidr)
+        addresses = cidrs[ipver]
+
+        cidrs[ipver] = NetworkList(addresses.bits)
+        try:
+            rules = self._build_nft_rules(ipver, set_match=f"{'ip6' if ipver == 'v6' else 'ip'} {direction} @{{set}}")
+        finally:
+            cidrs[ipver] = addresses
+
+        name = f"{self.TEMP_SET_PREFIX}{ipver[1]}-{hashlib.sha1(' | '.join(rules).encode()).hexdigest()[:8]}"
+        entries = [(a, self.timeout) for a in addresses.entries()]
+        self.temp_sets[ipver] = TempSet(name=name, family='inet6' if ipver == 'v6' else 'inet', entries=entries)
+        return [r.replace('{set}', name) for r in rules]
+
+    def add_from_cidr(self, *args, ipver='v4'):
+        """Add ``ipaddress`` network objects and/or :class:`.NetworkList`'s to the source addresses"""
+        for a in args:
+            self.from_cidr[ipver].extend(a if isinstance(a, NetworkList) else [a])
+
+    def add_to_cidr(self, *args, ipver='v4'):
+        """Add ``ipaddress`` network objects and/or :class:`.NetworkList`'s to the destination addresses"""
+        for a in args:
+            self.to_cidr[ipver].extend(a if isinstance(a, NetworkList) else [a])
 
     def add_from_iface(self, *args): self.from_iface += args
 
@@ -1,13 +1,15 @@
 import re
 import logging
 from decimal import Decimal
-from ipaddress import ip_network, IPv4Network, IPv6Network
 from typing import List, Tuple, Optional, Union, Any
 from privex.helpers import is_true, empty
 from privex.pyrewall.RuleBuilder import RuleBuilder
+from privex.pyrewall.emitters import Emitter, get_emitter
+from privex.pyrewall.cidr import NetworkList, parse_networks
 from privex.pyrewall.exceptions import RuleSyntaxError, InvalidPort
-from privex.pyrewall.core import valid_port
-from privex.pyrewall.types import IPT_TYPE, IPT_ACTION
+from privex.pyrewall.core import valid_port, parse_duration
+from privex.pyrewall.nat import parse_target
+from privex.pyrewall.types import IPT_TYPE, IPT_ACTION, TempSet, RateLimit, RecentMatch, LogAction, Balance
 from privex.pyrewall import conf
 
 log = logging.getLogger(__name__)
@@ -56,9 +58,15 @@ class RuleParser:
     # protocol: str
     rule: RuleBuilder
     rule_segment: int
+    last_sets: List[TempSet]
+    """The ipsets needed by the most recently parsed rule (only temporary ``for 30m`` rules use ipsets)"""
+    emitter: Emitter
+    """The output backend which builds the parsed rules (see :mod:`privex.pyrewall.emitters`)"""
 
-    def __init__(self, rule_type: str = IPT_TYPE.INPUT.value, table='filter', strict=False):
+    def __init__(self, rule_type: str = IPT_TYPE.INPUT.value, table='filter', strict=False,
+                 emitter: Union[str, Emitter] = None):
         self.table = table
+        self.emitter = get_emitter(emitter)
         self.rule_type = str(rule_type)
         self.default_action = IPT_ACTION.ALLOW
         self.rule = None
@@ -66,6 +74,7 @@ class RuleParser:
         self.chains = dict(conf.DEFAULT_CHAINS[self.table])
         self.strict = is_true(strict)
         self.has_v4, self.has_v6 = False, False
+        self.last_sets = []
         
         self.reset_rule()
         # self.protocol = None
@@ -193,21 +202,19 @@ class RuleParser:
                 break
             if rl in self.rule_handlers:
                 log.debug('Handler "%s" detected. Passing remaining rule to handler.', rl)
-                rule = list(self.rule_handlers[rl](self, *rule))
+                try:
+                    rule = list(self.rule_handlers[rl](self, *rule))
+                except RuleSyntaxError:
+                    self.reset_rule()
+                    raise
                 continue
             log.warning('WARNING: No known handler for keyword "%s". Ignoring.', rl)
+            # Don't let the half-built rule leak into the next rule parsed
+            self.reset_rule()
             return None, None
 
-        if not self.has_v4 and not self.has_v6:
-            res = list(self.rule.build())
-            out = res, res
-        else:
-            res = dict(v4=[], v6=[])
-            if self.has_v4:
-                res['v4'] = list(self.rule.build('v4'))
-            if self.has_v6:
-                res['v6'] = list(self.rule.build('v6'))
-            out = res['v4'], res['v6']
+        out = self.emitter.build(self.rule, has_v4=self.has_v4, has_v6=self.has_v6)
+        self.last_sets = list(self.rule.temp_sets.values())
 
         if reset_rule:
             self.reset_rule()
@@ -218,16 +225,27 @@ class RuleParser:
         args = list(args)
         ip4, ip6 = self._parse_ips(args.pop(0))
         self.has_v4, self.has_v6 = len(ip4) > 0 or self.has_v4, len(ip6) > 0 or self.has_v6
-        self.rule.add_from_cidr(*ip4, ipver='v4')
-        self.rule.add_from_cidr(*ip6, ipver='v6')
+        self.rule.add_from_cidr(ip4, ipver='v4')
+        self.rule.add_from_cidr(ip6, ipver='v6')
         return args
 
     def handle_to(self, *args, **kwargs):
         args = list(args)
         ip4, ip6 = self._parse_ips(args.pop(0))
         self.has_v4, self.has_v6 = len(ip4) > 0 or self.has_v4, len(ip6) > 0 or self.has_v6
-        self.rule.add_to_cidr(*ip4, ipver='v4')
-        self.rule.add_to_cidr(*ip6, ipver='v6')
+        self.rule.add_to_cidr(ip4, ipver='v4')
+        self.rule.add_to_cidr(ip6, ipver='v6')
+        return args
+
+    def handle_for(self, *args, **kwargs):
+        """
+        Handler for ``for [duration]`` - makes the rule temporary, e.g. ``drop from 1.2.3.4 for 30m``
+
+        The rule's addresses are added to an ipset with a timeout, and matched by one persistent rule - so the
+        kernel expires them after ``duration``, without any reload (see :py:meth:`.RuleBuilder._build_temp`).
+        """
+        args = list(args)
+        self.rule.timeout = parse_duration(args.pop(0))
         return args
 
     def handle_if_in(self, *args, **kwargs):
@@ -242,12 +260,16 @@ class RuleParser:
         self.rule.add_to_iface(*ifaces.split(','))
         return args
 
-    def _parse_ips(self, ips: str):
-        ips = ips.split(',')
-        ips = [ip_network(ip, strict=self.strict) for ip in ips]
-        ip4 = [ip for ip in ips if isinstance(ip, IPv4Network)]
-        ip6 = [ip for ip in ips if isinstance(ip, IPv6Network)]
-        return ip4, ip6
+    def _parse_ips(self, ips: str) -> Tuple[NetworkList, NetworkList]:
+        """
+        Parse a comma separated list of addresses / subnets into a compact :class:`.NetworkList` per IP version,
+        in a single pass (see :func:`.parse_networks`)
+
+            >>> RuleParser()._parse_ips('1.2.3.4,10.0.0.0/8,2a07:e00::/32')
+            (NetworkList(32, ['1.2.3.4/32', '10.0.0.0/8']), NetworkList(128, ['2a07:e00::/32']))
+
+        """
+        return parse_networks(ips.split(','), strict=self.strict)
 
     def handle_allow(self, *args, **kwargs):
         self.rule.action = IPT_ACTION.ALLOW
@@ -261,6 +283,320 @@ class RuleParser:
         self.rule.action = IPT_ACTION.REJECT
         return args
 
+    def handle_notrack(self, *args, **kwargs):
+        """
+        Handler for ``notrack`` - matching packets skip connection tracking (``-j CT --notrack``), e.g. for high packet
+        rate UDP services such as DNS. Only valid in the ``raw`` table, where the chain defaults to ``PREROUTING``.
+        Replies need their own rule in the ``OUTPUT`` chain, and the ``filter`` rules should ``allow state untracked``.
+
+            >>> RuleParser(table='raw').parse('notrack port udp 53')
+            (['-A PREROUTING -p udp --dport 53 -j CT --notrack'], ['-A PREROUTING -p udp --dport 53 -j CT --notrack'])
+
+        """
+        if self.table != 'raw':
+            raise RuleSyntaxError(f"'notrack' rules must be in the raw table (@table raw), not '{self.table}'")
+        self.rule.action = IPT_ACTION.NOTRACK
+        if self.rule.rule_type == IPT_TYPE.INPUT.value:
+            self.rule.rule_type = IPT_TYPE.PREROUTING.value
+        return args
+
+    def handle_mss(self, *args, **kwargs):
+        """
+        Handler for ``mss [clamp|size]`` - sets the MSS of TCP SYN packets to the path MTU (``clamp``) or a fixed
+        size (TCPMSS), e.g. for routers in front of tunnels or PPPoE links. Only valid in the ``mangle`` table, where
+        the chain defaults to ``FORWARD``.
+
+            >>> RuleParser(table='mangle').parse('mss clamp if-out ppp0')[0]
+            ['-A FORWARD -p tcp --tcp-flags SYN,RST SYN -o ppp0 -j TCPMSS --clamp-mss-to-pmtu']
+
+        """
+        args = list(args)
+        if self.table != 'mangle':
+            raise RuleSyntaxError(f"'mss' rules must be in the mangle table (@table mangle), not '{self.table}'")
+        mss = args.pop(0) if len(args) > 0 else ''
+        if mss not in ['clamp', 'pmtu'] and not (mss.isdigit() and 0 < int(mss) < 65536):
+            raise RuleSyntaxError(f"'mss' expects 'clamp' or an MSS size between 1 and 65535, got: '{mss}'")
+        self.rule.mss = 'pmtu' if mss in ['clamp', 'pmtu'] else mss
+        self.rule.protocol = 'tcp'
+        self.rule.match_rules.append('--tcp-flags SYN,RST SYN')
+        if self.rule.rule_type == IPT_TYPE.INPUT.value:
+            self.rule.rule_type = IPT_TYPE.FORWARD.value
+        return args
+
+    RATE_UNITS = ['second', 'minute', 'hour', 'day']
+    rgx_rate = re.compile(r'^([0-9]+)/([a-z]+)$')
+    rgx_recent_name = re.compile(r'^[\w.-]{1,200}$')
+
+    def _parse_rate(self, rate: str) -> str:
+        """Convert a rate such as ``10/min`` or ``5/s`` into the ``10/minute`` format used by iptables / nftables"""
+        m = self.rgx_rate.match(rate.lower())
+        units = [] if m is None else [u for u in self.RATE_UNITS if u.startswith(m.group(2))]
+        if m is None or int(m.group(1)) < 1 or len(units) == 0:
+            raise RuleSyntaxError(f"'{rate}' is not a valid rate - expected e.g. '10/second', '30/min' or '100/hour'")
+        return f'{int(m.group(1))}/{units[0]}'
+
+    @staticmethod
+    def _parse_masks(masks: str) -> dict:
+        """
+        Parse the prefix lengths of ``per /24`` or ``per /24,/56`` (IPv4, IPv6). With only an IPv4 prefix, IPv6
+        addresses are grouped by ``/64`` - or ``/128`` for ``/32``, and ``/0`` for ``/0``.
+        """
+        try:
+            vals = [int(m.strip().lstrip('/')) for m in masks.split(',')]
+        except ValueError:
+            vals = []
+        if len(vals) not in [1, 2] or not 0 <= vals[0] <= 32 or (len(vals) == 2 and not 0 <= vals[1] <= 128):
+            raise RuleSyntaxError(f"'per {masks}' expects an IPv4 prefix length (0-32) and optionally an IPv6 one, "
+                                  f"e.g. 'per /24' or 'per /24,/64'")
+        return dict(v4=vals[0], v6=vals[1] if len(vals) == 2 else {32: 128, 0: 0}.get(vals[0], 64))
+
+    def _parse_limit(self, kind: str, value: str, args: List[str], per: Optional[str]) -> Tuple[RateLimit, List[str]]:
+        """Parse the ``above`` / ``upto`` prefix and the ``burst`` / ``per-*`` options following a limit keyword"""
+        above = None
+        if value in ['above', 'over', 'upto']:
+            above, value = value != 'upto', args.pop(0) if len(args) > 0 else ''
+        if kind == 'limit':
+            value = self._parse_rate(value)
+        elif not value.isdigit() or int(value) < 1:
+            raise RuleSyntaxError(f"'connlimit' expects a number of connections, got: '{value}'")
+
+        burst, masks = None, dict(v4=32, v6=128)
+        while len(args) > 0 and args[0] in ['burst', 'per', 'per-source', 'per-src', 'per-dest', 'per-dst']:
+            opt = args.pop(0)
+            if opt in ['per-source', 'per-src', 'per-dest', 'per-dst']:
+                per = 'dst' if opt in ['per-dest', 'per-dst'] else 'src'
+                continue
+            if len(args) == 0:
+                raise RuleSyntaxError(f"'{opt}' expects a value, e.g. 'burst 20' or 'per /24'")
+            val = args.pop(0)
+            if opt == 'burst':
+                if not val.isdigit() or int(val) < 1:
+                    raise RuleSyntaxError(f"'burst' expects a number of packets, got: '{val}'")
+                burst = int(val)
+                continue
+            masks, per = self._parse_masks(val), 'src' if per is None else per
+        if kind == 'connlimit' and burst is not None:
+            raise RuleSyntaxError("'burst' can only be used with 'limit', not 'connlimit'")
+        # A connlimit grouping every address together is a single limit for the whole rule
+        if kind == 'connlimit' and masks['v4'] == 0 and masks['v6'] == 0:
+            per = None
+        return RateLimit(kind=kind, value=value, above=above, burst=burst, per=per, masks=masks), args
+
+    def handle_limit(self, *args, **kwargs):
+        """
+        Handler for ``limit [above|upto] [rate] (burst n) (per-source|per-dest) (per /v4mask(,/v6mask))``
+
+        Matches packets within ``rate`` (e.g. ``10/min``) - or over it for ``drop`` / ``reject`` rules, unless
+        ``above`` / ``upto`` is given. By default the limit is shared by all packets matching the rule, while
+        ``per-source`` / ``per-dest`` (or ``per /24``) keep a separate limit for each address / subnet.
+
+            >>> RuleParser().parse('allow port 22 limit 10/min per-source burst 20')[0]
+            ['-A INPUT -p tcp --dport 22 -m hashlimit --hashlimit-upto 10/minute --hashlimit-burst 20 \
+--hashlimit-mode srcip --hashlimit-name pyre-037d76a8 -j ACCEPT']
+
+        """
+        args = list(args)
+        lim, args = self._parse_limit('limit', args.pop(0) if len(args) > 0 else '', args, per=None)
+        self.rule.limits.append(lim)
+        return args
+
+    def handle_connlimit(self, *args, **kwargs):
+        """
+        Handler for ``connlimit [above|upto] [count] (per-dest) (per /v4mask(,/v6mask))``
+
+        Matches connections while the source address (or ``per-dest`` destination) has up to ``count`` connections
+        - or more than ``count`` for ``drop`` / ``reject`` rules, unless ``above`` / ``upto`` is given. Use ``per /24``
+        to count connections per subnet, or ``per /0`` for all connections of the rule.
+
+            >>> RuleParser().parse('drop port 80 connlimit above 200 per /24')
+            (['-A INPUT -p tcp --dport 80 -m connlimit --connlimit-above 200 --connlimit-mask 24 -j DROP'],
+             ['-A INPUT -p tcp --dport 80 -m connlimit --connlimit-above 200 --connlimit-mask 64 -j DROP'])
+
+        """
+        args = list(args)
+        lim, args = self._parse_limit('connlimit', args.pop(0) if len(args) > 0 else '', args, per='src')
+        self.rule.limits.append(lim)
+        return args
+
+    def handle_recent(self, *args, **kwargs):
+        """
+        Handler for ``recent [name] [set|remove|check|update] (hits/duration) (per-dest)`` - tracks the source (or
+        ``per-dest`` destination) addresses of packets in the kernel list ``name``, e.g. to block SSH brute force:
+
+            allow port 22 state new recent ssh set
+            drop port 22 state new recent ssh update 4/60s
+
+        ``hits/duration`` only matches addresses seen at least ``hits`` times within ``duration``.
+        """
+        args = list(args)
+        if len(args) < 2 or not self.rgx_recent_name.match(args[0]) or args[1] not in RuleBuilder.RECENT_COMMANDS:
+            raise RuleSyntaxError(f"'recent' expects a list name and one of: {', '.join(RuleBuilder.RECENT_COMMANDS)}")
+        name, command, hits, seconds, per = args.pop(0), args.pop(0), None, None, 'src'
+        if len(args) > 0 and '/' in args[0] and command in ['check', 'update']:
+            hits, duration = args.pop(0).split('/', 1)
+            if not hits.isdigit() or int(hits) < 1:
+                raise RuleSyntaxError(f"'recent' expects hits/duration such as '4/60s', got: '{hits}/{duration}'")
+            hits, seconds = int(hits), parse_duration(duration)
+        if len(args) > 0 and args[0] in ['per-dest', 'per-dst']:
+            args.pop(0)
+            per = 'dst'
+        self.rule.limits.append(RecentMatch(name=name, command=command, hits=hits, seconds=seconds, per=per))
+        return args
+
+    def handle_log(self, *args, **kwargs):
+        """
+        Handler for ``log (prefix text) (rate [rate] (burst n) (per-source)) (nflog) (group n) (threshold n)``
+
+        Logs matching packets to the kernel log (LOG), or to an NFLOG ``group`` (queueing ``threshold`` packets per
+        batch, default: :attr:`.conf.NFLOG_THRESHOLD`), with a log rule placed before the rule's verdict. The log
+        rule is always rate limited (default: :attr:`.conf.LOG_RULE_RATE`), so an attack can't flood the logs.
+        Without an action (e.g. ``log port 23``), only the log rule is generated.
+
+            >>> RuleParser().parse('drop port 23 log prefix "telnet: " rate 5/min')[0]
+            ['-A INPUT -p tcp --dport 23 -m limit --limit 5/minute -j LOG --log-prefix "telnet: "',
+             '-A INPUT -p tcp --dport 23 -j DROP']
+
+        """
+        args = list(args)
+        prefix, group, threshold = None, None, None
+        limit = RateLimit(kind='limit', value=self._parse_rate(conf.LOG_RULE_RATE), above=False,
+                          burst=conf.LOG_RULE_BURST, per=None, masks=dict(v4=32, v6=128))
+        while len(args) > 0 and args[0] in ['prefix', 'rate', 'nflog', 'group', 'threshold']:
+            opt = args.pop(0)
+            if opt == 'nflog':
+                group = 0 if group is None else group
+                continue
+            if len(args) == 0:
+                raise RuleSyntaxError(f"'log {opt}' expects a value")
+            if opt == 'prefix':
+                prefix = args.pop(0)
+                # Quoted prefixes can contain spaces, so join the words up to the closing quote
+                if prefix[0] in ['"', "'"]:
+                    quote = prefix[0]
+                    while (len(prefix) == 1 or not prefix.endswith(quote)) and len(args) > 0:
+                        prefix += ' ' + args.pop(0)
+                    prefix = prefix[1:-1] if len(prefix) > 1 and prefix.endswith(quote) else prefix[1:]
+                continue
+            if opt == 'rate':
+                limit, args = self._parse_limit('limit', args.pop(0), args, per=None)
+                limit = limit._replace(above=False)
+                continue
+            val = args.pop(0)
+            if not val.isdigit() or not (0 if opt == 'group' else 1) <= int(val) <= 65535:
+                raise RuleSyntaxError(f"'log {opt}' expects a number between 0 and 65535, got: '{val}'")
+            if opt == 'group':
+                group = int(val)
+            else:
+                threshold = int(val)
+
+        if threshold is not None and group is None:
+            raise RuleSyntaxError("'log threshold' can only be used with NFLOG ('nflog' / 'group')")
+        if prefix is not None:
+            # The kernel log prefix is directly followed by the packet details, so it ends with a space
+            prefix = prefix if group is not None or prefix.endswith(' ') else prefix + ' '
+            max_len = 29 if group is None else 63
+            if '"' in prefix or len(prefix) > max_len:
+                raise RuleSyntaxError(f"The log prefix '{prefix}' must be at most {max_len} characters, without '\"'")
+        threshold = conf.NFLOG_THRESHOLD if threshold is None and group is not None else threshold
+        self.rule.log = LogAction(prefix=prefix, limit=limit, group=group, threshold=threshold)
+        return args
+
+    def _nat_rule(self, keyword: str, action: IPT_ACTION, chain: IPT_TYPE, args: List[str], target=True) -> List[str]:
+        """
+        Set up a NAT rule for ``keyword`` - which is only valid in the ``nat`` table, where the chain defaults to
+        ``chain``. If ``target`` is True, the ``to [target]`` arguments are removed from ``args`` into
+        :py:attr:`.RuleBuilder.nat`, limiting the rule to the IP version of the target address.
+        """
+        if self.table != 'nat':
+            raise RuleSyntaxError(f"'{keyword}' rules must be in the nat table (@table nat), not '{self.table}'")
+        if target:
+            if 'to' not in args or args.index('to') == len(args) - 1:
+                raise RuleSyntaxError(f"'{keyword}' expects a target address, e.g. '{keyword} ... to 10.0.0.5'")
+            i = args.index('to')
+            self.rule.nat = parse_target(args[i + 1])
+            args = args[:i] + args[i + 2:]
+            self.has_v4, self.has_v6 = self.has_v4 or self.rule.nat.ipver == 'v4', self.has_v6 or self.rule.nat.ipver == 'v6'
+        self.rule.action = action
+        if self.rule.rule_type == IPT_TYPE.INPUT.value:
+            self.rule.rule_type = chain.value
+        return args
+
+    def handle_forward_port(self, *args, **kwargs):
+        """
+        Handler for ``forward-port [ports] (proto) to [address(:port)]`` - forwards the destination port(s) to another
+        address (DNAT). Only valid in the ``nat`` table, where the chain defaults to ``PREROUTING``.
+
+            >>> RuleParser(table='nat').parse('forward-port 8000-8999 to 10.0.0.5 if-in eth0')
+            (['-A PREROUTING -p tcp -m multiport --dports 8000:8999 -i eth0 -j DNAT --to-destination 10.0.0.5'], [])
+
+        """
+        args = self._nat_rule('forward-port', IPT_ACTION.DNAT, IPT_TYPE.PREROUTING, list(args))
+        return self.handle_port(*args, **kwargs)
+
+    def handle_snat(self, *args, **kwargs):
+        """
+        Handler for ``snat to [address(:ports)]`` - translates the source address of matching packets (SNAT). Only
+        valid in the ``nat`` table, where the chain defaults to ``POSTROUTING``.
+
+            >>> RuleParser(table='nat').parse('snat from 10.0.0.0/8 to 185.1.2.3 if-out eth0')
+            (['-A POSTROUTING -s 10.0.0.0/8 -o eth0 -j SNAT --to-source 185.1.2.3'], [])
+
+        """
+        return self._nat_rule('snat', IPT_ACTION.SNAT, IPT_TYPE.POSTROUTING, list(args))
+
+    def handle_masquerade(self, *args, **kwargs):
+        """
+        Handler for ``masquerade`` - translates the source address of matching packets to the address of the outgoing
+        interface (MASQUERADE). Only valid in the ``nat`` table, where the chain defaults to ``POSTROUTING``.
+        """
+        return self._nat_rule('masquerade', IPT_ACTION.MASQUERADE, IPT_TYPE.POSTROUTING, list(args), target=False)
+
+    BALANCE_MODES = ['random', 'nth', 'hash']
+    MAX_BALANCE_SLOTS = 1000
+    """The maximum total of the ``balance`` weights (each weight "slot" is a rule with ``mode nth`` / ``hash``)"""
+
+    def handle_balance(self, *args, **kwargs):
+        """
+        Handler for ``balance [matches] to [addr(:port)],[addr(:port)]... (weights 2,1,...) (mode random|nth|hash)`` -
+        spreads new connections over several backends with DNAT (see :py:meth:`.RuleBuilder._build_balance`). Only
+        valid in the ``nat`` table, where the chain defaults to ``PREROUTING``. The weights default to 1 each, and
+        the mode to ``random``.
+
+            >>> RuleParser(table='nat').parse('balance port 443 to 10.0.0.1,10.0.0.2 weights 3,1')
+            (['-A PREROUTING -p tcp --dport 443 -m statistic --mode random --probability 0.75000000000 -j DNAT --to-destination 10.0.0.1',
+              '-A PREROUTING -p tcp --dport 443 -j DNAT --to-destination 10.0.0.2'], [])
+
+        """
+        args = self._nat_rule('balance', IPT_ACTION.DNAT, IPT_TYPE.PREROUTING, list(args), target=False)
+        opts = {}
+        for opt in ['to', 'weights', 'mode']:
+            if opt in args:
+                i = args.index(opt)
+                if i == len(args) - 1:
+                    raise RuleSyntaxError(f"'balance' option '{opt}' expects a value")
+                opts[opt] = args[i + 1]
+                args = args[:i] + args[i + 2:]
+        if 'to' not in opts:
+            raise RuleSyntaxError("'balance' expects target addresses, e.g. 'balance port 80 to 10.0.0.1,10.0.0.2'")
+
+        targets = [parse_target(t) for t in opts['to'].split(',') if t != '']
+        weights = [1] * len(targets)
+        if 'weights' in opts:
+            weights = opts['weights'].split(',')
+            if len(weights) != len(targets) or not all(w.isdigit() and int(w) > 0 for w in weights):
+                raise RuleSyntaxError(f"'balance' weights '{opts['weights']}' must be a positive number per target")
+            weights = [int(w) for w in weights]
+        mode = opts.get('mode', 'random')
+        if mode not in self.BALANCE_MODES:
+            raise RuleSyntaxError(f"Invalid 'balance' mode '{mode}' - expected one of: {', '.join(self.BALANCE_MODES)}")
+        if sum(weights) > self.MAX_BALANCE_SLOTS:
+            raise RuleSyntaxError(f"The 'balance' weights add up to {sum(weights)}, the maximum is {self.MAX_BALANCE_SLOTS}")
+
+        self.rule.balance = Balance(targets=targets, weights=weights, mode=mode)
+        self.has_v4 = self.has_v4 or any(t.ipver == 'v4' for t in targets)
+        self.has_v6 = self.has_v6 or any(t.ipver == 'v6' for t in targets)
+        return args
+
     def handle_forward(self, *args, **kwargs):
         self.rule.rule_type = IPT_TYPE.FORWARD.value
         return args
@@ -274,7 +610,7 @@ class RuleParser:
         _state = args.pop(0).split(',')
 
         for i, state in enumerate(_state):
-            if state in ['invalid', 'new', 'related', 'established']: _state[i] = state.upper()
+            if state in ['invalid', 'new', 'related', 'established', 'untracked']: _state[i] = state.upper()
 
         self.rule.match_rules.append(f'-m state --state {",".join(_state)}')
         return args
@@ -414,9 +750,20 @@ class RuleParser:
         'accept': handle_allow,
         'drop': handle_drop,
         'reject': handle_reject,
+        'notrack': handle_notrack,
+        'mss': handle_mss,
+        'limit': handle_limit,
+        'connlimit': handle_connlimit,
+        'recent': handle_recent,
+        'log': handle_log,
+        'forward-port': handle_forward_port,
+        'snat': handle_snat,
+        'masquerade': handle_masquerade,
+        'balance': handle_balance,
         'forward': handle_forward,
         'from': handle_from,
         'to': handle_to,
+        'for': handle_for,
         'if-in': handle_if_in,
         'if-out': handle_if_out,
         'state': handle_state,
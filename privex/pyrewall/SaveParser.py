@@ -0,0 +1,353 @@
+"""
+A streaming parser for ``iptables-save`` output (e.g. from :func:`.core.save_rules`, with or without ``-c``
+counters), turning each rule into a normalised :class:`.SavedRule` - with the same fields as :class:`.RuleBuilder`.
+
+Rules are normalised so that equal rules compare equal, whichever order the options were given in, and whether they
+came from ``iptables-save`` or Pyre:
+
+    - Addresses and ports are canonicalised (see :mod:`privex.pyrewall.diff`), and ``--dport 22`` /
+      ``-m tcp --dport 22`` / ``-m multiport --dports 22`` are the same ``dports``
+    - The implicit ``-m tcp`` / ``-m udp`` / ``-m icmp`` matches added by ``iptables-save`` are merged with the
+      options following ``-p``, and ``-m state --state`` is treated as ``-m conntrack --ctstate``
+    - Options set to their default (e.g. ``--limit-burst 5`` or ``--reject-with icmp-port-unreachable``) are removed,
+      and rates are written in full (``10/min`` -> ``10/minute``)
+    - ``-m comment`` matches are ignored, and the order of the matches is ignored unless the rule uses a stateful match
+      (see :attr:`.diff.STATEFUL_MATCHES`)
+
+Each unique rule is only normalised once per parser, so re-parsing a ruleset (e.g. polling the kernel for changes)
+mostly costs a dict lookup per line.
+
+    >>> p = SaveParser()
+    >>> for rule, counters in p.parse_lines(save_rules('v4')):
+    ...     print(rule.chain, rule.dports, rule.target, counters)
+    INPUT 22 -j ACCEPT (12, 720)
+    >>> p.chains[('filter', 'INPUT')]
+    SavedChain(table='filter', name='INPUT', policy='DROP', packets=4, bytes=240)
+
+"""
+import logging
+import re
+from collections import OrderedDict
+from ipaddress import ip_network
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from privex.pyrewall.RuleBuilder import RuleBuilder
+from privex.pyrewall.diff import OPTION_ALIASES, PROTOCOLS, STATEFUL_MATCHES, _norm_net, _norm_ports, _norm_list
+from privex.pyrewall.exceptions import RuleSyntaxError
+from privex.pyrewall.types import SavedRule, SavedChain, IPT_ACTION
+
+log = logging.getLogger(__name__)
+
+_rgx_varying = re.compile(
+    r' (! )?(-s|-d|--source|--destination|--dports?|--sports?|--destination-ports?|--source-ports?) ([^\s!-]\S*)'
+)
+"""The address / port options of a rule, which are parsed separately from the rest of the rule"""
+_rgx_token = re.compile(r'"((?:[^"\\]|\\.)*)"|\'([^\']*)\'|(\S+)')
+_rgx_escape = re.compile(r'\\(.)')
+
+PROTOCOL_MATCHES = {'tcp': 'tcp', 'udp': 'udp', 'icmp': 'icmp', 'ipv6-icmp': 'icmp6', 'sctp': 'sctp', 'udplite': 'udplite'}
+"""The implicit match module of each protocol - for the options following ``-p`` (e.g. ``-p tcp --syn``)"""
+
+RATE_OPTIONS = {'--limit', '--hashlimit-upto', '--hashlimit-above', '--hashlimit'}
+RATE_UNITS = {'s': 'second', 'm': 'minute', 'h': 'hour', 'd': 'day'}
+
+MATCH_DEFAULTS = {
+    'limit': {'--limit 3/hour', '--limit-burst 5'},
+    'hashlimit': {'--hashlimit-burst 5'},
+    'connlimit': {'--connlimit-saddr'},
+}
+"""Options of each match module which are set to the default value, and so are removed"""
+
+TARGET_DEFAULTS = {
+    'REJECT': {'--reject-with icmp-port-unreachable', '--reject-with icmp6-port-unreachable'},
+    'LOG': {'--log-level 4', '--log-level warning'},
+    'NFLOG': {'--nflog-group 0'},
+}
+"""Options of each target which are set to the default value, and so are removed"""
+
+FIELD_OPTIONS = {'-s': 'source', '-d': 'destination', '-i': 'in_iface', '-o': 'out_iface'}
+
+COMMENT_MATCH = ' -m comment --comment '
+
+ACTIONS = {'-j ACCEPT': IPT_ACTION.ALLOW, '-j DROP': IPT_ACTION.DROP, '-j REJECT': IPT_ACTION.REJECT}
+
+_FIELD_INDEX = {f: i for i, f in enumerate(SavedRule._fields)}
+_VARYING_INDEX = {
+    opt: _FIELD_INDEX[FIELD_OPTIONS.get(alias, alias[2:])]
+    for opt, alias in [(o, OPTION_ALIASES.get(o, o)) for o in [
+        '-s', '-d', '--source', '--destination', '--dport', '--dports', '--sport', '--sports', '--destination-port',
+        '--destination-ports', '--source-port', '--source-ports',
+    ]]
+}
+"""The position in :class:`.SavedRule` of each option matched by ``_rgx_varying``"""
+_ADDRESS_INDEXES = {_FIELD_INDEX['source'], _FIELD_INDEX['destination']}
+
+
+def _norm_rate(value: str) -> str:
+    num, _, unit = value.partition('/')
+    return f'{num}/{RATE_UNITS.get(unit[:1], unit)}' if unit != '' else f'{num}/second'
+
+
+def _norm_addr(value: str) -> str:
+    # iptables-save already prints canonical addresses, so hosts (the vast majority) skip the full normalisation
+    addr, _, mask = value.rpartition('/')
+    if ',' in value:
+        return _norm_net(value)
+    if mask == '128' or mask == '32' and ':' not in addr:
+        return addr
+    return value if addr == '' else _norm_net(value)
+
+
+def _strip_comments(rule: str) -> str:
+    """
+    Remove the ``-m comment`` matches from a rule - they're ignored, and as iptables-save always quotes them, they'd
+    otherwise send every commented rule through the slower parsing of quoted values
+
+        >>> _strip_comments('-A INPUT -s 1.2.3.4/32 -m comment --comment "ban \\\\"x\\\\"" -j DROP')
+        '-A INPUT -s 1.2.3.4/32 -j DROP'
+
+    """
+    start = rule.find(COMMENT_MATCH)
+    while start >= 0:
+        pos = start + len(COMMENT_MATCH)
+        if rule.startswith('"', pos):
+            end = rule.find('"', pos + 1)
+            # Skip quotes escaped by an odd number of backslashes
+            while end > 0 and rule[end - 1] == '\\' and (end - len(rule[:end].rstrip('\\'))) % 2 == 1:
+                end = rule.find('"', end + 1)
+            end = len(rule) if end < 0 else end + 1
+        else:
+            end = rule.find(' ', pos)
+            end = len(rule) if end < 0 else end
+        rule = rule[:start] + rule[end:]
+        start = rule.find(COMMENT_MATCH, start)
+    return rule
+
+
+def _options(rule: str) -> Tuple[str, List[Tuple[str, str, str]]]:
+    """
+    Split a rule into its chain, and a list of ``(option, value, prefix)`` - where ``prefix`` is ``'! '`` for negated
+    options. Quoted values containing spaces are kept quoted, so they can be used in a rule again.
+    """
+    if '"' not in rule and "'" not in rule:
+        # Every option starts with ' -' (or ' ! -'), so they can be split without scanning each token
+        parts = rule.replace('! -', '-!').split(' -')
+        head, opts = parts[0].split(), []
+        for part in parts[1:]:
+            neg = part[0] == '!'
+            opt, _, value = (part[1:] if neg else part).partition(' ')
+            opts.append(('-' + opt, value.strip(), '! ' if neg else ''))
+        return head[1] if len(head) > 1 else '', opts
+
+    tokens = []
+    for double, single, plain in _rgx_token.findall(rule):
+        t = plain if plain != '' else (single if single != '' else _rgx_escape.sub(r'\1', double))
+        tokens.append(f'"{t}"' if ' ' in t or (plain == '' and t == '') else t)
+    opts, neg, i = [], False, 2
+    while i < len(tokens):
+        if tokens[i] == '!':
+            neg, i = True, i + 1
+            continue
+        j = i + 1
+        while j < len(tokens) and tokens[j] != '!' and not tokens[j].startswith('-'):
+            j += 1
+        opts.append((tokens[i], ' '.join(tokens[i + 1:j]), '! ' if neg else ''))
+        neg, i = False, j
+    return tokens[1] if len(tokens) > 1 else '', opts
+
+
+class SaveParser:
+    """
+    Parses ``iptables-save`` / ``ip6tables-save`` output into :class:`.SavedRule`'s (see the module docs). The chains
+    seen so far (with their policy and counters) are kept in :py:attr:`.chains`.
+
+    :param str ipver: The IP version of the rules (``v4`` / ``v6``), for the defaults which differ between versions
+    """
+    chains: Dict[Tuple[str, str], SavedChain]
+    """The chains of the parsed output by ``(table, chain)``, in the order they were declared"""
+
+    def __init__(self, ipver='v4'):
+        self.ipver = ipver
+        self.table = 'filter'
+        self.chains = OrderedDict()
+        self.match_defaults = {**MATCH_DEFAULTS}
+        self.match_defaults['connlimit'] = MATCH_DEFAULTS['connlimit'] | {
+            f"--connlimit-mask {32 if ipver == 'v4' else 128}"
+        }
+        self._memo: Dict[Tuple[str, str], SavedRule] = {}
+
+    def parse_lines(self, lines: Iterable[str]) -> Iterator[Tuple[SavedRule, Optional[Tuple[int, int]]]]:
+        """
+        Parse ``iptables-save`` output line by line, yielding each rule as it's read - as a tuple of the
+        :class:`.SavedRule` and its ``(packets, bytes)`` counters (``None`` if the output has no counters).
+        Lines can be a list, or any iterable such as an open file.
+
+            >>> list(SaveParser().parse_lines(['*filter', ':INPUT DROP [4:240]', '[12:720] -A INPUT -p tcp -m tcp --dport 22 -j ACCEPT']))
+            [(SavedRule(table='filter', chain='INPUT', protocol='tcp', source=None, destination=None, in_iface=None,
+                        out_iface=None, sports=None, dports='22', matches=(), target='-j ACCEPT'), (12, 720))]
+
+        """
+        for line in lines:
+            line = line.strip()
+            if line == '' or line[0] == '#' or line == 'COMMIT':
+                continue
+            if line[0] == '*':
+                self.table = line[1:]
+                continue
+            if line[0] == ':':
+                name, policy, counters = (line[1:].split() + ['-', '[0:0]'])[:3]
+                packets, _, num_bytes = counters.strip('[]').partition(':')
+                self.chains[(self.table, name)] = SavedChain(
+                    table=self.table, name=name, policy=policy, packets=int(packets or 0), bytes=int(num_bytes or 0)
+                )
+                continue
+            counters = None
+            if line[0] == '[':
+                end = line.find(']')
+                packets, _, num_bytes = line[1:end].partition(':')
+                if end < 0 or not packets.isdigit() or not num_bytes.isdigit():
+                    log.warning("Ignoring iptables-save line with invalid counters: %s", line)
+                    continue
+                counters, line = (int(packets), int(num_bytes)), line[end + 1:].lstrip()
+            if not line.startswith('-A ') and not line.startswith('--append '):
+                log.debug("Ignoring unsupported iptables-save line: %s", line)
+                continue
+            yield self.parse_rule(line), counters
+
+    def parse_file(self, path: str) -> List[Tuple[SavedRule, Optional[Tuple[int, int]]]]:
+        """Parse an ``iptables-save`` file (see :py:meth:`.parse_lines`), returning a list of the rules"""
+        with open(path, 'r') as fh:
+            return list(self.parse_lines(fh))
+
+    def parse_rule(self, rule: str, table: str = None) -> SavedRule:
+        """
+        Parse a single ``-A CHAIN ...`` rule (without counters) from the table ``table`` (default: the current
+        table of the output being parsed) into a :class:`.SavedRule`
+
+            >>> p = SaveParser()
+            >>> p.parse_rule('-A INPUT -s 10.0.0.0/8 -p tcp -m tcp --dport 22 -j ACCEPT') == \\
+            ...     p.parse_rule('-A INPUT -p tcp --dport 22 -s 10.0.0.0/8 -j ACCEPT')
+            True
+
+        """
+        table = self.table if table is None else table
+        if COMMENT_MATCH in rule:
+            rule = _strip_comments(rule)
+        if '"' in rule or "'" in rule:
+            key, parts = (table, rule), []
+        else:
+            # Most rules only differ by their addresses / ports, so the rest of the rule is only parsed once.
+            # split() returns the rest of the rule, with the (negation, option, value) of each match in-between.
+            parts = _rgx_varying.split(rule)
+            key = (table, ''.join(parts[::4]) if len(parts) > 1 else rule)
+        base = self._memo.get(key)
+        if base is None:
+            base = self._memo[key] = self._parse_rule(key[1], table)
+        if len(parts) <= 1:
+            return base
+        fields = list(base)
+        for i in range(1, len(parts), 4):
+            neg, idx, value = parts[i] or '', _VARYING_INDEX[parts[i + 1]], parts[i + 2]
+            if idx in _ADDRESS_INDEXES:
+                fields[idx] = neg + _norm_addr(value)
+            else:
+                fields[idx] = neg + (value if value.isdigit() else _norm_ports(value))
+        # Building the tuple directly is much faster than SavedRule._replace
+        return tuple.__new__(SavedRule, fields)
+
+    def _parse_rule(self, rule: str, table: str) -> SavedRule:
+        chain, opts = _options(rule)
+        if chain == '':
+            raise RuleSyntaxError(f"Invalid iptables rule (expected '-A CHAIN ...'): {rule}")
+        fields: Dict[str, Optional[str]] = dict(
+            protocol=None, source=None, destination=None, in_iface=None, out_iface=None, sports=None, dports=None
+        )
+        clauses: Dict[str, List[str]] = OrderedDict()
+        module, target = None, None
+        for opt, value, prefix in opts:
+            opt = OPTION_ALIASES.get(opt, opt)
+            if target is not None:
+                target.append(prefix + opt + ('' if value == '' else f' {value}'))
+            elif opt == '-j' or opt == '-g':
+                target = [f'{opt} {value}']
+            elif opt == '-p':
+                value = PROTOCOLS.get(value.lower(), value.lower())
+                fields['protocol'] = None if value == 'all' and prefix == '' else prefix + value
+                module = PROTOCOL_MATCHES.get(value)
+            elif opt == '-m':
+                module = 'conntrack' if value.lower() == 'state' else value.lower()
+                clauses.setdefault(module, [])
+            elif opt in FIELD_OPTIONS:
+                fields[FIELD_OPTIONS[opt]] = prefix + (_norm_addr(value) if opt in ['-s', '-d'] else value)
+            elif opt == '--dports' or opt == '--sports':
+                fields[opt[2:]] = prefix + (value if value.isdigit() else _norm_ports(value))
+            elif opt == '-f' or module is None:
+                clauses.setdefault('', []).append(prefix + opt + ('' if value == '' else f' {value}'))
+            else:
+                if opt == '--ctstate':
+                    value = _norm_list(value)
+                elif opt in RATE_OPTIONS:
+                    value = _norm_rate(value)
+                elif opt == '--ports':
+                    value = _norm_ports(value)
+                part = prefix + opt + ('' if value == '' else f' {value}')
+                if part not in self.match_defaults.get(module, ()):
+                    clauses.setdefault(module, []).append(part)
+
+        matches = [
+            (f'-m {name} ' if name != '' else '') + ' '.join(sorted(opts) if len(opts) > 1 else opts)
+            for name, opts in clauses.items() if len(opts) > 0 and name != 'comment'
+        ]
+        if len(matches) > 1 and not any(name in STATEFUL_MATCHES for name in clauses):
+            matches.sort()
+        if target is not None:
+            defaults = TARGET_DEFAULTS.get(target[0].split(' ', 1)[-1], ())
+            target = ' '.join(target[:1] + sorted(t for t in target[1:] if t not in defaults))
+        return SavedRule(table=table, chain=chain, matches=tuple(matches), target=target, **fields)
+
+def to_builder(rule: SavedRule, ipver='v4') -> RuleBuilder:
+    """
+    Convert a :class:`.SavedRule` into a :class:`.RuleBuilder` - e.g. for migrating existing iptables rules into Pyre.
+    Matches without a :class:`.RuleBuilder` field (including negated addresses / interfaces) are kept as raw
+    ``match_rules``.
+
+        >>> to_builder(SaveParser().parse_rule('-A INPUT -p tcp -m tcp --dport 22 -s 10.0.0.0/8 -j ACCEPT')).build()
+        ['-A INPUT -p tcp --dport 22 -s 10.0.0.0/8 -j ACCEPT']
+
+    :raises RuleSyntaxError: If the rule has no target, or a ``-g`` (goto) target, which RuleBuilder can't generate
+    """
+    if rule.target is None or not rule.target.startswith('-j '):
+        raise RuleSyntaxError(f"Rules without a '-j' target can't be converted into a RuleBuilder: {rule}")
+    r = RuleBuilder(rule_type=f'-A {rule.chain}')
+    if rule.protocol is not None:
+        if rule.protocol.startswith('!'):
+            r.match_rules.append(f'! -p {rule.protocol[2:]}')
+        else:
+            r.protocol = rule.protocol
+    if rule.dports is not None and not rule.dports.startswith('!'):
+        r.ports = rule.dports.split(',')
+    elif rule.dports is not None:
+        r.match_rules.append(f'-m multiport ! --dports {rule.dports[2:]}')
+    if rule.sports is not None and not rule.sports.startswith('!'):
+        r.sports = rule.sports.split(',')
+    elif rule.sports is not None:
+        r.match_rules.append(f'-m multiport ! --sports {rule.sports[2:]}')
+    r.match_rules += list(rule.matches)
+
+    for opt, value, add in [('-s', rule.source, r.add_from_cidr), ('-d', rule.destination, r.add_to_cidr)]:
+        if value is None:
+            continue
+        try:
+            add(*[ip_network(v) for v in value.split(',')], ipver=ipver)
+        except ValueError:      # Negated addresses, or hostnames
+            r.match_rules.append(f'! {opt} {value[2:]}' if value.startswith('!') else f'{opt} {value}')
+    for opt, value, add in [('-i', rule.in_iface, r.add_from_iface), ('-o', rule.out_iface, r.add_to_iface)]:
+        if value is not None and value.startswith('!'):
+            r.match_rules.append(f'! {opt} {value[2:]}')
+        elif value is not None:
+            add(value)
+
+    if rule.target in ACTIONS:
+        r.action = ACTIONS[rule.target]
+    else:
+        r.action, r.custom_action = IPT_ACTION.CUSTOM, rule.target[3:]
+    return r
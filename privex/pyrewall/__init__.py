@@ -39,6 +39,10 @@ from privex.pyrewall.core import find_file, valid_port
 from privex.pyrewall.RuleParser import RuleParser
 from privex.pyrewall.RuleBuilder import RuleBuilder
 from privex.pyrewall.PyreParser import PyreParser
+from privex.pyrewall.emitters import Emitter, IPTablesEmitter, NFTEmitter
+from privex.pyrewall.compiler import compile_pyre, compile_file, CompileContext, CompileResult
+from privex.pyrewall.ruleset import Ruleset
+from privex.pyrewall.SaveParser import SaveParser
 from privex.pyrewall.types import IPT_ACTION, IPT_TYPE
 from privex.pyrewall.exceptions import RuleSyntaxError, InvalidPort
 from privex.loghelper import LogHelper
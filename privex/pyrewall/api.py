@@ -0,0 +1,456 @@
+"""
+The dynamic rule API - a local Unix socket API (served by ``pyre daemon --api``) for adding and removing ban / allow
+entries and individual Pyre rules at a high rate, without editing ``.pyre`` files or re-loading the whole ruleset.
+
+Changes are queued in memory by the :class:`.RuleBatcher`, and committed into the kernel in batches every
+:attr:`privex.pyrewall.conf.API_BATCH_INTERVAL` seconds:
+
+ - ``ban`` / ``allow`` addresses are added to (or removed from) the ipsets ``pyre-ban`` / ``pyre-allow``
+   (``pyre-ban6`` / ``pyre-allow6`` for IPv6) with a single ``ipset restore`` per batch.
+ - Pyre rule lines (e.g. ``drop from 1.2.3.4 port 22``) are compiled by :class:`.RuleParser`, and appended to (or
+   deleted from) the ``PYRE-API-<chain>`` chains with a single ``iptables-restore --noflush`` per IP version.
+ - Operations cancelling each other out within the same batch (e.g. a ban followed by an unban) are coalesced,
+   and never reach the kernel.
+ - If the kernel rejects a batch, its changes are retried one at a time, so that a single bad change (e.g. deleting
+   a rule which isn't loaded) is logged and dropped, without discarding the rest of the batch.
+
+Each built-in ``filter`` chain jumps into its ``PYRE-API-<chain>`` chain first. Each API chain contains the
+allow set match (``ACCEPT``), then the ban set match (``DROP``), then the dynamic rules - so they all take
+priority over the rules loaded from your Pyre files. The API chains are re-created whenever the daemon
+re-loads the rules (see :meth:`.RuleBatcher.install`).
+
+**Protocol**
+
+Clients send one JSON object (a single operation) or JSON array (a batch of operations) per line, and receive
+one JSON object per line in reply:
+
+    $ echo '{"op": "ban", "address": "1.2.3.4", "timeout": 600}' | nc -U ~/.pyrewall/api.sock
+    {"ok": true, "queued": 1}
+    $ echo '[{"op": "ban", "address": "1.2.3.4"}, {"op": "rule", "rule": "allow from 10.0.0.0/8 port 22"}]' | ...
+    {"ok": true, "queued": 2, "errors": []}
+
+Operations: ``ban`` / ``unban`` / ``allow`` / ``unallow`` (``address`` or ``addresses``, optional ``timeout``
+in seconds for ``ban`` / ``allow``), ``rule`` / ``delete_rule`` (``rule``), ``flush`` (commit the queued
+changes immediately) and ``stats``.
+
+Basic usage (from Python):
+
+    >>> with ApiClient() as c:
+    ...     c.request('ban', addresses=['1.2.3.4', '2a07:e00::/32'], timeout=3600)
+    {'ok': True, 'queued': 2}
+
+"""
+import ipaddress
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from os.path import expanduser, exists
+from typing import Any, Callable, List, Dict, Union
+from privex.pyrewall import conf
+from privex.pyrewall.RuleParser import RuleParser
+from privex.pyrewall.apply import ApplyQueue
+from privex.pyrewall.core import load_rules, load_ipsets, save_rules
+from privex.pyrewall.exceptions import PyreException, RuleSyntaxError
+from privex.pyrewall.staged import rename_rule
+
+log = logging.getLogger(__name__)
+
+API_CHAIN_PREFIX = 'PYRE-API-'
+API_CHAINS = ['INPUT', 'FORWARD', 'OUTPUT']
+"""The built-in ``filter`` chains which jump into a ``PYRE-API-<chain>`` chain"""
+
+BatchResult = namedtuple('BatchResult', 'set_ops rule_ops failed duration')
+"""
+Returned by :meth:`.RuleBatcher.flush` - the number of ipset entries and iptables rules changed in the kernel,
+the number of changes which the kernel rejected (and were dropped), and how many seconds the commit took.
+"""
+
+IPVERS = ['v4', 'v6']
+
+
+def set_name(base: str, ipver: str) -> str:
+    """
+    Returns the name of the ipset ``base`` for the given IP version
+
+        >>> set_name('pyre-ban', 'v6')
+        'pyre-ban6'
+
+    """
+    return base + ('6' if ipver == 'v6' else '')
+
+
+class RuleBatcher:
+    """
+    Queues dynamic rule API changes in memory, and commits them into the kernel in coalesced batches - see the module
+    docstring of :mod:`privex.pyrewall.api`.
+
+    Thread safe - operations may be queued from any number of threads, while :meth:`.flush` runs in another.
+    """
+    active: Dict[str, 'OrderedDict[str, bool]']
+    """The dynamic rules (per IP version, in ``-A PYRE-API-<chain> ...`` form) which are currently in the kernel"""
+
+    def __init__(self, queue: ApplyQueue = None, ipver='both', ban_set: str = None, allow_set: str = None):
+        """
+        :param ApplyQueue queue: Commit batches while holding this queue's apply lock (``None`` to not lock)
+        :param str ipver: ``4`` / ``6`` to only manage IPv4 / IPv6 rules, or ``both``
+        :param str ban_set: The base name of the ban ipsets (default: :attr:`privex.pyrewall.conf.API_BAN_SET`)
+        :param str allow_set: The base name of the allow ipsets (default: :attr:`privex.pyrewall.conf.API_ALLOW_SET`)
+        """
+        self.queue = queue
+        self.ipvers = [v for v in IPVERS if ipver in [v, v[1], f'ip{v}', 'both']]
+        self.ban_set = conf.API_BAN_SET if ban_set is None else ban_set
+        self.allow_set = conf.API_ALLOW_SET if allow_set is None else allow_set
+        self.lock = threading.Lock()
+        self.rp = RuleParser(emitter='iptables')
+        self.pending_sets: Dict[str, OrderedDict] = OrderedDict()
+        self.pending_rules = {v: OrderedDict() for v in IPVERS}
+        self.active = {v: OrderedDict() for v in IPVERS}
+        self.stats = dict(ops=0, set_ops=0, rule_ops=0, batches=0, kernel_calls=0, errors=0, last_batch_secs=0.0)
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def renames(self) -> Dict[str, str]: return {c: API_CHAIN_PREFIX + c for c in API_CHAINS}
+
+    ###
+    # Queueing operations
+    ###
+
+    def _queue_address(self, base_set: str, address: str, add=True, timeout: int = None):
+        net = ipaddress.ip_network(str(address).strip(), strict=False)
+        ipver = f'v{net.version}'
+        if ipver not in self.ipvers:
+            raise RuleSyntaxError(f"Address {address} is IP{ipver}, but the API is only managing {self.ipvers}")
+        entry = str(net.network_address) if net.prefixlen == net.max_prefixlen else str(net)
+        with self.lock:
+            self.stats['ops'] += 1
+            # Later operations on the same entry replace earlier ones, so e.g. a ban + unban cancel out
+            self.pending_sets.setdefault(set_name(base_set, ipver), OrderedDict())[entry] = (add, timeout)
+
+    def ban(self, address: str, timeout: int = None):
+        """Queue ``address`` (an IP or CIDR subnet) to be added to the ban set, optionally expiring after ``timeout`` secs"""
+        self._queue_address(self.ban_set, address, add=True, timeout=timeout)
+
+    def unban(self, address: str):
+        self._queue_address(self.ban_set, address, add=False)
+
+    def allow(self, address: str, timeout: int = None):
+        """Queue ``address`` (an IP or CIDR subnet) to be added to the allow set, optionally expiring after ``timeout`` secs"""
+        self._queue_address(self.allow_set, address, add=True, timeout=timeout)
+
+    def unallow(self, address: str):
+        self._queue_address(self.allow_set, address, add=False)
+
+    def _queue_rule(self, line: str, add=True) -> int:
+        with self.lock:
+            try:
+                v4_rules, v6_rules = self.rp.parse(line)
+            finally:
+                # The parser is re-used for every rule, so make sure a failed parse can't leak into the next rule
+                self.rp.reset_rule()
+            if v4_rules is None or v6_rules is None:
+                raise RuleSyntaxError(f"Could not parse Pyre rule: {line}")
+            queued = 0
+            for ipver, rules in zip(IPVERS, [v4_rules, v6_rules]):
+                if ipver not in self.ipvers:
+                    continue
+                for r in rules:
+                    self.pending_rules[ipver][rename_rule(r, self.renames)] = add
+                    queued += 1
+            self.stats['ops'] += 1
+            return queued
+
+    def add_rule(self, line: str) -> int:
+        """Compile the Pyre rule ``line`` and queue the resulting rules to be appended. Returns the amount of rules."""
+        return self._queue_rule(line, add=True)
+
+    def delete_rule(self, line: str) -> int:
+        """Compile the Pyre rule ``line`` and queue the resulting rules to be deleted. Returns the amount of rules."""
+        return self._queue_rule(line, add=False)
+
+    ###
+    # Committing into the kernel
+    ###
+
+    def set_lines(self) -> List[str]:
+        """The ``ipset restore`` lines to create the ban / allow sets (if they don't already exist)"""
+        lines = []
+        for ipver in self.ipvers:
+            family = 'inet6' if ipver == 'v6' else 'inet'
+            for base in [self.allow_set, self.ban_set]:
+                lines.append(f'create {set_name(base, ipver)} hash:net family {family} timeout 0 -exist')
+        return lines
+
+    def chain_lines(self, ipver: str, current: List[str]) -> List[str]:
+        """
+        The ``iptables-restore --noflush`` lines to (re-)create the API chains with the set matches and active
+        dynamic rules, plus the jumps into them from the built-in chains missing from ``current`` (``iptables-save``)
+        """
+        lines = ['*filter'] + [f':{API_CHAIN_PREFIX}{c} - [0:0]' for c in API_CHAINS]
+        for c in API_CHAINS:
+            if c == 'OUTPUT':
+                continue
+            lines.append(f'-A {API_CHAIN_PREFIX}{c} -m set --match-set {set_name(self.allow_set, ipver)} src -j ACCEPT')
+            lines.append(f'-A {API_CHAIN_PREFIX}{c} -m set --match-set {set_name(self.ban_set, ipver)} src -j DROP')
+        lines += list(self.active[ipver].keys())
+        current = set(l.strip() for l in current)
+        lines += [f'-I {c} 1 -j {API_CHAIN_PREFIX}{c}' for c in API_CHAINS if f'-A {c} -j {API_CHAIN_PREFIX}{c}' not in current]
+        return lines + ['COMMIT']
+
+    def install(self):
+        """
+        Create the ban / allow ipsets, and (re-)create the API chains and the jumps into them.
+
+        Must be called after the ``filter`` table has been re-loaded (which removes the API chains), while
+        holding the apply lock. Safe to call repeatedly.
+        """
+        load_ipsets(self.set_lines())
+        self.stats['kernel_calls'] += 1
+        for ipver in self.ipvers:
+            with self.lock:
+                lines = self.chain_lines(ipver, save_rules(ipver))
+            load_rules(lines, ipver, noflush=True)
+            self.stats['kernel_calls'] += 2
+
+    def _take_pending(self):
+        with self.lock:
+            sets, self.pending_sets = self.pending_sets, OrderedDict()
+            rules, self.pending_rules = self.pending_rules, {v: OrderedDict() for v in IPVERS}
+        return sets, rules
+
+    def _load(self, loader: Callable[[List[str]], Any], lines: List[str]) -> List[bool]:
+        """
+        Load ``lines`` into the kernel with a single ``loader`` call. If the kernel rejects them, each line is retried
+        on its own, so that one bad change can't discard the rest of the batch. Returns whether each line was loaded.
+        """
+        try:
+            loader(lines)
+            return [True] * len(lines)
+        except PyreException as e:
+            log.warning("Batch of %d changes was rejected, retrying them one at a time. Error: %s %s",
+                        len(lines), type(e), str(e))
+        finally:
+            self.stats['kernel_calls'] += 1
+        loaded = []
+        for l in lines:
+            try:
+                loader([l])
+                loaded.append(True)
+            except PyreException as e:
+                log.error("Dropping dynamic change rejected by the kernel: '%s' - Error: %s %s", l, type(e), str(e))
+                loaded.append(False)
+            self.stats['kernel_calls'] += 1
+        return loaded
+
+    def _commit(self, sets: Dict[str, OrderedDict], rules: Dict[str, OrderedDict]) -> BatchResult:
+        started = time.monotonic()
+        set_lines = []
+        for name, entries in sets.items():
+            for entry, (add, timeout) in entries.items():
+                if not add:
+                    set_lines.append(f'del {name} {entry} -exist')
+                    continue
+                set_lines.append(f'add {name} {entry}' + ('' if timeout is None else f' timeout {int(timeout)}') + ' -exist')
+        # ipset restore stops at the first bad line, but every line uses -exist, so retrying the good ones is harmless
+        set_ops = sum(self._load(load_ipsets, set_lines)) if len(set_lines) > 0 else 0
+        failed = len(set_lines) - set_ops
+
+        rule_ops = 0
+        for ipver in self.ipvers:
+            active = self.active[ipver]
+            # Only rules which actually change the kernel state are sent - appending an active rule, or deleting
+            # one which isn't active (e.g. added and deleted within the same batch) is a no-op.
+            changes = [(r, add) for r, add in rules[ipver].items() if add != (r in active)]
+            if len(changes) == 0:
+                continue
+            loaded = self._load(
+                lambda ls: load_rules(['*filter'] + ls + ['COMMIT'], ipver, noflush=True),
+                [r if add else '-D' + r[2:] for r, add in changes]
+            )
+            with self.lock:
+                for (r, add), ok in zip(changes, loaded):
+                    if not ok:
+                        continue
+                    if add:
+                        active[r] = True
+                    else:
+                        active.pop(r, None)
+            rule_ops += sum(loaded)
+            failed += len(changes) - sum(loaded)
+        return BatchResult(
+            set_ops=set_ops, rule_ops=rule_ops, failed=failed, duration=time.monotonic() - started
+        )
+
+    def flush(self) -> BatchResult:
+        """Commit all queued changes into the kernel now, as one batch"""
+        sets, rules = self._take_pending()
+        if len(sets) == 0 and not any(len(r) > 0 for r in rules.values()):
+            return BatchResult(set_ops=0, rule_ops=0, failed=0, duration=0.0)
+        try:
+            if self.queue is None:
+                res = self._commit(sets, rules)
+            else:
+                with self.queue.exclusive():
+                    res = self._commit(sets, rules)
+        except PyreException as e:
+            self.stats['errors'] += 1
+            log.error("Failed to commit batch of dynamic rule changes: %s %s", type(e), str(e))
+            raise
+        self.stats['batches'] += 1
+        self.stats['set_ops'] += res.set_ops
+        self.stats['rule_ops'] += res.rule_ops
+        self.stats['errors'] += res.failed
+        self.stats['last_batch_secs'] = round(res.duration, 6)
+        log.debug("Committed %d ipset and %d rule changes (%d rejected) in %.4f seconds",
+                  res.set_ops, res.rule_ops, res.failed, res.duration)
+        return res
+
+    def _run(self, interval: float):
+        while not self._stop.wait(interval):
+            try:
+                self.flush()
+            except PyreException:
+                pass    # Already logged by flush - the next batch may well succeed.
+
+    def start(self, interval: float = None):
+        """Start a background thread which calls :meth:`.flush` every ``interval`` seconds"""
+        interval = conf.API_BATCH_INTERVAL if interval is None else float(interval)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(interval,), name='pyre-api-batcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background flush thread, and commit anything still queued"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+
+class ApiHandler(socketserver.StreamRequestHandler):
+    """Handles one API client connection - one JSON request per line, one JSON response per line"""
+    server: 'ApiServer'
+
+    def _op(self, req: dict) -> int:
+        b = self.server.batcher
+        op = req.get('op')
+        if op in ['ban', 'unban', 'allow', 'unallow']:
+            addresses = req['addresses'] if 'addresses' in req else [req['address']]
+            if not isinstance(addresses, list):
+                # Otherwise a string would be iterated one character at a time, queueing a change per character
+                raise TypeError(f'Expected a JSON array of addresses, got: {type(addresses).__name__}')
+            for a in addresses:
+                if op in ['ban', 'allow']:
+                    getattr(b, op)(a, timeout=req.get('timeout'))
+                else:
+                    getattr(b, op)(a)
+            return len(addresses)
+        if op == 'rule':
+            b.add_rule(req['rule'])
+            return 1
+        if op == 'delete_rule':
+            b.delete_rule(req['rule'])
+            return 1
+        raise RuleSyntaxError(f"Unknown API operation: {op}")
+
+    def respond(self, line: bytes) -> dict:
+        try:
+            req = json.loads(line)
+        except ValueError as e:
+            return dict(ok=False, error=f'Invalid JSON: {e!s}')
+        if isinstance(req, dict) and req.get('op') == 'stats':
+            return dict(ok=True, stats=dict(self.server.batcher.stats))
+        if isinstance(req, dict) and req.get('op') == 'flush':
+            try:
+                res = self.server.batcher.flush()
+                return dict(ok=res.failed == 0, **res._asdict())
+            except PyreException as e:
+                return dict(ok=False, error=str(e))
+        if isinstance(req, dict):
+            try:
+                return dict(ok=True, queued=self._op(req))
+            except (PyreException, ValueError, KeyError, TypeError) as e:
+                return dict(ok=False, error=f'{type(e).__name__}: {e!s}')
+        if not isinstance(req, list):
+            return dict(ok=False, error=f'Expected a JSON object or array, got: {type(req).__name__}')
+        queued, errors = 0, []
+        for i, r in enumerate(req):
+            try:
+                queued += self._op(r)
+            except (PyreException, ValueError, KeyError, TypeError, AttributeError) as e:
+                errors.append(dict(index=i, error=f'{type(e).__name__}: {e!s}'))
+        return dict(ok=len(errors) == 0, queued=queued, errors=errors)
+
+    def handle(self):
+        for line in self.rfile:
+            if line.strip() == b'':
+                continue
+            self.wfile.write(json.dumps(self.respond(line)).encode() + b"\n")
+            self.wfile.flush()
+
+
+class ApiServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serves the dynamic rule API on a Unix socket, queueing the changes into a :class:`.RuleBatcher`
+
+        >>> server = ApiServer(batcher=RuleBatcher(queue=ApplyQueue()))
+        >>> server.batcher.start()
+        >>> server.serve_forever()
+
+    """
+    daemon_threads = True
+
+    def __init__(self, path: str = None, batcher: RuleBatcher = None, mode: int = 0o660):
+        """
+        :param str path: The path to the Unix socket (default: :attr:`privex.pyrewall.conf.API_SOCKET`)
+        :param RuleBatcher batcher: The batcher to queue changes into (default: a new :class:`.RuleBatcher`)
+        :param int mode: The permissions set on the socket file
+        """
+        self.path = expanduser(conf.API_SOCKET if path is None else path)
+        self.batcher = RuleBatcher() if batcher is None else batcher
+        if exists(self.path):
+            log.debug("Removing stale API socket %s", self.path)
+            os.remove(self.path)
+        super().__init__(self.path, ApiHandler)
+        os.chmod(self.path, mode)
+
+    def server_close(self):
+        super().server_close()
+        if exists(self.path):
+            os.remove(self.path)
+
+
+class ApiClient:
+    """A simple client for the dynamic rule API - see the module docstring of :mod:`privex.pyrewall.api`"""
+
+    def __init__(self, path: str = None, timeout: float = 30.0):
+        self.path = expanduser(conf.API_SOCKET if path is None else path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(self.path)
+        self.fh = self.sock.makefile('rwb')
+
+    def send(self, req: Union[dict, list]) -> dict:
+        """Send a single operation (``dict``) or a batch of operations (``list``), and return the response"""
+        self.fh.write(json.dumps(req).encode() + b"\n")
+        self.fh.flush()
+        return json.loads(self.fh.readline())
+
+    def request(self, op: str, **kwargs) -> dict:
+        return self.send(dict(op=op, **kwargs))
+
+    def close(self):
+        self.fh.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
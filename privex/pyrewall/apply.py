@@ -0,0 +1,214 @@
+"""
+Serialised, coalescing application of compiled rules into the kernel.
+
+Multiple ``pyre load`` processes (cron, config management, deploy hooks) may try to apply rules at the same time.
+:class:`.ApplyQueue` guarantees that only one process applies rules at once (via an exclusive ``flock`` on
+an apply lock file), and that bursts of requests are merged into a single follow-up apply of the newest
+compiled state, instead of each one running their own full backup/restore cycle.
+
+Basic usage:
+
+    >>> def applier(payload: dict):
+    ...     if payload['v4'] is not None: load_rules(payload['v4'], 'v4')
+    ...     if payload['v6'] is not None: load_rules(payload['v6'], 'v6')
+    >>> q = ApplyQueue()
+    >>> res = q.submit(v4=['*filter', 'COMMIT'], v6=None, applier=applier)
+    >>> res.status
+    'applied'
+
+"""
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from os import makedirs
+from os.path import expanduser, join, exists
+from typing import Callable, List, Optional, Any, Tuple
+from privex.pyrewall import conf
+
+log = logging.getLogger(__name__)
+
+STATUS_APPLIED = 'applied'
+"""Our payload (or a newer one which superseded it) was applied by this process"""
+STATUS_COALESCED = 'coalesced'
+"""Another process holds the apply lock, and will apply our payload (or a newer one) as a follow-up apply"""
+
+ApplyResult = namedtuple('ApplyResult', 'status seq applied')
+"""
+Returned by :meth:`.ApplyQueue.submit` - ``status`` is one of :attr:`.STATUS_APPLIED` / :attr:`.STATUS_COALESCED`,
+``seq`` is the sequence number of the submitted payload, and ``applied`` is the number of payloads this process
+applied while holding the lock (``0`` if coalesced).
+"""
+
+
+class ApplyQueue:
+    """
+    An exclusive apply lock plus a single-slot coalescing queue, both stored in :attr:`.state_dir`
+
+    **How it works**
+
+     - :meth:`.submit` atomically writes the compiled payload into ``pending.json`` (replacing any older pending
+       payload - only the newest compiled state is ever kept).
+     - It then tries to take an exclusive ``flock`` on ``apply.lock``. If another process holds the lock, it
+       returns :attr:`.STATUS_COALESCED` straight away (unless ``wait=True``) - the lock holder is guaranteed to
+       pick up the pending payload before it finishes.
+     - The lock holder "drains" the queue - repeatedly taking the pending payload and passing it to the applier,
+       until there's nothing pending. After releasing the lock it checks for a pending payload one final time,
+       closing the race where a payload is written just as the lock is released.
+     - If the applier fails on a payload, the error is logged and the drain carries on with the next pending payload,
+       so coalesced payloads are never stranded. The error is only re-raised to the caller which submitted it.
+
+    Since both the IPv4 and IPv6 rules are applied by the applier while holding the lock, no other ``pyre load``
+    can observe (or backup) a half-applied ruleset.
+    """
+    LOCK_FILE = 'apply.lock'
+    QUEUE_LOCK_FILE = 'queue.lock'
+    PENDING_FILE = 'pending.json'
+    ACTIVE_FILE = 'applying.json'
+
+    def __init__(self, state_dir: str = None):
+        self.state_dir = expanduser(conf.STATE_DIR if state_dir is None else state_dir)
+        if not exists(self.state_dir):
+            log.debug("Creating folder %s", self.state_dir)
+            makedirs(self.state_dir, exist_ok=True)
+
+    @property
+    def lock_path(self) -> str: return join(self.state_dir, self.LOCK_FILE)
+
+    @property
+    def queue_lock_path(self) -> str: return join(self.state_dir, self.QUEUE_LOCK_FILE)
+
+    @property
+    def pending_path(self) -> str: return join(self.state_dir, self.PENDING_FILE)
+
+    @property
+    def active_path(self) -> str: return join(self.state_dir, self.ACTIVE_FILE)
+
+    def _pending_seq(self) -> Optional[int]:
+        try:
+            with open(self.pending_path) as fh:
+                return json.load(fh)['seq']
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+    def _write_pending(self, payload: dict):
+        """Atomically replace the pending payload with ``payload`` - unless the pending payload is newer than it"""
+        tmp_path = f"{self.pending_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as fh:
+            json.dump(payload, fh)
+        with open(self.queue_lock_path, 'a') as lock_fh:
+            fcntl.flock(lock_fh, fcntl.LOCK_EX)
+            try:
+                pending_seq = self._pending_seq()
+                if pending_seq is not None and pending_seq > payload['seq']:
+                    log.debug("Pending payload (seq %s) is newer than ours (seq %s) - not replacing it.",
+                              pending_seq, payload['seq'])
+                    os.remove(tmp_path)
+                    return
+                os.replace(tmp_path, self.pending_path)
+            finally:
+                fcntl.flock(lock_fh, fcntl.LOCK_UN)
+
+    def _take_pending(self) -> Optional[dict]:
+        """Atomically claim the pending payload (if any) by renaming it - returns ``None`` if nothing is pending"""
+        try:
+            os.replace(self.pending_path, self.active_path)
+        except FileNotFoundError:
+            return None
+        try:
+            with open(self.active_path) as fh:
+                return json.load(fh)
+        finally:
+            os.remove(self.active_path)
+
+    def _drain(self, applier: Callable[[dict], Any], seq: int) -> Tuple[List[int], Optional[Exception]]:
+        """
+        Apply pending payloads until none are left. Must only be called while holding the apply lock.
+
+        A payload which fails to apply is logged and skipped, so that payloads coalesced by other processes are
+        still applied. Returns the seqs which were applied, plus the exception raised while applying our own
+        payload ``seq`` (if any), for :meth:`.submit` to re-raise once the queue is drained.
+        """
+        applied, error = [], None
+        while True:
+            payload = self._take_pending()
+            if payload is None:
+                return applied, error
+            log.info("Applying compiled rules (seq %s) from %s", payload['seq'], payload.get('source'))
+            try:
+                applier(payload)
+            except Exception as e:
+                log.error("Failed to apply compiled rules (seq %s) from %s - %s %s",
+                          payload['seq'], payload.get('source'), type(e), str(e))
+                if payload['seq'] == seq:
+                    error = e
+                continue
+            applied.append(payload['seq'])
+
+    @contextmanager
+    def exclusive(self):
+        """Context manager which blocks until it holds the apply lock, for applying rules outside of :meth:`.submit`"""
+        with open(self.lock_path, 'a') as lock_fh:
+            fcntl.flock(lock_fh, fcntl.LOCK_EX)
+            try:
+                yield self
+            finally:
+                fcntl.flock(lock_fh, fcntl.LOCK_UN)
+
+    def submit(self, v4: List[str] = None, v6: List[str] = None, source: str = None,
+               applier: Callable[[dict], Any] = None, wait=False, after_apply: Callable[[], Any] = None,
+               options: dict = None, ipsets: dict = None) -> ApplyResult:
+        """
+        Queue a compiled ruleset to be applied, and apply it (plus anything else queued) if nobody else is.
+
+        :param List[str] v4: IPv4 iptables-restore lines, or ``None`` to leave the IPv4 rules untouched
+        :param List[str] v6: IPv6 iptables-restore lines, or ``None`` to leave the IPv6 rules untouched
+        :param str source: A human readable description of where the rules came from (used in logs)
+        :param applier: A callable which takes a payload dict (``v4``, ``v6``, ``ipsets``, ``source``, ``seq``,
+                        ``options``) and applies it
+        :param bool wait: If ``True``, block until the apply lock is free instead of coalescing into the current apply
+        :param after_apply: If this process applied anything, this is called while still holding the lock
+                            (e.g. for a "keep these rules?" confirmation with rollback)
+        :param dict options: Extra JSON serializable options stored in the payload (e.g. ``staged=True``), since
+                             the payload may be applied by a different process's applier
+        :param dict ipsets: The ipsets needed by the rules (see :py:attr:`.PyreParser.ipsets`), stored in the payload
+        :raises Exception: Whatever ``applier`` raised while applying our own payload - re-raised only after every
+                           other pending payload has been applied (and ``after_apply`` called, if any were)
+        :return ApplyResult res: The outcome of the submission
+        """
+        seq = time.time_ns()
+        self._write_pending(dict(
+            v4=v4, v6=v6, ipsets=ipsets, source=source, seq=seq, options={} if options is None else options
+        ))
+        applied, error = [], None
+        blocking = wait
+        while True:
+            with open(self.lock_path, 'a') as lock_fh:
+                try:
+                    fcntl.flock(lock_fh, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    break
+                try:
+                    ran, err = self._drain(applier, seq)
+                    applied += ran
+                    error = error if err is None else err
+                    if len(ran) > 0 and after_apply is not None:
+                        after_apply()
+                finally:
+                    fcntl.flock(lock_fh, fcntl.LOCK_UN)
+            # A payload may have been queued between our final drain and releasing the lock, by a process which
+            # then failed to get the lock. If so, loop around and try to take the lock again to apply it.
+            if not exists(self.pending_path):
+                break
+            blocking = False
+
+        if error is not None:
+            raise error
+        if len(applied) == 0 or max(applied) < seq:
+            log.info("Another process is applying rules - queued seq %s to be applied in its follow-up apply.", seq)
+            return ApplyResult(status=STATUS_COALESCED, seq=seq, applied=len(applied))
+        return ApplyResult(status=STATUS_APPLIED, seq=seq, applied=len(applied))
@@ -0,0 +1,75 @@
+"""
+Reading large plain text address lists (blocklists) for the ``@blocklist`` Pyre directive.
+
+A blocklist is a text file with one IPv4 / IPv6 address or CIDR subnet per line, e.g. the Spamhaus DROP lists or
+FireHOL ``.netset`` files. Anything after the first word of a line is ignored, as are blank lines and lines
+starting with ``#`` or ``;``.
+
+The file is memory-mapped and scanned with a regex (no Python objects are created for comments or blank lines), the
+entries are split by family and parsed in bulk into integer keys (see :func:`privex.pyrewall.cidr.parse_many`), then
+aggregated into the smallest list of subnets covering them - so overlapping and adjacent entries cost nothing
+once loaded.
+
+    >>> res = read_blocklist('/etc/pyrewall/lists/firehol_level1.netset')
+    >>> res.entries, len(res.v4), res.invalid
+    (4521, 4310, 0)
+
+"""
+import logging
+import mmap
+import re
+from collections import namedtuple
+from typing import List
+from privex.pyrewall.cidr import parse_many, summarise_keys
+from privex.pyrewall.exceptions import RuleSyntaxError
+from privex.pyrewall.staged import ipset_swap_lines
+
+log = logging.getLogger(__name__)
+
+BlocklistResult = namedtuple('BlocklistResult', 'v4 v6 entries invalid')
+"""
+The result of :func:`.read_blocklist` - ``v4`` / ``v6`` are the aggregated subnets as ``List[str]``, ``entries`` is
+the number of valid entries read from the file, and ``invalid`` is the number of entries which were skipped.
+"""
+
+_rgx_entry = re.compile(rb'^[ \t]*([^\s#;]+)', re.MULTILINE)
+
+
+def read_blocklist(path: str, strict=False) -> BlocklistResult:
+    """
+    Read, validate and aggregate the addresses / subnets in the blocklist file ``path``
+
+    :param str path: The absolute path to the blocklist file
+    :param bool strict: If ``True``, raise :class:`.RuleSyntaxError` on the first invalid entry instead of skipping it
+    :return BlocklistResult res: The aggregated IPv4 and IPv6 subnets
+    """
+    with open(path, 'rb') as fh:
+        try:
+            mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:      # Empty files can't be memory-mapped
+            return BlocklistResult(v4=[], v6=[], entries=0, invalid=0)
+        try:
+            entries = _rgx_entry.findall(mm)
+        finally:
+            mm.close()
+
+    keys4, invalid4 = parse_many([e for e in entries if b':' not in e], 32)
+    keys6, invalid6 = parse_many([e for e in entries if b':' in e], 128)
+    invalid = invalid4 + invalid6
+    if len(invalid) > 0:
+        if strict:
+            raise RuleSyntaxError(f"(strict mode) Invalid entry in blocklist {path}: {invalid[0].decode(errors='replace')}")
+        log.warning("Skipped %d invalid entries in blocklist %s (first: %s)", len(invalid), path, invalid[0])
+    return BlocklistResult(
+        v4=summarise_keys(keys4, 32), v6=summarise_keys(keys6, 128), entries=len(keys4) + len(keys6),
+        invalid=len(invalid)
+    )
+
+
+def blocklist_lines(name: str, family: str, entries: str, maxelem: int) -> List[str]:
+    """
+    Generate ``ipset restore`` lines which atomically replace the contents of the blocklist set ``name`` with
+    ``entries`` (newline separated subnets), using :func:`.ipset_swap_lines`.
+    """
+    create_args = f'hash:net family {family} maxelem {maxelem}'
+    return ipset_swap_lines(name, create_args, entries.split('\n') if entries != '' else [])
@@ -0,0 +1,359 @@
+"""
+Fast integer based IPv4 / IPv6 CIDR parsing and aggregation, for handling address lists far too large for
+:mod:`ipaddress` objects (e.g. blocklists with millions of entries).
+
+Addresses are handled as ``(start, end)`` tuples of integers (inclusive), which can be sorted, merged and split
+back into the smallest list of CIDR subnets covering them.
+
+    >>> summarise([parse_v4('10.0.0.0/25'), parse_v4('10.0.0.128/25'), parse_v4('10.0.1.7')], 32)
+    ['10.0.0.0/24', '10.0.1.7']
+
+For bulk lists, :func:`.parse_many` and :func:`.summarise_keys` do the same using a single integer "key" per subnet
+(``network << 8 | prefix_length``) instead of tuples, which is considerably faster to create and sort.
+
+    >>> keys, invalid = parse_many([b'10.0.0.0/25', b'10.0.0.128/25', b'10.0.1.7', b'10.0.0.300'], 32)
+    >>> summarise_keys(keys, 32), invalid
+    (['10.0.0.0/24', '10.0.1.7'], [b'10.0.0.300'])
+
+Arbitrary start/end ranges (e.g. from geo IP databases) are converted with :func:`.summarise_ranges`, which uses
+vectorised NumPy arithmetic for IPv4 if NumPy is installed (``pip3 install pyrewall[fast]``).
+
+The addresses in Pyre rules (e.g. ``allow from 1.2.3.4,10.0.0.0/8``) are parsed by :func:`.parse_networks` into
+a :class:`.NetworkList` per IP version, which stores the same integer keys compactly, and only creates
+:mod:`ipaddress` network objects when they're accessed.
+
+"""
+import socket
+from array import array
+from functools import lru_cache
+from ipaddress import ip_network, IPv4Network, IPv6Network
+from typing import Tuple, List, Iterable, Iterator, Union, Sequence
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+HAS_NUMPY = numpy is not None
+
+RANGE = Tuple[int, int]
+
+_inet_pton, _inet_ntop, AF_INET, AF_INET6 = socket.inet_pton, socket.inet_ntop, socket.AF_INET, socket.AF_INET6
+_from_bytes = int.from_bytes
+
+
+def _parse(addr: Union[str, bytes], family: int, bits: int) -> RANGE:
+    if isinstance(addr, bytes):
+        addr = addr.decode('ascii')
+    prefix = bits
+    if '/' in addr:
+        addr, prefix = addr.split('/', 1)
+        if not prefix.isdigit() or int(prefix) > bits:
+            raise ValueError(f"Invalid prefix length '/{prefix}'")
+        prefix = int(prefix)
+    try:
+        start = _from_bytes(_inet_pton(family, addr), 'big')
+    except OSError:
+        raise ValueError(f"Invalid IP address '{addr}'")
+    size = 1 << (bits - prefix)
+    # Host bits are masked off, like ``ip_network(addr, strict=False)``
+    start &= ~(size - 1)
+    return start, start + size - 1
+
+
+def parse_v4(addr: Union[str, bytes]) -> RANGE:
+    """
+    Parse an IPv4 address or CIDR subnet into an integer ``(start, end)`` range
+
+        >>> parse_v4('192.168.1.0/24')
+        (3232235776, 3232236031)
+
+    :raises ValueError: If ``addr`` isn't a valid IPv4 address / subnet
+    """
+    return _parse(addr, AF_INET, 32)
+
+
+def parse_v6(addr: Union[str, bytes]) -> RANGE:
+    """Parse an IPv6 address or CIDR subnet into an integer ``(start, end)`` range (see :func:`.parse_v4`)"""
+    return _parse(addr, AF_INET6, 128)
+
+
+def aggregate(ranges: Iterable[RANGE]) -> List[RANGE]:
+    """
+    Sort and merge overlapping / adjacent integer ranges
+
+        >>> aggregate([(10, 20), (0, 5), (6, 9), (15, 30), (40, 40)])
+        [(0, 30), (40, 40)]
+
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if len(merged) > 0 and start <= merged[-1][1] + 1:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+            continue
+        merged.append((start, end))
+    return merged
+
+
+def range_to_cidrs(start: int, end: int, bits: int) -> Iterator[Tuple[int, int]]:
+    """
+    Split an integer range into the smallest list of ``(network, prefix_length)`` CIDR subnets covering it
+
+        >>> list(range_to_cidrs(0, 5, 32))
+        [(0, 30), (4, 31)]
+
+    """
+    while start <= end:
+        # The largest block aligned at ``start``, limited to the largest power of two which fits within the range
+        size = (start & -start) if start > 0 else 1 << bits
+        fit = 1 << ((end - start + 1).bit_length() - 1)
+        if fit < size:
+            size = fit
+        yield start, bits - size.bit_length() + 1
+        start += size
+
+
+def format_cidr(network: int, prefix: int, bits: int) -> str:
+    """
+    Format an integer network + prefix length as a string. Single addresses are output without a prefix length.
+
+        >>> format_cidr(3232235776, 24, 32), format_cidr(1, 128, 128)
+        ('192.168.1.0/24', '::1')
+
+    """
+    addr = _inet_ntop(AF_INET if bits == 32 else AF_INET6, network.to_bytes(bits // 8, 'big'))
+    return addr if prefix == bits else f'{addr}/{prefix}'
+
+
+def summarise(ranges: Iterable[RANGE], bits: int) -> List[str]:
+    """Aggregate integer ranges, and return them as the smallest list of CIDR strings covering them"""
+    return [format_cidr(net, prefix, bits) for s, e in aggregate(ranges) for net, prefix in range_to_cidrs(s, e, bits)]
+
+
+def parse_many(entries: Iterable[bytes], bits: int) -> Tuple[List[int], List[bytes]]:
+    """
+    Parse many IPv4 (``bits=32``) or IPv6 (``bits=128``) addresses / subnets into integer keys
+    (``network << 8 | prefix_length``) for :func:`.summarise_keys`
+
+    :return tuple res: ``(keys, invalid)`` - the keys of the valid entries, plus a list of the invalid entries
+    """
+    family = AF_INET if bits == 32 else AF_INET6
+    keys, invalid = [], []
+    add, pton, from_bytes = keys.append, _inet_pton, _from_bytes
+    for entry in entries:
+        addr, slash, prefix = entry.partition(b'/')
+        try:
+            net = from_bytes(pton(family, addr.decode('ascii')), 'big')
+            if slash:
+                prefix = int(prefix) if prefix.isdigit() else -1
+                if prefix < 0 or prefix > bits:
+                    raise ValueError
+                net &= ~((1 << (bits - prefix)) - 1)
+            else:
+                prefix = bits
+        except (OSError, ValueError, UnicodeDecodeError):
+            invalid.append(entry)
+            continue
+        add(net << 8 | prefix)
+    return keys, invalid
+
+
+def summarise_keys(keys: List[int], bits: int) -> List[str]:
+    """
+    Aggregate integer subnet keys from :func:`.parse_many`, and return them as the smallest list of CIDR strings
+    covering them. ``keys`` is sorted in-place.
+    """
+    keys.sort()
+    out, fmt = [], format_cidr
+    cur_start, cur_end = None, -2
+    for key in keys:
+        start = key >> 8
+        end = start + (1 << (bits - (key & 255))) - 1
+        if start <= cur_end + 1:
+            if end > cur_end:
+                cur_end = end
+            continue
+        if cur_start is not None:
+            out.append((cur_start, cur_end))
+        cur_start, cur_end = start, end
+    if cur_start is not None:
+        out.append((cur_start, cur_end))
+
+    res = []
+    for start, end in out:
+        size = end - start + 1
+        # Most merged ranges are still a single aligned block, which doesn't need splitting
+        if size & (size - 1) == 0 and start & (size - 1) == 0:
+            res.append(fmt(start, bits - size.bit_length() + 1, bits))
+            continue
+        res += [fmt(net, prefix, bits) for net, prefix in range_to_cidrs(start, end, bits)]
+    return res
+
+
+def _summarise_ranges_np(starts: Sequence[int], ends: Sequence[int]) -> List[str]:
+    """Vectorised IPv4 implementation of :func:`.summarise_ranges` - each pass splits one CIDR off every range"""
+    np = numpy
+    s, e = np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64)
+    order = np.argsort(s, kind='stable')
+    s, e = s[order], e[order]
+    # A range starts a new merged group if it begins after the furthest end of every range before it
+    new_group = np.ones(len(s), dtype=bool)
+    new_group[1:] = s[1:] > np.maximum.accumulate(e)[:-1] + 1
+    idx = np.flatnonzero(new_group)
+    s, e = s[idx], np.maximum.reduceat(np.maximum.accumulate(e), idx)
+
+    nets, sizes = [], []
+    while len(s) > 0:
+        remaining = e - s + 1
+        # The largest power of two <= remaining (log2 is exact enough below 2**33, but is corrected just in case)
+        fit = np.left_shift(1, np.floor(np.log2(remaining)).astype(np.int64))
+        fit = np.where(fit > remaining, fit >> 1, fit)
+        fit = np.where(fit * 2 <= remaining, fit * 2, fit)
+        align = np.where(s == 0, 1 << 32, s & -s)
+        size = np.minimum(align, fit)
+        nets.append(s)
+        sizes.append(size)
+        s = s + size
+        keep = s <= e
+        s, e = s[keep], e[keep]
+
+    nets, sizes = np.concatenate(nets), np.concatenate(sizes)
+    order = np.argsort(nets, kind='stable')
+    prefixes = 32 - np.log2(sizes[order]).round().astype(np.int64)
+    return [format_cidr(n, p, 32) for n, p in zip(nets[order].tolist(), prefixes.tolist())]
+
+
+def summarise_ranges(starts: Sequence[int], ends: Sequence[int], bits: int, use_numpy: bool = None) -> List[str]:
+    """
+    Aggregate integer ``(start, end)`` ranges given as two parallel sequences, and return them as the smallest list
+    of CIDR strings covering them.
+
+        >>> summarise_ranges([167772160, 167772416], [167772415, 167772671], 32)
+        ['10.0.0.0/23']
+
+    :param bool use_numpy: Use the vectorised NumPy implementation (IPv4 only). Default: if NumPy is installed
+    """
+    use_numpy = HAS_NUMPY if use_numpy is None else use_numpy
+    if use_numpy and bits == 32 and len(starts) > 0:
+        if not HAS_NUMPY:
+            raise ImportError("summarise_ranges(use_numpy=True) requires NumPy - install it with: pip3 install numpy")
+        return _summarise_ranges_np(starts, ends)
+    return summarise(zip(starts, ends), bits)
+
+
+NETWORK = Union[IPv4Network, IPv6Network]
+
+
+@lru_cache(maxsize=65536)
+def key_network(key: int, bits: int) -> NETWORK:
+    """
+    Convert an integer network key (``network << 8 | prefix_length``) into an :mod:`ipaddress` network object.
+    Results are cached, so repeated networks share the same object.
+    """
+    return (IPv4Network if bits == 32 else IPv6Network)((key >> 8, key & 255))
+
+
+class NetworkList:
+    """
+    A compact list of IPv4 or IPv6 networks, stored as integer keys (``network << 8 | prefix_length``) - in an
+    ``array`` for IPv4, as IPv6 keys don't fit in a 64-bit integer.
+
+    Indexing / iterating returns :mod:`ipaddress` network objects (created on demand, see :func:`.key_network`),
+    while :py:meth:`.cidrs` and :py:meth:`.entries` format the networks as strings without creating any objects.
+
+        >>> v4, v6 = parse_networks(['10.0.0.0/8', '1.2.3.4', '2a07:e00::/32'])
+        >>> len(v4), v4[1], v4.cidrs()
+        (2, IPv4Network('1.2.3.4/32'), ['10.0.0.0/8', '1.2.3.4/32'])
+        >>> v4.entries()
+        ['10.0.0.0/8', '1.2.3.4']
+
+    """
+    __slots__ = ('bits', 'keys')
+
+    def __init__(self, bits: int = 32, keys: Iterable[int] = None):
+        self.bits = bits
+        self.keys = array('Q') if bits == 32 else []
+        if keys is not None:
+            self.keys.extend(keys)
+
+    def append(self, network: NETWORK):
+        self.keys.append(int(network.network_address) << 8 | network.prefixlen)
+
+    def extend(self, networks: Iterable[NETWORK]):
+        if isinstance(networks, NetworkList):
+            self.keys.extend(networks.keys)
+            return
+        for n in networks:
+            self.append(n)
+
+    def cidrs(self) -> List[str]:
+        """The networks as strings, always with a prefix length (the same as ``str(network)``)"""
+        if self.bits == 128:
+            # inet_ntop's IPv6 formatting can differ slightly from ipaddress (e.g. IPv4 mapped addresses)
+            return [str(n) for n in self]
+        ntop, to_bytes = _inet_ntop, int.to_bytes
+        return [f'{ntop(AF_INET, to_bytes(k >> 8, 4, "big"))}/{k & 255}' for k in self.keys]
+
+    def entries(self) -> List[str]:
+        """The networks as strings, with single addresses output without a prefix length"""
+        if self.bits == 128:
+            return [str(n.network_address) if n.prefixlen == 128 else str(n) for n in self]
+        return [format_cidr(k >> 8, k & 255, 32) for k in self.keys]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return NetworkList(self.bits, self.keys[item])
+        return key_network(self.keys[item], self.bits)
+
+    def __iter__(self) -> Iterator[NETWORK]:
+        bits = self.bits
+        return (key_network(k, bits) for k in self.keys)
+
+    def __iadd__(self, other: Iterable[NETWORK]):
+        self.extend(other)
+        return self
+
+    def __eq__(self, other):
+        if isinstance(other, NetworkList):
+            return self.bits == other.bits and list(self.keys) == list(other.keys)
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return f'NetworkList({self.bits}, {self.cidrs()!r})'
+
+
+def parse_networks(entries: Iterable[str], strict=False) -> Tuple[NetworkList, NetworkList]:
+    """
+    Parse IPv4 / IPv6 addresses and CIDR subnets into a :class:`.NetworkList` per IP version, in the same order.
+
+    Behaves like :func:`ipaddress.ip_network` for each entry - rarer forms (e.g. ``10.0.0.0/255.0.0.0``) are
+    passed to it directly.
+
+    :param bool strict: If ``True``, subnets with host bits set raise an error instead of being masked off
+    :raises ValueError: If an entry isn't a valid address / subnet (or has host bits set in strict mode)
+    :return tuple networks: ``(v4, v6)`` - two :class:`.NetworkList`'s
+    """
+    v4, v6 = NetworkList(32), NetworkList(128)
+    add4, add6, pton, from_bytes = v4.keys.append, v6.keys.append, _inet_pton, _from_bytes
+    for entry in entries:
+        addr, slash, prefix = entry.partition('/')
+        v6_entry = ':' in addr
+        bits = 128 if v6_entry else 32
+        try:
+            net = from_bytes(pton(AF_INET6 if v6_entry else AF_INET, addr), 'big')
+            prefix = int(prefix) if slash and prefix.isdigit() else (bits if not slash else -1)
+            if prefix < 0 or prefix > bits:
+                raise ValueError
+        except (OSError, ValueError):
+            n = ip_network(entry, strict=strict)
+            (v6 if n.version == 6 else v4).append(n)
+            continue
+        masked = net & ~((1 << (bits - prefix)) - 1)
+        if strict and masked != net:
+            raise ValueError(f'{entry} has host bits set')
+        (add6 if v6_entry else add4)(masked << 8 | prefix)
+    return v4, v6
@@ -0,0 +1,95 @@
+"""
+A thread-safe, reentrant API for compiling Pyre rules - for embedding Pyrewall in other applications, e.g. a policy
+service compiling many tenants' rules concurrently from a thread pool.
+
+Each call to :func:`.compile_pyre` uses its own :class:`.PyreParser` / :class:`.RuleParser` instances, and the parsers
+never modify any module or class level state (the handler tables such as :py:attr:`.RuleParser.rule_handlers` are
+only read). Everything which affects the output is passed in a :class:`.CompileContext`, rather than read from the
+global :mod:`privex.pyrewall.conf` at compile time.
+
+Basic usage:
+
+    >>> ctx = CompileContext(strict=True, search_dirs=['/srv/tenants/acme'])
+    >>> res = compile_pyre('@chain INPUT DROP\\nallow port 22 from 10.0.0.0/8', ctx)
+    >>> res.v4
+    ['*filter', ':INPUT DROP [0:0]', ':FORWARD ACCEPT [0:0]', ':OUTPUT ACCEPT [0:0]',
+     '-A INPUT -p tcp --dport 22 -s 10.0.0.0/8 -j ACCEPT', 'COMMIT', '### End of table filter ###']
+
+    >>> from concurrent.futures import ThreadPoolExecutor
+    >>> with ThreadPoolExecutor(8) as pool:
+    ...     results = list(pool.map(lambda src: compile_pyre(src, ctx), tenant_sources))
+
+"""
+from collections import namedtuple
+from typing import List, Optional, Union, Dict, Any
+from privex.pyrewall.PyreParser import PyreParser
+
+CompileResult = namedtuple('CompileResult', 'v4 v6 ipsets files')
+"""
+The result of :func:`.compile_pyre` - ``v4`` / ``v6`` are the iptables-restore lines as ``List[str]`` (or the nftables
+script and an empty list with the ``nft`` backend), ``ipsets``
+is :py:attr:`.PyreParser.ipsets` (``None`` if no sets are needed), and ``files`` is the list of files read
+(e.g. by ``@import``).
+"""
+
+
+class CompileContext:
+    """
+    The settings for compiling Pyre rules with :func:`.compile_pyre`. A context is never modified by compiling,
+    so one context can be shared by any number of concurrent compilations.
+    """
+    strict: bool
+    """Raise errors for unknown keywords / invalid ports etc. instead of skipping them"""
+    search_dirs: Optional[List[str]]
+    """The directories searched for ``@import`` / ``@blocklist`` etc. files (default: ``conf.SEARCH_DIRS``)"""
+    line_cache: Optional[dict]
+    """
+    An optional :py:attr:`.PyreParser.line_cache` shared by every compilation using this context. The cache is only
+    ever updated with single dict operations, so it's safe to share between threads.
+    """
+    backend: Optional[str]
+    """The output backend - ``iptables`` or ``nft`` (see :mod:`privex.pyrewall.emitters`, default: ``conf.BACKEND``)"""
+
+    def __init__(self, strict=False, search_dirs: List[str] = None, line_cache: dict = None, backend: str = None):
+        self.strict = strict
+        self.search_dirs = None if search_dirs is None else list(search_dirs)
+        self.line_cache = line_cache
+        self.backend = backend
+
+    def __repr__(self):
+        return f'CompileContext(strict={self.strict!r}, search_dirs={self.search_dirs!r}, backend={self.backend!r})'
+
+
+DEFAULT_CONTEXT = CompileContext()
+
+
+def compile_pyre(source: Union[str, List[str]], context: CompileContext = None,
+                 variables: Dict[str, Any] = None) -> CompileResult:
+    """
+    Compile Pyre rules into iptables-restore lines. Safe to call concurrently from multiple threads.
+
+    :param source: The Pyre rules, as either a string or a list of lines
+    :param CompileContext context: The settings to compile with (default: :attr:`.DEFAULT_CONTEXT`)
+    :param dict variables: Variables for ``$name`` substitution / ``@if`` (see :py:attr:`.PyreParser.variables`)
+    :raises RuleSyntaxError: (and other :class:`.PyreException`'s) when the rules are invalid
+    :return CompileResult res: The compiled rules
+    """
+    context = DEFAULT_CONTEXT if context is None else context
+    lines = source.splitlines() if isinstance(source, str) else list(source)
+    p = PyreParser(
+        line_cache=context.line_cache, search_dirs=context.search_dirs, variables=variables, strict=context.strict,
+        emitter=context.backend
+    )
+    v4, v6 = p.parse_lines(lines)
+    return CompileResult(v4=v4, v6=v6, ipsets=p.ipsets, files=list(p.files))
+
+
+def compile_file(path: str, context: CompileContext = None, variables: Dict[str, Any] = None) -> CompileResult:
+    """Compile the Pyre file ``path`` (absolute path) with :func:`.compile_pyre`"""
+    context = DEFAULT_CONTEXT if context is None else context
+    p = PyreParser(
+        line_cache=context.line_cache, search_dirs=context.search_dirs, variables=variables, strict=context.strict,
+        emitter=context.backend
+    )
+    v4, v6 = p.parse_file(path)
+    return CompileResult(v4=v4, v6=v6, ipsets=p.ipsets, files=list(p.files))
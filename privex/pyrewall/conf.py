@@ -1,6 +1,6 @@
 import logging
 from os.path import join, dirname, abspath
-from os import getenv as env, getcwd
+from os import getenv as env, getcwd, cpu_count
 from privex.helpers import env_csv, env_bool
 import dotenv
 
@@ -13,6 +13,8 @@ BASE_DIR = dirname(dirname(dirname(abspath(__file__))))
 
 SERVICE_FILE = join(PKG_DIR, 'files', 'pyrewall.service')
 SERVICE_FILE_DEST = '/etc/systemd/system/pyrewall.service'
+DAEMON_SERVICE_FILE = join(PKG_DIR, 'files', 'pyrewall-daemon.service')
+DAEMON_SERVICE_FILE_DEST = '/etc/systemd/system/pyrewall-daemon.service'
 
 CONF_DIRS = [
     '/etc/pyrewall',
@@ -70,6 +72,14 @@ These will be searched for in order, within each :attr:`.SEARCH_DIRS`, until a m
 
 MAIN_PYRE = env_csv('MAIN_PYRE', MAIN_PYRE)
 
+STATE_DIR = env('STATE_DIR', '~/.pyrewall')
+"""Folder used for Pyrewall's runtime state, such as rule backups and the apply lock / queue"""
+
+SNAPSHOT_RETAIN = int(env('SNAPSHOT_RETAIN', 30))
+"""Maximum number of rule snapshots to keep in the snapshot store (``STATE_DIR/snapshots``)"""
+SNAPSHOT_COMPRESS = int(env('SNAPSHOT_COMPRESS', 6))
+"""gzip compression level (1 to 9) used for snapshot store objects"""
+
 # Valid environment log levels (from least to most severe) are:
 # DEBUG, INFO, WARNING, ERROR, FATAL, CRITICAL
 LOG_LEVEL = env('LOG_LEVEL', None)
@@ -78,6 +88,82 @@ LOG_LEVEL = logging.getLevelName(str(LOG_LEVEL).upper()) if LOG_LEVEL is not Non
 if LOG_LEVEL is None:
     LOG_LEVEL = logging.DEBUG if DEBUG else logging.INFO
 
+IPT4_SAVE = env('IPT4_SAVE', 'iptables-save')
+IPT6_SAVE = env('IPT6_SAVE', 'ip6tables-save')
+IPT4_RESTORE = env('IPT4_RESTORE', 'iptables-restore')
+IPT6_RESTORE = env('IPT6_RESTORE', 'ip6tables-restore')
+"""
+The names (or absolute paths) of the iptables save/restore binaries used by :func:`.save_rules` and :func:`.load_rules`.
+
+Mostly useful for pointing Pyrewall at a wrapper script, or a fake binary while testing.
+"""
+
+IPSET_BIN = env('IPSET_BIN', 'ipset')
+
+BACKEND = env('BACKEND', 'iptables')
+"""
+The default firewall backend which Pyre rules are compiled for (see :mod:`privex.pyrewall.emitters`) - either
+``iptables`` (iptables-restore + ipset) or ``nft`` (a single nftables ``inet`` table, applied with ``nft -f``)
+"""
+NFT_BIN = env('NFT_BIN', 'nft')
+"""The name (or absolute path) of the ``nft`` binary used by :func:`.load_nft`"""
+NFT_TABLE = env('NFT_TABLE', 'pyrewall')
+"""The name of the ``inet`` table which the ``nft`` backend generates, replacing it on every load"""
+
+NETNS_DIR = env('NETNS_DIR', '/var/run/netns')
+"""The folder where ``ip netns`` stores named network namespaces"""
+NETNS_WORKERS = int(env('NETNS_WORKERS', 16))
+"""Maximum number of network namespaces to apply rules into concurrently with ``pyre load --netns``"""
+FLEET_WORKERS = int(env('FLEET_WORKERS', cpu_count() or 1))
+"""Number of worker processes used by ``pyre build-fleet`` to compile the rules of each host (default: CPU count)"""
+
+DAEMON_DEBOUNCE = float(env('DAEMON_DEBOUNCE', 0.5))
+"""Seconds without any further file changes before ``pyre daemon`` reloads the rules"""
+DAEMON_DEBOUNCE_MAX = float(env('DAEMON_DEBOUNCE_MAX', 5.0))
+"""Maximum seconds ``pyre daemon`` will delay a reload while changes keep arriving"""
+
+API_SOCKET = env('API_SOCKET', join(STATE_DIR, 'api.sock'))
+"""The Unix socket which ``pyre daemon --api`` serves the dynamic rule API on"""
+API_BATCH_INTERVAL = float(env('API_BATCH_INTERVAL', 0.2))
+"""Seconds between each batched commit of queued dynamic rule API changes into the kernel"""
+API_BAN_SET = env('API_BAN_SET', 'pyre-ban')
+API_ALLOW_SET = env('API_ALLOW_SET', 'pyre-allow')
+"""
+Names of the ipsets used by the dynamic rule API's ``ban`` / ``allow`` operations. The IPv6 sets have ``6``
+appended to the name, e.g. ``pyre-ban6``.
+"""
+BLOCKLIST_MAXELEM = int(env('BLOCKLIST_MAXELEM', 4194304))
+"""
+The ``maxelem`` of the ipsets created by ``@blocklist`` directives - the maximum amount of (aggregated) subnets in
+a single blocklist. It's the same for every blocklist, as a set can't be re-created with different options.
+"""
+LOG_RULE_RATE = env('LOG_RULE_RATE', '10/minute')
+"""The default rate limit of the packets logged by a ``log`` rule (``rate`` overrides it per rule)"""
+LOG_RULE_BURST = int(env('LOG_RULE_BURST', 5))
+"""The default burst of packets logged by a ``log`` rule before :attr:`.LOG_RULE_RATE` applies"""
+NFLOG_THRESHOLD = int(env('NFLOG_THRESHOLD', 20))
+"""
+The default number of packets an ``nflog`` rule queues in the kernel before sending them to userspace in one batch
+(``threshold`` overrides it per rule)
+"""
+BALANCE_MARK_OFFSET = int(env('BALANCE_MARK_OFFSET', 0x10000))
+"""
+The first packet mark set by the HMARK rule of ``balance ... mode hash`` rules (iptables backend) - each backend gets
+the marks from this value up to its weight. Change it if it clashes with the marks used by your other rules.
+"""
+
+XTABLES_WAIT = int(env('XTABLES_WAIT', 10))
+"""
+Maximum amount of seconds that ``iptables-restore --wait`` will block for while another program holds the
+xtables lock. Set to ``0`` to disable passing ``--wait`` entirely.
+"""
+XTABLES_RETRIES = int(env('XTABLES_RETRIES', 3))
+"""How many times to retry an iptables command which failed due to xtables lock contention"""
+XTABLES_BACKOFF = float(env('XTABLES_BACKOFF', 0.5))
+"""Base delay (in seconds) for the jittered exponential backoff between xtables lock retries"""
+XTABLES_BACKOFF_MAX = float(env('XTABLES_BACKOFF_MAX', 8.0))
+"""Upper limit (in seconds) for any single backoff delay between xtables lock retries"""
+
 EXTENSION_TYPES = {
     FILE_SUFFIX: 'pyre',
     IPT4_SUFFIX: 'ip4',
@@ -95,6 +181,17 @@ DEFAULT_CHAINS = {
         'INPUT': ['ACCEPT', '[0:0]'],
         'OUTPUT': ['ACCEPT', '[0:0]'],
         'POSTROUTING': ['ACCEPT', '[0:0]'],
-    }
+    },
+    'raw': {
+        'PREROUTING': ['ACCEPT', '[0:0]'],
+        'OUTPUT': ['ACCEPT', '[0:0]'],
+    },
+    'mangle': {
+        'PREROUTING': ['ACCEPT', '[0:0]'],
+        'INPUT': ['ACCEPT', '[0:0]'],
+        'FORWARD': ['ACCEPT', '[0:0]'],
+        'OUTPUT': ['ACCEPT', '[0:0]'],
+        'POSTROUTING': ['ACCEPT', '[0:0]'],
+    },
 }
 
@@ -1,10 +1,13 @@
+import random
+import re
 import subprocess
 import sys
+import time
 from collections import namedtuple
 from os.path import join, expanduser
 from typing import List, Union
 from privex.helpers import run_sync, byteify, empty, stringify
-from privex.pyrewall.exceptions import InvalidPort, IPTablesError, ReturnCodeError
+from privex.pyrewall.exceptions import InvalidPort, IPTablesError, ReturnCodeError, XTablesLockError, RuleSyntaxError
 from privex.pyrewall import conf
 from subprocess import PIPE, STDOUT
 import logging
@@ -34,7 +37,8 @@ def find_file(filename: str, paths: List[str] = None, extensions=None) -> str:
     :return str path: If the file was found, returns an absolute path to the matched file
     """
 
-    extensions = conf.SEARCH_EXTENSIONS if not extensions else extensions
+    # Copied, so that appending '' below doesn't modify the caller's list (or conf.SEARCH_EXTENSIONS)
+    extensions = list(conf.SEARCH_EXTENSIONS if not extensions else extensions)
     paths = conf.SEARCH_DIRS if not paths else paths
 
     if '' not in extensions:
@@ -86,6 +90,26 @@ def valid_port(port: Union[str, int]) -> int:
         raise InvalidPort(f'Port number "{port}" is not a valid port number')
 
 
+_duration_units = dict(s=1, m=60, h=3600, d=86400, w=604800)
+_rgx_duration = re.compile(r'([0-9]+)([smhdw]?)')
+
+
+def parse_duration(duration: str) -> int:
+    """
+    Convert a human duration such as ``30m``, ``1h30m`` or ``90`` (seconds) into an integer amount of seconds
+
+        >>> parse_duration('1h30m')
+        5400
+
+    :raises RuleSyntaxError: If ``duration`` isn't a valid duration
+    """
+    duration = str(duration).strip().lower()
+    parts = _rgx_duration.findall(duration)
+    if len(parts) == 0 or ''.join(n + u for n, u in parts) != duration:
+        raise RuleSyntaxError(f'"{duration}" is not a valid duration - expected e.g. "90s", "30m", "1h30m" or "2d"')
+    return sum(int(n) * _duration_units[u if u != '' else 's'] for n, u in parts)
+
+
 def columnize(items, displaywidth=80):
     """Display a items of strings as a compact set of columns.
 
@@ -179,11 +203,112 @@ def run_prog_ex(prog: str, *args, write=None, **kwargs):
     return res
 
 
+XTablesResult = namedtuple('XTablesResult', 'stdout stderr code waited retries')
+"""
+Returned by :func:`.run_xtables` - same fields as :class:`.ProcResult`, plus ``waited`` (seconds spent running every
+attempt - including any time blocked on the xtables lock by ``--wait`` - plus backoff sleeps) and ``retries``
+(number of times the command was re-ran).
+"""
+
+XTABLES_LOCK_MSGS = ['xtables lock', 'Another app is currently holding']
+
+
+def is_ipv4(ipver) -> bool:
+    return ipver in ['v4', '4', 'ipv4', 4]
+
+
+def sudo_prefix() -> List[str]:
+    """Returns ``['sudo', '-n']`` if we aren't running as root, otherwise an empty list"""
+    return [] if is_root() else ['sudo', '-n']
+
+
+def netns_prefix(netns: str = None) -> List[str]:
+    """Returns the command prefix for running a command within the network namespace ``netns`` (if not ``None``)"""
+    return [] if netns is None else ['ip', 'netns', 'exec', netns]
+
+
+def xtables_locked(res: ProcResult) -> bool:
+    """Returns ``True`` if a :class:`.ProcResult` appears to have failed due to another process holding the xtables lock"""
+    if res.code == 0:
+        return False
+    out = stringify(res.stdout if res.stdout is not None else '') + stringify(res.stderr if res.stderr is not None else '')
+    return any(m in out for m in XTABLES_LOCK_MSGS)
+
+
+def backoff_delay(attempt: int, base: float = None, cap: float = None) -> float:
+    """
+    Calculate the "full jitter" exponential backoff delay for a given (zero-indexed) retry ``attempt``, i.e.
+    a random amount of seconds between ``0`` and ``min(cap, base * 2 ** attempt)``
+
+        >>> 0 <= backoff_delay(3, base=0.5, cap=8.0) <= 4.0
+        True
+
+    """
+    base = conf.XTABLES_BACKOFF if base is None else base
+    cap = conf.XTABLES_BACKOFF_MAX if cap is None else cap
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def run_xtables(cmd: List[str], *args, write=None, wait: int = None, retries: int = None,
+                use_wait=True, **kwargs) -> XTablesResult:
+    """
+    Run an iptables binary (``cmd`` - e.g. ``['sudo', '-n', 'iptables-restore']``) with the arguments ``args``,
+    handling xtables lock contention gracefully.
+
+     - If ``use_wait`` is True and ``wait`` is above zero, ``--wait [wait]`` is passed to the binary, so that it
+       blocks for up to ``wait`` seconds for the xtables lock instead of failing instantly.
+     - If the command still fails because the lock is held, it's retried up to ``retries`` times, sleeping
+       for a jittered exponential backoff (see :func:`.backoff_delay`) between each attempt.
+
+    Usage:
+
+        >>> res = run_xtables(['iptables-restore'], write="*filter\nCOMMIT\n")
+        >>> res.code, res.retries
+        (0, 0)
+
+    :param List[str] cmd: The command to run, with the iptables binary as the last item
+    :param args: Extra arguments to pass after the binary (and after ``--wait``)
+    :param write: Optionally write this string/bytes into the command's stdin
+    :param int wait: Seconds for ``--wait`` (default: :attr:`.conf.XTABLES_WAIT`)
+    :param int retries: Maximum retries on lock contention (default: :attr:`.conf.XTABLES_RETRIES`)
+    :param bool use_wait: Pass ``False`` for binaries which don't support ``--wait`` (e.g. ``iptables-save``)
+    :raises XTablesLockError: When the lock still couldn't be obtained after ``retries`` retries
+    :return XTablesResult res: The result of the final attempt, plus lock wait statistics
+    """
+    wait = conf.XTABLES_WAIT if wait is None else int(wait)
+    retries = conf.XTABLES_RETRIES if retries is None else int(retries)
+    cmd = list(cmd)
+    if use_wait and wait > 0:
+        cmd += ['--wait', str(wait)]
+    cmd += list(args)
+
+    waited, attempt = 0.0, 0
+    while True:
+        started = time.monotonic()
+        res = run_prog(*cmd, write=write, **kwargs)
+        # Every attempt is timed, as a successful attempt may have spent most of its time blocked by --wait
+        waited += time.monotonic() - started
+        if not xtables_locked(res):
+            return XTablesResult(stdout=res.stdout, stderr=res.stderr, code=res.code, waited=waited, retries=attempt)
+
+        if attempt >= retries:
+            log.error("Gave up waiting for the xtables lock after %d retries (%.2f seconds) - command: %s",
+                      attempt, waited, cmd)
+            raise XTablesLockError(
+                f"Could not obtain the xtables lock after {attempt} retries ({waited:.2f} seconds) - command: {cmd}"
+            )
+        delay = backoff_delay(attempt)
+        log.warning("xtables lock is held by another process. Retrying in %.2f seconds (retry %d of %d)",
+                    delay, attempt + 1, retries)
+        time.sleep(delay)
+        waited += delay
+        attempt += 1
+
+
 def save_rules(ipver='v4') -> List[str]:
-    cmd = [] if is_root() else ['sudo', '-n']
-    cmd += ['iptables-save'] if ipver in ['v4', '4', 'ipv4', 4] else ['ip6tables-save']
+    cmd = sudo_prefix() + [conf.IPT4_SAVE if is_ipv4(ipver) else conf.IPT6_SAVE]
     
-    res = run_prog(*cmd)
+    res = run_xtables(cmd, use_wait=False)
     
     if res.code != 0:
         log.error(f"ERROR! Non-zero return code ({res.code}) from command: {cmd}")
@@ -194,21 +319,33 @@ def save_rules(ipver='v4') -> List[str]:
     return stringify(res.stdout).split("\n")
 
 
-def load_rules(rules: Union[str, list], ipver='v4'):
-    cmd = [] if is_root() else ['sudo', '-n']
-    cmd += ['iptables-restore'] if ipver in ['v4', '4', 'ipv4', 4] else ['ip6tables-restore']
+def load_rules(rules: Union[str, bytes, list], ipver='v4', noflush=False, netns: str = None) -> XTablesResult:
+    """
+    Load rules into the kernel using ``iptables-restore`` / ``ip6tables-restore``
+
+    :param rules: Either a ``str`` path to an iptables-restore file, the raw ``bytes`` of an iptables-restore payload,
+                  or a ``List[str]`` of iptables-restore lines.
+    :param str ipver: The IP version of the rules - ``v4`` or ``v6``
+    :param bool noflush: Pass ``--noflush`` so that only the chains/rules mentioned in ``rules`` are changed
+    :param str netns: Load the rules into this network namespace (using ``ip netns exec``) instead of the current one
+    """
+    cmd = sudo_prefix() + netns_prefix(netns) + [conf.IPT4_RESTORE if is_ipv4(ipver) else conf.IPT6_RESTORE]
+    if noflush:
+        cmd += ['--noflush']
     
-    if isinstance(rules, str):
-        cmd += [rules]
+    if isinstance(rules, bytes):
+        log.info("Restoring %d byte IPTables payload using command %s", len(rules), cmd)
+        res = run_xtables(cmd, write=rules)
+    elif isinstance(rules, str):
         log.info("Restoring IPTables file %s using command %s", rules, cmd)
-        res = run_prog(*cmd)
+        res = run_xtables(cmd, rules)
         
         # print(f"Rules file {rules} appeared to restore successfully :)\n", file=sys.stderr)
     else:
         rule_list = list(rules)
         rule_list = [r.strip("\n").strip() for r in rule_list if not empty(r.strip("\n").strip())]
         l_rules = "\n".join(rule_list)
-        res = run_prog(*cmd, write=l_rules)
+        res = run_xtables(cmd, write=l_rules)
 
     if res.code != 0:
         log.error(f"ERROR! Non-zero return code ({res.code}) from command: {cmd}")
@@ -219,12 +356,46 @@ def load_rules(rules: Union[str, list], ipver='v4'):
     log.debug(f"Got successful (zero) exit code from command: {cmd}")
     log.debug("Command stdout: %s", res.stdout)
     log.debug("Command stderr: %s", res.stderr)
+    if res.retries > 0:
+        log.info("xtables lock was contended - waited %.2f seconds over %d retries", res.waited, res.retries)
     
     return res
 
+
+def load_ipsets(lines: Union[List[str], bytes], netns: str = None) -> ProcResult:
+    """
+    Load ``ipset restore`` lines (e.g. ``create``, ``add``, ``swap``) into the kernel
+
+    :param lines: A ``List[str]`` of ipset restore lines, or the raw ``bytes`` of an ipset restore payload
+    :param str netns: Load the sets into this network namespace (using ``ip netns exec``) instead of the current one
+    """
+    cmd = sudo_prefix() + netns_prefix(netns) + [conf.IPSET_BIN, 'restore']
+    res = run_prog(*cmd, write=lines if isinstance(lines, bytes) else "\n".join(lines) + "\n")
     
+    if res.code != 0:
+        log.error(f"ERROR! Non-zero return code ({res.code}) from command: {cmd}")
+        log.error("Command stdout: %s", res.stdout)
+        log.error("Command stderr: %s", res.stderr)
+        raise IPTablesError(f"Non-zero return code ({res.code}) from command: {cmd}")
     
-    
-    
-    
+    return res
+
+
+def load_nft(lines: Union[List[str], bytes], netns: str = None) -> ProcResult:
+    """
+    Load an nftables script (e.g. from :class:`.NFTEmitter`) into the kernel with ``nft -f -``. The whole script is
+    applied as a single transaction - if any line fails, nothing is changed.
+
+    :param lines: A ``List[str]`` of nftables script lines, or the raw ``bytes`` of an nftables script
+    :param str netns: Load the script into this network namespace (using ``ip netns exec``) instead of the current one
+    """
+    cmd = sudo_prefix() + netns_prefix(netns) + [conf.NFT_BIN, '-f', '-']
+    res = run_prog(*cmd, write=lines if isinstance(lines, bytes) else "\n".join(lines) + "\n")
 
+    if res.code != 0:
+        log.error(f"ERROR! Non-zero return code ({res.code}) from command: {cmd}")
+        log.error("Command stdout: %s", res.stdout)
+        log.error("Command stderr: %s", res.stderr)
+        raise IPTablesError(f"Non-zero return code ({res.code}) from command: {cmd}")
+
+    return res
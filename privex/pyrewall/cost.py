@@ -0,0 +1,404 @@
+"""
+Static analysis of how much work compiled rules give the kernel - used by ``pyre parse --cost``, to spot a ruleset
+which will be slow (or large) before it's loaded, rather than from the softirq CPU usage after.
+
+For every chain of each IP version, :py:meth:`.RuleCost.report` works out:
+
+ - **worst** - the most rules a packet entering the chain can evaluate, i.e. when it matches nothing but the jumps
+   into user chains (which all return), or gets sent to the most expensive ``goto`` target.
+ - **average** - the rules evaluated per packet entering the chain, weighted by either a sample of flows (traced
+   through the ``filter`` table like ``pyre trace``, see :mod:`privex.pyrewall.trace`), or the packet counters of the
+   rules which are loaded (``iptables-save -c`` output). Without either, the average is None.
+ - **depth** - the deepest chain of jumps into user chains starting from the chain.
+
+    >>> c = RuleCost.from_file('/etc/pyrewall/rules.pyre')
+    >>> for line in format_cost(c.report(flows=read_flows('flows.csv')), c.footprint()):
+    ...     print(line)
+    # family table    chain                     rules  worst  average  depth
+    v4      filter   INPUT                         12     40     6.51      1
+    ...
+    # v4 kernel footprint: 14 rules in 2 tables, rule blob 3.1 KiB, counters 1.8 KiB (8 CPUs), ipsets 0 B, total 4.9 KiB
+
+:py:meth:`.RuleCost.footprint` estimates the kernel memory used by the rules with the x_tables (``iptables-legacy``)
+layout on 64-bit kernels: the size of each rule entry, match and target in the rule blob, the per-CPU packet counters,
+and the ipset elements. ``iptables-nft`` and ipset hash tables have their own overheads, so treat it as an estimate.
+
+"""
+import logging
+import os
+from collections import defaultdict, deque, namedtuple
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+from privex.pyrewall.PyreParser import PyreParser
+from privex.pyrewall.SaveParser import SaveParser
+from privex.pyrewall.trace import MAX_DEPTH, Flow, PacketTracer, _addr_int, _family, parse_flow, target_kind
+from privex.pyrewall.types import SavedRule
+
+log = logging.getLogger(__name__)
+
+ChainCost = namedtuple('ChainCost', 'ipver table chain rules worst average depth')
+"""
+The traversal cost of one chain (see the module docs). ``rules`` is the number of rules in the chain itself, ``worst``
+and ``average`` the rules evaluated per packet entering it (including the rules of the chains it jumps to), and
+``depth`` the deepest chain of jumps from it. ``average`` is None if there are no flows / counters for the chain.
+"""
+
+Footprint = namedtuple('Footprint', 'ipver rules tables blob counters sets total cpus')
+"""The estimated kernel memory (in bytes) used by the rules of one IP version (see :py:meth:`.RuleCost.footprint`)"""
+
+ENTRY_SIZE = dict(v4=112, v6=168)
+"""The size of a rule entry without its matches / target (``struct ipt_entry`` / ``struct ip6t_entry``)"""
+
+MATCH_HEADER = 32
+"""The size of the header before the data of each match / target (``struct xt_entry_match`` / ``xt_entry_target``)"""
+
+MATCH_SIZES = {
+    'tcp': 16, 'udp': 16, 'sctp': 40, 'icmp': 8, 'icmp6': 8, 'multiport': 48, 'conntrack': 168, 'state': 8,
+    'comment': 256, 'limit': 40, 'set': 48, 'recent': 232, 'connlimit': 32, 'hashlimit': 168, 'iprange': 72,
+    'mark': 16, 'connmark': 16, 'string': 160, 'length': 8, 'mac': 16, 'addrtype': 8, 'physdev': 72, 'time': 40,
+    'statistic': 24, 'tcpmss': 8, 'owner': 16, 'pkttype': 8, 'ttl': 8, 'hl': 8,
+}
+"""The (8 byte aligned) data size of the kernel structures of common match modules"""
+
+TARGET_SIZES = {
+    'standard': 8, 'ACCEPT': 8, 'DROP': 8, 'REJECT': 8, 'LOG': 32, 'NFLOG': 80, 'DNAT': 24, 'SNAT': 24,
+    'MASQUERADE': 24, 'REDIRECT': 24, 'MARK': 8, 'CONNMARK': 16, 'HMARK': 56, 'CT': 72, 'NOTRACK': 0, 'TCPMSS': 8, 'ERROR': 32,
+}
+"""The (8 byte aligned) data size of the kernel structures of common targets - ``standard`` is ACCEPT / DROP / jumps"""
+
+DEFAULT_SIZE = 32
+"""The data size assumed for matches / targets which aren't in :attr:`.MATCH_SIZES` / :attr:`.TARGET_SIZES`"""
+
+NAT_TARGETS = {'DNAT', 'SNAT', 'MASQUERADE', 'REDIRECT'}
+"""Targets which take a NAT range, which is larger in IPv6 rules"""
+
+NAT6_SIZE = 56
+"""The data size of the :attr:`.NAT_TARGETS` in IPv6 rules (``struct nf_nat_range2``)"""
+
+COUNTER_SIZE = 16
+"""The size of the packet / byte counters kept for each rule entry on each CPU"""
+
+SET_ENTRY_SIZE = dict(inet=16, inet6=40)
+"""The approximate size of an ipset ``hash:net`` element per family - plus 8 bytes for elements with a timeout"""
+
+BUILTIN_CHAINS = {'INPUT', 'FORWARD', 'OUTPUT', 'PREROUTING', 'POSTROUTING'}
+"""Chains which don't need an ``ERROR`` entry naming them in the rule blob"""
+
+
+def _entry_size(rule: SavedRule, kind: str, ipver: str) -> int:
+    """The estimated size of the kernel rule entry for ``rule`` (with its matches and target)"""
+    size = ENTRY_SIZE[ipver]
+    # '-p tcp --dport 22' adds an implicit tcp match, and port lists a multiport match
+    ports = [p for p in [rule.sports, rule.dports] if p is not None]
+    if len(ports) > 0:
+        module = 'multiport' if any(',' in p for p in ports) else (rule.protocol or '').lstrip('! ')
+        size += MATCH_HEADER + MATCH_SIZES.get(module, DEFAULT_SIZE)
+    for m in rule.matches:
+        tokens = m.split()
+        module = tokens[1] if len(tokens) > 1 and tokens[0] == '-m' else None
+        size += MATCH_HEADER + MATCH_SIZES.get(module, DEFAULT_SIZE)
+    name = None if rule.target is None else rule.target.split()[1]
+    if name is None or kind in ['jump', 'goto', 'return']:
+        # Rules without a target still get an empty standard target (XT_CONTINUE)
+        data = TARGET_SIZES['standard']
+    elif ipver == 'v6' and name in NAT_TARGETS:
+        data = NAT6_SIZE
+    else:
+        data = TARGET_SIZES.get(name, DEFAULT_SIZE)
+    return size + MATCH_HEADER + data
+
+
+class RuleCost:
+    """
+    Static traversal cost and kernel footprint of compiled rules (see the module docs).
+
+    :param dict rules: The iptables-restore lines per IP version, e.g. ``dict(v4=[...], v6=[...])``
+    :param dict ipsets: The ipsets used by the rules, e.g. from :py:attr:`.PyreParser.ipsets` (optional)
+    """
+    chains: Dict[str, Dict[Tuple[str, str], List[SavedRule]]]
+    """The rules of each ``(table, chain)`` per IP version - in the order they were declared"""
+
+    def __init__(self, rules: Dict[str, List[str]], ipsets: Dict[str, dict] = None):
+        self.lines, self.ipsets = rules, {} if ipsets is None else ipsets
+        self.chains, self.policies = {}, {}
+        for ipver, lines in rules.items():
+            sp = SaveParser(ipver)
+            parsed = [r for r, _ in sp.parse_lines(lines)]
+            chains = {k: [] for k in sp.chains.keys()}
+            for r in parsed:
+                chains.setdefault((r.table, r.chain), []).append(r)
+            self.chains[ipver] = chains
+            self.policies[ipver] = {k: c.policy for k, c in sp.chains.items() if c.policy != '-'}
+        self._tracer = None
+        # Caches per (ipver, table) / (ipver, table, chain) - the rules never change after loading
+        self._names, self._rule_jumps, self._worst, self._depth = {}, {}, {}, {}
+
+    @classmethod
+    def from_parser(cls, parser: PyreParser) -> 'RuleCost':
+        """Create a cost model for the rules of a :class:`.PyreParser` which has already parsed its rules"""
+        return cls(dict(v4=parser.output.v4, v6=parser.output.v6), parser.ipsets)
+
+    @classmethod
+    def from_file(cls, path: str, **parser_args) -> 'RuleCost':
+        """Compile the Pyre file ``path`` (with ``parser_args`` for the :class:`.PyreParser`), and create a cost model"""
+        p = PyreParser(**{**parser_args, 'emitter': 'iptables'})
+        p.parse_file(path)
+        return cls.from_parser(p)
+
+    def _kind(self, ipver: str, rule: SavedRule) -> str:
+        key = (ipver, rule.table)
+        if key not in self._names:
+            self._names[key] = {name for table, name in self.chains[ipver].keys() if table == rule.table}
+        return target_kind(rule.target, self._names[key])
+
+    def _jumps(self, ipver: str, table: str, chain: str) -> List[Tuple[SavedRule, str, Optional[str]]]:
+        """The rules of a chain with their kind, and the chain they jump / goto (or None)"""
+        key = (ipver, table, chain)
+        if key not in self._rule_jumps:
+            jumps = []
+            for r in self.chains[ipver].get((table, chain), []):
+                kind = self._kind(ipver, r)
+                jumps.append((r, kind, r.target.split()[1] if kind in ['jump', 'goto'] else None))
+            self._rule_jumps[key] = jumps
+        return self._rule_jumps[key]
+
+    def _cut_off(self, chain: str, _seen: tuple) -> bool:
+        """Whether following ``chain`` after the chains ``_seen`` would loop, or go past :attr:`.MAX_DEPTH` chains"""
+        if chain in _seen:
+            log.warning("Chain %s jumps back into itself (via %s) - not counting the loop", chain, ' > '.join(_seen))
+            return True
+        if len(_seen) >= MAX_DEPTH:
+            log.warning("Jumps from chain %s are nested over %d chains deep - not counting past chain %s",
+                        _seen[0], MAX_DEPTH, chain)
+            return True
+        return False
+
+    def worst(self, ipver: str, table: str, chain: str) -> int:
+        """The most rules a packet entering ``chain`` can evaluate, including the chains it jumps to"""
+        return self._worst_of(ipver, table, chain)[0]
+
+    def _worst_of(self, ipver: str, table: str, chain: str, _seen=()) -> Tuple[int, bool]:
+        """
+        Returns :py:meth:`.worst` for ``chain``, and whether it's complete. Results which hit a loop or the
+        :attr:`.MAX_DEPTH` cut-off depend on the path into ``chain``, so they're not cached.
+        """
+        key = (ipver, table, chain)
+        if key in self._worst:
+            return self._worst[key], True
+        if self._cut_off(chain, _seen):
+            return 0, False
+        running, most, complete = 0, 0, True
+        for r, kind, sub in self._jumps(ipver, table, chain):
+            running += 1
+            if kind not in ['jump', 'goto']:
+                continue
+            n, sub_complete = self._worst_of(ipver, table, sub, _seen + (chain,))
+            complete = complete and sub_complete
+            if kind == 'jump':
+                running += n
+            else:
+                most = max(most, running + n)
+        if complete:
+            self._worst[key] = max(most, running)
+        return max(most, running), complete
+
+    def depth(self, ipver: str, table: str, chain: str) -> int:
+        """The deepest chain of jumps / gotos into user chains starting from ``chain``"""
+        return self._depth_of(ipver, table, chain)[0]
+
+    def _depth_of(self, ipver: str, table: str, chain: str, _seen=()) -> Tuple[int, bool]:
+        """Returns :py:meth:`.depth` for ``chain``, and whether it's complete (see :py:meth:`._worst_of`)"""
+        key = (ipver, table, chain)
+        if key in self._depth:
+            return self._depth[key], True
+        if chain in _seen or len(_seen) >= MAX_DEPTH:
+            return 0, False
+        deepest, complete = 0, True
+        for s in {sub for _, _, sub in self._jumps(ipver, table, chain) if sub is not None}:
+            n, sub_complete = self._depth_of(ipver, table, s, _seen + (chain,))
+            deepest, complete = max(deepest, 1 + n), complete and sub_complete
+        if complete:
+            self._depth[key] = deepest
+        return deepest, complete
+
+    def flow_averages(self, flows: Iterable[Union[str, Flow]]) -> Dict[Tuple[str, str, str], float]:
+        """
+        The average number of rules evaluated per packet entering each chain of the ``filter`` table, for a sample of
+        ``flows`` (see :func:`.parse_flow` / :func:`.read_flows`). Returns ``{(ipver, 'filter', chain): average}``
+        for the chains which any of the flows entered.
+        """
+        if self._tracer is None:
+            self._tracer = PacketTracer(self.lines, ipsets=self.ipsets)
+        t, stats = self._tracer, defaultdict(lambda: [0, 0])
+        for flow in flows:
+            flow = parse_flow(flow) if isinstance(flow, str) else flow
+            ipver = _family(flow.src)
+            if ipver in t.rules:
+                self._walk(ipver, flow, flow.chain, _addr_int(flow.src), _addr_int(flow.dst), stats)
+        return {(ipver, 'filter', chain): n / entered for (ipver, chain), (entered, n) in stats.items()}
+
+    def _walk(self, ipver: str, flow: Flow, chain: str, src: int, dst: int, stats, depth=0) -> Tuple[int, bool]:
+        """
+        Walk ``flow`` through every rule of ``chain`` in order (unlike :py:meth:`.PacketTracer.trace`, which skips the
+        rules which can't match), returning the number of rules evaluated and whether a verdict was reached
+        """
+        t = self._tracer
+        evaluated, decided = 0, False
+        for i in t.chains[ipver].get(chain, []):
+            r = t.rules[ipver][i]
+            evaluated += 1
+            if r.kind == 'continue' or len(r.unsupported) > 0 or not t._matches(r, flow, src, dst):
+                continue
+            if r.kind == 'verdict':
+                decided = True
+                break
+            if r.kind == 'return':
+                break
+            if r.kind in ['jump', 'goto'] and depth < MAX_DEPTH:
+                n, decided = self._walk(ipver, flow, r.target, src, dst, stats, depth + 1)
+                evaluated += n
+                if decided or r.kind == 'goto':
+                    break
+        entry = stats[(ipver, chain)]
+        entry[0], entry[1] = entry[0] + 1, entry[1] + evaluated
+        return evaluated, decided
+
+    def counter_averages(self, ipver: str, saved: Iterable[str]) -> Dict[Tuple[str, str, str], float]:
+        """
+        The average number of rules evaluated per packet entering each chain, from the packet counters in ``saved``
+        (``iptables-save -c`` output for ``ipver``). Rules are matched to the loaded ones with :class:`.SaveParser`,
+        so equivalent rules count even if they're written differently - rules which aren't loaded count as never
+        matched. Returns ``{(ipver, table, chain): average}`` for the chains which any packets entered.
+        """
+        sp, counts = SaveParser(ipver), defaultdict(deque)
+        for r, c in sp.parse_lines(saved):
+            counts[r].append(0 if c is None else c[0])
+        matched = {
+            k: [counts[r].popleft() if len(counts[r]) > 0 else 0 for r in rules]
+            for k, rules in self.chains[ipver].items()
+        }
+        # Packets entering a user chain are the ones matching the rules which jump to it
+        entered = defaultdict(int)
+        for (table, chain), rules in self.chains[ipver].items():
+            for (r, kind, sub), m in zip(self._jumps(ipver, table, chain), matched[(table, chain)]):
+                if sub is not None:
+                    entered[(table, sub)] += m
+        for k, c in sp.chains.items():
+            if c.policy != '-' and k in self.chains[ipver]:
+                entered[k] = None
+        results = {}
+
+        def visit(table: str, chain: str, _seen=()) -> Tuple[Optional[float], float]:
+            """Returns the average cost of ``chain`` per packet entering it, and the share of packets it returns"""
+            key = (table, chain)
+            if key in results:
+                return results[key]
+            if chain in _seen or len(_seen) >= MAX_DEPTH:
+                return 0.0, 1.0
+            rules = list(self._jumps(ipver, table, chain))
+            subs = {sub: visit(table, sub, _seen + (chain,)) for _, _, sub in rules if sub is not None}
+            # How many of the packets matching each rule leave the chain there (or return to the caller)
+            left, returned = [], 0
+            for (r, kind, sub), m in zip(rules, matched[key]):
+                if kind in ['verdict', 'goto', 'return']:
+                    left.append(m)
+                    returned += m if kind == 'return' else (m * subs[sub][1] if kind == 'goto' else 0)
+                elif kind == 'jump':
+                    left.append(m * (1 - subs[sub][1]))
+                else:
+                    left.append(0)
+            total = entered[key]
+            if total is None:
+                # Built-in chains: every packet either left at a rule, or fell through to the policy
+                policy = sp.chains.get(key)
+                total = sum(left) + (0 if policy is None else policy.packets)
+            if total <= 0:
+                results[key] = None, 1.0
+                return results[key]
+            remaining, cost = total, 0.0
+            for (r, kind, sub), m, gone in zip(rules, matched[key], left):
+                cost += remaining
+                if sub is not None:
+                    cost += m * (subs[sub][0] or 0)
+                remaining = max(remaining - gone, 0)
+            results[key] = cost / total, min((remaining + returned) / total, 1.0)
+            return results[key]
+
+        for table, chain in self.chains[ipver].keys():
+            visit(table, chain)
+        return {(ipver,) + k: avg for k, (avg, _) in results.items() if avg is not None}
+
+    def report(self, flows: Iterable[Union[str, Flow]] = None, counters: Dict[str, Iterable[str]] = None) \
+            -> List[ChainCost]:
+        """
+        The :class:`.ChainCost` of every chain, per IP version. The averages are weighted by the sample of ``flows``
+        (see :py:meth:`.flow_averages`), and / or the ``iptables-save -c`` output per IP version in ``counters``
+        (see :py:meth:`.counter_averages`) - for the chains in both, the flows take priority.
+        """
+        averages = {}
+        for ipver, saved in ({} if counters is None else counters).items():
+            averages.update(self.counter_averages(ipver, saved))
+        if flows is not None:
+            averages.update(self.flow_averages(flows))
+        return [
+            ChainCost(ipver, table, chain, len(rules), self.worst(ipver, table, chain), averages.get((ipver, table, chain)),
+                      self.depth(ipver, table, chain))
+            for ipver, chains in self.chains.items() for (table, chain), rules in chains.items()
+        ]
+
+    def footprint(self, cpus: int = None) -> List[Footprint]:
+        """
+        The estimated kernel memory used by the rules of each IP version (see the module docs), with packet counters
+        for ``cpus`` CPUs (default: the CPUs of this machine)
+        """
+        cpus = (os.cpu_count() or 1) if cpus is None else cpus
+        results = []
+        for ipver, chains in self.chains.items():
+            tables = {table for table, _ in chains.keys()}
+            entry = ENTRY_SIZE[ipver]
+            blob, entries = 0, 0
+            for (table, chain), rules in chains.items():
+                blob += sum(_entry_size(r, self._kind(ipver, r), ipver) for r in rules)
+                # Every chain ends with its policy (or a RETURN), and user chains start with an ERROR entry naming them
+                blob += entry + MATCH_HEADER + TARGET_SIZES['standard']
+                entries += len(rules) + 1
+                if chain not in BUILTIN_CHAINS:
+                    blob += entry + MATCH_HEADER + TARGET_SIZES['ERROR']
+                    entries += 1
+            # ... and each table ends with an ERROR entry
+            blob += len(tables) * (entry + MATCH_HEADER + TARGET_SIZES['ERROR'])
+            entries += len(tables)
+            sets = 0
+            for s in self.ipsets.values():
+                family = s.get('family', 'inet')
+                if (family == 'inet6') != (ipver == 'v6'):
+                    continue
+                elements = s.get('entries', [])
+                if isinstance(elements, str):
+                    sets += len([e for e in elements.split('\n') if e.strip() != '']) * SET_ENTRY_SIZE[family]
+                else:
+                    sets += len(elements) * (SET_ENTRY_SIZE[family] + 8)
+            counters = entries * COUNTER_SIZE * cpus
+            rules = sum(len(r) for r in chains.values())
+            results.append(Footprint(ipver, rules, len(tables), blob, counters, sets, blob + counters + sets, cpus))
+        return results
+
+
+def _size(n: int) -> str:
+    for unit in ['B', 'KiB', 'MiB']:
+        if n < 1024 or unit == 'MiB':
+            return f'{n} {unit}' if unit == 'B' else f'{n:.1f} {unit}'
+        n /= 1024
+
+
+def format_cost(costs: List[ChainCost], footprints: List[Footprint] = None) -> List[str]:
+    """Format the results of :py:meth:`.RuleCost.report` and :py:meth:`.RuleCost.footprint` as a table"""
+    lines = [f"# {'family':<6} {'table':<8} {'chain':<24} {'rules':>6} {'worst':>6} {'average':>8} {'depth':>6}"]
+    for c in costs:
+        avg = '-' if c.average is None else f'{c.average:.2f}'
+        lines.append(f"{c.ipver:<8} {c.table:<8} {c.chain:<24} {c.rules:>6} {c.worst:>6} {avg:>8} {c.depth:>6}")
+    for f in ([] if footprints is None else footprints):
+        lines.append(
+            f"# {f.ipver} kernel footprint: {f.rules} rules in {f.tables} table(s), rule blob {_size(f.blob)}, "
+            f"counters {_size(f.counters)} ({f.cpus} CPUs), ipsets {_size(f.sets)}, total {_size(f.total)}"
+        )
+    return lines
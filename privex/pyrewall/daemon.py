@@ -0,0 +1,331 @@
+"""
+The long-running Pyre daemon - watches the master Pyre file plus everything it ``@import``'s, and re-applies the
+rules whenever any of them change.
+
+ - Changes are detected with Linux inotify (via ``ctypes``), falling back to polling file modification times
+   if inotify isn't available.
+ - Bursts of changes (e.g. an editor's save, or a deploy writing many files) are debounced into a single reload.
+ - Compiled rule lines are kept in a :attr:`.PyreParser.line_cache` shared between reloads, so only lines which
+   actually changed are re-compiled.
+ - The last applied (and previously applied) compiled rules are kept in memory, for an immediate
+   :meth:`.PyreDaemon.rollback` (``SIGUSR1``) without touching any files.
+ - With ``api=True``, the dynamic rule API (see :mod:`privex.pyrewall.api`) is served on a Unix socket, and its
+   chains are re-created after every reload.
+
+Basic usage:
+
+    >>> d = PyreDaemon('/etc/pyrewall/rules.pyre')
+    >>> d.run()     # Blocks forever. SIGHUP forces a reload, SIGUSR1 rolls back, SIGTERM / SIGINT exits.
+
+"""
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import signal
+import struct
+import threading
+import time
+from os.path import dirname, basename, getmtime, abspath
+from typing import List, Optional, Dict, Set, Tuple
+from privex.pyrewall import conf
+from privex.pyrewall.PyreParser import PyreParser
+from privex.pyrewall.api import ApiServer, RuleBatcher
+from privex.pyrewall.apply import ApplyQueue
+from privex.pyrewall.core import load_rules
+from privex.pyrewall.exceptions import PyreException
+from privex.pyrewall.snapshots import SnapshotStore
+from privex.pyrewall.staged import apply_staged
+from privex.pyrewall.ipsets import apply_ipsets, select_ipsets
+from privex.pyrewall.nft import apply_nft
+
+log = logging.getLogger(__name__)
+
+IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_FROM = 0x002, 0x004, 0x008, 0x040
+IN_MOVED_TO, IN_CREATE, IN_DELETE, IN_DELETE_SELF, IN_IGNORED = 0x080, 0x100, 0x200, 0x400, 0x8000
+IN_NONBLOCK, IN_CLOEXEC = 0o4000, 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_CREATE | IN_DELETE | IN_ATTRIB
+"""
+The inotify events watched for on each directory containing a Pyre file. Directories (rather than the files
+themselves) are watched, since most editors save by writing a new file and renaming it over the original.
+"""
+
+_event_header = struct.Struct('iIII')
+
+
+class Inotify:
+    """A minimal ``ctypes`` wrapper around the Linux inotify API, watching directories for changes to named files"""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches: Dict[int, str] = {}
+
+    def watch(self, folders: Set[str]):
+        """Replace the set of watched directories with ``folders``"""
+        for wd, folder in list(self.watches.items()):
+            if folder not in folders:
+                self._rm_watch(self.fd, wd)
+                del self.watches[wd]
+        for folder in folders - set(self.watches.values()):
+            wd = self._add_watch(self.fd, folder.encode(), WATCH_MASK)
+            if wd < 0:
+                log.warning("Failed to add inotify watch for %s (errno %s)", folder, ctypes.get_errno())
+                continue
+            self.watches[wd] = folder
+
+    def read(self, timeout: float = None) -> List[str]:
+        """Wait up to ``timeout`` seconds (``None`` = forever) for events, and return the paths that changed"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        paths, pos = [], 0
+        while pos < len(data):
+            wd, mask, _cookie, name_len = _event_header.unpack_from(data, pos)
+            pos += _event_header.size
+            name = data[pos:pos + name_len].rstrip(b'\0').decode()
+            pos += name_len
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if wd in self.watches and name:
+                paths.append(abspath(os.path.join(self.watches[wd], name)))
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+class MtimePoller:
+    """Fallback for :class:`.Inotify` on systems without it - polls the modification times of the watched files"""
+
+    def __init__(self, interval: float = 1.0):
+        self.interval = interval
+        self.mtimes: Dict[str, Optional[float]] = {}
+
+    @staticmethod
+    def _mtime(path: str) -> Optional[float]:
+        try:
+            return getmtime(path)
+        except OSError:
+            return None
+
+    def watch_files(self, files: Set[str]):
+        self.mtimes = {f: self.mtimes.get(f, self._mtime(f)) for f in files}
+
+    def read(self, timeout: float = None) -> List[str]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            changed = [f for f, m in self.mtimes.items() if self._mtime(f) != m]
+            for f in changed:
+                self.mtimes[f] = self._mtime(f)
+            if len(changed) > 0:
+                return changed
+            if deadline is not None and time.monotonic() >= deadline:
+                return []
+            time.sleep(self.interval if deadline is None else min(self.interval, max(0.0, deadline - time.monotonic())))
+
+    def close(self):
+        pass
+
+
+class PyreDaemon:
+    """
+    Watches a master Pyre file and its ``@import`` tree, re-compiling and applying the rules when they change.
+
+    See the module docstring of :mod:`privex.pyrewall.daemon` for details.
+    """
+    applied: Optional[Tuple[List[str], List[str], Optional[dict]]]
+    """The compiled ``(v4_rules, v6_rules, ipsets)`` which were most recently applied by this daemon"""
+    previous: Optional[Tuple[List[str], List[str], Optional[dict]]]
+    """The compiled ``(v4_rules, v6_rules, ipsets)`` applied before :attr:`.applied` - used by :meth:`.rollback`"""
+
+    def __init__(self, path: str, ipver='both', debounce: float = None, staged=False, watcher=None, api=False,
+                 api_socket: str = None):
+        """
+        :param str path: Absolute path to the master Pyre file
+        :param str ipver: ``4`` / ``6`` to only apply IPv4 / IPv6 rules, or ``both``
+        :param float debounce: Seconds of quiet required after a change before reloading (default: ``DAEMON_DEBOUNCE``)
+        :param bool staged: Apply rules using a staged apply (see :mod:`privex.pyrewall.staged`)
+        :param watcher: Override the change watcher (an :class:`.Inotify` or :class:`.MtimePoller` compatible object)
+        :param bool api: Serve the dynamic rule API (see :mod:`privex.pyrewall.api`)
+        :param str api_socket: The Unix socket to serve the API on (default: ``API_SOCKET``)
+        """
+        self.path = abspath(path)
+        self.ipver = ipver
+        self.debounce = conf.DAEMON_DEBOUNCE if debounce is None else float(debounce)
+        self.staged = staged
+        self.line_cache = {}
+        self.files: Set[str] = {self.path}
+        self.applied, self.previous = None, None
+        self.queue, self.store = ApplyQueue(), SnapshotStore()
+        self.batcher = RuleBatcher(queue=self.queue, ipver=ipver) if api else None
+        self.api_socket = api_socket
+        self.should_exit, self.force_reload, self.should_rollback = False, False, False
+        if watcher is None:
+            try:
+                watcher = Inotify()
+            except (OSError, AttributeError) as e:
+                log.warning("inotify is unavailable (%s) - falling back to polling for file changes.", str(e))
+                watcher = MtimePoller()
+        self.watcher = watcher
+
+    @property
+    def using_v4(self): return self.ipver in ['4', 'v4', 'ipv4', 'both']
+
+    @property
+    def using_v6(self): return self.ipver in ['6', 'v6', 'ipv6', 'both']
+
+    def _update_watches(self):
+        if isinstance(self.watcher, Inotify):
+            self.watcher.watch(set(dirname(f) for f in self.files))
+        else:
+            self.watcher.watch_files(self.files)
+
+    def compile(self) -> Tuple[List[str], List[str], Optional[dict]]:
+        """
+        Compile the master Pyre file using the shared line cache, and update the set of watched files.
+
+        :return tuple rules: ``(v4_rules, v6_rules, ipsets)`` - see :py:attr:`.PyreParser.ipsets` for ``ipsets``
+        """
+        p = PyreParser(line_cache=self.line_cache, emitter='iptables')
+        v4_rules, v6_rules = p.parse_file(self.path)
+        self.files = set(abspath(f) for f in p.files)
+        self._update_watches()
+        return v4_rules, v6_rules, p.ipsets
+
+    def _apply_payload(self, payload: dict):
+        if payload['options'].get('backend') == 'nft':
+            # Queued by a 'pyre load --backend nft' while we held the apply lock
+            return apply_nft(payload['v4'], payload.get('ipsets'))
+        self.store.take(v4=payload['v4'] is not None, v6=payload['v6'] is not None, source=payload['source'])
+        apply_ipsets(payload.get('ipsets'))
+        loader = apply_staged if payload['options'].get('staged') else load_rules
+        if payload['v4'] is not None: loader(payload['v4'], 'v4')
+        if payload['v6'] is not None: loader(payload['v6'], 'v6')
+        if self.batcher is not None:
+            # Re-loading the filter table removes the API chains, so they need re-creating (with their active rules)
+            self.batcher.install()
+
+    def apply(self, rules: Tuple[List[str], List[str], Optional[dict]], source: str = None):
+        """Apply compiled ``(v4_rules, v6_rules, ipsets)`` through the :class:`.ApplyQueue`, remembering the previous rules"""
+        ip4, ip6, ipsets = rules
+        self.queue.submit(
+            v4=ip4 if self.using_v4 else None, v6=ip6 if self.using_v6 else None, source=source or self.path,
+            applier=self._apply_payload, wait=True, options=dict(staged=self.staged),
+            ipsets=select_ipsets(ipsets, v4=self.using_v4, v6=self.using_v6)
+        )
+        self.previous, self.applied = self.applied, rules
+
+    def reload(self, force=False) -> bool:
+        """
+        Re-compile the rules, and apply them if they differ from the last applied rules (or if ``force`` is True).
+
+        :return bool applied: ``True`` if the rules were applied, ``False`` if unchanged (or compiling / applying failed)
+        """
+        started = time.monotonic()
+        try:
+            rules = self.compile()
+        except Exception as e:
+            log.error("Failed to compile %s - keeping the current rules. Error: %s %s", self.path, type(e), str(e))
+            return False
+        if not force and rules == self.applied:
+            log.info("Compiled rules are unchanged after %.3f seconds - not re-applying them.", time.monotonic() - started)
+            return False
+        try:
+            self.apply(rules)
+        except PyreException as e:
+            # e.g. iptables-restore rejected the rules - keep watching, so a fixed file can be applied
+            log.error("Failed to apply %s - keeping the current rules. Error: %s %s", self.path, type(e), str(e))
+            return False
+        log.info("Compiled and applied %s in %.3f seconds", self.path, time.monotonic() - started)
+        return True
+
+    def rollback(self) -> bool:
+        """
+        Immediately re-apply the previously applied compiled rules (held in memory). Returns ``False`` if there are
+        none, or applying them failed.
+        """
+        if self.previous is None:
+            log.warning("There are no previously applied rules to rollback to.")
+            return False
+        log.info("Rolling back to the previously applied rules.")
+        try:
+            self.apply(self.previous, source=f'rollback of {self.path}')
+        except PyreException as e:
+            log.error("Failed to rollback to the previously applied rules. Error: %s %s", type(e), str(e))
+            return False
+        return True
+
+    def wait_for_changes(self) -> List[str]:
+        """
+        Block until a watched file changes, then keep collecting changes until there's been no change for
+        :attr:`.debounce` seconds (capped at ``DAEMON_DEBOUNCE_MAX`` seconds in total), and return the changed files.
+        """
+        changed = []
+        while not changed and not self._interrupted:
+            changed = [p for p in self.watcher.read(timeout=1.0) if p in self.files]
+        deadline = time.monotonic() + conf.DAEMON_DEBOUNCE_MAX
+        while not self._interrupted:
+            more = self.watcher.read(timeout=min(self.debounce, max(0.0, deadline - time.monotonic())))
+            more = [p for p in more if p in self.files]
+            if len(more) == 0 or time.monotonic() >= deadline:
+                break
+            changed += more
+        return sorted(set(changed))
+
+    @property
+    def _interrupted(self) -> bool:
+        return self.should_exit or self.force_reload or self.should_rollback
+
+    def _handle_signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self.force_reload = True
+        elif signum == signal.SIGUSR1:
+            self.should_rollback = True
+        else:
+            self.should_exit = True
+
+    def run(self):
+        """Apply the rules, then watch for changes and re-apply them until SIGTERM / SIGINT"""
+        for sig in [signal.SIGHUP, signal.SIGUSR1, signal.SIGTERM, signal.SIGINT]:
+            signal.signal(sig, self._handle_signal)
+        self.reload(force=True)
+        log.info("Watching %d files for changes: %s", len(self.files), ', '.join(sorted(self.files)))
+        server = None
+        if self.batcher is not None:
+            server = ApiServer(path=self.api_socket, batcher=self.batcher)
+            threading.Thread(target=server.serve_forever, name='pyre-api', daemon=True).start()
+            self.batcher.start()
+            log.info("Serving the dynamic rule API on %s", server.path)
+        try:
+            while not self.should_exit:
+                changed = self.wait_for_changes()
+                if self.should_exit:
+                    break
+                if self.should_rollback:
+                    self.should_rollback = False
+                    self.rollback()
+                    continue
+                force, self.force_reload = self.force_reload, False
+                if len(changed) > 0:
+                    log.info("Detected changes to: %s", ', '.join(basename(c) for c in changed))
+                self.reload(force=force)
+        finally:
+            self.watcher.close()
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+                self.batcher.stop()
+        log.info("Pyre daemon exiting.")
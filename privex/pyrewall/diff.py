@@ -0,0 +1,338 @@
+"""
+Semantic diffs between two compiled Pyre policies - used by ``pyre diff old.pyre new.pyre``.
+
+Both sides are compiled into iptables-restore lines (keeping the Pyre source line of each rule, see
+:py:attr:`.PyreParser.output_origins`), split per IP version, table and chain, and each rule is normalised into a
+canonical form where it's semantically safe to do so:
+
+    - CIDRs are canonicalised (``10.1.2.3/8`` -> ``10.0.0.0/8``, ``1.2.3.4/32`` -> ``1.2.3.4``), ports and
+      ``--state`` lists are sorted, and ``--dport 22`` / ``-m multiport --dports 22`` are treated as the same match
+    - ``-m state --state`` is treated as ``-m conntrack --ctstate``, and ``-m comment`` matches are ignored
+    - The order of the matches within a rule is ignored, unless the rule uses a stateful match (e.g. ``limit`` or
+      ``recent``), where evaluating the matches in a different order could change its behaviour
+    - The order of consecutive rules in a chain with the same ``ACCEPT`` / ``DROP`` / ``REJECT`` target is ignored,
+      as a packet matching any of them gets the same verdict
+
+Each canonical rule is identified by a hash, so diffing a chain is a dict lookup per rule plus an ``O(n log n)``
+longest increasing subsequence to find the rules which were moved - staying near-linear for 100k-rule policies.
+
+    >>> for d in diff_files('/etc/pyrewall/old.pyre', '/etc/pyrewall/new.pyre'):
+    ...     print(d.kind, d.ipver, d.table, d.chain, d.rule, d.source)
+    removed v4 filter INPUT -A INPUT -p tcp --dport 22 -j ACCEPT RuleSource(file='/etc/pyrewall/old.pyre', line=3, ...)
+    added v4 filter INPUT -A INPUT -p tcp --dport 2222 -j ACCEPT RuleSource(file='/etc/pyrewall/new.pyre', line=3, ...)
+
+"""
+import hashlib
+import logging
+import shlex
+from bisect import bisect_right
+from collections import namedtuple, OrderedDict
+from itertools import repeat
+from typing import List, Optional, Tuple, Dict, Iterable
+from privex.pyrewall.PyreParser import PyreParser
+from privex.pyrewall.cidr import format_cidr, _inet_pton, _from_bytes, AF_INET, AF_INET6
+from privex.pyrewall.types import RuleSource
+
+log = logging.getLogger(__name__)
+
+NormalRule = namedtuple('NormalRule', 'id canonical target ordered rule source index run')
+"""
+A rule normalised by :func:`.normalise_policy` - ``id`` is the hash of its ``canonical`` form, ``target`` is its
+canonical ``-j`` clause, ``ordered`` is ``True`` if the order of its matches matters, ``rule`` is the original rule,
+``source`` is its :class:`.RuleSource` (or ``None``) and ``index`` is its 1-based position in the chain. Consecutive
+rules which can be reordered freely (see :attr:`.TERMINAL_TARGETS`) share the same ``run`` number.
+"""
+
+DiffEntry = namedtuple('DiffEntry', 'kind ipver table chain rule source old_index new_index')
+"""
+A single difference found by :func:`.diff_rules`. ``kind`` is one of:
+
+    - ``added`` / ``removed`` / ``moved`` - ``rule`` and ``source`` are from the new side (or the old side for
+      ``removed``), and ``old_index`` / ``new_index`` are the rule's 1-based positions in the chain
+    - ``policy`` - the chain's policy changed, ``rule`` is e.g. ``ACCEPT -> DROP``
+    - ``chain_added`` / ``chain_removed`` - ``rule`` is the chain's policy
+"""
+
+ChainKey = Tuple[str, str]
+
+OPTION_ALIASES = {
+    '--source': '-s', '--src': '-s', '--destination': '-d', '--dst': '-d', '--in-interface': '-i',
+    '--out-interface': '-o', '--protocol': '-p', '--match': '-m', '--jump': '-j', '--goto': '-g', '--fragment': '-f',
+    '--dport': '--dports', '--destination-port': '--dports', '--destination-ports': '--dports',
+    '--sport': '--sports', '--source-port': '--sports', '--source-ports': '--sports',
+    '--state': '--ctstate',
+}
+"""Options which are normalised into another option with the same meaning"""
+
+GENERIC_OPTIONS = {'-s', '-d', '-i', '-o', '-f', '-4', '-6', '--dports', '--sports', '--ports'}
+"""Options which are matches by themselves, rather than options of the preceding ``-m`` / ``-p`` module"""
+
+STATEFUL_MATCHES = {'limit', 'hashlimit', 'recent', 'connlimit', 'quota', 'statistic', 'connbytes'}
+"""Matches with side effects, making the order of the matches in a rule (and its position in the chain) significant"""
+
+TERMINAL_TARGETS = {'ACCEPT', 'DROP', 'REJECT'}
+"""Targets where the order of consecutive rules with the same target doesn't matter"""
+
+PROTOCOLS = {'1': 'icmp', '6': 'tcp', '17': 'udp', '58': 'ipv6-icmp', 'icmpv6': 'ipv6-icmp', 'all': 'all', '0': 'all'}
+
+
+def _norm_net(value: str) -> str:
+    nets = []
+    for v in value.split(','):
+        addr, _, prefix = v.partition('/')
+        family, bits = (AF_INET6, 128) if ':' in addr else (AF_INET, 32)
+        try:
+            prefix = bits if prefix == '' else int(prefix)
+            network = _from_bytes(_inet_pton(family, addr), 'big') >> (bits - prefix) << (bits - prefix)
+            nets.append(format_cidr(network, prefix, bits))
+        except (OSError, ValueError):       # e.g. hostnames, or dotted netmasks
+            nets.append(v)
+    return ','.join(sorted(nets))
+
+
+def _port_key(port: str):
+    start = port.split(':')[0]
+    return (0, int(start), port) if start.isdigit() else (1, 0, port)
+
+
+def _norm_ports(value: str) -> str:
+    ports = []
+    for p in value.split(','):
+        start, _, end = p.partition(':')
+        ports.append(start if end == '' or end == start else f'{start}:{end}')
+    return ','.join(sorted(set(ports), key=_port_key))
+
+
+def _norm_list(value: str) -> str:
+    return ','.join(sorted(set(value.upper().split(','))))
+
+
+VALUE_NORMALISERS = {
+    '-s': _norm_net, '-d': _norm_net, '-p': lambda v: PROTOCOLS.get(v.lower(), v.lower()), '-m': str.lower,
+    '--dports': _norm_ports, '--sports': _norm_ports, '--ports': _norm_ports, '--ctstate': _norm_list,
+}
+
+
+def _tokens(rule: str) -> List[str]:
+    return shlex.split(rule) if '"' in rule or "'" in rule else rule.split()
+
+
+def _clauses(tokens: List[str]) -> Tuple[List[list], List[str]]:
+    """Split the tokens of a rule (after the chain) into match clauses (``[head, option, option...]``) and the target"""
+    clauses, target, cur, neg, i = [], None, None, False, 0
+    while i < len(tokens):
+        if tokens[i] == '!':
+            neg, i = True, i + 1
+            continue
+        opt, j = OPTION_ALIASES.get(tokens[i], tokens[i]), i + 1
+        while j < len(tokens) and tokens[j] != '!' and not tokens[j].startswith('-'):
+            j += 1
+        values = ' '.join(tokens[i + 1:j])
+        norm = VALUE_NORMALISERS.get(opt)
+        part = ('! ' if neg else '') + opt + ('' if values == '' else ' ' + (values if norm is None else norm(values)))
+        neg, i = False, j
+        if target is not None:
+            target.append(part)
+        elif opt in ['-j', '-g']:
+            target = [part]
+        elif opt in ['-m', '-p']:
+            cur = [part]
+            clauses.append(cur)
+        elif opt in GENERIC_OPTIONS or cur is None:
+            clauses.append([part])
+        else:
+            cur.append(part)
+    return clauses, [] if target is None else target
+
+
+def normalise_rule(rule: str) -> Tuple[str, str, bool]:
+    """
+    Normalise an iptables rule (``-A CHAIN ...``) into its canonical form (see the module docs). Returns
+    ``(canonical, target, ordered)`` - ``target`` is the canonical target, and ``ordered`` is ``True`` if the rule
+    uses a stateful match (so the order of its matches was kept).
+
+        >>> normalise_rule('-A INPUT -p tcp -m multiport --dports 443,80 -s 10.1.2.3/8 -j ACCEPT')[0]
+        'INPUT --dports 80,443 -p tcp -s 10.0.0.0/8 -j ACCEPT'
+        >>> normalise_rule('-A INPUT -s 10.0.0.0/8 -p 6 --dport 80,443 -m comment --comment "web" -j ACCEPT')[0]
+        'INPUT --dports 80,443 -p tcp -s 10.0.0.0/8 -j ACCEPT'
+
+    """
+    tokens = _tokens(rule)
+    chain, (clauses, target) = tokens[1], _clauses(tokens[2:])
+    parts = []
+    for clause in clauses:
+        head = clause[0]
+        if head == '-m state':
+            head = '-m conntrack'
+        elif head == '-m comment' or (head in ['-m multiport', '-m tcp', '-m udp'] and len(clause) == 1):
+            continue        # Comments don't affect matching, and the port options are already separate clauses
+        parts.append(' '.join([head] + sorted(clause[1:])))
+    ordered = any(p.startswith('-m ') and p.split(' ')[1] in STATEFUL_MATCHES for p in parts)
+    target = ' '.join(target[:1] + sorted(target[1:]))
+    canonical = ' '.join([chain] + (parts if ordered else sorted(parts)) + ([target] if target != '' else []))
+    return canonical, target, ordered
+
+
+def _rule_id(canonical: str) -> str:
+    return hashlib.blake2b(canonical.encode(), digest_size=8).hexdigest()
+
+
+def _reorderable(target: str, ordered: bool) -> bool:
+    """Whether consecutive rules with this (canonical) ``target`` can be reordered (see :attr:`.TERMINAL_TARGETS`)"""
+    target = target.split(' ')
+    return not ordered and len(target) > 1 and target[0] == '-j' and target[1] in TERMINAL_TARGETS
+
+
+def normalise_policy(lines: List[str], origins: List[Optional[RuleSource]] = None, memo: dict = None) \
+        -> Tuple[Dict[ChainKey, List[NormalRule]], Dict[ChainKey, str]]:
+    """
+    Split iptables-restore ``lines`` into their normalised rules per ``(table, chain)``, plus the policy of each chain.
+
+    :param List[str] lines: iptables-restore lines, e.g. from :py:attr:`.PyreParser.output`
+    :param list origins: The source of each line, e.g. from :py:attr:`.PyreParser.output_origins`
+    :param dict memo: An optional dict to cache normalised rules in - e.g. shared between both sides of a diff,
+                      as most rules are usually identical
+    :return tuple res: ``(rules, policies)`` - both dicts keyed by ``(table, chain)``
+    """
+    memo = {} if memo is None else memo
+    table, chains, policies = 'filter', OrderedDict(), OrderedDict()
+    for line, origin in zip(lines, repeat(None) if origins is None else origins):
+        line = line.strip()
+        if line == '' or line[0] == '#' or line == 'COMMIT':
+            continue
+        if line[0] == '*':
+            table = line[1:]
+        elif line[0] == ':':
+            name, policy = (line[1:].split() + ['-'])[:2]
+            policies[(table, name)] = policy
+            chains.setdefault((table, name), [])
+        elif line.startswith('-A ') or line.startswith('--append '):
+            if line not in memo:
+                canonical, target, ordered = normalise_rule(line)
+                memo[line] = (_rule_id(canonical), canonical, target, ordered, _reorderable(target, ordered))
+            rule_id, canonical, target, ordered, reorderable = memo[line]
+            rules = chains.setdefault((table, line.split()[1]), [])
+            run = 0
+            if len(rules) > 0:
+                prev = rules[-1]
+                same_run = reorderable and prev.target == target and _reorderable(prev.target, prev.ordered)
+                run = prev.run if same_run else prev.run + 1
+            rules.append(NormalRule(
+                id=rule_id, canonical=canonical, target=target, ordered=ordered, rule=line, source=origin,
+                index=len(rules) + 1, run=run
+            ))
+        else:
+            log.debug("Ignoring unsupported iptables-restore line while normalising: %s", line)
+    return chains, policies
+
+
+def _keyed(rules: List[NormalRule]) -> Dict[tuple, NormalRule]:
+    """Key each rule by ``(id, occurrence)``, so identical rules in the same chain are matched up in order"""
+    seen, res = {}, OrderedDict()
+    for r in rules:
+        seen[r.id] = seen.get(r.id, 0) + 1
+        res[(r.id, seen[r.id])] = r
+    return res
+
+
+def _lis(seq: List[int]) -> set:
+    """Return the indexes (into ``seq``) of a longest non-decreasing subsequence of ``seq`` in ``O(n log n)``"""
+    tails, tail_idx, prev = [], [], [-1] * len(seq)
+    for i, v in enumerate(seq):
+        pos = bisect_right(tails, v)
+        if pos > 0:
+            prev[i] = tail_idx[pos - 1]
+        if pos == len(tails):
+            tails.append(v)
+            tail_idx.append(i)
+        else:
+            tails[pos], tail_idx[pos] = v, i
+    res, i = set(), tail_idx[-1] if len(tail_idx) > 0 else -1
+    while i != -1:
+        res.add(i)
+        i = prev[i]
+    return res
+
+
+def _diff_chain(old: List[NormalRule], new: List[NormalRule], ipver: str, key: ChainKey) -> List[DiffEntry]:
+    old_k, new_k = _keyed(old), _keyed(new)
+    entry = lambda kind, r, o, n: DiffEntry(kind, ipver, key[0], key[1], r.rule, r.source, o, n)
+    res = [entry('removed', r, r.index, None) for k, r in old_k.items() if k not in new_k]
+
+    # Rules in the same run can be in any order, so within each old run, the rules are put in the order of their new
+    # run - and the rules which aren't part of the longest non-decreasing sequence of new runs have been moved.
+    common = sorted((k for k in old_k if k in new_k), key=lambda k: (old_k[k].run, new_k[k].run))
+    in_order = _lis([new_k[k].run for k in common])
+    res += [entry('moved', new_k[k], old_k[k].index, new_k[k].index) for i, k in enumerate(common) if i not in in_order]
+    res += [entry('added', r, None, r.index) for k, r in new_k.items() if k not in old_k]
+    return res
+
+
+def diff_rules(old_lines: List[str], new_lines: List[str], ipver='v4', old_origins: List[RuleSource] = None,
+               new_origins: List[RuleSource] = None) -> List[DiffEntry]:
+    """
+    Compare two sets of iptables-restore lines (e.g. from :py:attr:`.PyreParser.output`) semantically, returning
+    the added / removed / moved rules and chain policy changes (see :class:`.DiffEntry`)
+
+        >>> diff_rules(['*filter', ':INPUT ACCEPT [0:0]', '-A INPUT -p tcp --dport 22 -j ACCEPT', 'COMMIT'],
+        ...            ['*filter', ':INPUT DROP [0:0]', '-A INPUT -p tcp -m multiport --dports 22 -j ACCEPT', 'COMMIT'])
+        [DiffEntry(kind='policy', ipver='v4', table='filter', chain='INPUT', rule='ACCEPT -> DROP', source=None,
+                   old_index=None, new_index=None)]
+
+    """
+    memo = {}
+    old_rules, old_policies = normalise_policy(old_lines, old_origins, memo)
+    new_rules, new_policies = normalise_policy(new_lines, new_origins, memo)
+    res = []
+    for key in list(new_rules.keys()) + [k for k in old_rules.keys() if k not in new_rules]:
+        old_p, new_p = old_policies.get(key), new_policies.get(key)
+        if key not in old_rules:
+            res.append(DiffEntry('chain_added', ipver, key[0], key[1], new_p, None, None, None))
+        elif key not in new_rules:
+            res.append(DiffEntry('chain_removed', ipver, key[0], key[1], old_p, None, None, None))
+        elif old_p != new_p:
+            res.append(DiffEntry('policy', ipver, key[0], key[1], f'{old_p} -> {new_p}', None, None, None))
+        res += _diff_chain(old_rules.get(key, []), new_rules.get(key, []), ipver, key)
+    return res
+
+
+def diff_parsers(old: PyreParser, new: PyreParser, ipvers: Iterable[str] = ('v4', 'v6')) -> List[DiffEntry]:
+    """Semantically diff the output of two :class:`.PyreParser`'s which have already parsed their rules"""
+    res = []
+    for ipver in ipvers:
+        res += diff_rules(old.output[ipver], new.output[ipver], ipver, old.output_origins[ipver],
+                          new.output_origins[ipver])
+    return res
+
+
+def diff_files(old_path: str, new_path: str, ipvers: Iterable[str] = ('v4', 'v6'), **parser_args) -> List[DiffEntry]:
+    """
+    Compile the Pyre files ``old_path`` and ``new_path`` (absolute paths) and semantically diff them.
+    ``parser_args`` are passed to each :class:`.PyreParser` (e.g. ``strict=True``). The rules are always compiled
+    with the ``iptables`` backend, as the diff compares normalised iptables rules.
+    """
+    parser_args = {**parser_args, 'emitter': 'iptables'}
+    old, new = PyreParser(**parser_args), PyreParser(**parser_args)
+    old.parse_file(old_path)
+    new.parse_file(new_path)
+    return diff_parsers(old, new, ipvers)
+
+
+def format_diff(entries: List[DiffEntry]) -> List[str]:
+    """
+    Format diff entries for humans, grouped under a ``@@ ipver table chain @@`` header per chain. Rules are prefixed
+    with ``-`` (removed), ``+`` (added) or ``~`` (moved), their position(s) in the chain, and their Pyre source line.
+    """
+    lines, chain = [], None
+    for d in entries:
+        if (d.ipver, d.table, d.chain) != chain:
+            chain = (d.ipver, d.table, d.chain)
+            lines.append(f'@@ {d.ipver} {d.table} {d.chain} @@')
+        if d.kind in ['policy', 'chain_added', 'chain_removed']:
+            lines.append(f"  {d.kind.replace('_', ' ')}: {d.rule}")
+            continue
+        sign, pos = dict(removed='-', added='+', moved='~')[d.kind], d.new_index if d.old_index is None else d.old_index
+        pos = f'{d.old_index}->{d.new_index}' if d.kind == 'moved' else pos
+        src = '' if d.source is None else f'    # {d.source.file or "<input>"}:{d.source.line}: {d.source.text}'
+        lines.append(f'{sign} [{pos}] {d.rule}{src}')
+    return lines
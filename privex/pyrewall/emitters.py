@@ -0,0 +1,261 @@
+"""
+Emitters - the output backends which decide what compiled Pyre rules look like.
+
+:class:`.RuleParser` collects each Pyre rule into a :class:`.RuleBuilder`, and :class:`.PyreParser` handles the
+tables, chains and sets around them - while the emitter chosen for the parser (``emitter='iptables'`` /
+``emitter='nft'``, default: :attr:`.conf.BACKEND`) turns them into the output format:
+
+    - ``iptables`` (:class:`.IPTablesEmitter`) - ``iptables-restore`` lines per IP version, one rule per address /
+      port combination, with ``@blocklist`` and temporary rules matching ipsets (see :mod:`privex.pyrewall.ipsets`)
+    - ``nft`` (:class:`.NFTEmitter`) - a single nftables script with one ``inet`` table covering both IP versions,
+      matching multiple addresses / ports with anonymous sets, and ``@blocklist`` / temporary rules with named sets
+      declared in the table. It's returned as the IPv4 rules, while the IPv6 rules are always empty. The script
+      replaces the whole table, so it's applied in a single ``nft -f`` transaction (see :func:`.apply_nft`).
+
+Basic usage:
+
+    >>> p = PyreParser(emitter='nft')
+    >>> script, _ = p.parse_lines(['@chain INPUT DROP', 'allow port 80,443 from 10.0.0.0/8,192.168.0.0/16'])
+    >>> print('\\n'.join(script))
+    table inet pyrewall
+    delete table inet pyrewall
+    table inet pyrewall {
+        chain INPUT {
+            type filter hook input priority 0; policy drop;
+            ip saddr { 10.0.0.0/8, 192.168.0.0/16 } tcp dport { 80, 443 } accept
+        }
+        ...
+    }
+
+"""
+from collections import OrderedDict
+from typing import List, Tuple, Optional, Union, Dict
+from privex.pyrewall import conf
+from privex.pyrewall.RuleBuilder import RuleBuilder
+from privex.pyrewall.exceptions import RuleSyntaxError
+from privex.pyrewall.nat import bucket_mappings, format_target
+from privex.pyrewall.nft import NFT_HOOKS, nft_chain, set_declarations
+from privex.pyrewall.types import IPT_ACTION, RuleSource, PortMapping
+
+
+class Emitter:
+    """The interface of an output backend used by :class:`.PyreParser` / :class:`.RuleParser`"""
+    name: str = None
+
+    def build(self, rule: RuleBuilder, has_v4=False, has_v6=False) -> Tuple[List[str], List[str]]:
+        """Build a parsed Pyre rule into ``(v4_rules, v6_rules)``"""
+        raise NotImplementedError
+
+    def set_rule(self, chain: str, name: str, ipver: str, direction: str,
+                 action: IPT_ACTION) -> Tuple[List[str], List[str]]:
+        """The ``(v4_rules, v6_rules)`` matching the set ``name`` as the ``direction`` (``src`` / ``dst``) address"""
+        raise NotImplementedError
+
+    def set_match(self, name: str) -> str:
+        """A string which is only found in a rule if it matches the set ``name``"""
+        raise NotImplementedError
+
+    def offload(self, name: str, devices: List[str], hw: bool, rule: RuleBuilder) -> Tuple[List[str], List[str]]:
+        """
+        Declare the flowtable ``name`` on ``devices`` (``hw`` = hardware offload), returning ``(v4_rules, v6_rules)``
+        for ``rule`` - which adds matching flows to it
+        """
+        raise RuleSyntaxError(f"@offload needs a backend with flowtables (e.g. nft), not '{self.name}'")
+
+    def port_map(self, name: str, chain: str, protocols: List[str], iface: Optional[str],
+                 mappings: List[PortMapping]) -> Tuple[List[str], List[str], List[str]]:
+        """
+        Forward the destination ports of ``mappings`` (from :func:`.read_portmap`) for each of ``protocols``
+        (arriving on ``iface``, if set) in ``chain``, without comparing each packet against every mapping. Returns
+        ``(v4_rules, v6_rules, chains)``, where ``chains`` are the new chains used by the rules (named after ``name``).
+        """
+        raise NotImplementedError
+
+    def commit(self, parser, ipver='v4'):
+        """Move the rules of the current table from ``parser.cache[ipver]`` into ``parser.output``"""
+        raise NotImplementedError
+
+
+class IPTablesEmitter(Emitter):
+    """Outputs ``iptables-restore`` / ``ip6tables-restore`` lines (the default backend)"""
+    name = 'iptables'
+
+    def build(self, rule: RuleBuilder, has_v4=False, has_v6=False) -> Tuple[List[str], List[str]]:
+        # Limits group addresses by a prefix length per IP version, so rules using them are built for each version
+        if not has_v4 and not has_v6 and len(rule.limits) == 0 and rule.log is None:
+            res = list(rule.build())
+            return res, res
+        if not has_v4 and not has_v6:
+            has_v4, has_v6 = True, True
+        return list(rule.build('v4')) if has_v4 else [], list(rule.build('v6')) if has_v6 else []
+
+    def set_rule(self, chain: str, name: str, ipver: str, direction: str,
+                 action: IPT_ACTION) -> Tuple[List[str], List[str]]:
+        rule = f'-A {chain} -m set --match-set {name} {direction} {action.value}'
+        return [rule] if ipver == 'v4' else [], [rule] if ipver == 'v6' else []
+
+    def set_match(self, name: str) -> str:
+        return f' --match-set {name} '
+
+    def port_map(self, name: str, chain: str, protocols: List[str], iface: Optional[str],
+                 mappings: List[PortMapping]) -> Tuple[List[str], List[str], List[str]]:
+        """
+        Large lists are split into buckets of consecutive ports (see :func:`.bucket_mappings`), each with its own
+        chain holding the DNAT rules - while ``chain`` only has one rule per bucket, jumping to it for its port range.
+        """
+        rules, chains, match_if = dict(v4=[], v6=[]), [], '' if iface is None else f' -i {iface}'
+
+        def dport(start, end):
+            return f'--dport {start}' if start == end else f'--dport {start}:{end}'
+
+        for ipver in ['v4', 'v6']:
+            buckets = bucket_mappings([m for m in mappings if m.target.ipver == ipver])
+            for proto in protocols:
+                for i, bucket in enumerate(buckets):
+                    sub = chain
+                    if len(buckets) > 1:
+                        sub = f'{name}-{ipver[1]}{proto[0]}{i}'
+                        rules[ipver].append(f'-A {chain}{match_if} -p {proto} {dport(bucket[0].start, bucket[-1].end)} -j {sub}')
+                        chains.append(sub)
+                    rules[ipver] += [
+                        f'-A {sub}{match_if if sub == chain else ""} -p {proto} {dport(m.start, m.end)} '
+                        f'-j DNAT --to-destination {format_target(m.target)}' for m in bucket
+                    ]
+        return rules['v4'], rules['v6'], chains
+
+    def commit(self, parser, ipver='v4'):
+        header = [f'*{parser.table}']
+        for cname, cdata in parser.chains.items():
+            header += [f':{cname} {cdata[0]} {cdata[1]}']
+        merged = header + parser.cache[ipver] + ['COMMIT', f'### End of table {parser.table} ###']
+        parser.output[ipver] += merged
+        parser.output_origins[ipver] += [None] * len(header) + parser.origins[ipver] + [None, None]
+        parser.cache[ipver], parser.origins[ipver] = [], []
+
+
+class NFTEmitter(Emitter):
+    """
+    Outputs a single nftables script replacing the ``inet`` table :attr:`.conf.NFT_TABLE` (see the module docs).
+
+    As the whole table is replaced at once, each :py:meth:`.commit` merges the committed iptables table (e.g.
+    ``filter`` or ``nat``) into :py:attr:`.tables`, and re-renders the entire script into ``parser.output.v4``.
+    Chains of tables other than ``filter`` are prefixed with the table name, e.g. ``nat_POSTROUTING``.
+    """
+    name = 'nft'
+    table: str
+    """The name of the nftables ``inet`` table"""
+    tables: Dict[str, dict]
+    """The committed ``chains`` (name -> policy) and ``rules`` (chain -> ``[(rule, origin)]``) of each table"""
+    flowtables: Dict[str, Tuple[List[str], bool]]
+    """The ``(devices, hw_offload)`` of each flowtable declared by ``@offload``, keyed by name"""
+
+    def __init__(self, table: str = None):
+        self.table = conf.NFT_TABLE if table is None else table
+        self.tables = OrderedDict()
+        self.flowtables = OrderedDict()
+
+    def build(self, rule: RuleBuilder, has_v4=False, has_v6=False) -> Tuple[List[str], List[str]]:
+        return rule.build_nft(has_v4=has_v4, has_v6=has_v6), []
+
+    def set_rule(self, chain: str, name: str, ipver: str, direction: str,
+                 action: IPT_ACTION) -> Tuple[List[str], List[str]]:
+        addr = f"{'ip6' if ipver == 'v6' else 'ip'} {'saddr' if direction == 'src' else 'daddr'}"
+        return [f'-A {chain} {addr} @{name} {RuleBuilder.NFT_VERDICTS[action]}'], []
+
+    def set_match(self, name: str) -> str:
+        return f' @{name} '
+
+    def offload(self, name: str, devices: List[str], hw: bool, rule: RuleBuilder) -> Tuple[List[str], List[str]]:
+        self.flowtables[name] = (devices, hw)
+        return rule.build_nft(), []
+
+    def port_map(self, name: str, chain: str, protocols: List[str], iface: Optional[str],
+                 mappings: List[PortMapping]) -> Tuple[List[str], List[str], List[str]]:
+        """
+        Each IP version and protocol gets a single rule looking up the destination port in an anonymous map - one map
+        for the mappings which keep the original port, and one mapping to an ``address . port``
+        """
+        rules, match_if = [], '' if iface is None else f'iifname "{iface}" '
+        # Packets with a port missing from the map don't match the rule, as the map lookup fails
+        for ipver, fam, nfproto in [('v4', 'ip', 'ipv4'), ('v6', 'ip6', 'ipv6')]:
+            maps = [m for m in mappings if m.target.ipver == ipver]
+            for proto in protocols:
+                match = f'-A {chain} {match_if}meta nfproto {nfproto}'
+                keep = [m for m in maps if m.target.port is None]
+                if len(keep) > 0:
+                    elements = ', '.join(f'{self._ports(m)} : {m.target.address}' for m in keep)
+                    rules.append(f'{match} dnat {fam} to {proto} dport map {{ {elements} }}')
+                ported = [m for m in maps if m.target.port is not None]
+                if len(ported) > 0:
+                    elements = ', '.join(f'{self._ports(m)} : {m.target.address} . {m.target.port}' for m in ported)
+                    rules.append(f'{match} dnat {fam} addr . port to {proto} dport map {{ {elements} }}')
+        return rules, [], []
+
+    @staticmethod
+    def _ports(m: PortMapping) -> str:
+        return str(m.start) if m.start == m.end else f'{m.start}-{m.end}'
+
+    def commit(self, parser, ipver='v4'):
+        tdata = self.tables.setdefault(parser.table, dict(chains=OrderedDict(), rules=OrderedDict()))
+        for cname, cdata in parser.chains.items():
+            tdata['chains'][cname] = cdata[0]
+        for line, origin in zip(parser.cache[ipver], parser.origins[ipver]):
+            if not line.startswith('-A '):
+                if line.startswith('#') or line == '':
+                    continue
+                raise RuleSyntaxError(f"iptables line can't be used with the nftables backend: {line}")
+            _, chain, rule = line.split(' ', 2)
+            tdata['chains'].setdefault(chain, '-')
+            tdata['rules'].setdefault(chain, []).append((rule, origin))
+        parser.cache[ipver], parser.origins[ipver] = [], []
+        parser.output.v4, parser.output_origins.v4 = self.render(parser.ipsets)
+        parser.output.v6, parser.output_origins.v6 = [], []
+
+    def render(self, ipsets: Optional[dict] = None) -> Tuple[List[str], List[Optional[RuleSource]]]:
+        """
+        Render the nftables script for :py:attr:`.tables` and :py:attr:`.flowtables`, plus the declarations of
+        ``ipsets`` (from :py:attr:`.PyreParser.ipsets`), returning ``(lines, origins)``
+        """
+        t = self.table
+        lines = [f'table inet {t}', f'delete table inet {t}', f'table inet {t} {{']
+        for name, (devices, hw) in self.flowtables.items():
+            flags = ' flags offload;' if hw else ''
+            lines.append(f"    flowtable {name} {{ hook ingress priority 0; devices = {{ {', '.join(devices)} }};{flags} }}")
+        lines += [f'    {d}' for d in set_declarations(ipsets)]
+        origins = [None] * len(lines)
+        for table, tdata in self.tables.items():
+            for chain, policy in tdata['chains'].items():
+                lines.append(f'    chain {nft_chain(table, chain)} {{')
+                hook = NFT_HOOKS.get((table, chain))
+                if hook is not None and policy != '-':
+                    lines.append(f'        type {hook[0]} hook {hook[1]} priority {hook[2]}; policy {policy.lower()};')
+                origins += [None] * (len(lines) - len(origins))
+                for rule, origin in tdata['rules'].get(chain, []):
+                    lines.append(f'        {rule}')
+                    origins.append(origin)
+                lines.append('    }')
+                origins.append(None)
+        lines.append('}')
+        origins.append(None)
+        return lines, origins
+
+
+EMITTERS = {
+    'iptables': IPTablesEmitter,
+    'nft': NFTEmitter,
+    'nftables': NFTEmitter,
+}
+"""Maps each backend name to its :class:`.Emitter` class"""
+
+
+def get_emitter(emitter: Union[str, Emitter] = None) -> Emitter:
+    """
+    Returns a new instance of the emitter named ``emitter`` (default: :attr:`.conf.BACKEND`) - or ``emitter`` itself
+    if it's already an :class:`.Emitter` instance.
+    """
+    if isinstance(emitter, Emitter):
+        return emitter
+    emitter = conf.BACKEND if emitter is None else emitter
+    if emitter not in EMITTERS:
+        raise AttributeError(f"Unknown backend '{emitter}' - valid backends are: {', '.join(EMITTERS)}")
+    return EMITTERS[emitter]()
@@ -19,6 +19,16 @@ class IPTablesError(PyreException):
     pass
 
 
+class XTablesLockError(IPTablesError):
+    """Raised when an iptables command still couldn't obtain the xtables lock after exhausting all retries"""
+    pass
+
+
+class StagedApplyError(PyreException):
+    """Raised when a ruleset can't be applied using a staged apply (see :mod:`privex.pyrewall.staged`)"""
+    pass
+
+
 class ReturnCodeError(PyreException):
     pass
 
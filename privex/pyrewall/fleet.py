@@ -0,0 +1,182 @@
+"""
+Compiling one family of Pyre templates for a whole fleet of hosts, each with its own variables (see the ``@var`` and
+``@if`` directives of :class:`.PyreParser`) - used by ``pyre build-fleet``.
+
+The fleet is described by a YAML (requires ``PyYAML``) or JSON hosts file:
+
+.. code-block:: yaml
+
+    template: fleet.pyre            # The master Pyre file (relative to the hosts file), can be overridden per host
+    vars:                           # Default variables for every host
+      ssh_port: 22
+      admins: [10.0.0.1, 10.0.0.2]  # Lists are joined with commas, e.g. "allow port 22 from $admins"
+    hosts:
+      web1: {role: web, public_ip: 185.1.2.3}
+      db1: {role: db, template: db.pyre}
+
+Each host's ``host`` variable is its name. The first host is compiled in the parent process, which warms a shared
+:py:attr:`.PyreParser.line_cache` with the template files and every compiled rule line. The worker processes are
+forked from the parent, so they start with the warm cache instead of re-reading and re-parsing the templates. Lines
+are cached by their text after variable substitution, so only lines which differ between hosts are compiled again.
+
+    >>> hosts = load_fleet('/etc/pyrewall/fleet/hosts.yml')
+    >>> for r in build_fleet(hosts, '/srv/fleet-rules', workers=8):
+    ...     print(r.host, 'OK' if r.error is None else r.error)
+    web1 OK
+    db1 OK
+
+"""
+import json
+import logging
+import multiprocessing
+import os
+import re
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from os.path import join, dirname, abspath
+from typing import List, Optional
+from privex.pyrewall import conf
+from privex.pyrewall.compiler import CompileContext, CompileResult, compile_file
+from privex.pyrewall.exceptions import PyreException
+from privex.pyrewall.ipsets import restore_lines
+from privex.pyrewall.nft import element_lines
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+log = logging.getLogger(__name__)
+
+FleetHost = namedtuple('FleetHost', 'name template variables')
+"""A host from a fleet hosts file - ``template`` is the absolute path to its master Pyre file"""
+
+FleetResult = namedtuple('FleetResult', 'host files duration error')
+"""
+The outcome of building one host: ``files`` are the output files written, ``duration`` is the number of seconds it
+took, and ``error`` holds the exception message if it failed (otherwise ``None``).
+"""
+
+_rgx_host = re.compile(r'^[\w.-]+$')
+
+_context: Optional[CompileContext] = None
+"""The compile context of a worker process, set by :func:`._init_worker`"""
+
+
+def load_fleet(path: str) -> List[FleetHost]:
+    """
+    Load the hosts from a fleet hosts file (see the module docs). Files ending in ``.json`` are read as JSON,
+    anything else as YAML.
+
+    :raises PyreException: When the file is invalid, or PyYAML isn't installed for a YAML file
+    """
+    with open(path, 'r') as fh:
+        if path.endswith('.json'):
+            data = json.load(fh)
+        elif yaml is None:
+            raise PyreException(f"PyYAML is required to read {path} - run 'pip3 install pyyaml', or use a .json file")
+        else:
+            data = yaml.safe_load(fh)
+    if not isinstance(data, dict) or not isinstance(data.get('hosts'), dict):
+        raise PyreException(f"The fleet hosts file {path} must contain a 'hosts' mapping of host names to variables")
+
+    base_dir, defaults = dirname(abspath(path)), dict(data.get('vars') or {})
+    hosts = []
+    for name, variables in data['hosts'].items():
+        name, variables = str(name), dict(variables or {})
+        if not _rgx_host.match(name):
+            raise PyreException(f"Invalid host name '{name}' in {path} (used as a file name, so only letters, numbers, "
+                                f"'_', '.' and '-' are allowed)")
+        template = variables.pop('template', data.get('template'))
+        if template is None:
+            raise PyreException(f"Host '{name}' in {path} has no template, and there's no default 'template'")
+        hosts.append(FleetHost(
+            name=name, template=join(base_dir, template), variables={**defaults, 'host': name, **variables}
+        ))
+    return hosts
+
+
+def _write(path: str, lines: List[str]):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as fh:
+        fh.write(''.join(f'{l}\n' for l in lines))
+    os.replace(tmp_path, path)
+
+
+def write_host(host: FleetHost, res: CompileResult, output_dir: str, backend: str = None) -> List[str]:
+    """
+    Write the compiled rules of ``host`` into ``output_dir`` as ``{name}.v4`` and ``{name}.v6`` (for
+    ``iptables-restore``), plus ``{name}.ipset`` (for ``ipset restore``) if the rules need any ipsets.
+    With the ``nft`` backend, a single ``{name}.nft`` (for ``nft -f``) is written instead, including the set elements.
+    """
+    if (conf.BACKEND if backend is None else backend) in ['nft', 'nftables']:
+        outputs = [(f'{host.name}.nft', res.v4 + element_lines(res.ipsets, remaining=False))]
+    else:
+        outputs = [(f'{host.name}.v4', res.v4), (f'{host.name}.v6', res.v6)]
+    if res.ipsets is not None and len(outputs) == 2:
+        outputs.append((f'{host.name}.ipset', restore_lines(res.ipsets)))
+    files = []
+    for name, lines in outputs:
+        _write(join(output_dir, name), lines)
+        files.append(join(output_dir, name))
+    return files
+
+
+def build_host(host: FleetHost, output_dir: str, context: CompileContext) -> FleetResult:
+    """Compile and write the rules of a single ``host`` (see :func:`.write_host`), catching any errors"""
+    start = time.time()
+    try:
+        res = compile_file(host.template, context, variables=host.variables)
+        files = write_host(host, res, output_dir, backend=context.backend)
+    except (PyreException, OSError, AttributeError) as e:
+        log.warning("Failed to build rules for host %s: %s %s", host.name, type(e).__name__, str(e))
+        return FleetResult(host=host.name, files=[], duration=time.time() - start, error=f'{type(e).__name__}: {e!s}')
+    return FleetResult(host=host.name, files=files, duration=time.time() - start, error=None)
+
+
+def _init_worker(context: CompileContext):
+    global _context
+    _context = context
+
+
+def _build_worker(host: FleetHost, output_dir: str) -> FleetResult:
+    return build_host(host, output_dir, _context)
+
+
+def build_fleet(hosts: List[FleetHost], output_dir: str, workers: int = None,
+                context: CompileContext = None) -> List[FleetResult]:
+    """
+    Compile the rules of every host in ``hosts`` (from :func:`.load_fleet`) and write them into ``output_dir``
+    (see :func:`.write_host`). A host failing to compile doesn't stop the others - check each result's ``error``.
+
+    :param List[FleetHost] hosts: The hosts to build
+    :param str output_dir: The folder to write the rules into (created if it doesn't exist)
+    :param int workers: Number of worker processes (default: :attr:`.conf.FLEET_WORKERS`), ``1`` = build in-process
+    :param CompileContext context: The settings to compile with. If it has no ``line_cache``, a new one is used.
+    :return List[FleetResult] results: The result of each host, in the same order as ``hosts``
+    """
+    workers = conf.FLEET_WORKERS if workers is None else int(workers)
+    context = CompileContext() if context is None else context
+    if context.line_cache is None:
+        context = CompileContext(
+            strict=context.strict, search_dirs=context.search_dirs, line_cache={}, backend=context.backend
+        )
+    os.makedirs(output_dir, exist_ok=True)
+    if len(hosts) == 0:
+        return []
+
+    # Building the first host in this process parses the shared templates, warming the cache for the workers
+    results = [build_host(hosts[0], output_dir, context)]
+    if workers <= 1 or len(hosts) == 1:
+        return results + [build_host(h, output_dir, context) for h in hosts[1:]]
+
+    # Forked workers inherit the warm cache (copy-on-write), instead of it being pickled into each worker
+    mp_context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+    chunksize = max(1, (len(hosts) - 1) // (workers * 4))
+    log.info("Building rules for %d hosts using %d worker processes", len(hosts), workers)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context, initializer=_init_worker,
+                             initargs=(context,)) as pool:
+        results += pool.map(_build_worker, hosts[1:], repeat(output_dir), chunksize=chunksize)
+    return results
@@ -0,0 +1,77 @@
+"""
+Loading every kind of ipset needed by compiled Pyre rules into the kernel.
+
+:py:attr:`.PyreParser.ipsets` holds the sets of both temporary rules (``drop from 1.2.3.4 for 30m``, see
+:mod:`privex.pyrewall.tempsets`) and ``@blocklist`` directives (see :mod:`privex.pyrewall.blocklist`). Each set
+has a ``type`` (``temp`` if missing) which decides how its ``ipset restore`` lines are generated:
+
+    - ``temp`` - created with a default timeout, with each entry added with its remaining time
+    - ``blocklist`` - its entire contents are atomically replaced using ``ipset swap``
+
+Basic usage:
+
+    >>> p = PyreParser()
+    >>> v4_rules, v6_rules = p.parse_lines(['@blocklist /etc/pyrewall/lists/drop.netset', 'drop from 1.2.3.4 for 30m'])
+    >>> apply_ipsets(p.ipsets)      # Must be loaded before the rules, as the rules reference the sets
+    >>> load_rules(v4_rules, 'v4')
+
+"""
+import logging
+from typing import Dict, Optional, List
+from privex.pyrewall.blocklist import blocklist_lines
+from privex.pyrewall.core import load_ipsets
+from privex.pyrewall.tempsets import temp_set_lines, restore_lines as temp_restore_lines
+
+log = logging.getLogger(__name__)
+
+
+def _split(ipsets: Optional[Dict[str, dict]]):
+    ipsets = {} if ipsets is None else ipsets
+    temp = {name: s for name, s in ipsets.items() if s.get('type', 'temp') == 'temp'}
+    blocklists = {name: s for name, s in ipsets.items() if s.get('type') == 'blocklist'}
+    return temp, blocklists
+
+
+def _blocklist_lines(blocklists: Dict[str, dict]) -> List[str]:
+    lines = []
+    for name, s in blocklists.items():
+        lines += blocklist_lines(name, s['family'], s['entries'], s['maxelem'])
+    return lines
+
+
+def select_ipsets(ipsets: Optional[Dict[str, dict]], v4=True, v6=True) -> Optional[Dict[str, dict]]:
+    """Filter ``ipsets`` (from :py:attr:`.PyreParser.ipsets`) to the IPv4 and/or IPv6 sets. Returns ``None`` if empty."""
+    families = (['inet'] if v4 else []) + (['inet6'] if v6 else [])
+    ipsets = {name: s for name, s in ({} if ipsets is None else ipsets).items() if s['family'] in families}
+    return ipsets if len(ipsets) > 0 else None
+
+
+def ipset_lines(ipsets: Optional[Dict[str, dict]], now: float = None, path: str = None) -> List[str]:
+    """
+    Generate the ``ipset restore`` lines to load every set in ``ipsets`` (from :py:attr:`.PyreParser.ipsets`) into
+    the kernel. Temporary rule sets are handled by :func:`.temp_set_lines` (``now`` and ``path`` are passed to it).
+    """
+    temp, blocklists = _split(ipsets)
+    return _blocklist_lines(blocklists) + (temp_set_lines(temp, now=now, path=path) if len(temp) > 0 else [])
+
+
+def restore_lines(ipsets: Optional[Dict[str, dict]]) -> List[str]:
+    """
+    Like :func:`.ipset_lines`, but temporary entries are added with their full duration, without tracking when
+    they were first loaded (e.g. for ``pyre parse`` output).
+    """
+    temp, blocklists = _split(ipsets)
+    return _blocklist_lines(blocklists) + temp_restore_lines(temp)
+
+
+def apply_ipsets(ipsets: Optional[Dict[str, dict]], netns: str = None):
+    """
+    Load the sets in ``ipsets`` (from :py:attr:`.PyreParser.ipsets`) into the kernel (see :func:`.ipset_lines`).
+    Does nothing if ``ipsets`` is empty / ``None``.
+
+    Should be called while holding the apply lock (see :class:`privex.pyrewall.apply.ApplyQueue`).
+    """
+    if not ipsets:
+        return None
+    log.info("Loading %d ipsets", len(ipsets))
+    return load_ipsets(ipset_lines(ipsets), netns=netns)
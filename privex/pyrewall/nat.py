@@ -0,0 +1,131 @@
+"""
+NAT targets and port mapping lists, for the ``forward-port`` / ``snat`` rule keywords and the ``@portmap`` directive.
+
+A port mapping list has one port forward per line - the destination port (or range) followed by the address to
+forward it to, with an optional port. Blank lines and anything after a ``#`` are skipped:
+
+.. code-block:: text
+
+    # port(s)    target
+    2201         10.0.0.1:22
+    2202         10.0.0.2:22
+    8000-8999    10.0.0.5          # Keeps the original port
+    443          [2a07:e00::5]:8443
+
+Instead of one rule per mapping, large lists are split into buckets of consecutive ports by :func:`.bucket_mappings`,
+so each packet is only compared against one rule per bucket, plus the mappings of its bucket (see
+:py:meth:`.Emitter.port_map`).
+
+    >>> mappings = read_portmap('/etc/pyrewall/portmap.txt')
+    >>> mappings[0]
+    PortMapping(start=2201, end=2201, target=NatTarget(address='10.0.0.1', port='22', ipver='v4'))
+
+"""
+import logging
+import math
+from ipaddress import ip_address
+from typing import List
+from privex.pyrewall.core import valid_port
+from privex.pyrewall.exceptions import RuleSyntaxError, InvalidPort
+from privex.pyrewall.types import NatTarget, PortMapping
+
+log = logging.getLogger(__name__)
+
+MIN_BUCKET = 16
+"""The minimum number of mappings per bucket - lists up to this size are output as plain rules"""
+
+
+def _parse_ports(ports: str) -> List[int]:
+    """Parse a port or port range (``8000-8999`` / ``8000:8999``) into ``[start, end]``"""
+    bounds = ports.replace(':', '-').split('-')
+    if len(bounds) not in [1, 2]:
+        raise InvalidPort(f'"{ports}" is not a valid port or port range')
+    start, end = valid_port(bounds[0]), valid_port(bounds[-1])
+    if start > end:
+        raise InvalidPort(f'The port range "{ports}" starts after it ends')
+    return [start, end]
+
+
+def parse_target(target: str) -> NatTarget:
+    """
+    Parse a NAT target such as ``10.0.0.5``, ``10.0.0.5:8080``, ``10.0.0.5:9000-9999`` or ``[2a07:e00::5]:80``
+
+        >>> parse_target('[2a07:e00::5]:80')
+        NatTarget(address='2a07:e00::5', port='80', ipver='v6')
+
+    :raises RuleSyntaxError: If ``target`` isn't a valid address, or has an invalid port
+    """
+    address, port = target, None
+    try:
+        if target.startswith('['):
+            if ']' not in target:
+                raise ValueError
+            address, _, rest = target[1:].partition(']')
+            port = rest[1:] if rest.startswith(':') and len(rest) > 1 else None
+            if rest != '' and port is None:
+                raise ValueError
+        elif target.count(':') == 1:
+            address, port = target.split(':')
+        addr = ip_address(address)
+        if port is not None:
+            start, end = _parse_ports(port)
+            port = str(start) if start == end else f'{start}-{end}'
+    except (ValueError, InvalidPort):
+        raise RuleSyntaxError(f'"{target}" is not a valid NAT target - expected e.g. "10.0.0.5", "10.0.0.5:8080" or '
+                              f'"[2a07:e00::5]:80"')
+    return NatTarget(address=str(addr), port=port, ipver=f'v{addr.version}')
+
+
+def format_target(target: NatTarget) -> str:
+    """The iptables / nftables form of a :class:`.NatTarget`, e.g. ``10.0.0.5:8080`` or ``[2a07:e00::5]:80``"""
+    if target.port is None:
+        return target.address
+    return f'[{target.address}]:{target.port}' if target.ipver == 'v6' else f'{target.address}:{target.port}'
+
+
+def read_portmap(path: str, strict=False) -> List[PortMapping]:
+    """
+    Read the port forwards of a port mapping list (see the module docs), sorted by port. Mappings can't translate
+    to a port range, and the ports of two mappings to the same IP version can't overlap.
+
+    :param str path: The absolute path to the port mapping list
+    :param bool strict: If ``True``, raise :class:`.RuleSyntaxError` for invalid lines instead of skipping them
+    :raises RuleSyntaxError: When two mappings overlap, or (in strict mode) for any invalid line
+    """
+    mappings = []
+    with open(path, 'r') as fh:
+        for lineno, line in enumerate(fh, start=1):
+            cols = line.split('#', 1)[0].split()
+            if len(cols) == 0:
+                continue
+            try:
+                if len(cols) != 2:
+                    raise RuleSyntaxError('expected a port (or port range) and a target address')
+                (start, end), target = _parse_ports(cols[0]), parse_target(cols[1])
+                if target.port is not None and '-' in target.port:
+                    raise RuleSyntaxError(f"mappings can't translate to a port range ({cols[1]})")
+            except (RuleSyntaxError, InvalidPort) as e:
+                if strict:
+                    raise RuleSyntaxError(f'(strict mode) Invalid port mapping in {path} line {lineno}: {e!s}')
+                log.warning('Skipping invalid port mapping in %s line %d: %s', path, lineno, str(e))
+                continue
+            mappings.append(PortMapping(start=start, end=end, target=target))
+
+    mappings.sort(key=lambda m: (m.target.ipver, m.start))
+    for prev, m in zip(mappings, mappings[1:]):
+        if prev.target.ipver == m.target.ipver and m.start <= prev.end:
+            raise RuleSyntaxError(f'Port mappings overlap in {path}: {prev.start}-{prev.end} and {m.start}-{m.end}')
+    return mappings
+
+
+def bucket_mappings(mappings: List[PortMapping]) -> List[List[PortMapping]]:
+    """
+    Split ``mappings`` (sorted by port) into buckets of consecutive ports, with about ``sqrt(len(mappings))``
+    mappings each (at least :attr:`.MIN_BUCKET`) - so a lookup checks about ``2 * sqrt(n)`` rules instead of ``n``.
+
+        >>> [len(b) for b in bucket_mappings([PortMapping(p, p, None) for p in range(1000)])]
+        [32, 32, 32, ..., 8]
+
+    """
+    size = max(MIN_BUCKET, math.ceil(math.sqrt(len(mappings))))
+    return [mappings[i:i + size] for i in range(0, len(mappings), size)]
@@ -0,0 +1,113 @@
+"""
+Applying one compiled ruleset into many network namespaces concurrently.
+
+The Pyre rules are compiled once, joined into a single iptables-restore payload per IP version, and then applied
+into each matching network namespace (via ``ip netns exec``) by a bounded pool of worker threads.
+
+Basic usage:
+
+    >>> v4_rules, v6_rules = PyreParser().parse_file('/etc/pyrewall/rules.pyre')
+    >>> namespaces = match_netns('ct-*', list_netns())
+    >>> for r in apply_netns(namespaces, v4=v4_rules, v6=v6_rules, workers=8):
+    ...     print(r.netns, 'OK' if r.ok else r.error, f'{r.duration:.3f}s')
+    ct-web1 OK 0.041s
+    ct-web2 OK 0.043s
+
+"""
+import logging
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatchcase
+from typing import List, Optional, Callable
+from privex.pyrewall import conf
+from privex.pyrewall.core import load_rules, load_ipsets
+from privex.pyrewall.ipsets import ipset_lines
+
+log = logging.getLogger(__name__)
+
+NetnsResult = namedtuple('NetnsResult', 'netns ok duration error')
+"""
+The outcome of applying rules into one network namespace: ``ok`` is ``True`` on success, ``duration`` is the
+number of seconds the apply took, and ``error`` holds the exception message if it failed (otherwise ``None``).
+"""
+
+RUNNER = Callable[[str, bytes, str], object]
+
+
+def list_netns(path: str = None) -> List[str]:
+    """List the names of the network namespaces known to ``ip netns`` (i.e. the entries in ``/var/run/netns``)"""
+    path = conf.NETNS_DIR if path is None else path
+    try:
+        return sorted(os.listdir(path))
+    except FileNotFoundError:
+        return []
+
+
+def match_netns(pattern: str, namespaces: List[str]) -> List[str]:
+    """
+    Filter ``namespaces`` using one or more comma separated glob patterns, or ``all`` to match every namespace.
+
+        >>> match_netns('ct-*,vpn1', ['ct-a', 'ct-b', 'vpn1', 'vpn2'])
+        ['ct-a', 'ct-b', 'vpn1']
+
+    """
+    if pattern == 'all':
+        return list(namespaces)
+    globs = pattern.split(',')
+    return [n for n in namespaces if any(fnmatchcase(n, g) for g in globs)]
+
+
+def netns_runner(netns: str, payload: bytes, ipver: str):
+    """
+    The default :func:`.apply_netns` runner - loads ``payload`` with ``ip netns exec [netns] iptables-restore``,
+    or ``ip netns exec [netns] ipset restore`` if ``ipver`` is ``ipset``
+    """
+    if ipver == 'ipset':
+        return load_ipsets(payload, netns=netns)
+    return load_rules(payload, ipver, netns=netns)
+
+
+def _payload(rules: Optional[List[str]]) -> Optional[bytes]:
+    if rules is None:
+        return None
+    return "\n".join(r.strip() for r in rules if r.strip() != '').encode() + b"\n"
+
+
+def apply_netns(namespaces: List[str], v4: List[str] = None, v6: List[str] = None, workers: int = None,
+                runner: RUNNER = None, ipsets: dict = None) -> List[NetnsResult]:
+    """
+    Apply compiled IPv4 and/or IPv6 rules into each of the network namespaces ``namespaces`` concurrently.
+
+    A failure in one namespace doesn't stop the others - check :attr:`.NetnsResult.ok` for each result.
+
+    :param List[str] namespaces: The names of the network namespaces to apply the rules into
+    :param List[str] v4: IPv4 iptables-restore lines, or ``None`` to leave the IPv4 rules untouched
+    :param List[str] v6: IPv6 iptables-restore lines, or ``None`` to leave the IPv6 rules untouched
+    :param int workers: Maximum amount of namespaces to apply concurrently (default: :attr:`.conf.NETNS_WORKERS`)
+    :param runner: A callable ``(netns, payload: bytes, ipver)`` which applies a payload into a namespace
+                   (default: :func:`.netns_runner`). ``ipver`` is ``ipset`` for the ipset payload.
+    :param dict ipsets: The ipsets needed by the rules (see :py:attr:`.PyreParser.ipsets`), loaded before the rules
+    :return List[NetnsResult] results: One result per namespace, in the same order as ``namespaces``
+    """
+    workers = conf.NETNS_WORKERS if workers is None else int(workers)
+    runner = netns_runner if runner is None else runner
+    # The payloads are only joined/encoded once, and shared between every worker
+    payloads = [(ipver, p) for ipver, p in [('v4', _payload(v4)), ('v6', _payload(v6))] if p is not None]
+    if ipsets:
+        payloads.insert(0, ('ipset', _payload(ipset_lines(ipsets))))
+
+    def _apply(netns: str) -> NetnsResult:
+        started = time.monotonic()
+        try:
+            for ipver, payload in payloads:
+                runner(netns, payload, ipver)
+        except Exception as e:
+            log.error("Failed to apply rules into network namespace %s - %s %s", netns, type(e), str(e))
+            return NetnsResult(netns=netns, ok=False, duration=time.monotonic() - started, error=str(e))
+        return NetnsResult(netns=netns, ok=True, duration=time.monotonic() - started, error=None)
+
+    log.info("Applying rules into %d network namespaces using %d workers", len(namespaces), workers)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        return list(pool.map(_apply, namespaces))
@@ -0,0 +1,132 @@
+"""
+Applying the output of the nftables backend (see :class:`.NFTEmitter`) into the kernel.
+
+The compiled script replaces the whole ``inet`` table :attr:`.conf.NFT_TABLE`, declaring (but not filling) the
+named sets of ``@blocklist`` and temporary rules. :func:`.apply_nft` appends the set elements - with the remaining
+time of each temporary entry (see :mod:`privex.pyrewall.tempsets`) - and loads everything with a single ``nft -f``,
+so the rules and sets are swapped in one atomic transaction. If anything fails, nothing is changed.
+
+Basic usage:
+
+    >>> p = PyreParser(emitter='nft')
+    >>> script, _ = p.parse_file('/etc/pyrewall/rules.pyre')
+    >>> saved = snapshot_nft()       # The current table, for rolling back with restore_nft(saved)
+    >>> apply_nft(script, p.ipsets)
+
+"""
+import logging
+from subprocess import PIPE
+from typing import Dict, List, Optional, Tuple
+from privex.helpers import stringify
+from privex.pyrewall import conf
+from privex.pyrewall.core import load_nft, run_prog, sudo_prefix, netns_prefix
+from privex.pyrewall.exceptions import IPTablesError
+from privex.pyrewall.tempsets import remaining_entries
+
+log = logging.getLogger(__name__)
+
+NFT_HOOKS: Dict[Tuple[str, str], Tuple[str, str, int]] = {
+    ('filter', 'INPUT'): ('filter', 'input', 0),
+    ('filter', 'FORWARD'): ('filter', 'forward', 0),
+    ('filter', 'OUTPUT'): ('filter', 'output', 0),
+    ('nat', 'PREROUTING'): ('nat', 'prerouting', -100),
+    ('nat', 'INPUT'): ('nat', 'input', 100),
+    ('nat', 'OUTPUT'): ('nat', 'output', -100),
+    ('nat', 'POSTROUTING'): ('nat', 'postrouting', 100),
+    ('raw', 'PREROUTING'): ('filter', 'prerouting', -300),
+    ('raw', 'OUTPUT'): ('filter', 'output', -300),
+    ('mangle', 'PREROUTING'): ('filter', 'prerouting', -150),
+    ('mangle', 'INPUT'): ('filter', 'input', -150),
+    ('mangle', 'FORWARD'): ('filter', 'forward', -150),
+    ('mangle', 'OUTPUT'): ('route', 'output', -150),
+    ('mangle', 'POSTROUTING'): ('filter', 'postrouting', -150),
+}
+"""
+The nftables ``(type, hook, priority)`` of each built-in iptables ``(table, chain)``. The priorities are the same as
+iptables', so the rules run in the same order relative to other netfilter users.
+"""
+
+ELEMENT_CHUNK = 10000
+"""The maximum number of elements added by a single ``add element`` statement"""
+
+
+def nft_chain(table: str, chain: str) -> str:
+    """The nftables chain name for the iptables ``chain`` of ``table`` - e.g. ``INPUT`` or ``nat_POSTROUTING``"""
+    return chain if table == 'filter' else f'{table}_{chain}'
+
+
+def set_declarations(ipsets: Optional[Dict[str, dict]]) -> List[str]:
+    """
+    The nftables ``set`` declarations for ``ipsets`` (from :py:attr:`.PyreParser.ipsets`)
+
+        >>> set_declarations({'pyre-tmp4-45deea69': {'family': 'inet', 'entries': [['1.2.3.4', 1800]]}})
+        ['set pyre-tmp4-45deea69 { type ipv4_addr; flags interval, timeout; }']
+
+    """
+    lines = []
+    for name, s in ({} if ipsets is None else ipsets).items():
+        flags = 'interval' if s.get('type') == 'blocklist' else 'interval, timeout'
+        lines.append(f"set {name} {{ type {'ipv6_addr' if s['family'] == 'inet6' else 'ipv4_addr'}; flags {flags}; }}")
+    return lines
+
+
+def element_lines(ipsets: Optional[Dict[str, dict]], table: str = None, remaining=True, now: float = None,
+                  path: str = None) -> List[str]:
+    """
+    Generate the ``add element`` statements filling the sets in ``ipsets`` (from :py:attr:`.PyreParser.ipsets`).
+
+    If ``remaining`` is True, temporary entries are added with their remaining time, and expired entries are skipped
+    (see :func:`.remaining_entries` - ``now`` and ``path`` are passed to it). Otherwise they're added with their full
+    duration, without tracking when they were first loaded (e.g. for ``pyre parse`` output).
+    """
+    ipsets = {} if ipsets is None else ipsets
+    table = conf.NFT_TABLE if table is None else table
+    temp = {name: s for name, s in ipsets.items() if s.get('type', 'temp') == 'temp'}
+    if remaining and len(temp) > 0:
+        temp_entries = remaining_entries(temp, now=now, path=path)
+    else:
+        temp_entries = {name: [tuple(e) for e in s['entries']] for name, s in temp.items()}
+
+    lines = []
+    for name, s in ipsets.items():
+        if name in temp:
+            entries = [f'{entry} timeout {timeout}s' for entry, timeout in temp_entries.get(name, [])]
+        else:
+            entries = s['entries'].split('\n') if s['entries'] != '' else []
+        for i in range(0, len(entries), ELEMENT_CHUNK):
+            lines.append(f"add element inet {table} {name} {{ {', '.join(entries[i:i + ELEMENT_CHUNK])} }}")
+    return lines
+
+
+def apply_nft(script: List[str], ipsets: Optional[Dict[str, dict]] = None, netns: str = None):
+    """
+    Load a script from the nftables backend plus the elements of its ``ipsets`` into the kernel, in a single
+    ``nft -f`` transaction.
+
+    Should be called while holding the apply lock (see :class:`privex.pyrewall.apply.ApplyQueue`).
+    """
+    lines = list(script) + element_lines(ipsets)
+    log.info("Loading nftables table inet %s (%d lines)", conf.NFT_TABLE, len(lines))
+    return load_nft(lines, netns=netns)
+
+
+def snapshot_nft(netns: str = None) -> List[str]:
+    """
+    Returns the current contents of the ``inet`` table :attr:`.conf.NFT_TABLE` (``nft list table``), or an empty list
+    if it doesn't exist - for rolling back with :func:`.restore_nft`
+    """
+    cmd = sudo_prefix() + netns_prefix(netns) + [conf.NFT_BIN, 'list', 'table', 'inet', conf.NFT_TABLE]
+    # stderr is kept separate from the listing, so we can tell a missing table apart from any other failure
+    res = run_prog(*cmd, stderr=PIPE)
+    if res.code != 0:
+        if 'No such file or directory' in stringify(res.stderr):
+            return []
+        log.error("Command stderr: %s", res.stderr)
+        raise IPTablesError(f"Non-zero return code ({res.code}) from command: {cmd}")
+    return stringify(res.stdout).split("\n")
+
+
+def restore_nft(saved: List[str], netns: str = None):
+    """Replace the ``inet`` table :attr:`.conf.NFT_TABLE` with a snapshot from :func:`.snapshot_nft`"""
+    t = conf.NFT_TABLE
+    return load_nft([f'table inet {t}', f'delete table inet {t}'] + list(saved), netns=netns)
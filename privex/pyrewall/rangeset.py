@@ -0,0 +1,97 @@
+"""
+Reading local IP range databases (e.g. country / ASN geo IP CSVs) for the ``@rangeset`` and ``@geoset`` Pyre
+directives.
+
+A range database is a CSV file where the first two columns of each row are the start and end of an IP range
+(inclusive) - either as IP addresses (e.g. DB-IP: ``1.0.0.0,1.0.0.255,AU``), or as integers (e.g. IP2Location:
+``"16777216","16777471","AU","Australia"``). The remaining columns (country codes, ASNs, names etc.) can be used
+to select only some of the rows. Blank lines and lines starting with ``#`` are skipped, and an invalid first row
+is treated as a header.
+
+The file is streamed row by row, keeping only the integer start/end of matching rows, which are then converted
+into the smallest list of CIDR subnets covering them with :func:`privex.pyrewall.cidr.summarise_ranges`
+(vectorised with NumPy when available).
+
+    >>> res = read_rangeset('/etc/pyrewall/geo/dbip-country-lite.csv', values=['CN', 'RU'])
+    >>> res.rows, res.matched, len(res.v4), len(res.v6)
+    (612304, 16789, 9102, 2211)
+
+"""
+import csv
+import logging
+from collections import namedtuple
+from typing import Optional, List, Tuple
+from privex.pyrewall.cidr import summarise_ranges, _inet_pton, _from_bytes, AF_INET, AF_INET6
+from privex.pyrewall.exceptions import RuleSyntaxError
+
+log = logging.getLogger(__name__)
+
+RangesetResult = namedtuple('RangesetResult', 'v4 v6 rows matched invalid')
+"""
+The result of :func:`.read_rangeset` - ``v4`` / ``v6`` are the aggregated subnets as ``List[str]``, ``rows`` is the
+number of valid rows in the file, ``matched`` the number of them selected by ``values``, and ``invalid`` is the
+number of rows which were skipped.
+"""
+
+V4_MAX = 0xFFFFFFFF
+
+
+def _parse_bound(value: str) -> Tuple[int, bool]:
+    """Parse a range start/end into ``(address, is_v6)`` - integers above ``V4_MAX`` are treated as IPv6"""
+    value = value.strip()
+    if value.isdigit():
+        num = int(value)
+        return num, num > V4_MAX
+    if ':' in value:
+        return _from_bytes(_inet_pton(AF_INET6, value), 'big'), True
+    return _from_bytes(_inet_pton(AF_INET, value), 'big'), False
+
+
+def read_rangeset(path: str, values: Optional[List[str]] = None, strict=False) -> RangesetResult:
+    """
+    Read and convert the IP ranges in the CSV range database ``path`` into aggregated CIDR subnets
+
+    :param str path: The absolute path to the CSV file
+    :param List[str] values: Only use rows where any column after the start/end matches one of these values
+                             (case insensitive), e.g. ``['CN', 'RU']``. Default: use every row.
+    :param bool strict: If ``True``, raise :class:`.RuleSyntaxError` on the first invalid row instead of skipping it
+    :return RangesetResult res: The aggregated IPv4 and IPv6 subnets
+    """
+    values = None if values is None else set(v.strip().upper() for v in values)
+    starts4, ends4, starts6, ends6 = [], [], [], []
+    rows, matched, invalid, header = 0, 0, 0, False
+    with open(path, 'r', newline='') as fh:
+        for lineno, row in enumerate(csv.reader(fh), start=1):
+            if len(row) == 0 or row[0].startswith('#'):
+                continue
+            try:
+                (start, start_v6), (end, end_v6) = _parse_bound(row[0]), _parse_bound(row[1])
+                if start > end or (start_v6 and not end_v6):
+                    raise ValueError(f"Range start {row[0]} is after its end {row[1]}")
+            except (IndexError, OSError, ValueError) as e:
+                if rows == 0 and invalid == 0 and not header:
+                    log.debug("Skipping header row in range database %s: %s", path, row)
+                    header = True
+                    continue
+                if strict:
+                    raise RuleSyntaxError(f"(strict mode) Invalid row in range database {path} line {lineno}: {e!s}")
+                invalid += 1
+                continue
+            rows += 1
+            if values is not None and not any(c.strip().upper() in values for c in row[2:]):
+                continue
+            matched += 1
+            # Integer databases can have an IPv6 range starting within IPv4 space (e.g. ``::`` to ``::fffe:ffff:ffff``)
+            if end_v6:
+                starts6.append(start)
+                ends6.append(end)
+            else:
+                starts4.append(start)
+                ends4.append(end)
+
+    if invalid > 0:
+        log.warning("Skipped %d invalid rows in range database %s", invalid, path)
+    return RangesetResult(
+        v4=summarise_ranges(starts4, ends4, 32), v6=summarise_ranges(starts6, ends6, 128),
+        rows=rows, matched=matched, invalid=invalid
+    )
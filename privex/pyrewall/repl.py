@@ -34,7 +34,7 @@ class PyreRepl:
     file = None
 
     buffer: List[str]
-    pyre = PyreParser()
+    pyre: PyreParser
     hist_file_name = '.pyre_repl_history'
 
     style = merge_styles([
@@ -52,6 +52,7 @@ class PyreRepl:
 
     def __init__(self, *args, **kwargs):
         self.buffer = []
+        self.pyre = PyreParser()
         self.hist_file = os.path.expanduser(f'~/{self.hist_file_name}')
         self.should_exit = False
         self.keywords = list(self.pyre.control_handlers.keys()) + list(self.pyre.rp.rule_handlers.keys())
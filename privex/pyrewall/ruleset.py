@@ -0,0 +1,392 @@
+"""
+A mutable object model of a firewall policy - :class:`.Ruleset` > :class:`.Table` > :class:`.Chain` > :class:`.Rule` -
+for programs which build and change policies in Python, instead of generating Pyre text and re-compiling all of it
+after every change.
+
+Each rule is a single Pyre rule line, compiled once when it's added to a chain. Every chain tracks whether it has
+changed (is "dirty"), so:
+
+ - :py:meth:`.Ruleset.render` only re-renders the chains which changed since they were last rendered, re-using
+   the cached lines of every other chain.
+ - :py:meth:`.Ruleset.delta` generates the minimal ``iptables-restore --noflush`` payload to bring the kernel from
+   the last applied state (see :py:meth:`.Ruleset.mark_clean`) to the current one - only the dirty chains are
+   flushed and re-filled, atomically within one transaction per table.
+
+Basic usage:
+
+    >>> rs = Ruleset()
+    >>> rs.chain('INPUT').policy = 'DROP'
+    >>> rs.append('INPUT', 'allow port 22 from 10.0.0.0/8')
+    >>> rs.add_chain('WEB')
+    >>> rs.append('WEB', 'allow port 80,443')
+    >>> rs.append('INPUT', 'ipt -A INPUT -j WEB')
+    >>> rs.apply()                   # Loads the delta of every (new) chain
+    >>> rs.replace('WEB', 0, 'allow port 80,443,8443')
+    >>> rs.delta('v4')               # Only the WEB chain changed
+    ['*filter', ':WEB - [0:0]', '-A WEB -p tcp -m multiport --dports 80,443,8443 -j ACCEPT', 'COMMIT']
+
+"""
+import logging
+from collections import OrderedDict
+from typing import List, Dict, Optional, Union, Iterator, Tuple
+from privex.pyrewall import conf
+from privex.pyrewall.RuleParser import RuleParser
+from privex.pyrewall.exceptions import RuleSyntaxError
+from privex.pyrewall.types import TempSet
+
+log = logging.getLogger(__name__)
+
+
+class Rule:
+    """
+    A single Pyre rule line (e.g. ``allow port 22``), compiled into the iptables rules for one chain.
+
+    Rules are immutable once created - use :py:meth:`.Chain.replace` to change a rule.
+    """
+    __slots__ = ('pyre', 'v4', 'v6', 'temp_sets')
+
+    def __init__(self, pyre: str, v4: List[str], v6: List[str], temp_sets: List[TempSet] = None):
+        self.pyre, self.v4, self.v6 = pyre, v4, v6
+        self.temp_sets = [] if temp_sets is None else temp_sets
+
+    @classmethod
+    def compile(cls, pyre: str, chain: str, table: str = 'filter', strict=False) -> 'Rule':
+        """
+        Compile the Pyre rule line ``pyre`` for the chain ``chain``
+
+        :raises RuleSyntaxError: If the rule is invalid, or outputs rules for any other chain (e.g. ``allow all``)
+        """
+        rp = RuleParser(rule_type=f'-A {chain}', table=table, strict=strict, emitter='iptables')
+        v4, v6 = rp.parse(pyre)
+        if v4 is None or v6 is None:
+            raise RuleSyntaxError(f"Unknown keyword in rule '{pyre}'")
+        prefix = f'-A {chain} '
+        for r in v4 + v6:
+            if not r.startswith('#') and not r.startswith(prefix):
+                raise RuleSyntaxError(f"Rule '{pyre}' outputs rules for a chain other than {chain}: {r}")
+        return cls(pyre, list(v4), list(v6), list(rp.last_sets))
+
+    def __getitem__(self, ipver: str) -> List[str]:
+        return self.v6 if ipver == 'v6' else self.v4
+
+    def __repr__(self):
+        return f'Rule({self.pyre!r})'
+
+
+class Chain:
+    """
+    An iptables chain within a :class:`.Table` - an ordered list of :class:`.Rule`'s, plus its policy (``-`` for
+    user defined chains).
+
+    Rules can be passed to the mutation methods as either Pyre rule lines (compiled for this chain), or
+    :class:`.Rule`'s compiled for this chain.
+    """
+    name: str
+    table: str
+    builtin: bool
+    """``True`` for the table's built-in chains (e.g. ``INPUT``), which can't be deleted and always have a policy"""
+    dirty: bool
+    """``True`` if the chain has changed since :py:meth:`.mark_clean` was last called (i.e. since it was applied)"""
+
+    def __init__(self, name: str, table: str = 'filter', policy: str = None, strict=False):
+        self.name, self.table, self.strict = name, table, strict
+        self.builtin = name in conf.DEFAULT_CHAINS.get(table, {})
+        self._policy = ('ACCEPT' if self.builtin else '-') if policy is None else policy
+        self.rules: List[Rule] = []
+        self.dirty = True
+        self._rendered = {}
+
+    def _changed(self):
+        self.dirty = True
+        self._rendered = {}
+
+    def _rule(self, rule: Union[str, Rule]) -> Rule:
+        return rule if isinstance(rule, Rule) else Rule.compile(rule, self.name, self.table, strict=self.strict)
+
+    @property
+    def policy(self) -> str:
+        return self._policy
+
+    @policy.setter
+    def policy(self, policy: str):
+        if not self.builtin and policy != '-':
+            raise RuleSyntaxError(f"User defined chain {self.name} can't have a policy")
+        if policy != self._policy:
+            self._policy = policy
+            self._changed()
+
+    def append(self, rule: Union[str, Rule]) -> Rule:
+        rule = self._rule(rule)
+        self.rules.append(rule)
+        self._changed()
+        return rule
+
+    def insert(self, index: int, rule: Union[str, Rule]) -> Rule:
+        rule = self._rule(rule)
+        self.rules.insert(index, rule)
+        self._changed()
+        return rule
+
+    def replace(self, index: int, rule: Union[str, Rule]) -> Rule:
+        rule = self._rule(rule)
+        self.rules[index] = rule
+        self._changed()
+        return rule
+
+    def remove(self, index: int) -> Rule:
+        rule = self.rules.pop(index)
+        self._changed()
+        return rule
+
+    def clear(self):
+        self.rules = []
+        self._changed()
+
+    def render(self, ipver: str = 'v4') -> List[str]:
+        """The iptables-restore lines of this chain's rules (cached until the chain changes)"""
+        if ipver not in self._rendered:
+            self._rendered[ipver] = [line for r in self.rules for line in r[ipver]]
+        return self._rendered[ipver]
+
+    def header(self) -> str:
+        return f':{self.name} {self._policy} [0:0]'
+
+    def mark_clean(self):
+        self.dirty = False
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __iter__(self) -> Iterator[Rule]:
+        return iter(self.rules)
+
+    def __getitem__(self, index: int) -> Rule:
+        return self.rules[index]
+
+    def __repr__(self):
+        return f'Chain({self.name!r}, table={self.table!r}, policy={self._policy!r}, rules={len(self.rules)})'
+
+
+class Table:
+    """An iptables table (e.g. ``filter``) within a :class:`.Ruleset` - an ordered collection of :class:`.Chain`'s"""
+
+    def __init__(self, name: str = 'filter', strict=False):
+        self.name, self.strict = name, strict
+        self.chains: Dict[str, Chain] = OrderedDict(
+            (c, Chain(c, name, policy=data[0], strict=strict)) for c, data in conf.DEFAULT_CHAINS.get(name, {}).items()
+        )
+        self.removed: List[str] = []
+        """User defined chains removed since the table was last marked clean, which must be deleted by the delta"""
+
+    def chain(self, name: str) -> Chain:
+        return self.chains[name]
+
+    def add_chain(self, name: str) -> Chain:
+        if name in self.chains:
+            raise RuleSyntaxError(f"Chain {name} already exists in table {self.name}")
+        self.chains[name] = chain = Chain(name, self.name, strict=self.strict)
+        if name in self.removed:
+            self.removed.remove(name)
+        return chain
+
+    def remove_chain(self, name: str) -> Chain:
+        chain = self.chains[name]
+        if chain.builtin:
+            raise RuleSyntaxError(f"Can't remove built-in chain {name} from table {self.name}")
+        del self.chains[name]
+        self.removed.append(name)
+        return chain
+
+    @property
+    def dirty(self) -> bool:
+        return len(self.removed) > 0 or any(c.dirty for c in self.chains.values())
+
+    def render(self, ipver: str = 'v4') -> List[str]:
+        lines = [f'*{self.name}'] + [c.header() for c in self.chains.values()]
+        for c in self.chains.values():
+            lines += c.render(ipver)
+        return lines + ['COMMIT', f'### End of table {self.name} ###']
+
+    def delta(self, ipver: str = 'v4') -> List[str]:
+        """
+        The ``iptables-restore --noflush`` lines which replace the dirty chains of this table, and delete its
+        removed chains (empty if nothing changed).
+
+        With ``--noflush``, declaring a user defined chain (``:NAME - [0:0]``) creates or flushes it, while
+        declaring a built-in chain only sets its policy - so built-in chains are flushed with ``-F``.
+        """
+        if not self.dirty:
+            return []
+        dirty = [c for c in self.chains.values() if c.dirty]
+        lines = [f'*{self.name}']
+        for c in dirty:
+            lines += [c.header(), f'-F {c.name}'] if c.builtin else [c.header()]
+        for c in dirty:
+            lines += c.render(ipver)
+        # Removed chains are deleted last, once the rules jumping to them have been replaced
+        for name in self.removed:
+            lines += [f'-F {name}', f'-X {name}']
+        return lines + ['COMMIT']
+
+    def mark_clean(self):
+        self.removed = []
+        for c in self.chains.values():
+            c.mark_clean()
+
+    def __repr__(self):
+        return f'Table({self.name!r}, chains={list(self.chains.keys())})'
+
+
+class Ruleset:
+    """
+    A mutable firewall policy made up of :class:`.Table`'s, with dirty tracking for incremental rendering and
+    minimal apply deltas. See the module documentation for usage.
+    """
+
+    def __init__(self, strict=False):
+        self.strict = strict
+        self.tables: Dict[str, Table] = OrderedDict(filter=Table('filter', strict=strict))
+
+    def table(self, name: str = 'filter') -> Table:
+        """Get the table ``name``, creating it (with its default chains) if it doesn't exist yet"""
+        if name not in self.tables:
+            self.tables[name] = Table(name, strict=self.strict)
+        return self.tables[name]
+
+    def chain(self, name: str, table: str = 'filter') -> Chain:
+        return self.table(table).chain(name)
+
+    def add_chain(self, name: str, table: str = 'filter') -> Chain:
+        return self.table(table).add_chain(name)
+
+    def remove_chain(self, name: str, table: str = 'filter') -> Chain:
+        return self.table(table).remove_chain(name)
+
+    def append(self, chain: str, rule: Union[str, Rule], table: str = 'filter') -> Rule:
+        return self.chain(chain, table).append(rule)
+
+    def insert(self, chain: str, index: int, rule: Union[str, Rule], table: str = 'filter') -> Rule:
+        return self.chain(chain, table).insert(index, rule)
+
+    def replace(self, chain: str, index: int, rule: Union[str, Rule], table: str = 'filter') -> Rule:
+        return self.chain(chain, table).replace(index, rule)
+
+    def remove(self, chain: str, index: int, table: str = 'filter') -> Rule:
+        return self.chain(chain, table).remove(index)
+
+    @property
+    def dirty(self) -> bool:
+        return any(t.dirty for t in self.tables.values())
+
+    @property
+    def ipsets(self) -> Optional[dict]:
+        """The ipsets needed by temporary (``for 30m``) rules, in the same format as :py:attr:`.PyreParser.ipsets`"""
+        sets = OrderedDict()
+        for t in self.tables.values():
+            for c in t.chains.values():
+                for r in c.rules:
+                    for ts in r.temp_sets:
+                        sets.setdefault(ts.name, dict(family=ts.family, entries=[]))['entries'] += [list(e) for e in ts.entries]
+        return sets if len(sets) > 0 else None
+
+    def render(self, ipver: str = 'v4') -> List[str]:
+        """
+        The complete iptables-restore lines for the ruleset (like :py:meth:`.PyreParser.parse_lines`). Only the
+        chains which changed since they were last rendered are re-rendered.
+        """
+        lines = []
+        for t in self.tables.values():
+            lines += t.render(ipver)
+        return lines
+
+    def delta(self, ipver: str = 'v4') -> List[str]:
+        """
+        The minimal ``iptables-restore --noflush`` lines to apply the changes made since :py:meth:`.mark_clean`
+        was last called (empty if nothing changed). Until the ruleset is first marked clean, every chain is dirty.
+        """
+        lines = []
+        for t in self.tables.values():
+            lines += t.delta(ipver)
+        return lines
+
+    def mark_clean(self):
+        """Mark every table / chain as clean, i.e. the current ruleset has been applied to the kernel"""
+        for t in self.tables.values():
+            t.mark_clean()
+
+    def apply(self, ipvers: Tuple[str, ...] = ('v4', 'v6'), queue=None) -> Dict[str, List[str]]:
+        """
+        Apply the changes since the ruleset was last applied (see :py:meth:`.delta`) to the kernel, while holding
+        the apply lock, then mark the ruleset clean.
+
+        :param tuple ipvers: The IP versions to apply
+        :param ApplyQueue queue: The :class:`.ApplyQueue` whose lock to hold (default: a new ``ApplyQueue()``)
+        :return dict deltas: The delta lines which were loaded, per IP version
+        """
+        from privex.pyrewall.apply import ApplyQueue
+        from privex.pyrewall.core import load_rules
+        from privex.pyrewall.ipsets import apply_ipsets
+
+        queue = ApplyQueue() if queue is None else queue
+        deltas = {ipver: self.delta(ipver) for ipver in ipvers}
+        with queue.exclusive():
+            apply_ipsets(self.ipsets)
+            for ipver, lines in deltas.items():
+                if len(lines) > 0:
+                    load_rules(lines, ipver, noflush=True)
+        self.mark_clean()
+        return deltas
+
+    @classmethod
+    def from_pyre(cls, lines: List[str], strict=False) -> 'Ruleset':
+        """
+        Build a ruleset from Pyre rule lines. Rules which output into several chains (e.g. ``allow all``) are
+        split into one :class:`.Rule` per chain. Only the ``@table`` and ``@chain`` directives are supported.
+
+            >>> rs = Ruleset.from_pyre(['@chain INPUT DROP', 'allow all from 10.0.0.0/8'])
+            >>> [len(c) for c in rs.table('filter').chains.values()]
+            [1, 1, 1]
+
+        """
+        rs, table = cls(strict=strict), 'filter'
+        for line in lines:
+            sline = line.split()
+            if len(sline) == 0 or sline[0].startswith('#'):
+                continue
+            if sline[0] == '@table':
+                table = sline[1]
+                rs.table(table)
+                continue
+            if sline[0] == '@chain':
+                t = rs.table(table)
+                chain = t.chains[sline[1]] if sline[1] in t.chains else t.add_chain(sline[1])
+                if chain.builtin:
+                    chain.policy = sline[2] if len(sline) > 2 else 'ACCEPT'
+                continue
+            if sline[0].startswith('@'):
+                raise RuleSyntaxError(f"Directive {sline[0]} isn't supported by Ruleset.from_pyre")
+            rp = RuleParser(table=table, strict=strict, emitter='iptables')
+            # 'all' outputs the rule into every known chain of the table
+            rp.chains = OrderedDict((c.name, [c.policy, '[0:0]']) for c in rs.table(table).chains.values())
+            v4, v6 = rp.parse(line)
+            if v4 is None or v6 is None:
+                raise RuleSyntaxError(f"Unknown keyword in rule '{line.strip()}'")
+            for chain, rule in _split_chains(line.strip(), v4, v6, rp.last_sets).items():
+                rs.chain(chain, table).append(rule)
+        return rs
+
+
+def _split_chains(pyre: str, v4: List[str], v6: List[str], temp_sets: List[TempSet]) -> Dict[str, Rule]:
+    """Split a compiled Pyre rule into a :class:`.Rule` per chain (comments are kept with the following rule)"""
+    rules, pending = OrderedDict(), dict(v4=[], v6=[])
+    for ipver, lines in [('v4', v4), ('v6', v6)]:
+        for line in lines:
+            if line.startswith('#'):
+                pending[ipver].append(line)
+                continue
+            chain = line.split()[1]
+            if chain not in rules:
+                rules[chain] = Rule(pyre, [], [], temp_sets if len(rules) == 0 else [])
+            rules[chain][ipver].extend(pending[ipver] + [line])
+            pending[ipver] = []
+    return rules
@@ -0,0 +1,187 @@
+"""
+Content-addressed store of iptables rule snapshots, used for backing up rules before a load, and instant rollback.
+
+Each snapshot references a normalised ``iptables-save`` payload per IP version. Payloads are stored gzip compressed
+in ``objects/``, named by the SHA256 hash of their contents - so identical rule states are only ever stored once,
+no matter how many snapshots reference them. The snapshot list itself lives in ``index.json``, and is pruned to
+:attr:`privex.pyrewall.conf.SNAPSHOT_RETAIN` entries (unreferenced objects are deleted during pruning).
+
+Basic usage:
+
+    >>> store = SnapshotStore()
+    >>> snap = store.take(v4=True, v6=True, source='/etc/pyrewall/rules.pyre')  # Snapshot the current kernel rules
+    >>> # ... load some new rules, then something breaks ...
+    >>> store.restore(store.get(1))                                             # Restore the newest snapshot
+
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+from collections import namedtuple
+from datetime import datetime
+from os import makedirs
+from os.path import expanduser, join, exists
+from typing import List, Optional
+from privex.pyrewall import conf
+from privex.pyrewall.core import save_rules, load_rules
+
+log = logging.getLogger(__name__)
+
+Snapshot = namedtuple('Snapshot', 'id time v4 v6 source')
+"""
+A single snapshot from the :class:`.SnapshotStore` index. ``v4`` / ``v6`` are the object hashes of the IPv4 / IPv6
+payloads (or ``None`` if that IP version wasn't snapshotted), ``time`` is an ISO8601 UTC timestamp.
+"""
+
+_rgx_counters = re.compile(r'\[[0-9]+:[0-9]+\]')
+
+
+def normalise_save(lines: List[str]) -> bytes:
+    """
+    Normalise ``iptables-save`` output into a stable payload suitable for hashing and ``iptables-restore``.
+
+    Comment lines (which contain a timestamp) and blank lines are removed, and packet/byte counters are
+    zeroed, so that two saves of an unchanged ruleset always produce identical bytes.
+
+        >>> normalise_save(['# Generated by iptables-save on Mon Jan 1', '*filter', ':INPUT ACCEPT [12:3456]', 'COMMIT'])
+        b'*filter\\n:INPUT ACCEPT [0:0]\\nCOMMIT\\n'
+
+    """
+    out = []
+    for l in lines:
+        l = l.strip()
+        if l == '' or l[0] == '#':
+            continue
+        out.append(_rgx_counters.sub('[0:0]', l))
+    return ("\n".join(out) + "\n").encode()
+
+
+class SnapshotStore:
+    """
+    A content-addressed snapshot store - see the module docstring of :mod:`privex.pyrewall.snapshots`.
+
+    All methods which modify the store should be called while holding the apply lock
+    (see :class:`privex.pyrewall.apply.ApplyQueue`), to avoid concurrent index updates.
+    """
+    INDEX_FILE = 'index.json'
+    OBJECT_DIR = 'objects'
+
+    def __init__(self, path: str = None, retain: int = None):
+        self.path = expanduser(join(conf.STATE_DIR, 'snapshots') if path is None else path)
+        self.retain = conf.SNAPSHOT_RETAIN if retain is None else int(retain)
+        makedirs(join(self.path, self.OBJECT_DIR), exist_ok=True)
+
+    @property
+    def index_path(self) -> str: return join(self.path, self.INDEX_FILE)
+
+    def object_path(self, obj_hash: str) -> str: return join(self.path, self.OBJECT_DIR, f'{obj_hash}.gz')
+
+    def _read_index(self) -> List[dict]:
+        try:
+            with open(self.index_path) as fh:
+                return json.load(fh)
+        except FileNotFoundError:
+            return []
+
+    def _write_index(self, index: List[dict]):
+        tmp_path = f'{self.index_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as fh:
+            json.dump(index, fh, indent=1)
+        os.replace(tmp_path, self.index_path)
+
+    def put_object(self, data: bytes) -> str:
+        """Store ``data`` (if it isn't already stored) and return its hash"""
+        obj_hash = hashlib.sha256(data).hexdigest()
+        path = self.object_path(obj_hash)
+        if exists(path):
+            log.debug("Snapshot object %s already exists, not storing it again.", obj_hash)
+            return obj_hash
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with gzip.open(tmp_path, 'wb', compresslevel=conf.SNAPSHOT_COMPRESS) as fh:
+            fh.write(data)
+        os.replace(tmp_path, path)
+        return obj_hash
+
+    def get_object(self, obj_hash: str) -> bytes:
+        with gzip.open(self.object_path(obj_hash), 'rb') as fh:
+            return fh.read()
+
+    def list(self) -> List[Snapshot]:
+        """List all snapshots, newest first"""
+        return [Snapshot(**s) for s in reversed(self._read_index())]
+
+    def get(self, n: int = 1) -> Snapshot:
+        """
+        Get the ``n``'th newest snapshot (``1`` = the newest snapshot)
+
+        :raises IndexError: When there are less than ``n`` snapshots
+        """
+        snaps = self.list()
+        if n < 1 or n > len(snaps):
+            raise IndexError(f"Snapshot number {n} does not exist - there are {len(snaps)} snapshots.")
+        return snaps[n - 1]
+
+    def record(self, v4: Optional[bytes] = None, v6: Optional[bytes] = None, source: str = None) -> Snapshot:
+        """
+        Record a snapshot of the given (already normalised) IPv4 and/or IPv6 payloads.
+
+        If the newest snapshot references exactly the same payloads, no new snapshot is added, and the
+        existing one is returned instead.
+        """
+        v4_hash = None if v4 is None else self.put_object(v4)
+        v6_hash = None if v6 is None else self.put_object(v6)
+        index = self._read_index()
+        if len(index) > 0 and index[-1]['v4'] == v4_hash and index[-1]['v6'] == v6_hash:
+            log.info("Current rules are identical to snapshot %s - not recording a new snapshot.", index[-1]['id'])
+            return Snapshot(**index[-1])
+
+        snap = Snapshot(
+            id=(index[-1]['id'] + 1) if len(index) > 0 else 1, time=datetime.utcnow().replace(microsecond=0).isoformat(),
+            v4=v4_hash, v6=v6_hash, source=source
+        )
+        index.append(snap._asdict())
+        self._write_index(index)
+        self.prune()
+        return snap
+
+    def take(self, v4=True, v6=True, source: str = None) -> Snapshot:
+        """Snapshot the rules currently loaded into the kernel using ``iptables-save`` / ``ip6tables-save``"""
+        return self.record(
+            v4=normalise_save(save_rules('v4')) if v4 else None,
+            v6=normalise_save(save_rules('v6')) if v6 else None,
+            source=source
+        )
+
+    def restore(self, snap: Snapshot, ipver='both'):
+        """
+        Restore a :class:`.Snapshot` into the kernel, directly from the stored payload bytes.
+
+        :param Snapshot snap: The snapshot to restore
+        :param str ipver: ``v4`` / ``v6`` to only restore one IP version, or ``both``
+        """
+        if snap.v4 is not None and ipver in ['4', 'v4', 'ipv4', 'both']:
+            log.info("Restoring IPv4 rules from snapshot %s (object %s)", snap.id, snap.v4)
+            load_rules(self.get_object(snap.v4), 'v4')
+        if snap.v6 is not None and ipver in ['6', 'v6', 'ipv6', 'both']:
+            log.info("Restoring IPv6 rules from snapshot %s (object %s)", snap.id, snap.v6)
+            load_rules(self.get_object(snap.v6), 'v6')
+
+    def prune(self) -> List[str]:
+        """Trim the index to :attr:`.retain` snapshots, and delete any objects no longer referenced by it"""
+        index = self._read_index()
+        if len(index) > self.retain > 0:
+            index = index[-self.retain:]
+            self._write_index(index)
+
+        referenced = set(s[k] for s in index for k in ['v4', 'v6'] if s[k] is not None)
+        removed = []
+        for fname in os.listdir(join(self.path, self.OBJECT_DIR)):
+            if not fname.endswith('.gz') or fname[:-3] in referenced:
+                continue
+            log.debug("Removing unreferenced snapshot object %s", fname)
+            os.remove(join(self.path, self.OBJECT_DIR, fname))
+            removed.append(fname[:-3])
+        return removed
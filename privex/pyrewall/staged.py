@@ -0,0 +1,249 @@
+"""
+Staged ("zero-gap") application of compiled rules, using versioned chains and ``ipset swap``.
+
+A normal load replaces entire tables with ``iptables-restore``. A staged apply instead works in three small
+``iptables-restore --noflush`` transactions per IP version:
+
+ 1. **Stage** - every chain of the new ruleset is created under a versioned name, e.g. ``INPUT`` becomes
+    ``PYRE7-INPUT``, and populated with the new rules (jumps to user chains are renamed to match). Live traffic
+    is unaffected, as nothing jumps to the new generation yet.
+ 2. **Swap** - each built-in chain's single jump rule is replaced with a jump into the new generation
+    (``-R INPUT 1 -j PYRE7-INPUT``), and the built-in chain policies are set - a change of one rule per chain,
+    whatever the size of the ruleset. Any other jump into an older generation (e.g. from a table or built-in chain
+    which the new ruleset no longer contains) is deleted, so that nothing references the old chains any more.
+ 3. **Garbage collect** - the chains of every older generation are flushed and deleted.
+
+ipsets are staged the same way: the new contents are loaded into a temporary set, which is then atomically
+exchanged with the live set using ``ipset swap`` (see :func:`.ipset_swap_lines`).
+
+Basic usage:
+
+    >>> v4_rules, v6_rules = PyreParser().parse_file('/etc/pyrewall/rules.pyre')
+    >>> plan = apply_staged(v4_rules, 'v4')
+    >>> plan.generation
+    7
+
+"""
+import logging
+import re
+from collections import namedtuple, OrderedDict
+from typing import List, Dict, Set, Iterable
+from privex.pyrewall.core import save_rules, load_rules
+from privex.pyrewall.exceptions import StagedApplyError
+
+log = logging.getLogger(__name__)
+
+CHAIN_PREFIX = 'PYRE'
+MAX_CHAIN_LEN = 28
+"""The maximum length of an iptables chain name (``XT_EXTENSION_MAXNAMELEN - 1``)"""
+MAX_SET_LEN = 31
+"""The maximum length of an ipset name (``IPSET_MAXNAMELEN - 1``)"""
+MAX_GENERATION = 999
+"""Generation numbers wrap back around to the lowest unused number after this, to keep chain names short"""
+
+BUILTIN_CHAINS = {
+    'filter': ['INPUT', 'FORWARD', 'OUTPUT'],
+    'nat': ['PREROUTING', 'INPUT', 'OUTPUT', 'POSTROUTING'],
+    'mangle': ['PREROUTING', 'INPUT', 'FORWARD', 'OUTPUT', 'POSTROUTING'],
+    'raw': ['PREROUTING', 'OUTPUT'],
+    'security': ['INPUT', 'FORWARD', 'OUTPUT'],
+}
+
+_rgx_gen_chain = re.compile(r'^' + CHAIN_PREFIX + r'([0-9]+)-')
+_jump_flags = ['-j', '--jump', '-g', '--goto']
+_chain_flags = ['-A', '--append', '-I', '--insert']
+
+StagedPlan = namedtuple('StagedPlan', 'generation stage swap gc')
+"""
+The three ``iptables-restore --noflush`` payloads (each a ``List[str]``) making up a staged apply, plus the
+``generation`` number of the new chains.
+"""
+
+
+def gen_chain(generation: int, chain: str) -> str:
+    """
+    Returns the versioned name of ``chain`` for a given generation
+
+        >>> gen_chain(7, 'INPUT')
+        'PYRE7-INPUT'
+
+    """
+    name = f'{CHAIN_PREFIX}{generation}-{chain}'
+    if len(name) > MAX_CHAIN_LEN:
+        raise StagedApplyError(
+            f"Chain name '{chain}' is too long for a staged apply - '{name}' is over {MAX_CHAIN_LEN} characters."
+        )
+    return name
+
+
+def split_tables(lines: Iterable[str]) -> Dict[str, dict]:
+    """
+    Split iptables-restore / iptables-save lines into a dict of tables, each containing an (ordered) dict of
+    ``chains`` (chain name -> policy) and a list of ``rules`` (with comments and counters removed).
+
+        >>> split_tables(['*filter', ':INPUT DROP [0:0]', '-A INPUT -j ACCEPT', 'COMMIT'])
+        {'filter': {'chains': OrderedDict([('INPUT', 'DROP')]), 'rules': ['-A INPUT -j ACCEPT']}}
+
+    """
+    tables, table = OrderedDict(), None
+    for l in lines:
+        l = l.strip()
+        if l == '' or l[0] == '#' or l == 'COMMIT':
+            continue
+        if l[0] == '*':
+            table = tables.setdefault(l[1:], dict(chains=OrderedDict(), rules=[]))
+            continue
+        if table is None:
+            raise StagedApplyError(f"Rule found outside of a table (missing '*table' line?): {l}")
+        if l[0] == ':':
+            chain = l[1:].split()
+            table['chains'][chain[0]] = chain[1] if len(chain) > 1 else '-'
+            continue
+        if l[0] == '[':
+            l = l.split(None, 1)[1]
+        table['rules'].append(l)
+    return tables
+
+
+def rename_rule(rule: str, renames: Dict[str, str]) -> str:
+    """
+    Rename the chain a rule is appended/inserted into, along with any chain it jumps to, using ``renames``
+
+        >>> rename_rule('-A INPUT -p tcp -j MYCHAIN', {'INPUT': 'PYRE2-INPUT', 'MYCHAIN': 'PYRE2-MYCHAIN'})
+        '-A PYRE2-INPUT -p tcp -j PYRE2-MYCHAIN'
+
+    """
+    words = rule.split(' ')
+    for i, w in enumerate(words[:-1]):
+        if w in _chain_flags or w in _jump_flags:
+            words[i + 1] = renames.get(words[i + 1], words[i + 1])
+    return ' '.join(words)
+
+
+def live_generations(current: Dict[str, dict]) -> Set[int]:
+    """Returns the generation numbers of all staged chains found in ``current`` (output of :func:`.split_tables`)"""
+    gens = set()
+    for tdata in current.values():
+        for chain in tdata['chains']:
+            m = _rgx_gen_chain.match(chain)
+            if m: gens.add(int(m.group(1)))
+    return gens
+
+
+def _stale_jumps(live: dict, flushed: Set[str], replaced: Set[tuple]) -> List[str]:
+    """
+    Returns ``-D`` lines for the rules in ``live`` (a table from :func:`.split_tables`) which jump into a staged chain
+    from outside of one, except for those the swap already removes - rules in the ``flushed`` chains, and the
+    ``(chain, position)`` jumps in ``replaced``.
+    """
+    lines, positions = [], {}
+    for r in live['rules']:
+        words = r.split()
+        chain = words[1]
+        positions[chain] = pos = positions.get(chain, 0) + 1
+        if chain in flushed or (chain, pos) in replaced or _rgx_gen_chain.match(chain):
+            continue
+        if any(w in _jump_flags and _rgx_gen_chain.match(target) for w, target in zip(words, words[1:])):
+            lines.append('-D' + r[2:])
+    return lines
+
+
+def plan_staged(rules: List[str], current_rules: List[str]) -> StagedPlan:
+    """
+    Build the stage / swap / garbage collection payloads to move from ``current_rules`` (the output of
+    ``iptables-save``) to the compiled ``rules`` (e.g. from :meth:`.PyreParser.parse_file`)
+
+    :param List[str] rules: The new iptables-restore rules to apply
+    :param List[str] current_rules: The rules currently loaded into the kernel, as output by ``iptables-save``
+    :return StagedPlan plan: The payloads making up the staged apply
+    """
+    new, current = split_tables(rules), split_tables(current_rules)
+    old_gens = live_generations(current)
+    generation = max(old_gens) + 1 if len(old_gens) > 0 else 1
+    if generation > MAX_GENERATION:
+        generation = min(g for g in range(1, MAX_GENERATION + 2) if g not in old_gens)
+    stage, swap, gc = [], [], []
+
+    for table, tdata in new.items():
+        builtins = BUILTIN_CHAINS.get(table, [])
+        renames = {c: gen_chain(generation, c) for c in tdata['chains']}
+        stage += [f'*{table}'] + [f':{renames[c]} - [0:0]' for c in tdata['chains']]
+        stage += [rename_rule(r, renames) for r in tdata['rules']] + ['COMMIT']
+
+        live = current.get(table, dict(chains={}, rules=[]))
+        flushed, replaced = set(), set()
+        swap.append(f'*{table}')
+        for chain, policy in tdata['chains'].items():
+            if chain not in builtins:
+                continue
+            if policy != '-':
+                swap.append(f':{chain} {policy} [0:0]')
+            # Find the position of the previous generation's jump within the built-in chain, so we can replace
+            # just that one rule. Otherwise this is the first staged apply, and the chain is rebuilt from scratch.
+            chain_rules = [r for r in live['rules'] if r.split()[1] == chain]
+            pos = next((
+                i for i, r in enumerate(chain_rules, start=1)
+                if re.fullmatch(r'-A ' + chain + r' -j ' + CHAIN_PREFIX + r'[0-9]+-' + chain, r)
+            ), None)
+            if pos is None:
+                swap += [f'-F {chain}', f'-A {chain} -j {renames[chain]}']
+                flushed.add(chain)
+            else:
+                swap.append(f'-R {chain} {pos} -j {renames[chain]}')
+                replaced.add((chain, pos))
+        # Deleted after the -R's above, as deleting a rule first would shift the positions being replaced
+        swap += _stale_jumps(live, flushed, replaced) + ['COMMIT']
+
+    # Tables dropped from the new ruleset may still jump into the old generation, which would stop gc deleting it
+    for table, tdata in current.items():
+        stale = [] if table in new else _stale_jumps(tdata, set(), set())
+        if len(stale) > 0:
+            swap += [f'*{table}'] + stale + ['COMMIT']
+
+    for table, tdata in current.items():
+        old_chains = [c for c in tdata['chains'] if _rgx_gen_chain.match(c)]
+        if len(old_chains) == 0:
+            continue
+        # Any references between the old chains must be removed (by flushing them all) before they can be deleted
+        gc += [f'*{table}'] + [f'-F {c}' for c in old_chains] + [f'-X {c}' for c in old_chains] + ['COMMIT']
+
+    return StagedPlan(generation=generation, stage=stage, swap=swap, gc=gc)
+
+
+def apply_staged(rules: List[str], ipver='v4') -> StagedPlan:
+    """
+    Apply the compiled ``rules`` for IP version ``ipver`` using a staged apply (see module docstring).
+
+    :raises StagedApplyError: If a chain name is too long once versioned
+    :raises IPTablesError: If any of the stage / swap / gc transactions fail
+    """
+    plan = plan_staged(rules, save_rules(ipver))
+    log.info("Staging %s rules as generation %d", ipver, plan.generation)
+    load_rules(plan.stage, ipver, noflush=True)
+    log.info("Swapping %s built-in chains into generation %d", ipver, plan.generation)
+    load_rules(plan.swap, ipver, noflush=True)
+    if len(plan.gc) > 0:
+        log.info("Removing previous %s rule generations", ipver)
+        load_rules(plan.gc, ipver, noflush=True)
+    return plan
+
+
+def ipset_swap_lines(name: str, create_args: str, entries: Iterable[str], generation: int = None) -> List[str]:
+    """
+    Generate ``ipset restore`` lines which atomically replace the contents of the set ``name`` with ``entries``,
+    by populating a temporary set and exchanging it with the live set using ``ipset swap``.
+
+        >>> ipset_swap_lines('blocklist', 'hash:net family inet', ['10.0.0.0/8', '1.2.3.4'], generation=2)
+        ['create blocklist hash:net family inet -exist', 'create blocklist-g2 hash:net family inet -exist',
+         'flush blocklist-g2', 'add blocklist-g2 10.0.0.0/8', 'add blocklist-g2 1.2.3.4',
+         'swap blocklist-g2 blocklist', 'destroy blocklist-g2']
+
+    """
+    tmp_name = f'{name}-g{1 if generation is None else generation}'
+    if len(tmp_name) > MAX_SET_LEN:
+        raise StagedApplyError(f"ipset name '{name}' is too long to be staged - '{tmp_name}' is over {MAX_SET_LEN} chars.")
+    lines = [f'create {name} {create_args} -exist', f'create {tmp_name} {create_args} -exist', f'flush {tmp_name}']
+    lines += [f'add {tmp_name} {e}' for e in entries]
+    lines += [f'swap {tmp_name} {name}', f'destroy {tmp_name}']
+    return lines
+
@@ -0,0 +1,135 @@
+"""
+Loading the ipsets behind temporary Pyre rules (e.g. ``drop from 1.2.3.4 for 30m``) into the kernel.
+
+Each temporary rule compiles into a single rule matching an ipset (see :py:meth:`.RuleBuilder._build_temp`), while
+its addresses are added to the set with a ``timeout`` - so the kernel removes them once they expire, without any
+cron job or reload.
+
+A temporary rule's duration counts from the first time it was loaded, not from every load. The time each entry was
+first loaded is recorded in ``STATE_DIR/tempsets.json``, so re-loading the rules (e.g. ``pyre load``, or the
+daemon reloading after an unrelated change) only adds each entry with its *remaining* time, and entries which
+have already expired aren't added back. Changing a rule's duration starts it again from the new duration.
+
+Basic usage:
+
+    >>> p = PyreParser()
+    >>> v4_rules, v6_rules = p.parse_lines(['drop from 1.2.3.4 for 30m'])
+    >>> apply_temp_sets(p.ipsets)      # Must be loaded before the rules, as the rules reference the sets
+    >>> load_rules(v4_rules, 'v4')
+
+Callers loading the output of :py:attr:`.PyreParser.ipsets` should generally use :mod:`privex.pyrewall.ipsets`
+instead, which also loads the sets of ``@blocklist`` directives.
+
+"""
+import json
+import logging
+import os
+import time
+from os import makedirs
+from os.path import expanduser, join, dirname
+from typing import List, Dict, Optional, Tuple
+from privex.pyrewall import conf
+from privex.pyrewall.core import load_ipsets
+
+log = logging.getLogger(__name__)
+
+
+def state_path() -> str:
+    """The path of the file recording when each temporary rule entry was first loaded"""
+    return join(expanduser(conf.STATE_DIR), 'tempsets.json')
+
+
+def create_lines(ipsets: Dict[str, dict]) -> List[str]:
+    """
+    Returns the ``ipset restore`` lines to create the sets in ``ipsets`` (from :py:attr:`.PyreParser.ipsets`)
+
+        >>> create_lines({'pyre-tmp4-45deea69': {'family': 'inet', 'entries': [['1.2.3.4', 1800]]}})
+        ['create pyre-tmp4-45deea69 hash:net family inet timeout 0 -exist']
+
+    """
+    return [f"create {name} hash:net family {s['family']} timeout 0 -exist" for name, s in ipsets.items()]
+
+
+def restore_lines(ipsets: Dict[str, dict]) -> List[str]:
+    """
+    Returns ``ipset restore`` lines to create the sets in ``ipsets`` and add every entry with its full duration,
+    without tracking when entries were first loaded (e.g. for ``pyre parse`` output).
+    """
+    lines = create_lines(ipsets)
+    for name, s in ipsets.items():
+        lines += [f'add {name} {entry} timeout {timeout} -exist' for entry, timeout in s['entries']]
+    return lines
+
+
+def remaining_entries(ipsets: Optional[Dict[str, dict]], now: float = None,
+                      path: str = None) -> Dict[str, List[Tuple[str, int]]]:
+    """
+    Returns the unexpired entries of each set in ``ipsets`` (from :py:attr:`.PyreParser.ipsets`) as
+    ``(entry, remaining_seconds)`` tuples, keyed by set name.
+
+    The first-loaded times in ``path`` (default: :func:`.state_path`) are updated - new entries are recorded as
+    first loaded at ``now``, and entries no longer in the sets are forgotten. Entries of sets which aren't in
+    ``ipsets`` at all (e.g. the IPv6 sets during an IPv4 only load) are kept until they expire.
+
+    :param dict ipsets: The ipsets from :py:attr:`.PyreParser.ipsets` (``None`` is treated as no sets)
+    :param float now: The current UNIX time (default: :func:`time.time`)
+    :param str path: Override the path of the first-loaded times state file
+    """
+    ipsets = {} if ipsets is None else ipsets
+    now = time.time() if now is None else now
+    path = state_path() if path is None else path
+    try:
+        with open(path) as fh:
+            first_loaded = json.load(fh)
+    except (FileNotFoundError, ValueError):
+        first_loaded = {}
+
+    res = {}
+    seen = {
+        k: t for k, t in first_loaded.items() if k.split(' ')[0] not in ipsets and t + int(k.split(' ')[2]) > now
+    }
+    for name, s in ipsets.items():
+        res[name] = []
+        for entry, timeout in s['entries']:
+            key = f'{name} {entry} {timeout}'
+            seen[key] = first_loaded.get(key, now)
+            remaining = int(timeout - (now - seen[key]))
+            if remaining < 1:
+                log.debug("Temporary entry %s in set %s has expired - not adding it.", entry, name)
+                continue
+            res[name].append((entry, remaining))
+
+    makedirs(dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as fh:
+        json.dump(seen, fh)
+    os.replace(tmp_path, path)
+    return res
+
+
+def temp_set_lines(ipsets: Optional[Dict[str, dict]], now: float = None, path: str = None) -> List[str]:
+    """
+    Generate the ``ipset restore`` lines to create the sets in ``ipsets`` (from :py:attr:`.PyreParser.ipsets`), and
+    add each entry with its remaining time - skipping entries which have already expired
+    (see :func:`.remaining_entries` - ``now`` and ``path`` are passed to it).
+
+    :return List[str] lines: ``ipset restore`` lines
+    """
+    ipsets = {} if ipsets is None else ipsets
+    lines = create_lines(ipsets)
+    for name, entries in remaining_entries(ipsets, now=now, path=path).items():
+        lines += [f'add {name} {entry} timeout {remaining} -exist' for entry, remaining in entries]
+    return lines
+
+
+def apply_temp_sets(ipsets: Optional[Dict[str, dict]], netns: str = None):
+    """
+    Create the sets in ``ipsets`` (from :py:attr:`.PyreParser.ipsets`) and load their unexpired entries into the
+    kernel (see :func:`.temp_set_lines`). Does nothing if ``ipsets`` is empty / ``None``.
+
+    Should be called while holding the apply lock (see :class:`privex.pyrewall.apply.ApplyQueue`).
+    """
+    if not ipsets:
+        return None
+    log.info("Loading %d temporary rule ipsets", len(ipsets))
+    return load_ipsets(temp_set_lines(ipsets), netns=netns)
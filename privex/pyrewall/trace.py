@@ -0,0 +1,589 @@
+"""
+Simulating which compiled rule decides a packet - used by ``pyre trace``, to check that a policy does what's expected
+(e.g. against samples of real traffic) before loading it.
+
+The rules of the ``filter`` table are normalised by :class:`.SaveParser`, and walked like the kernel would: following
+jumps into (and returns from) user chains, skipping non-terminating targets such as ``LOG``, until a verdict or the
+chain policy decides the packet. Each chain is indexed by protocol and destination port, so only the rules which can
+match a packet's protocol / port are checked.
+
+Matches which can't be simulated (e.g. ``limit``, ``recent`` or ``--tcp-flags``) are never assumed to match - the rules
+which would otherwise have matched the packet are listed in :py:attr:`.TraceResult.uncertain` instead.
+
+    >>> t = PacketTracer.from_file('/etc/pyrewall/rules.pyre')
+    >>> t.trace('tcp 1.2.3.4:5555 -> 10.0.0.1:443 in eth0')
+    TraceResult(flow=Flow(protocol='tcp', src='1.2.3.4', sport=5555, dst='10.0.0.1', dport=443, in_iface='eth0',
+                out_iface=None, state='new', chain='INPUT'), verdict='ACCEPT', rule='-A INPUT -p tcp --dport 443 -j ACCEPT',
+                source=RuleSource(file='/etc/pyrewall/rules.pyre', line=12, text='allow port 443'), chains=('INPUT',),
+                uncertain=())
+
+Large batches of flows (e.g. from a CSV file, see :func:`.read_flows`) are traced with :py:meth:`.PacketTracer.trace_many`,
+which matches every IPv4 flow sharing a protocol / port index entry at once using vectorised NumPy arithmetic, if
+NumPy is installed (``pip3 install pyrewall[fast]``).
+
+"""
+import csv
+import logging
+from bisect import bisect_right
+from collections import namedtuple
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+from privex.pyrewall.PyreParser import PyreParser
+from privex.pyrewall.SaveParser import SaveParser
+from privex.pyrewall.cidr import RANGE, aggregate, parse_v4, parse_v6
+from privex.pyrewall.diff import PROTOCOLS
+from privex.pyrewall.exceptions import RuleSyntaxError
+from privex.pyrewall.nat import parse_target
+from privex.pyrewall.types import NatTarget, RuleSource, SavedRule
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+HAS_NUMPY = numpy is not None
+
+log = logging.getLogger(__name__)
+
+Flow = namedtuple('Flow', 'protocol src sport dst dport in_iface out_iface state chain')
+"""
+A packet to trace (see :func:`.parse_flow`). ``sport`` / ``dport`` are integers, or None for protocols without ports -
+for ICMP, ``dport`` is the ICMP type instead. ``state`` is its conntrack state (e.g. ``new``), and ``chain`` is the
+built-in chain it enters.
+"""
+
+TraceResult = namedtuple('TraceResult', 'flow verdict rule source chains uncertain')
+"""
+The outcome of tracing a :class:`.Flow`. ``verdict`` is the target which decided it (e.g. ``ACCEPT``), ``rule`` and
+``source`` are the deciding iptables rule and its :class:`.RuleSource` (both None if the chain policy decided it),
+``chains`` are the chains it passed through in order, and ``uncertain`` are the rules it may have matched first, which
+use matches that can't be simulated.
+"""
+
+TraceRule = namedtuple('TraceRule', 'rule source saved conditions unsupported kind target')
+"""
+A compiled rule prepared for tracing - ``conditions`` is a list of ``(kind, value, negated)`` checks, ``unsupported``
+the matches which can't be simulated, and ``kind`` is ``verdict`` / ``jump`` / ``goto`` / ``return`` / ``continue``
+(for non-terminating targets such as ``LOG``).
+"""
+
+NON_TERMINATING_TARGETS = {
+    'LOG', 'NFLOG', 'ULOG', 'MARK', 'CONNMARK', 'HMARK', 'TCPMSS', 'TRACE', 'AUDIT', 'CLASSIFY', 'CT', 'NOTRACK', 'DSCP',
+    'TOS', 'TTL', 'HL', 'TEE', 'SECMARK', 'CONNSECMARK',
+}
+"""Targets which packets continue past to the next rule"""
+
+STATES = ['new', 'established', 'related', 'invalid', 'untracked']
+
+MAX_DEPTH = 64
+"""The maximum depth of chain jumps followed, in case of loops"""
+
+_NO_PORT = -1
+
+
+def target_kind(target: Optional[str], chains) -> str:
+    """
+    What a :py:attr:`.SavedRule.target` does with matching packets - ``verdict``, ``jump`` / ``goto`` (into one of the
+    ``chains`` of the rule's table), ``return``, or ``continue`` (for non-terminating targets, or no target)
+
+        >>> target_kind('-j LOG --log-prefix "ssh "', ['INPUT', 'web']), target_kind('-j web', ['INPUT', 'web'])
+        ('continue', 'jump')
+
+    """
+    if target is None:
+        return 'continue'
+    flag, name = target.split()[:2]
+    if flag == '-g':
+        return 'goto'
+    if name == 'RETURN':
+        return 'return'
+    if name in chains:
+        return 'jump'
+    return 'continue' if name in NON_TERMINATING_TARGETS else 'verdict'
+
+
+def _family(addr: str) -> str:
+    return 'v6' if ':' in addr else 'v4'
+
+
+def _addr_int(addr: str) -> int:
+    return (parse_v6(addr) if ':' in addr else parse_v4(addr))[0]
+
+
+def _port(value: Optional[Union[str, int]], what: str) -> Optional[int]:
+    if value is None or value == '':
+        return None
+    value = str(value)
+    if not value.isdigit() or int(value) > 65535:
+        raise RuleSyntaxError(f"Invalid {what} '{value}'")
+    return int(value)
+
+
+def _norm_protocol(proto: str) -> str:
+    proto = proto.lower()
+    return {'icmpv6': 'ipv6-icmp', 'icmp6': 'ipv6-icmp'}.get(proto, PROTOCOLS.get(proto, proto))
+
+
+def _parse_endpoint(value: str, what: str, spec: str) -> NatTarget:
+    try:
+        return parse_target(value)
+    except RuleSyntaxError:
+        raise RuleSyntaxError(f"Invalid flow {what} '{value}' in '{spec}' - expected e.g. '1.2.3.4', '1.2.3.4:5555' "
+                              f"or '[2a07:e00::1]:443'")
+
+
+def parse_flow(spec: str) -> Flow:
+    """
+    Parse a flow description: ``(proto) [src(:port)] -> [dst(:port)] (in iface) (out iface) (state s) (type n)
+    (chain name)``. IPv6 addresses with a port are written as ``[2a07:e00::1]:443``. The protocol defaults to
+    ``tcp``, the state to ``new``, and the chain to ``FORWARD`` if both interfaces are given, ``OUTPUT`` if only
+    ``out`` is given, otherwise ``INPUT``.
+
+        >>> parse_flow('udp 1.2.3.4:5353 -> 10.0.0.1:53 in eth0')
+        Flow(protocol='udp', src='1.2.3.4', sport=5353, dst='10.0.0.1', dport=53, in_iface='eth0', out_iface=None,
+             state='new', chain='INPUT')
+
+    :raises RuleSyntaxError: If the flow is invalid
+    """
+    args = spec.split()
+    if '->' not in args or args.index('->') not in [1, 2] or args.index('->') == len(args) - 1:
+        raise RuleSyntaxError(f"Invalid flow '{spec}' - expected e.g. 'tcp 1.2.3.4:5555 -> 10.0.0.1:443 in eth0'")
+    i = args.index('->')
+    proto = _norm_protocol(args[0]) if i == 2 else 'tcp'
+    src, dst = _parse_endpoint(args[i - 1], 'source', spec), _parse_endpoint(args[i + 1], 'destination', spec)
+    if src.ipver != dst.ipver:
+        raise RuleSyntaxError(f"The source and destination of flow '{spec}' must be the same IP version")
+    opts, rest = {}, args[i + 2:]
+    while len(rest) > 0:
+        if rest[0] not in ['in', 'out', 'state', 'type', 'chain'] or len(rest) < 2:
+            raise RuleSyntaxError(f"Invalid flow option '{rest[0]}' in '{spec}'")
+        opts[rest[0]], rest = rest[1], rest[2:]
+    state = opts.get('state', 'new').lower()
+    if state not in STATES:
+        raise RuleSyntaxError(f"Invalid flow state '{state}' - expected one of: {', '.join(STATES)}")
+    chain = opts.get('chain')
+    if chain is None:
+        chain = 'FORWARD' if 'in' in opts and 'out' in opts else ('OUTPUT' if 'out' in opts else 'INPUT')
+    return Flow(
+        protocol=proto, src=src.address, sport=_port(src.port, 'source port'), dst=dst.address,
+        dport=_port(opts['type'], 'ICMP type') if 'type' in opts else _port(dst.port, 'destination port'),
+        in_iface=opts.get('in'), out_iface=opts.get('out'), state=state, chain=chain
+    )
+
+
+def read_flows(path: str) -> Iterator[Flow]:
+    """
+    Read flows from a CSV file with a header row, using the columns named like the fields of :class:`.Flow` (only
+    ``src`` and ``dst`` are required - missing / empty columns get the same defaults as :func:`.parse_flow`)
+
+    :raises RuleSyntaxError: If a row is invalid
+    """
+    with open(path, 'r', newline='') as fh:
+        for n, row in enumerate(csv.DictReader(fh), start=2):
+            row = {k.strip().lower(): (v or '').strip() for k, v in row.items() if k is not None}
+            try:
+                spec = f"{row.get('protocol') or 'tcp'} {row['src']} -> {row['dst']}"
+                for opt, col in [('in', 'in_iface'), ('out', 'out_iface'), ('state', 'state'), ('chain', 'chain')]:
+                    spec += f' {opt} {row[col]}' if row.get(col) else ''
+                flow = parse_flow(spec)
+                yield flow._replace(sport=_port(row.get('sport'), 'source port'),
+                                    dport=_port(row.get('dport'), 'destination port'))
+            except (KeyError, RuleSyntaxError) as e:
+                raise RuleSyntaxError(f"Invalid flow on line {n} of {path}: {e!s}")
+
+
+def _ranges(value: str, parse) -> List[RANGE]:
+    return [parse(v) for v in value.split(',')]
+
+
+def _port_ranges(value: str) -> List[RANGE]:
+    res = []
+    for p in value.split(','):
+        start, sep, end = p.partition(':')
+        res.append((int(start or 0), int(end or 65535)) if sep != '' else (int(start), int(start)))
+    return res
+
+
+def _neg(value: str) -> Tuple[str, bool]:
+    return (value[2:], True) if value.startswith('! ') else (value, False)
+
+
+def _iface_match(pattern: str, iface: Optional[str]) -> bool:
+    if iface is None:
+        return False
+    return iface.startswith(pattern[:-1]) if pattern.endswith('+') else iface == pattern
+
+
+def _in_ranges(x: int, ranges: List[RANGE]) -> bool:
+    for lo, hi in ranges:
+        if lo <= x <= hi:
+            return True
+    return False
+
+
+def _in_set(x: int, starts: List[int], ends: List[int]) -> bool:
+    i = bisect_right(starts, x) - 1
+    return i >= 0 and x <= ends[i]
+
+
+class _ChainIndex:
+    """The candidate rules of a chain per protocol and destination port interval (see :py:meth:`.lookup`)"""
+
+    def __init__(self, rules: List[TraceRule]):
+        protos = {c[1] for r in rules for c in r.conditions if c[0] == 'proto' and not c[2]}
+        self.protos = {p: self._build(rules, p) for p in list(protos) + [None]}
+
+    @staticmethod
+    def _build(rules: List[TraceRule], proto: Optional[str]) -> Tuple[List[int], List[List[int]]]:
+        relevant = []
+        for i, r in enumerate(rules):
+            cond = {c[0]: c for c in r.conditions}
+            p = cond.get('proto')
+            if p is not None and not p[2] and p[1] != proto:
+                continue
+            d = cond.get('dports')
+            relevant.append((i, None if d is None or d[2] else d[1]))
+        # Each interval between two boundaries is either fully covered by a rule's ports, or not at all
+        bounds = sorted({_NO_PORT, 0} | {b for _, ranges in relevant if ranges for lo, hi in ranges for b in (lo, hi + 1)})
+        candidates = [
+            [i for i, ranges in relevant if ranges is None or _in_ranges(b, ranges)] for b in bounds
+        ]
+        return bounds, candidates
+
+    def lookup(self, proto: str, dport: Optional[int]) -> List[int]:
+        """The indexes of the rules which can match packets of ``proto`` to ``dport``"""
+        bounds, candidates = self.protos.get(proto, self.protos[None])
+        return candidates[bisect_right(bounds, _NO_PORT if dport is None else dport) - 1]
+
+    def intervals(self, proto: str):
+        """The ``(boundaries, candidates)`` of ``proto``, for looking up many ports at once"""
+        return self.protos.get(proto, self.protos[None])
+
+
+class PacketTracer:
+    """
+    Traces flows through the ``filter`` table of compiled rules (see the module docs).
+
+    :param dict rules: The iptables-restore lines per IP version, e.g. ``dict(v4=[...], v6=[...])``
+    :param dict origins: The :class:`.RuleSource` of each line per IP version (optional)
+    :param dict ipsets: The ipsets used by the rules, e.g. from :py:attr:`.PyreParser.ipsets` (optional)
+    """
+    rules: Dict[str, List[TraceRule]]
+    """Every traced rule per IP version"""
+    chains: Dict[str, Dict[str, List[int]]]
+    """The indexes (into :py:attr:`.rules`) of each chain's rules, per IP version"""
+    policies: Dict[str, Dict[str, str]]
+    """The policy of each built-in chain per IP version"""
+
+    def __init__(self, rules: Dict[str, List[str]], origins: Dict[str, List[Optional[RuleSource]]] = None,
+                 ipsets: Dict[str, dict] = None):
+        self.sets = self._load_sets({} if ipsets is None else ipsets)
+        self.rules, self.chains, self.policies, self.index = {}, {}, {}, {}
+        for ipver, lines in rules.items():
+            self._load(ipver, lines, (origins or {}).get(ipver))
+
+    @classmethod
+    def from_parser(cls, parser: PyreParser) -> 'PacketTracer':
+        """Create a tracer for the rules of a :class:`.PyreParser` which has already parsed its rules"""
+        out, origins = parser.output, parser.output_origins
+        return cls(dict(v4=out.v4, v6=out.v6), dict(v4=origins.v4, v6=origins.v6), parser.ipsets)
+
+    @classmethod
+    def from_file(cls, path: str, **parser_args) -> 'PacketTracer':
+        """Compile the Pyre file ``path`` (with ``parser_args`` for the :class:`.PyreParser`), and create a tracer for it"""
+        p = PyreParser(**{**parser_args, 'emitter': 'iptables'})
+        p.parse_file(path)
+        return cls.from_parser(p)
+
+    @staticmethod
+    def _load_sets(ipsets: Dict[str, dict]) -> Dict[str, Tuple[List[int], List[int]]]:
+        sets = {}
+        for name, s in ipsets.items():
+            entries = s.get('entries', [])
+            entries = entries.split('\n') if isinstance(entries, str) else [e[0] for e in entries]
+            parse, ranges = parse_v6 if s.get('family') == 'inet6' else parse_v4, []
+            for e in entries:
+                try:
+                    ranges.append(parse(e.strip()))
+                except ValueError:
+                    continue
+            ranges = aggregate(ranges)
+            sets[name] = ([r[0] for r in ranges], [r[1] for r in ranges])
+        return sets
+
+    def _load(self, ipver: str, lines: List[str], origins: Optional[List[Optional[RuleSource]]]):
+        sp, table = SaveParser(ipver), None
+        rules, chains, policies = [], {}, {}
+        for n, line in enumerate(lines):
+            line = line.strip()
+            if line.startswith('*'):
+                table = line[1:]
+            elif table != 'filter' or line == '' or line[0] == '#':
+                continue
+            elif line[0] == ':':
+                name, policy = (line[1:].split() + ['-'])[:2]
+                chains.setdefault(name, [])
+                if policy != '-':
+                    policies[name] = policy
+            elif line.startswith('-A '):
+                saved = sp.parse_rule(line, table)
+                chains.setdefault(saved.chain, []).append(len(rules))
+                rules.append(self._compile(saved, line, None if origins is None else origins[n], ipver))
+        # Jumps can only be told apart from other targets once every chain is known
+        for i, r in enumerate(rules):
+            rules[i] = r._replace(kind=target_kind(r.saved.target, chains))
+        self.rules[ipver], self.chains[ipver], self.policies[ipver] = rules, chains, policies
+        self.index[ipver] = {name: _ChainIndex([rules[i] for i in idx]) for name, idx in chains.items()}
+
+    def _compile(self, saved: SavedRule, line: str, source: Optional[RuleSource], ipver: str) -> TraceRule:
+        parse = parse_v6 if ipver == 'v6' else parse_v4
+        conditions, unsupported = [], []
+        if saved.protocol is not None:
+            proto, neg = _neg(saved.protocol)
+            conditions.append(('proto', proto, neg))
+        for kind in ['src', 'dst', 'sports', 'dports', 'in_iface', 'out_iface']:
+            value = dict(src=saved.source, dst=saved.destination).get(kind, getattr(saved, kind, None))
+            if value is None:
+                continue
+            value, neg = _neg(value)
+            try:
+                if kind in ['src', 'dst']:
+                    value = _ranges(value, parse)
+                elif kind in ['sports', 'dports']:
+                    value = _port_ranges(value)
+            except ValueError:
+                unsupported.append(f'{kind} {value}')
+                continue
+            conditions.append((kind, value, neg))
+
+        for m in saved.matches:
+            tokens = m.split()
+            neg = '!' in tokens
+            opts = [t for t in tokens[2:] if t != '!']
+            module = tokens[1] if len(tokens) > 1 and tokens[0] == '-m' else None
+            if module == 'conntrack' and len(opts) == 2 and opts[0] == '--ctstate':
+                conditions.append(('state', {s.lower() for s in opts[1].split(',')}, neg))
+            elif module in ['icmp', 'icmp6'] and len(opts) == 2 and opts[1].split('/')[0].isdigit():
+                conditions.append(('icmp_type', int(opts[1].split('/')[0]), neg))
+            elif module == 'set' and len(opts) == 3 and opts[0] == '--match-set' and opts[2] in ['src', 'dst'] \
+                    and opts[1] in self.sets:
+                conditions.append(('set_' + opts[2], self.sets[opts[1]], neg))
+            else:
+                unsupported.append(m)
+
+        name = None if saved.target is None else saved.target.split()[1]
+        return TraceRule(rule=line, source=source, saved=saved, conditions=conditions, unsupported=unsupported,
+                         kind=None, target=name)
+
+    @staticmethod
+    def _matches(r: TraceRule, flow: Flow, src: int, dst: int) -> bool:
+        for kind, value, neg in r.conditions:
+            if kind == 'proto':
+                res = flow.protocol == value
+            elif kind == 'src' or kind == 'dst':
+                res = _in_ranges(src if kind == 'src' else dst, value)
+            elif kind == 'sports' or kind == 'dports':
+                port = flow.sport if kind == 'sports' else flow.dport
+                res = port is not None and flow.protocol not in ['icmp', 'ipv6-icmp'] and _in_ranges(port, value)
+            elif kind == 'in_iface' or kind == 'out_iface':
+                res = _iface_match(value, getattr(flow, kind))
+            elif kind == 'state':
+                res = flow.state in value
+            elif kind == 'icmp_type':
+                res = flow.dport == value
+            else:
+                res = _in_set(src if kind == 'set_src' else dst, *value)
+            if res == neg:
+                return False
+        return True
+
+    def trace(self, flow: Union[str, Flow]) -> TraceResult:
+        """
+        Trace a single flow (a :class:`.Flow`, or a flow description for :func:`.parse_flow`) through the rules,
+        returning the :class:`.TraceResult` with the rule which decided it
+        """
+        flow = parse_flow(flow) if isinstance(flow, str) else flow
+        ipver = _family(flow.src)
+        if ipver not in self.rules:
+            raise RuleSyntaxError(f"There are no IP{ipver} rules to trace flow {flow} through")
+        rules, chains, index = self.rules[ipver], self.chains[ipver], self.index[ipver]
+        src, dst = _addr_int(flow.src), _addr_int(flow.dst)
+        path, uncertain = [flow.chain], []
+        # Each stack entry is a chain being walked and the position of its next candidate rule
+        stack = [(flow.chain, index[flow.chain].lookup(flow.protocol, flow.dport) if flow.chain in index else [], 0)]
+        while len(stack) > 0:
+            chain, cands, pos = stack.pop()
+            while pos < len(cands):
+                r, pos = rules[chains[chain][cands[pos]]], pos + 1
+                if r.kind == 'continue' or not self._matches(r, flow, src, dst):
+                    continue
+                if len(r.unsupported) > 0:
+                    uncertain.append(r.rule)
+                    continue
+                if r.kind == 'verdict':
+                    return TraceResult(flow, r.target, r.rule, r.source, tuple(path), tuple(uncertain))
+                if r.kind in ['jump', 'goto'] and len(stack) < MAX_DEPTH:
+                    if r.kind == 'jump':
+                        stack.append((chain, cands, pos))
+                    path.append(r.target)
+                    stack.append((r.target, index[r.target].lookup(flow.protocol, flow.dport), 0))
+                    break
+                if r.kind == 'return':
+                    break
+        policy = self.policies[ipver].get(flow.chain, 'ACCEPT')
+        return TraceResult(flow, policy, None, None, tuple(path), tuple(uncertain))
+
+    def trace_many(self, flows: Iterable[Union[str, Flow]], use_numpy: bool = None) -> List[TraceResult]:
+        """
+        Trace many flows, returning their results in the same order. IPv4 flows are matched in bulk with NumPy
+        (see the module docs) if ``use_numpy`` is True, or by default if NumPy is installed.
+        """
+        flows = [parse_flow(f) if isinstance(f, str) else f for f in flows]
+        use_numpy = HAS_NUMPY if use_numpy is None else use_numpy
+        if use_numpy and not HAS_NUMPY:
+            raise ImportError("trace_many(use_numpy=True) requires NumPy - install it with: pip3 install numpy")
+        if not use_numpy or 'v4' not in self.rules:
+            return [self.trace(f) for f in flows]
+        v4 = [i for i, f in enumerate(flows) if _family(f.src) == 'v4']
+        results: List[Optional[TraceResult]] = [None] * len(flows)
+        for i, res in zip(v4, _VectorTrace(self, [flows[i] for i in v4]).run()):
+            results[i] = res
+        return [self.trace(f) if r is None else r for f, r in zip(flows, results)]
+
+
+class _VectorTrace:
+    """Traces a batch of IPv4 flows through a :class:`.PacketTracer` with vectorised NumPy matching"""
+
+    def __init__(self, tracer: PacketTracer, flows: Sequence[Flow]):
+        np = numpy
+        self.tracer, self.flows = tracer, flows
+        self.rules, self.chains, self.index = tracer.rules['v4'], tracer.chains['v4'], tracer.index['v4']
+        self.protos, self.ifaces, self.states = {}, {None: 0}, {}
+        col = lambda vals: np.array(vals, dtype=np.int64)
+        self.proto = col([self.protos.setdefault(f.protocol, len(self.protos)) for f in flows])
+        self.src, self.dst = col([_addr_int(f.src) for f in flows]), col([_addr_int(f.dst) for f in flows])
+        self.sport = col([_NO_PORT if f.sport is None else f.sport for f in flows])
+        self.dport = col([_NO_PORT if f.dport is None else f.dport for f in flows])
+        self.in_iface = col([self.ifaces.setdefault(f.in_iface, len(self.ifaces)) for f in flows])
+        self.out_iface = col([self.ifaces.setdefault(f.out_iface, len(self.ifaces)) for f in flows])
+        self.state = col([self.states.setdefault(f.state, len(self.states)) for f in flows])
+        self.portless = np.isin(self.proto, [self.protos.get('icmp', -1), self.protos.get('ipv6-icmp', -1)])
+        self.decided = np.full(len(flows), -1, dtype=np.int64)
+        self.events: List[Tuple[str, object, object]] = []
+
+    def _mask(self, r: TraceRule, idx):
+        np = numpy
+        m = np.ones(len(idx), dtype=bool)
+        for kind, value, neg in r.conditions:
+            if kind == 'proto':
+                res = self.proto[idx] == self.protos.get(value, -1)
+            elif kind in ['src', 'dst', 'sports', 'dports']:
+                x = getattr(self, kind.rstrip('s'))[idx]
+                res = np.zeros(len(idx), dtype=bool)
+                for lo, hi in value:
+                    res |= (x >= lo) & (x <= hi)
+                if kind in ['sports', 'dports']:
+                    res &= ~self.portless[idx]
+            elif kind in ['in_iface', 'out_iface']:
+                codes = [c for name, c in self.ifaces.items() if _iface_match(value, name)]
+                res = np.isin(getattr(self, kind)[idx], codes)
+            elif kind == 'state':
+                res = np.isin(self.state[idx], [c for s, c in self.states.items() if s in value])
+            elif kind == 'icmp_type':
+                res = self.dport[idx] == value
+            else:
+                x = (self.src if kind == 'set_src' else self.dst)[idx]
+                starts, ends = np.array(value[0], dtype=np.int64), np.array(value[1], dtype=np.int64)
+                pos = np.searchsorted(starts, x, side='right') - 1
+                res = (pos >= 0) & (x <= ends[np.maximum(pos, 0)]) if len(starts) > 0 else np.zeros(len(idx), bool)
+            m &= ~res if neg else res
+        return m
+
+    def _walk(self, chain: str, idx, depth=0):
+        """Walk the flows ``idx`` through ``chain``, returning the ones which reached its end (or a RETURN)"""
+        np = numpy
+        returned = []
+        for proto, code in self.protos.items():
+            pidx = idx[self.proto[idx] == code]
+            if len(pidx) == 0:
+                continue
+            bounds, candidates = self.index[chain].intervals(proto)
+            slot = np.searchsorted(np.array(bounds, dtype=np.int64), self.dport[pidx], side='right') - 1
+            for k in np.unique(slot).tolist():
+                pend = pidx[slot == k]
+                for c in candidates[k]:
+                    if len(pend) == 0:
+                        break
+                    ri = self.chains[chain][c]
+                    r = self.rules[ri]
+                    if r.kind == 'continue':
+                        continue
+                    m = self._mask(r, pend)
+                    if not m.any():
+                        continue
+                    hit = pend[m]
+                    if len(r.unsupported) > 0:
+                        self.events.append(('uncertain', hit, r.rule))
+                    elif r.kind == 'verdict':
+                        self.decided[hit], pend = ri, pend[~m]
+                    elif r.kind in ['jump', 'goto'] and depth < MAX_DEPTH:
+                        self.events.append(('chain', hit, r.target))
+                        back = self._walk(r.target, hit, depth + 1)
+                        if r.kind == 'jump':
+                            pend = np.concatenate([pend[~m], back])
+                        else:
+                            returned.append(back)
+                            pend = pend[~m]
+                    elif r.kind == 'return':
+                        returned.append(hit)
+                        pend = pend[~m]
+                returned.append(pend)
+        return np.concatenate(returned) if len(returned) > 0 else idx[:0]
+
+    def run(self) -> List[TraceResult]:
+        np = numpy
+        chains = np.array([f.chain for f in self.flows], dtype=object)
+        for chain in dict.fromkeys(chains.tolist()):
+            idx = np.flatnonzero(chains == chain)
+            if chain in self.index:
+                self._walk(chain, idx)
+        paths = [[f.chain] for f in self.flows]
+        uncertain = [[] for _ in self.flows]
+        for kind, hit, value in self.events:
+            for i in hit.tolist():
+                (paths if kind == 'chain' else uncertain)[i].append(value)
+        policies, res = self.tracer.policies['v4'], []
+        for f, ri, path, unc in zip(self.flows, self.decided.tolist(), paths, uncertain):
+            if ri < 0:
+                res.append(TraceResult(f, policies.get(f.chain, 'ACCEPT'), None, None, tuple(path), tuple(unc)))
+            else:
+                r = self.rules[ri]
+                res.append(TraceResult(f, r.target, r.rule, r.source, tuple(path), tuple(unc)))
+        return res
+
+
+def _endpoint(addr: str, port: Optional[int]) -> str:
+    if port is None:
+        return addr
+    return f'[{addr}]:{port}' if ':' in addr else f'{addr}:{port}'
+
+
+def format_result(res: TraceResult) -> str:
+    """
+    Format a :class:`.TraceResult` for humans, as a single line
+
+        >>> format_result(t.trace('tcp 1.2.3.4:5555 -> 10.0.0.1:443'))
+        'tcp 1.2.3.4:5555 -> 10.0.0.1:443 [INPUT]: ACCEPT by -A INPUT -p tcp --dport 443 -j ACCEPT    # rules.pyre:12: allow port 443'
+
+    """
+    f = res.flow
+    if f.protocol in ['icmp', 'ipv6-icmp']:
+        line = f"{f.protocol} {f.src} -> {f.dst}" + ('' if f.dport is None else f' type {f.dport}')
+    else:
+        line = f"{f.protocol} {_endpoint(f.src, f.sport)} -> {_endpoint(f.dst, f.dport)}"
+    line += f" [{' > '.join(res.chains)}]: {res.verdict} by "
+    line += f'chain policy ({f.chain})' if res.rule is None else res.rule
+    if res.source is not None:
+        line += f"    # {res.source.file or '<stdin>'}:{res.source.line}: {res.source.text}"
+    if len(res.uncertain) > 0:
+        line += f"  (uncertain - may have matched first: {' | '.join(res.uncertain)})"
+    return line
@@ -1,3 +1,4 @@
+from collections import namedtuple
 from enum import Enum
 from ipaddress import IPv4Network, IPv6Network
 from typing import TypeVar, List
@@ -7,6 +8,10 @@ class IPT_ACTION(Enum):
     ALLOW = '-j ACCEPT'
     REJECT = '-j REJECT'
     DROP = '-j DROP'
+    NOTRACK = '-j CT --notrack'
+    DNAT = '-j DNAT'
+    SNAT = '-j SNAT'
+    MASQUERADE = '-j MASQUERADE'
     CUSTOM = '#CUSTOM#'
 
 
@@ -67,3 +72,65 @@ class IPVersionList(object):
     def __repr__(self): return str(dict(self))
 
     def __str__(self): return self.__repr__()
+
+
+TempSet = namedtuple('TempSet', 'name family entries')
+"""
+An ipset backing temporary (``for 30m``) rules. ``family`` is ``inet`` or ``inet6``, and ``entries`` is a list of
+``(address, timeout)`` tuples - the addresses / subnets added to the set, and the seconds until each one expires.
+"""
+
+RuleSource = namedtuple('RuleSource', 'file line text')
+"""
+Where a compiled iptables rule came from - the Pyre ``file`` (``None`` for lines not read from a file), the 1-based
+``line`` number within it, and the ``text`` of the Pyre line (see :py:attr:`.PyreParser.output_origins`).
+"""
+
+RateLimit = namedtuple('RateLimit', 'kind value above burst per masks')
+"""
+A ``limit`` (``kind='limit'``, ``value`` is a rate such as ``10/minute``) or ``connlimit`` (``kind='connlimit'``,
+``value`` is a number of connections) of a rule. ``above`` is True to match traffic over the limit, False for traffic
+within it, or None to decide by the rule's action (over the limit for ``drop`` / ``reject``). ``per`` is ``src`` /
+``dst`` to keep a separate limit per address, or None for one limit shared by the whole rule, and ``masks`` is a dict
+of the prefix length addresses are grouped by per IP version, e.g. ``dict(v4=24, v6=64)``.
+"""
+
+RecentMatch = namedtuple('RecentMatch', 'name command hits seconds per')
+"""
+A ``recent`` match of a rule, tracking addresses in the kernel list ``name``. ``command`` is ``set``, ``remove``,
+``check`` or ``update``, and ``hits`` / ``seconds`` (or None) require at least ``hits`` packets within ``seconds``.
+``per`` is ``src`` or ``dst`` - which address of the packet is tracked.
+"""
+
+LogAction = namedtuple('LogAction', 'prefix limit group threshold')
+"""
+The ``log`` action of a rule - packets are logged (rate limited by the :class:`.RateLimit` ``limit``) before the rule's
+verdict. If ``group`` is set they're sent to that NFLOG group, queueing ``threshold`` packets per batch, otherwise to
+the kernel log (LOG). ``prefix`` is the log prefix, or None.
+"""
+
+NatTarget = namedtuple('NatTarget', 'address port ipver')
+"""
+The address a DNAT / SNAT rule translates to (see :func:`privex.pyrewall.nat.parse_target`) - ``port`` is the port or
+port range (``8000-8999``) to translate to, or None to keep the original port. ``ipver`` is ``v4`` or ``v6``.
+"""
+
+PortMapping = namedtuple('PortMapping', 'start end target')
+"""A port forward from an ``@portmap`` file - the destination ports ``start`` to ``end`` (inclusive) to a :class:`.NatTarget`"""
+
+Balance = namedtuple('Balance', 'targets weights mode')
+"""
+The backends of a ``balance`` rule - a list of :class:`.NatTarget` and their integer ``weights``, balanced by ``mode``:
+``random`` (by weighted probability), ``nth`` (weighted round robin) or ``hash`` (by a hash of the source address).
+"""
+
+SavedRule = namedtuple('SavedRule', 'table chain protocol source destination in_iface out_iface sports dports matches target')
+"""
+A normalised rule from ``iptables-save`` output (see :class:`privex.pyrewall.SaveParser.SaveParser`), mirroring the
+fields of :class:`.RuleBuilder`. Every field is a string (or None if the rule doesn't match on it) - negated matches
+start with ``! `` - except ``matches``, a tuple of the other ``-m`` matches (e.g. ``-m conntrack --ctstate NEW``).
+``target`` is the ``-j`` / ``-g`` clause, or None for rules without a target. Equal rules compare (and hash) equal.
+"""
+
+SavedChain = namedtuple('SavedChain', 'table name policy packets bytes')
+"""A chain from ``iptables-save`` output - ``policy`` is ``-`` for user chains, and its counters (0 if not saved)"""
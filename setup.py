@@ -57,6 +57,10 @@ setup(
         'privex-helpers>=2.10.0', 'python-dotenv', 'prompt_toolkit>=2.0.0',
         'pygments', 'colorama'
     ],
+    extras_require={
+        'fast': ['numpy'],
+        'fleet': ['pyyaml'],
+    },
     packages=find_packages(),
     scripts=['bin/pyre', 'bin/pyre-parse', 'bin/pyre-parse4', 'bin/pyre-parse6'],
     include_package_data=True,
@@ -1,15 +1,44 @@
 #!/usr/bin/env python3
+import fcntl
+import os
+import signal
+import tempfile
+import threading
+import time
 import unittest
 from collections import OrderedDict
+from unittest import mock
 from os.path import abspath, dirname, join
 
 from privex import pyrewall
-from privex.pyrewall import find_file
+from privex.pyrewall import find_file, conf, core
+from privex.pyrewall.apply import ApplyQueue, STATUS_APPLIED, STATUS_COALESCED
+from privex.pyrewall.snapshots import SnapshotStore, normalise_save
+from privex.pyrewall.staged import plan_staged, ipset_swap_lines
+from privex.pyrewall.netns import apply_netns, match_netns
+from privex.pyrewall.daemon import PyreDaemon, MtimePoller
+from privex.pyrewall.api import RuleBatcher, ApiServer, ApiClient
+from privex.pyrewall.tempsets import temp_set_lines
+from privex.pyrewall.blocklist import read_blocklist
+from privex.pyrewall.ipsets import restore_lines
+from privex.pyrewall.cidr import parse_many, summarise_keys, summarise_ranges, HAS_NUMPY, parse_networks
+from privex.pyrewall.rangeset import read_rangeset
+from privex.pyrewall.compiler import compile_pyre, CompileContext
+from privex.pyrewall.ruleset import Ruleset
+from privex.pyrewall.fleet import load_fleet, build_fleet
+from privex.pyrewall.diff import normalise_rule, diff_rules, diff_files
+from privex.pyrewall.nft import apply_nft, element_lines, snapshot_nft, restore_nft
+from privex.pyrewall.nat import read_portmap
+from privex.pyrewall.SaveParser import SaveParser, to_builder
+from privex.pyrewall.trace import PacketTracer, parse_flow, read_flows
+from privex.pyrewall.cost import RuleCost, format_cost
+from privex.pyrewall.exceptions import RuleSyntaxError, XTablesLockError, IPTablesError
 
 BASE_DIR = dirname(abspath(__file__))
 DIR_FF1 = join(BASE_DIR, 'testdata', 'findfile')
 DIR_FF2 = join(BASE_DIR, 'testdata', 'findfile2')
 DIR_CONF = join(BASE_DIR, 'testdata', 'configs')
+FAKE_XTABLES = join(BASE_DIR, 'testdata', 'bin', 'fake-xtables')
 
 TEST_SEARCH_PATH = [DIR_FF1, DIR_FF2, DIR_CONF]
 TEST_SEARCH_EXT = ['.pyre', '.txt', '.log']
@@ -255,5 +284,1340 @@ class TestFindFile(unittest.TestCase):
             _find_file(join(BASE_DIR, 'testdata', 'TOTALLY_NON_EXISTENT_FILE.PYRE'))
 
 
+class FakeXTablesMixin:
+    """
+    Points :mod:`privex.pyrewall.conf`'s iptables / ipset binaries at ``testdata/bin/fake-xtables``, with a fresh temporary
+    state folder for each test. Set ``FAKE_XT_LOCKED`` in :attr:`.fake_env` to simulate xtables lock contention, or
+    ``FAKE_XT_FAIL`` / ``FAKE_XT_REJECT`` to make calls with matching arguments / stdin fail.
+    """
+    fake_env = {}
+
+    def setUp(self):
+        self.state_dir = tempfile.TemporaryDirectory()
+        self._orig_conf = {k: getattr(conf, k) for k in ['IPT4_RESTORE', 'IPT6_RESTORE', 'IPT4_SAVE', 'IPT6_SAVE',
+                                                        'IPSET_BIN', 'NFT_BIN', 'XTABLES_BACKOFF', 'XTABLES_RETRIES']}
+        conf.IPT4_RESTORE = conf.IPT6_RESTORE = conf.IPT4_SAVE = conf.IPT6_SAVE = conf.IPSET_BIN = FAKE_XTABLES
+        conf.NFT_BIN = FAKE_XTABLES
+        conf.XTABLES_BACKOFF = 0.01
+        self._orig_env = dict(os.environ)
+        os.environ.update({'FAKE_XT_STATE': self.state_dir.name, **self.fake_env})
+
+    def tearDown(self):
+        for k, v in self._orig_conf.items():
+            setattr(conf, k, v)
+        os.environ.clear()
+        os.environ.update(self._orig_env)
+        self.state_dir.cleanup()
+
+    def fake_state(self, name: str) -> str:
+        with open(join(self.state_dir.name, name)) as fh:
+            return fh.read()
+
+
+class TestXTablesLock(FakeXTablesMixin, unittest.TestCase):
+    def test_load_rules_passes_wait(self):
+        """Test load_rules passes ``--wait`` to iptables-restore and writes the rules into stdin"""
+        res = core.load_rules(['*filter', '-A INPUT -j ACCEPT', 'COMMIT'])
+        self.assertEqual(res.retries, 0)
+        self.assertIn(f'--wait {conf.XTABLES_WAIT}', self.fake_state('args'))
+        self.assertEqual(self.fake_state('stdin'), "*filter\n-A INPUT -j ACCEPT\nCOMMIT")
+
+    def test_load_rules_retries_contention(self):
+        """Test load_rules retries with backoff while the xtables lock is held, and records the retries"""
+        os.environ['FAKE_XT_LOCKED'] = '2'
+        res = core.load_rules(['*filter', 'COMMIT'], ipver='v6')
+        self.assertEqual(res.code, 0)
+        self.assertEqual(res.retries, 2)
+        self.assertGreater(res.waited, 0)
+        self.assertEqual(self.fake_state('calls').strip(), '3')
+
+    def test_load_rules_times_wait(self):
+        """Test the time a successful attempt spends blocked inside ``--wait`` is counted in ``waited``"""
+        run_prog = core.run_prog
+
+        def blocked_run_prog(*args, **kwargs):
+            time.sleep(0.2)
+            return run_prog(*args, **kwargs)
+        with mock.patch.object(core, 'run_prog', blocked_run_prog):
+            res = core.load_rules(['*filter', 'COMMIT'])
+        self.assertEqual(res.retries, 0)
+        self.assertGreaterEqual(res.waited, 0.2)
+
+    def test_load_rules_gives_up(self):
+        """Test load_rules raises XTablesLockError once the retries are exhausted"""
+        os.environ['FAKE_XT_LOCKED'] = '100'
+        conf.XTABLES_RETRIES = 1
+        with self.assertRaises(XTablesLockError):
+            core.load_rules(['*filter', 'COMMIT'])
+        self.assertEqual(self.fake_state('calls').strip(), '2')
+
+    def test_save_rules_no_wait(self):
+        """Test save_rules retries on contention, but never passes ``--wait`` (unsupported by iptables-save)"""
+        os.environ['FAKE_XT_LOCKED'] = '1'
+        core.save_rules('v4')
+        self.assertNotIn('--wait', self.fake_state('args'))
+        self.assertEqual(self.fake_state('calls').strip(), '2')
+
+
+class TestApplyQueue(unittest.TestCase):
+    def setUp(self):
+        self.state_dir = tempfile.TemporaryDirectory()
+        self.queue = ApplyQueue(state_dir=self.state_dir.name)
+        self.applied = []
+
+    def tearDown(self):
+        self.state_dir.cleanup()
+
+    def applier(self, payload):
+        self.applied.append(payload)
+
+    def test_submit_applies(self):
+        """Test submitting with a free apply lock applies the payload immediately"""
+        res = self.queue.submit(v4=['*filter', 'COMMIT'], v6=None, source='test', applier=self.applier)
+        self.assertEqual(res.status, STATUS_APPLIED)
+        self.assertEqual(len(self.applied), 1)
+        self.assertEqual(self.applied[0]['v4'], ['*filter', 'COMMIT'])
+        self.assertIsNone(self.applied[0]['v6'])
+
+    def test_submit_coalesces_while_locked(self):
+        """Test submissions while the apply lock is held are coalesced into one apply of the newest payload"""
+        with open(self.queue.lock_path, 'a') as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            r1 = self.queue.submit(v4=['first'], applier=self.applier)
+            r2 = self.queue.submit(v4=['second'], applier=self.applier)
+            fcntl.flock(fh, fcntl.LOCK_UN)
+        self.assertEqual((r1.status, r2.status), (STATUS_COALESCED, STATUS_COALESCED))
+        self.assertEqual(len(self.applied), 0)
+
+        r3 = self.queue.submit(v4=['third'], applier=self.applier)
+        self.assertEqual(r3.status, STATUS_APPLIED)
+        self.assertEqual([p['v4'] for p in self.applied], [['third']])
+
+    def test_concurrent_burst(self):
+        """Test a burst of concurrent submissions never overlap, and the newest payload is always applied last"""
+        active, overlaps = [], []
+
+        def slow_applier(payload):
+            if len(active) > 0: overlaps.append(payload)
+            active.append(payload)
+            time.sleep(0.05)
+            self.applied.append(payload)
+            active.remove(payload)
+
+        results = []
+
+        def submit(i):
+            results.append(ApplyQueue(state_dir=self.state_dir.name).submit(v4=[str(i)], applier=slow_applier))
+        threads = [threading.Thread(target=submit, args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+            time.sleep(0.005)
+        for t in threads:
+            t.join()
+
+        self.assertEqual(overlaps, [])
+        self.assertLess(len(self.applied), 8)
+        self.assertEqual(self.applied[-1]['seq'], max(r.seq for r in results))
+        self.assertFalse(os.path.exists(self.queue.pending_path))
+
+    def test_applier_failure(self):
+        """Test a failing applier doesn't strand payloads coalesced during the apply, and only raises for our seq"""
+        after = []
+
+        def failing_applier(payload):
+            if payload['v4'] == ['first']:
+                # Another process coalesces a payload into our apply, then our own payload fails to apply
+                ApplyQueue(state_dir=self.state_dir.name).submit(v4=['second'], applier=self.applier)
+                raise ValueError('bad rules')
+            if payload['v4'] == ['third']:
+                raise ValueError('bad rules')
+            if payload['v4'] == ['fourth']:
+                self.queue._write_pending(dict(v4=['third'], seq=time.time_ns()))
+            self.applied.append(payload)
+
+        with self.assertRaises(ValueError):
+            self.queue.submit(v4=['first'], applier=failing_applier, after_apply=lambda: after.append(1))
+        self.assertEqual([p['v4'] for p in self.applied], [['second']])
+        self.assertEqual(after, [1])
+        self.assertFalse(os.path.exists(self.queue.pending_path))
+
+        # A coalesced payload which fails to apply is logged and skipped, without raising in the lock holder
+        res = self.queue.submit(v4=['fourth'], applier=failing_applier)
+        self.assertEqual(res.status, STATUS_APPLIED)
+        self.assertEqual([p['v4'] for p in self.applied], [['second'], ['fourth']])
+
+
+class TestSnapshotStore(FakeXTablesMixin, unittest.TestCase):
+    save_output = [
+        '# Generated by iptables-save v1.8.4 on Mon Jan  6 12:00:00 2020', '*filter', ':INPUT DROP [{n}:{n}00]',
+        '-A INPUT -s 10.0.0.0/8 -j ACCEPT', 'COMMIT', '# Completed on Mon Jan  6 12:00:00 2020',
+    ]
+
+    def setUp(self):
+        super().setUp()
+        self.store_dir = tempfile.TemporaryDirectory()
+        self.store = SnapshotStore(path=self.store_dir.name, retain=3)
+        self.save_file = join(self.state_dir.name, 'save.txt')
+        os.environ['FAKE_XT_OUTPUT'] = self.save_file
+        self.set_saved(1)
+
+    def tearDown(self):
+        super().tearDown()
+        self.store_dir.cleanup()
+
+    def set_saved(self, n, extra=''):
+        with open(self.save_file, 'w') as fh:
+            fh.write("\n".join(self.save_output).format(n=n) + extra + "\n")
+
+    def test_normalise_save(self):
+        """Test normalise_save strips comments and zeroes counters"""
+        self.assertEqual(
+            normalise_save(l.format(n=5) for l in self.save_output),
+            b'*filter\n:INPUT DROP [0:0]\n-A INPUT -s 10.0.0.0/8 -j ACCEPT\nCOMMIT\n'
+        )
+
+    def test_take_dedup(self):
+        """Test taking snapshots of an unchanged ruleset (with changed counters) doesn't add snapshots or objects"""
+        s1 = self.store.take(v4=True, v6=False, source='a.pyre')
+        self.set_saved(99)
+        s2 = self.store.take(v4=True, v6=False, source='b.pyre')
+        self.assertEqual(s1, s2)
+        self.assertEqual(len(self.store.list()), 1)
+        self.assertEqual(len(os.listdir(join(self.store_dir.name, 'objects'))), 1)
+
+    def test_retention(self):
+        """Test the store is pruned to its retention limit, deleting unreferenced objects"""
+        for i in range(5):
+            self.set_saved(1, extra=f"\n# {i}\n-A INPUT -s 10.{i}.0.0/16 -j DROP")
+            self.store.take(v4=True, v6=False, source=f'{i}.pyre')
+        snaps = self.store.list()
+        self.assertEqual([s.source for s in snaps], ['4.pyre', '3.pyre', '2.pyre'])
+        self.assertEqual(len(os.listdir(join(self.store_dir.name, 'objects'))), 3)
+
+    def test_restore_stored_bytes(self):
+        """Test restoring a snapshot writes the stored payload to iptables-restore, without calling iptables-save"""
+        snap = self.store.take(v4=True, v6=False)
+        calls = int(self.fake_state('calls'))
+        self.store.restore(self.store.get(1))
+        self.assertEqual(int(self.fake_state('calls')), calls + 1)
+        self.assertTrue(self.fake_state('stdin').endswith('-A INPUT -s 10.0.0.0/8 -j ACCEPT\nCOMMIT\n'))
+        self.assertEqual(self.store.get_object(snap.v4), normalise_save(l.format(n=1) for l in self.save_output))
+
+
+class TestStagedApply(unittest.TestCase):
+    compiled = [
+        '*filter', ':INPUT DROP [0:0]', ':FORWARD ACCEPT [0:0]', ':OUTPUT ACCEPT [0:0]', ':SSH - [0:0]',
+        '-A INPUT -p tcp --dport 22 -j SSH', '-A SSH -s 10.0.0.0/8 -j ACCEPT', 'COMMIT',
+    ]
+
+    def test_first_staged_apply(self):
+        """Test the first staged apply stages generation 1 chains and rebuilds the built-in chains as single jumps"""
+        live = ['*filter', ':INPUT ACCEPT [5:100]', ':FORWARD ACCEPT [0:0]', ':OUTPUT ACCEPT [0:0]',
+                '-A INPUT -j ACCEPT', 'COMMIT']
+        plan = plan_staged(self.compiled, live)
+        self.assertEqual(plan.generation, 1)
+        self.assertIn(':PYRE1-SSH - [0:0]', plan.stage)
+        self.assertIn('-A PYRE1-INPUT -p tcp --dport 22 -j PYRE1-SSH', plan.stage)
+        self.assertIn('-A PYRE1-SSH -s 10.0.0.0/8 -j ACCEPT', plan.stage)
+        self.assertEqual(plan.swap[:4], ['*filter', ':INPUT DROP [0:0]', '-F INPUT', '-A INPUT -j PYRE1-INPUT'])
+        self.assertNotIn('-A SSH', ' '.join(plan.swap))
+        self.assertEqual(plan.gc, [])
+
+    def test_swap_replaces_jump(self):
+        """Test a later staged apply replaces only the previous generation's jump rule, then removes its chains"""
+        live = [
+            '*filter', ':INPUT DROP [0:0]', ':FORWARD ACCEPT [0:0]', ':OUTPUT ACCEPT [0:0]', ':PYRE4-INPUT - [0:0]',
+            ':PYRE4-FORWARD - [0:0]', ':PYRE4-OUTPUT - [0:0]', ':PYRE4-SSH - [0:0]', ':DOCKER - [0:0]',
+            '-A INPUT -j DOCKER', '-A INPUT -j PYRE4-INPUT', '-A FORWARD -j PYRE4-FORWARD',
+            '-A OUTPUT -j PYRE4-OUTPUT', '-A PYRE4-INPUT -p tcp --dport 22 -j PYRE4-SSH', 'COMMIT',
+        ]
+        plan = plan_staged(self.compiled, live)
+        self.assertEqual(plan.generation, 5)
+        self.assertIn('-R INPUT 2 -j PYRE5-INPUT', plan.swap)
+        self.assertIn('-R FORWARD 1 -j PYRE5-FORWARD', plan.swap)
+        self.assertNotIn('-F INPUT', plan.swap)
+        self.assertEqual(plan.gc[1:5], ['-F PYRE4-INPUT', '-F PYRE4-FORWARD', '-F PYRE4-OUTPUT', '-F PYRE4-SSH'])
+        self.assertIn('-X PYRE4-SSH', plan.gc)
+        self.assertNotIn('-X DOCKER', plan.gc)
+
+    def test_swap_removed_chains(self):
+        """Test jumps into the old generation from built-in chains / tables missing from the new rules are deleted"""
+        live = [
+            '*nat', ':PREROUTING ACCEPT [0:0]', ':POSTROUTING ACCEPT [0:0]', ':PYRE4-PREROUTING - [0:0]',
+            ':PYRE4-POSTROUTING - [0:0]', '-A PREROUTING -j PYRE4-PREROUTING', '-A POSTROUTING -j PYRE4-POSTROUTING',
+            'COMMIT',
+            '*filter', ':INPUT DROP [0:0]', ':FORWARD ACCEPT [0:0]', ':OUTPUT ACCEPT [0:0]', ':PYRE4-INPUT - [0:0]',
+            ':PYRE4-FORWARD - [0:0]', ':PYRE4-OUTPUT - [0:0]', '-A INPUT -j PYRE4-INPUT', '-A FORWARD -j PYRE4-FORWARD',
+            '-A OUTPUT -j DOCKER', '-A OUTPUT -j PYRE4-OUTPUT', 'COMMIT',
+        ]
+        plan = plan_staged([l for l in self.compiled if not l.startswith(':OUTPUT')], live)
+        self.assertEqual(plan.swap[-7:], [
+            '-R FORWARD 1 -j PYRE5-FORWARD', '-D OUTPUT -j PYRE4-OUTPUT', 'COMMIT',
+            '*nat', '-D PREROUTING -j PYRE4-PREROUTING', '-D POSTROUTING -j PYRE4-POSTROUTING', 'COMMIT',
+        ])
+        self.assertNotIn('-D INPUT -j PYRE4-INPUT', plan.swap)
+        self.assertNotIn('-D OUTPUT -j DOCKER', plan.swap)
+        self.assertIn('-X PYRE4-PREROUTING', plan.gc)
+
+    def test_ipset_swap(self):
+        """Test ipset_swap_lines populates a temporary set, and swaps it with the live set"""
+        lines = ipset_swap_lines('ban', 'hash:ip family inet', ['1.2.3.4'], generation=3)
+        self.assertEqual(lines[-3:], ['add ban-g3 1.2.3.4', 'swap ban-g3 ban', 'destroy ban-g3'])
+        self.assertEqual(lines[0], 'create ban hash:ip family inet -exist')
+
+
+class TestNetns(unittest.TestCase):
+    def test_match_netns(self):
+        """Test matching network namespaces with comma separated globs and ``all``"""
+        names = ['ct-a', 'ct-b', 'vpn1', 'vpn2']
+        self.assertEqual(match_netns('ct-*,vpn1', names), ['ct-a', 'ct-b', 'vpn1'])
+        self.assertEqual(match_netns('all', names), names)
+
+    def test_apply_netns_bounded(self):
+        """Test apply_netns applies one shared payload per family into each namespace, with bounded concurrency"""
+        lock, calls, active, peak = threading.Lock(), [], [0], [0]
+
+        def runner(netns, payload, ipver):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+                calls.append((netns, ipver, payload))
+            time.sleep(0.02)
+            with lock:
+                active[0] -= 1
+            if netns == 'ns3':
+                raise Exception('simulated failure')
+
+        names = [f'ns{i}' for i in range(10)]
+        results = apply_netns(names, v4=['*filter', 'COMMIT'], v6=['*filter', 'COMMIT'], workers=3, runner=runner)
+        self.assertEqual([r.netns for r in results], names)
+        self.assertEqual([r.netns for r in results if not r.ok], ['ns3'])
+        self.assertEqual(results[3].error, 'simulated failure')
+        self.assertTrue(all(r.duration > 0 for r in results))
+        self.assertEqual(len(calls), 19)  # ns3 fails on v4, so its v6 payload is never applied
+        self.assertLessEqual(peak[0], 3)
+        self.assertEqual(len(set(id(c[2]) for c in calls)), 2)
+
+
+class TestDaemon(FakeXTablesMixin, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self._orig_state_dir = conf.STATE_DIR
+        conf.STATE_DIR = join(self.state_dir.name, 'pyrewall')
+        self.master, self.imported = join(self.state_dir.name, 'rules.pyre'), join(self.state_dir.name, 'extra.pyre')
+        with open(self.master, 'w') as fh:
+            fh.write(f"@chain INPUT DROP\nallow port 22\n@import {self.imported}\n")
+        self.write_imported('allow port 80')
+
+    def tearDown(self):
+        conf.STATE_DIR = self._orig_state_dir
+        super().tearDown()
+
+    def write_imported(self, rule):
+        with open(self.imported, 'w') as fh:
+            fh.write(rule + "\n")
+
+    def test_line_cache_reuse(self):
+        """Test a shared line_cache produces identical output, without passing cached lines to the RuleParser"""
+        cache = {}
+        expected = pyrewall.PyreParser(line_cache=cache).parse_file(_find_file('test1.pyre'))
+        p = pyrewall.PyreParser(line_cache=cache)
+        p.rp.parse = lambda line: self.fail(f'Cached line was re-compiled: {line}')
+        self.assertEqual(p.parse_file(_find_file('test1.pyre')), expected)
+        self.assertEqual(expected, pyrewall.PyreParser().parse_file(_find_file('test1.pyre')))
+
+    def test_reload_tracks_imports(self):
+        """Test the daemon watches imported files, and only re-applies the rules when the compiled output changes"""
+        d = PyreDaemon(self.master, ipver='4', watcher=MtimePoller())
+        self.assertTrue(d.reload(force=True))
+        self.assertEqual(d.files, {self.master, self.imported})
+        self.assertFalse(d.reload())
+        self.write_imported('allow port 443')
+        self.assertTrue(d.reload())
+        self.assertIn('--dport 443', self.fake_state('stdin'))
+
+    def test_rollback_previous(self):
+        """Test rollback re-applies the previously applied compiled rules from memory"""
+        d = PyreDaemon(self.master, ipver='4', watcher=MtimePoller())
+        self.assertFalse(d.rollback())
+        d.reload(force=True)
+        first = d.applied
+        self.write_imported('allow port 443')
+        d.reload()
+        self.assertTrue(d.rollback())
+        self.assertEqual(d.applied, first)
+        self.assertTrue(self.fake_state('stdin').rstrip().endswith("\n".join(first[0]).rstrip()))
+
+    def test_apply_failure(self):
+        """Test the daemon keeps its last applied rules and keeps running when iptables-restore rejects the rules"""
+        d = PyreDaemon(self.master, ipver='4', watcher=MtimePoller())
+        d.reload(force=True)
+        self.write_imported('allow port 443')
+        d.reload()
+        applied, previous = d.applied, d.previous
+        with mock.patch.dict(os.environ, FAKE_XT_FAIL='--wait'):
+            self.write_imported('allow port 8080')
+            self.assertFalse(d.reload())
+            self.assertFalse(d.rollback())
+            self.assertEqual((d.applied, d.previous), (applied, previous))
+
+            class ExitWatcher(MtimePoller):
+                def read(self, timeout: float = None):
+                    d.should_exit = True
+                    return []
+
+            handlers = {sig: signal.getsignal(sig) for sig in [signal.SIGHUP, signal.SIGUSR1, signal.SIGTERM, signal.SIGINT]}
+            try:
+                d.watcher = ExitWatcher()
+                d.run()
+            finally:
+                for sig, handler in handlers.items():
+                    signal.signal(sig, handler)
+            self.assertEqual(d.applied, applied)
+        self.assertTrue(d.reload())
+        self.assertIn('--dport 8080', self.fake_state('stdin'))
+
+
+class TestDynamicApi(FakeXTablesMixin, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.batcher = RuleBatcher()
+
+    def test_address_ops_coalesced(self):
+        """Test queued ban / unban operations are coalesced into a single ipset restore per batch"""
+        self.batcher.ban('1.2.3.4')
+        self.batcher.ban('5.6.7.8/24')
+        self.batcher.unban('1.2.3.4')
+        self.batcher.ban('2a07:e00::1', timeout=60)
+        res = self.batcher.flush()
+        self.assertEqual((res.set_ops, res.rule_ops), (3, 0))
+        self.assertEqual(self.fake_state('calls').strip(), '1')
+        self.assertEqual(self.fake_state('stdin').splitlines(), [
+            'del pyre-ban 1.2.3.4 -exist', 'add pyre-ban 5.6.7.0/24 -exist', 'add pyre-ban6 2a07:e00::1 timeout 60 -exist'
+        ])
+        self.assertEqual(self.batcher.flush().set_ops, 0)
+        self.assertEqual(self.fake_state('calls').strip(), '1')
+
+    def test_rule_ops(self):
+        """Test Pyre rules are appended into the API chains, and rules added + deleted in one batch never reach the kernel"""
+        self.batcher.add_rule('drop from 1.2.3.4 port 22')
+        self.batcher.add_rule('allow port 80')
+        self.batcher.delete_rule('allow port 80')
+        self.assertEqual(self.batcher.flush().rule_ops, 1)
+        self.assertEqual(self.fake_state('stdin'), "*filter\n-A PYRE-API-INPUT -p tcp --dport 22 -s 1.2.3.4/32 -j DROP\nCOMMIT")
+        self.assertIn('--noflush', self.fake_state('args'))
+
+        self.batcher.delete_rule('drop from 1.2.3.4 port 22')
+        self.batcher.flush()
+        self.assertTrue(self.fake_state('stdin').endswith("-D PYRE-API-INPUT -p tcp --dport 22 -s 1.2.3.4/32 -j DROP\nCOMMIT"))
+        self.assertEqual(len(self.batcher.active['v4']), 0)
+
+    def test_chain_lines_jumps(self):
+        """Test the API chains contain the set matches and active rules, and only missing jumps are inserted"""
+        self.batcher.add_rule('allow from 10.0.0.0/8')
+        self.batcher.flush()
+        lines = self.batcher.chain_lines('v4', ['*filter', '-A INPUT -j PYRE-API-INPUT', 'COMMIT'])
+        self.assertIn('-A PYRE-API-INPUT -m set --match-set pyre-ban src -j DROP', lines)
+        self.assertIn('-A PYRE-API-INPUT -s 10.0.0.0/8 -j ACCEPT', lines)
+        self.assertNotIn('-I INPUT 1 -j PYRE-API-INPUT', lines)
+        self.assertIn('-I FORWARD 1 -j PYRE-API-FORWARD', lines)
+
+    def test_socket_roundtrip(self):
+        """Test batches of operations sent over the Unix socket are queued, with per-operation errors reported"""
+        server = ApiServer(path=join(self.state_dir.name, 'api.sock'), batcher=self.batcher)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            with ApiClient(path=server.path) as c:
+                res = c.send([dict(op='ban', address='1.2.3.4'), dict(op='ban', address='not-an-ip'),
+                              dict(op='rule', rule='drop from 4.3.2.1')])
+                self.assertEqual((res['ok'], res['queued']), (False, 2))
+                self.assertEqual(res['errors'][0]['index'], 1)
+                self.assertEqual(c.request('flush')['set_ops'], 1)
+                self.assertEqual(c.request('stats')['stats']['rule_ops'], 1)
+                self.assertFalse(c.send(5)['ok'])
+                self.assertFalse(c.send('ban')['ok'])
+                res = c.request('ban', addresses='1.2.3.4')
+                self.assertEqual((res['ok'], res['error']), (False, 'TypeError: Expected a JSON array of addresses, got: str'))
+                self.assertEqual(c.send([dict(op='unban', addresses='1.2.3.4')])['queued'], 0)
+                self.assertTrue(c.request('stats')['ok'])
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_rejected_op(self):
+        """Test one change rejected by the kernel is dropped, without discarding the rest of the batch"""
+        self.batcher.add_rule('drop from 1.2.3.4')
+        self.batcher.flush()
+        self.batcher.ban('5.6.7.8')
+        self.batcher.ban('1.1.1.1')
+        self.batcher.delete_rule('drop from 1.2.3.4')
+        self.batcher.add_rule('drop from 5.6.7.8')
+        self.batcher.add_rule('allow port 80')
+        with mock.patch.dict(os.environ, FAKE_XT_REJECT='5.6.7.8'):
+            res = self.batcher.flush()
+        self.assertEqual((res.set_ops, res.rule_ops, res.failed), (1, 3, 2))
+        self.assertEqual(self.batcher.stats['errors'], 2)
+        self.assertEqual(list(self.batcher.active['v4']), ['-A PYRE-API-INPUT -p tcp --dport 80 -j ACCEPT'])
+        stdin = self.fake_state('stdin')
+        self.assertIn('add pyre-ban 1.1.1.1 -exist', stdin)
+        self.assertIn('-D PYRE-API-INPUT -s 1.2.3.4/32 -j DROP', stdin)
+        self.assertNotIn('5.6.7.8', stdin)
+
+
+class TestTempRules(unittest.TestCase):
+    def test_for_handler(self):
+        """Test a temporary rule compiles into one set match rule per IP version, with the addresses as set entries"""
+        rp = pyrewall.RuleParser()
+        v4r, v6r = rp.parse('drop from 1.2.3.4,2a07:e00::/32 port 22 for 1h30m')
+        name4, name6 = rp.last_sets[0].name, rp.last_sets[1].name
+        self.assertEqual(v4r, [f'-A INPUT -p tcp --dport 22 -m set --match-set {name4} src -j DROP'])
+        self.assertEqual(v6r, [f'-A INPUT -p tcp --dport 22 -m set --match-set {name6} src -j DROP'])
+        self.assertEqual(rp.last_sets[0].entries, [('1.2.3.4', 5400)])
+        self.assertEqual((rp.last_sets[1].family, rp.last_sets[1].entries), ('inet6', [('2a07:e00::/32', 5400)]))
+        with self.assertRaises(RuleSyntaxError):
+            rp.parse('allow port 22 for 1h')
+
+    def test_shared_set(self):
+        """Test temporary rules differing only by address share one set and one rule, including via the line cache"""
+        lines = ['drop from 1.2.3.4 for 30m', 'drop from 5.6.7.8 for 1h', 'drop from 9.9.9.9 port 22 for 1h']
+        cache = {}
+        for _ in range(2):
+            p = pyrewall.PyreParser(line_cache=cache)
+            v4r, _v6r = p.parse_lines(lines)
+            self.assertEqual(len([r for r in v4r if '--match-set' in r]), 2)
+            self.assertEqual(len(p.ipsets), 2)
+            self.assertEqual(list(p.ipsets.values())[0]['entries'], [['1.2.3.4', 1800], ['5.6.7.8', 3600]])
+
+    def test_remaining_timeouts(self):
+        """Test re-loading temporary rules only adds entries with their remaining time, and skips expired entries"""
+        with tempfile.TemporaryDirectory() as d:
+            path = join(d, 'tempsets.json')
+            ipsets = {'pyre-tmp4-x': dict(family='inet', entries=[['1.2.3.4', 1800], ['5.6.7.8', 60]])}
+            self.assertEqual(temp_set_lines(ipsets, now=1000, path=path)[1:], [
+                'add pyre-tmp4-x 1.2.3.4 timeout 1800 -exist', 'add pyre-tmp4-x 5.6.7.8 timeout 60 -exist'
+            ])
+            self.assertEqual(temp_set_lines(ipsets, now=1600, path=path), [
+                'create pyre-tmp4-x hash:net family inet timeout 0 -exist', 'add pyre-tmp4-x 1.2.3.4 timeout 1200 -exist'
+            ])
+
+
+class TestBulkAddresses(unittest.TestCase):
+    def test_parse_networks(self):
+        """Test bulk address parsing splits by family in order, masks host bits, and falls back to ip_network"""
+        v4, v6 = parse_networks(['10.1.2.3/16', '2a07:e00::1', '1.2.3.4', '10.0.0.0/255.0.0.0'])
+        self.assertEqual(v4.cidrs(), ['10.1.0.0/16', '1.2.3.4/32', '10.0.0.0/8'])
+        self.assertEqual((v4.entries()[1], v6.cidrs()), ('1.2.3.4', ['2a07:e00::1/128']))
+        # Networks are only created when accessed, and repeated networks share the same object
+        self.assertIs(v4[1], parse_networks(['1.2.3.4'])[0][0])
+        for bad, strict in [('1.2.3.4/33', False), ('1.2.3.256', False), ('10.1.2.3/16', True)]:
+            with self.assertRaises(ValueError):
+                parse_networks([bad], strict=strict)
+
+    def test_many_addresses(self):
+        """Test a rule with many (repeated) addresses outputs one rule per address, in order"""
+        ips = [f'10.0.{i // 256}.{i % 256}' for i in range(1000)] + ['10.0.0.1', '2a07:e00::/32']
+        v4r, v6r = pyrewall.RuleParser().parse(f"allow port 22 from {','.join(ips)}")
+        self.assertEqual(len(v4r), 1001)
+        self.assertEqual((v4r[0], v4r[-1]), (
+            '-A INPUT -p tcp --dport 22 -s 10.0.0.0/32 -j ACCEPT', '-A INPUT -p tcp --dport 22 -s 10.0.0.1/32 -j ACCEPT'
+        ))
+        self.assertEqual(v6r, ['-A INPUT -p tcp --dport 22 -s 2a07:e00::/32 -j ACCEPT'])
+
+
+class TestCompiler(unittest.TestCase):
+    @staticmethod
+    def _tenant_source(i: int) -> str:
+        policy = 'DROP' if i % 2 == 0 else 'REJECT'
+        return '\n'.join([
+            f'@chain INPUT {policy}', f'@chain TENANT{i}', f'allow port {1000 + i} from 10.{i}.0.0/16,2a07:e00:{i:x}::/48',
+            f'drop from 192.0.2.{i} for {i + 1}m', '@table nat', f'@chain PREROUTING {policy}', 'allow port 53 udp',
+        ])
+
+    def test_concurrent_stress(self):
+        """Test compiling many different policies concurrently gives the same results as compiling them serially"""
+        from concurrent.futures import ThreadPoolExecutor
+        sources = [self._tenant_source(i) for i in range(40)] * 5
+        ctx = CompileContext(strict=True, line_cache={})
+        expected = [compile_pyre(src) for src in sources]
+        with ThreadPoolExecutor(16) as pool:
+            results = list(pool.map(lambda src: compile_pyre(src, ctx), sources))
+        self.assertEqual(results, expected)
+        self.assertIn(':TENANT7 ACCEPT [0:0]', results[7].v4)
+        self.assertIn(':PREROUTING REJECT [0:0]', results[7].v4)
+
+    def test_default_chains_unchanged(self):
+        """Test changing chain policies (including after a parser's first commit) never modifies the shared defaults"""
+        p = pyrewall.PyreParser()
+        p.parse_lines(['allow port 22'])
+        p.parse_lines(['@chain INPUT DROP', 'allow port 80'])
+        compile_pyre('@table nat\n@chain POSTROUTING DROP\nallow port 53')
+        self.assertEqual(conf.DEFAULT_CHAINS['filter']['INPUT'], ['ACCEPT', '[0:0]'])
+        self.assertEqual(conf.DEFAULT_CHAINS['nat']['POSTROUTING'], ['ACCEPT', '[0:0]'])
+        self.assertIn(':INPUT ACCEPT [0:0]', compile_pyre('allow port 22').v4)
+
+    def test_context_search_dirs(self):
+        """Test each context imports files from its own search directories"""
+        res = compile_pyre('@import test1', CompileContext(search_dirs=[DIR_CONF]))
+        self.assertEqual(res.files, [join(DIR_CONF, 'test1.pyre')])
+        with self.assertRaises(FileNotFoundError):
+            compile_pyre('@import test1', CompileContext(search_dirs=[DIR_FF2]))
+
+
+class TestRuleset(FakeXTablesMixin, unittest.TestCase):
+    def test_delta_dirty_chains(self):
+        """Test the delta only replaces the chains changed since the ruleset was last marked clean"""
+        rs = Ruleset()
+        rs.append('INPUT', 'allow port 22')
+        rs.add_chain('WEB')
+        rs.append('WEB', 'allow port 80')
+        self.assertEqual(len([l for l in rs.delta('v4') if l.startswith(':')]), 4)
+        rs.mark_clean()
+        self.assertEqual(rs.delta('v4'), [])
+        rs.insert('WEB', 0, 'allow port 443')
+        self.assertEqual(rs.delta('v4'), [
+            '*filter', ':WEB - [0:0]', '-A WEB -p tcp --dport 443 -j ACCEPT', '-A WEB -p tcp --dport 80 -j ACCEPT', 'COMMIT'
+        ])
+        rs.mark_clean()
+        rs.chain('INPUT').policy = 'DROP'
+        rs.remove_chain('WEB')
+        self.assertEqual(rs.delta('v6'), [
+            '*filter', ':INPUT DROP [0:0]', '-F INPUT', '-A INPUT -p tcp --dport 22 -j ACCEPT', '-F WEB', '-X WEB', 'COMMIT'
+        ])
+
+    def test_render_and_validation(self):
+        """Test rendering matches PyreParser, and rules outputting into other chains are rejected"""
+        lines = ['@chain INPUT DROP', 'allow port 22 from 10.0.0.0/8,2a07:e00::/32', 'reject forward from 1.2.3.4']
+        rs = Ruleset.from_pyre(lines)
+        v4, v6 = pyrewall.PyreParser().parse_lines(lines)
+        self.assertEqual((rs.render('v4'), rs.render('v6')), (v4, v6))
+        with self.assertRaises(RuleSyntaxError):
+            rs.append('INPUT', 'allow all port 80')
+        with self.assertRaises(RuleSyntaxError):
+            rs.remove_chain('FORWARD')
+
+    def test_apply_noflush(self):
+        """Test applying loads each IP version's delta with --noflush, then marks the ruleset clean"""
+        rs = Ruleset()
+        rs.append('OUTPUT', 'drop to 192.0.2.1')
+        deltas = rs.apply(queue=ApplyQueue(state_dir=self.state_dir.name))
+        self.assertEqual(deltas['v6'], ['*filter', ':INPUT ACCEPT [0:0]', '-F INPUT', ':FORWARD ACCEPT [0:0]',
+                                         '-F FORWARD', ':OUTPUT ACCEPT [0:0]', '-F OUTPUT', 'COMMIT'])
+        self.assertEqual(self.fake_state('args').count('--noflush'), 2)
+        self.assertIn('-A OUTPUT -d 192.0.2.1/32 -j DROP', self.fake_state('stdin'))
+        self.assertFalse(rs.dirty)
+        self.assertEqual(rs.apply(queue=ApplyQueue(state_dir=self.state_dir.name)), dict(v4=[], v6=[]))
+
+
+class TestBlocklist(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = join(self.tmp.name, 'drop.netset')
+        with open(self.path, 'w') as fh:
+            fh.write('# comment\n10.0.0.0/25\n  10.0.0.128/25 ; SBL123\n\n10.0.0.5\n1.2.3.4/30\n2a07:e00::/32\nnot-an-ip\n')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_aggregate(self):
+        """Test bulk parsed subnets are aggregated, with host bits masked off and invalid entries returned"""
+        keys, invalid = parse_many([b'10.0.0.0/25', b'10.0.0.200/25', b'10.0.1.0/24', b'10.0.3.1', b'1.2.3.4/33'], 32)
+        self.assertEqual(invalid, [b'1.2.3.4/33'])
+        self.assertEqual(summarise_keys(keys, 32), ['10.0.0.0/23', '10.0.3.1'])
+        keys, _ = parse_many([b'2a07:e00::/33', b'2a07:e00:8000::/33', b'::1'], 128)
+        self.assertEqual(summarise_keys(keys, 128), ['::1', '2a07:e00::/32'])
+
+    def test_read_blocklist(self):
+        """Test reading a blocklist file skips comments / invalid entries, and raises them in strict mode"""
+        res = read_blocklist(self.path)
+        self.assertEqual((res.v4, res.v6, res.entries, res.invalid), (['1.2.3.4/30', '10.0.0.0/24'], ['2a07:e00::/32'], 5, 1))
+        with self.assertRaises(RuleSyntaxError):
+            read_blocklist(self.path, strict=True)
+
+    def test_directive(self):
+        """Test @blocklist outputs one set match rule per chain, and its ipsets are swapped in atomically"""
+        p = pyrewall.PyreParser()
+        v4r, v6r = p.parse_lines([f'@blocklist {self.path} reject INPUT OUTPUT', 'allow port 22'])
+        name4, name6 = sorted(p.ipsets.keys())
+        self.assertEqual(v4r[4:7], [
+            f'-A INPUT -m set --match-set {name4} src -j REJECT', f'-A OUTPUT -m set --match-set {name4} dst -j REJECT',
+            '-A INPUT -p tcp --dport 22 -j ACCEPT'
+        ])
+        self.assertIn(f'-A INPUT -m set --match-set {name6} src -j REJECT', v6r)
+        self.assertIn(self.path, p.files)
+        lines = restore_lines(p.ipsets)
+        self.assertIn(f'add {name4}-g1 10.0.0.0/24', lines)
+        self.assertIn(f'swap {name4}-g1 {name4}', lines)
+
+
+class TestRangeset(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = join(self.tmp.name, 'geo.csv')
+        with open(self.path, 'w') as fh:
+            fh.write('"ip_from","ip_to","country_code"\n"16777216","16777471","AU"\n"16777472","16778239","CN"\n')
+            fh.write('1.0.4.0,1.0.7.255,CN\n2a07:e00::,2a07:e00:ffff:ffff:ffff:ffff:ffff:ffff,GB\n"5","1",CN\n')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_summarise_ranges(self):
+        """Test arbitrary ranges are merged and split into the smallest list of CIDRs"""
+        starts, ends = [167772161, 167772160, 0], [167772418, 167772165, 3]
+        self.assertEqual(
+            summarise_ranges(starts, ends, 32, use_numpy=False), ['0.0.0.0/30', '10.0.0.0/24', '10.0.1.0/31', '10.0.1.2']
+        )
+        self.assertEqual(summarise_ranges([1, 3], [2, 6], 128), ['::1', '::2/127', '::4/127', '::6'])
+
+    @unittest.skipUnless(HAS_NUMPY, 'NumPy is not installed')
+    def test_summarise_ranges_numpy(self):
+        """Test the vectorised NumPy range conversion matches the pure Python one"""
+        starts = [0, 167772161, 167772160, 3232235777, 4294967295]
+        ends = [3, 167772418, 167772165, 3232301055, 4294967295]
+        self.assertEqual(summarise_ranges(starts, ends, 32, use_numpy=True), summarise_ranges(starts, ends, 32, use_numpy=False))
+
+    def test_read_rangeset(self):
+        """Test reading a range database skips its header and invalid rows, and filters rows by value"""
+        res = read_rangeset(self.path)
+        self.assertEqual((res.v4, res.v6, res.rows, res.invalid), (['1.0.0.0/21'], ['2a07:e00::/32'], 4, 1))
+        res = read_rangeset(self.path, values=['cn'])
+        self.assertEqual((res.v4, res.v6, res.matched), (['1.0.1.0/24', '1.0.2.0/23', '1.0.4.0/22'], [], 2))
+        with self.assertRaises(RuleSyntaxError):
+            read_rangeset(self.path, strict=True)
+
+    def test_geoset_directive(self):
+        """Test @geoset outputs one set match rule per IP version for the matching rows"""
+        p = pyrewall.PyreParser()
+        v4r, v6r = p.parse_lines([f'@geoset {self.path} CN,GB reject'])
+        self.assertEqual(len([r for r in v4r + v6r if '--match-set pyre-rs' in r and r.endswith('-j REJECT')]), 2)
+        self.assertEqual([s['entries'] for s in p.ipsets.values()], ['1.0.1.0/24\n1.0.2.0/23\n1.0.4.0/22', '2a07:e00::/32'])
+
+
+class TestFleet(unittest.TestCase):
+    TEMPLATE = [
+        '@var ssh_port 22', '@chain INPUT DROP', 'allow port $ssh_port from ${admins}',
+        '@if role web', 'allow port 80,443', '@elif role db', 'allow port 5432 from $app_net', '@else',
+        '@if !host misc*', 'drop port 25', '@endif', '@endif',
+    ]
+
+    def test_variables_and_conditions(self):
+        """Test variables are substituted, host variables override @var defaults, and @if/@elif/@else nest"""
+        variables = dict(admins=['10.0.0.1', '10.0.0.2'], role='db', app_net='10.1.0.0/16', ssh_port=2222)
+        v4, _ = pyrewall.PyreParser(variables=variables).parse_lines(self.TEMPLATE)
+        self.assertEqual(v4[4:-2], [
+            '-A INPUT -p tcp --dport 2222 -s 10.0.0.1/32 -j ACCEPT', '-A INPUT -p tcp --dport 2222 -s 10.0.0.2/32 -j ACCEPT',
+            '-A INPUT -p tcp --dport 5432 -s 10.1.0.0/16 -j ACCEPT',
+        ])
+        v4, _ = pyrewall.PyreParser(variables=dict(admins='10.0.0.1', host='other')).parse_lines(self.TEMPLATE)
+        self.assertEqual(v4[4:-2], ['-A INPUT -p tcp --dport 22 -s 10.0.0.1/32 -j ACCEPT', '-A INPUT -p tcp --dport 25 -j DROP'])
+        v4, _ = pyrewall.PyreParser(variables=dict(admins='10.0.0.1', host='misc1')).parse_lines(self.TEMPLATE)
+        self.assertEqual(v4[4:-2], ['-A INPUT -p tcp --dport 22 -s 10.0.0.1/32 -j ACCEPT'])
+
+    def test_invalid_templates(self):
+        """Test undefined variables and unbalanced @if blocks raise RuleSyntaxError"""
+        with self.assertRaises(RuleSyntaxError):
+            pyrewall.PyreParser().parse_lines(['allow from $nowhere'])
+        with self.assertRaises(RuleSyntaxError):
+            pyrewall.PyreParser().parse_lines(['@if host x', 'allow port 22'])
+        with self.assertRaises(RuleSyntaxError):
+            pyrewall.PyreParser().parse_lines(['@endif'])
+        # Undefined variables inside an inactive block are never substituted
+        v4, _ = pyrewall.PyreParser(variables=dict(host='a')).parse_lines(['@if host b', 'allow from $nowhere', '@endif'])
+        self.assertEqual(v4, [])
+
+    def test_build_fleet(self):
+        """Test building a fleet writes every host's rules, compiling shared lines only once"""
+        import json
+        with tempfile.TemporaryDirectory() as d:
+            with open(join(d, 'fleet.pyre'), 'w') as fh:
+                fh.write('\n'.join(self.TEMPLATE + ['@blocklist drop.netset']))
+            with open(join(d, 'drop.netset'), 'w') as fh:
+                fh.write('192.0.2.0/25\n192.0.2.128/25\n')
+            hosts = dict(web1=dict(role='web'), db1=dict(role='db', ssh_port=2222), broken=dict(template='missing.pyre'))
+            with open(join(d, 'hosts.json'), 'w') as fh:
+                json.dump(dict(template='fleet.pyre', vars=dict(admins='10.0.0.1', app_net='10.1.0.0/16'), hosts=hosts), fh)
+
+            ctx = CompileContext(search_dirs=[d], line_cache={})
+            results = build_fleet(load_fleet(join(d, 'hosts.json')), join(d, 'out'), workers=2, context=ctx)
+            self.assertEqual([(r.host, r.error is None) for r in results], [('web1', True), ('db1', True), ('broken', False)])
+            self.assertEqual(sorted(os.listdir(join(d, 'out'))), [
+                'db1.ipset', 'db1.v4', 'db1.v6', 'web1.ipset', 'web1.v4', 'web1.v6'
+            ])
+            with open(join(d, 'out', 'db1.v4')) as fh:
+                self.assertIn('-A INPUT -p tcp --dport 5432 -s 10.1.0.0/16 -j ACCEPT\n', fh.read())
+            with open(join(d, 'out', 'web1.ipset')) as fh:
+                self.assertIn('add pyre-bl4-', fh.read())
+            # The first host warms the cache in this process - lines are cached by their text after substitution
+            self.assertIn(('allow port 22 from 10.0.0.1', 'filter', ('INPUT', 'FORWARD', 'OUTPUT'), False, 'iptables'), ctx.line_cache)
+            self.assertNotIn(('allow port 2222 from 10.0.0.1', 'filter', ('INPUT', 'FORWARD', 'OUTPUT'), False, 'iptables'), ctx.line_cache)
+
+
+class TestDiff(unittest.TestCase):
+    def test_normalise_rule(self):
+        """Test semantically equal rules normalise to the same canonical form, unless the match order matters"""
+        same = [
+            '-A INPUT -p tcp --dport 443,80 -s 10.1.2.3/8 -m state --state RELATED,ESTABLISHED -j ACCEPT',
+            '-A INPUT -m conntrack --ctstate ESTABLISHED,RELATED -s 10.0.0.0/8 -p 6 -m multiport --dports 80,443 '
+            '-m comment --comment "web traffic" -j ACCEPT',
+        ]
+        self.assertEqual(normalise_rule(same[0]), normalise_rule(same[1]))
+        self.assertNotEqual(normalise_rule(same[0])[0], normalise_rule(same[0].replace('10.1.2.3/8', '10.1.2.3/16'))[0])
+        limited = ['-A INPUT -m limit --limit 5/min -p tcp --dport 22 -j ACCEPT',
+                   '-A INPUT -p tcp --dport 22 -m limit --limit 5/min -j ACCEPT']
+        self.assertTrue(normalise_rule(limited[0])[2])
+        self.assertNotEqual(normalise_rule(limited[0])[0], normalise_rule(limited[1])[0])
+
+    def test_diff_rules(self):
+        """Test added / removed / moved rules are found, ignoring reordering within runs of the same verdict"""
+        old = ['*filter', ':INPUT ACCEPT [0:0]', '-A INPUT -p tcp --dport 22 -j ACCEPT', '-A INPUT -p tcp --dport 80 -j ACCEPT',
+               '-A INPUT -s 1.2.3.4/32 -j DROP', '-A INPUT -p udp --dport 53 -j ACCEPT', 'COMMIT']
+        new = ['*filter', ':INPUT DROP [0:0]', '-A INPUT -p tcp --dport 80 -j ACCEPT', '-A INPUT -p tcp --dport 22 -j ACCEPT',
+               '-A INPUT -p udp --dport 53 -j ACCEPT', '-A INPUT -s 1.2.3.4 -j DROP', '-A INPUT -p tcp --dport 25 -j ACCEPT',
+               ':EXTRA - [0:0]', 'COMMIT']
+        diffs = [(d.kind, d.chain, d.rule, d.old_index, d.new_index) for d in diff_rules(old, new)]
+        self.assertEqual(diffs, [
+            ('policy', 'INPUT', 'ACCEPT -> DROP', None, None),
+            ('moved', 'INPUT', '-A INPUT -s 1.2.3.4 -j DROP', 3, 4),
+            ('added', 'INPUT', '-A INPUT -p tcp --dport 25 -j ACCEPT', None, 5),
+            ('chain_added', 'EXTRA', '-', None, None),
+        ])
+        self.assertEqual(diff_rules(old, list(old)), [])
+
+    def test_diff_files_sources(self):
+        """Test differences between two Pyre files report the Pyre file and line which generated each rule"""
+        with tempfile.TemporaryDirectory() as d:
+            for name, lines in [('old.pyre', ['allow port 22', 'allow port 80']),
+                                ('new.pyre', ['# web only', 'allow port 80', 'drop from 2a07:e00::1'])]:
+                with open(join(d, name), 'w') as fh:
+                    fh.write('\n'.join(lines))
+            diffs = diff_files(join(d, 'old.pyre'), join(d, 'new.pyre'))
+        self.assertEqual([(d.kind, d.ipver, d.source.file[len(d.source.file) - 8:], d.source.line) for d in diffs], [
+            ('removed', 'v4', 'old.pyre', 1), ('removed', 'v6', 'old.pyre', 1), ('added', 'v6', 'new.pyre', 3),
+        ])
+        self.assertEqual(diffs[2].source.text, 'drop from 2a07:e00::1')
+
+
+
+class TestNFTBackend(FakeXTablesMixin, unittest.TestCase):
+    def test_native_sets(self):
+        """Test multi address / port rules compile into one nftables rule using anonymous sets, for both IP versions"""
+        rp = pyrewall.RuleParser(emitter='nft')
+        self.assertEqual(rp.parse('allow port 80,443,8000-8080 from 10.0.0.0/8,10.1.0.0/16,192.168.0.0/16'), (
+            ['-A INPUT ip saddr { 10.0.0.0/8, 192.168.0.0/16 } tcp dport { 80, 443, 8000-8080 } accept'], []
+        ))
+        self.assertEqual(rp.parse('drop port both 53 if-in eth+ state new'), (
+            ['-A INPUT iifname "eth*" meta l4proto { tcp, udp } th dport 53 ct state new drop'], []
+        ))
+        with self.assertRaises(RuleSyntaxError):
+            rp.parse('ipt -A INPUT -j ACCEPT')
+
+    def test_inet_table(self):
+        """Test a Pyre file compiles into one inet table script, with named sets for temporary rules and blocklists"""
+        lines = ['@chain INPUT DROP', 'allow port 22 from 10.0.0.0/8,2a07:e00::/32', 'drop from 1.2.3.4 for 30m',
+                 'drop from 5.6.7.8 for 1h', '@table nat', 'allow chain postrouting from 10.0.0.0/8']
+        p = pyrewall.PyreParser(emitter='nft')
+        script, v6r = p.parse_lines(lines)
+        name = list(p.ipsets)[0]
+        self.assertEqual(v6r, [])
+        self.assertEqual(script[:3], ['table inet pyrewall', 'delete table inet pyrewall', 'table inet pyrewall {'])
+        self.assertIn(f'    set {name} {{ type ipv4_addr; flags interval, timeout; }}', script)
+        self.assertIn('        type filter hook input priority 0; policy drop;', script)
+        self.assertIn('        ip saddr 10.0.0.0/8 tcp dport 22 accept', script)
+        self.assertIn('        ip6 saddr 2a07:e00::/32 tcp dport 22 accept', script)
+        self.assertEqual(len([r for r in script if f'@{name}' in r]), 1)
+        self.assertIn('    chain nat_POSTROUTING {', script)
+        self.assertEqual(p.output_origins.v4[script.index('        ip saddr 10.0.0.0/8 accept')].line, 6)
+        self.assertEqual(element_lines(p.ipsets, remaining=False), [
+            f'add element inet pyrewall {name} {{ 1.2.3.4 timeout 1800s, 5.6.7.8 timeout 3600s }}'
+        ])
+
+    def test_offload(self):
+        """Test @offload declares a flowtable, and adds established TCP / UDP flows to it in the FORWARD chain"""
+        p = pyrewall.PyreParser(emitter='nft')
+        script, _ = p.parse_lines(['@offload if eth0,eth1 hw', 'allow forward if-in eth1 if-out eth0'])
+        name = list(p.emitter.flowtables)[0]
+        self.assertIn(f'    flowtable {name} {{ hook ingress priority 0; devices = {{ eth0, eth1 }}; flags offload; }}', script)
+        fwd = script[script.index('    chain FORWARD {') + 2:script.index('    chain FORWARD {') + 4]
+        self.assertEqual(fwd, [f'        meta l4proto {{ tcp, udp }} ct state established flow add @{name}',
+                               '        iifname "eth1" oifname "eth0" accept'])
+        with self.assertRaises(RuleSyntaxError):
+            pyrewall.PyreParser(emitter='iptables').parse_lines(['@offload if eth0'])
+
+    def test_single_transaction(self):
+        """Test the script and set elements are loaded with a single 'nft -f' call"""
+        conf_state = conf.STATE_DIR
+        conf.STATE_DIR = self.state_dir.name
+        try:
+            p = pyrewall.PyreParser(emitter='nft')
+            script, _ = p.parse_lines(['allow port 22', 'drop from 1.2.3.4 for 30m'])
+            apply_nft(script, p.ipsets)
+        finally:
+            conf.STATE_DIR = conf_state
+        self.assertEqual(self.fake_state('args').strip(), '-f -')
+        stdin = self.fake_state('stdin')
+        self.assertTrue(stdin.startswith('table inet pyrewall\ndelete table inet pyrewall\n'))
+        self.assertIn(f'add element inet pyrewall {list(p.ipsets)[0]} {{ 1.2.3.4 timeout 1800s }}', stdin)
+
+    def test_snapshot_restore(self):
+        """Test snapshotting a missing table returns no rules, and a snapshot is restored by replacing the table"""
+        with mock.patch.dict(os.environ, FAKE_XT_FAIL='list', FAKE_XT_ERROR='Error: No such file or directory'):
+            self.assertEqual(snapshot_nft(), [])
+        with mock.patch.dict(os.environ, FAKE_XT_FAIL='list', FAKE_XT_ERROR='Error: Operation not permitted'):
+            with self.assertRaises(IPTablesError):
+                snapshot_nft()
+
+        saved = ['table inet pyrewall {', '    chain INPUT {', '    }', '}']
+        listing = join(self.state_dir.name, 'listing')
+        with open(listing, 'w') as fh:
+            fh.write("\n".join(saved))
+        with mock.patch.dict(os.environ, FAKE_XT_OUTPUT=listing):
+            self.assertEqual(snapshot_nft(), saved)
+        restore_nft(saved)
+        self.assertTrue(self.fake_state('stdin').startswith(
+            "table inet pyrewall\ndelete table inet pyrewall\ntable inet pyrewall {\n    chain INPUT {"
+        ))
+
+
+class TestRawMangle(unittest.TestCase):
+    def test_notrack(self):
+        """Test notrack rules in the raw table default to PREROUTING, and are refused in other tables"""
+        p = pyrewall.PyreParser()
+        v4r, _ = p.parse_lines(['@table raw', 'notrack port udp 53', 'notrack chain output sport udp 53'])
+        self.assertEqual(v4r[:5], [
+            '*raw', ':PREROUTING ACCEPT [0:0]', ':OUTPUT ACCEPT [0:0]',
+            '-A PREROUTING -p udp --dport 53 -j CT --notrack', '-A OUTPUT -p udp --sport 53 -j CT --notrack'
+        ])
+        self.assertEqual(pyrewall.RuleParser().parse('allow state untracked')[0],
+                         ['-A INPUT -m state --state UNTRACKED -j ACCEPT'])
+        with self.assertRaises(RuleSyntaxError):
+            pyrewall.RuleParser().parse('notrack port udp 53')
+
+    def test_mss(self):
+        """Test mss rules in the mangle table clamp to the PMTU or set a fixed MSS on forwarded TCP SYNs"""
+        rp = pyrewall.RuleParser(table='mangle')
+        self.assertEqual(rp.parse('mss clamp if-out ppp0')[0],
+                         ['-A FORWARD -p tcp --tcp-flags SYN,RST SYN -o ppp0 -j TCPMSS --clamp-mss-to-pmtu'])
+        self.assertEqual(rp.parse('mss 1360 chain postrouting')[0],
+                         ['-A POSTROUTING -p tcp --tcp-flags SYN,RST SYN -j TCPMSS --set-mss 1360'])
+        for line in ['mss 70000', 'mss']:
+            with self.assertRaises(RuleSyntaxError):
+                rp.parse(line)
+        with self.assertRaises(RuleSyntaxError):
+            pyrewall.RuleParser(table='raw').parse('mss clamp')
+
+    def test_nft(self):
+        """Test notrack / mss rules are translated for the nftables backend, using the raw and mangle priorities"""
+        p = pyrewall.PyreParser(emitter='nft')
+        script, _ = p.parse_lines(['@table raw', 'notrack port udp 53', '@table mangle', 'mss clamp if-out ppp0'])
+        i = script.index('    chain raw_PREROUTING {')
+        self.assertEqual(script[i + 1:i + 3], ['        type filter hook prerouting priority -300; policy accept;',
+                                               '        udp dport 53 notrack'])
+        self.assertIn('        oifname "ppp0" meta l4proto tcp tcp flags & (syn | rst) == syn '
+                      'tcp option maxseg size set rt mtu', script)
+        self.assertIn('        type route hook output priority -150; policy accept;', script)
+
+
+
+class TestLimits(unittest.TestCase):
+    def test_limit(self):
+        """Test limit uses -m limit for a shared rate, and hashlimit for per address limits or rates to drop over"""
+        rp = pyrewall.RuleParser()
+        self.assertEqual(rp.parse('allow icmp limit 5/s burst 10'), (
+            ['-A INPUT -p icmp -m limit --limit 5/second --limit-burst 10 -j ACCEPT'],
+            ['-A INPUT -p ipv6-icmp -m limit --limit 5/second --limit-burst 10 -j ACCEPT']
+        ))
+        v4r, v6r = rp.parse('drop port 53 udp limit 100/s per /24,/56')
+        self.assertIn('-m hashlimit --hashlimit-above 100/second --hashlimit-mode srcip --hashlimit-srcmask 24 '
+                      '--hashlimit-name pyre-', v4r[0])
+        self.assertIn('--hashlimit-srcmask 56 ', v6r[0])
+        self.assertTrue(v4r[0].endswith(' -j DROP'))
+        # Each rule gets its own hashlimit table, named after the rule
+        a, b = rp.parse('allow port 22 limit 10/min per-source')[0][0], rp.parse('allow port 23 limit 10/min per-source')[0][0]
+        self.assertNotEqual(a.split('--hashlimit-name ')[1], b.split('--hashlimit-name ')[1])
+        for line in ['allow limit 10/fortnight', 'allow limit 0/s', 'allow port 22 limit 10/min per /40']:
+            with self.assertRaises(RuleSyntaxError):
+                rp.parse(line)
+
+    def test_connlimit_recent(self):
+        """Test connlimit groups addresses by the per-version prefix, and recent tracks addresses in a named list"""
+        rp = pyrewall.RuleParser()
+        self.assertEqual(rp.parse('drop port 80 connlimit above 200 per /24'), (
+            ['-A INPUT -p tcp --dport 80 -m connlimit --connlimit-above 200 --connlimit-mask 24 -j DROP'],
+            ['-A INPUT -p tcp --dport 80 -m connlimit --connlimit-above 200 --connlimit-mask 64 -j DROP']
+        ))
+        self.assertEqual(rp.parse('allow port 80 connlimit 50 from 10.0.0.0/8')[0],
+                         ['-A INPUT -p tcp --dport 80 -s 10.0.0.0/8 -m connlimit --connlimit-upto 50 -j ACCEPT'])
+        self.assertEqual(rp.parse('drop port 22 state new recent ssh update 4/60s')[0], [
+            '-A INPUT -p tcp --dport 22 -m state --state NEW -m recent --name ssh --update --seconds 60 --hitcount 4 -j DROP'
+        ])
+        with self.assertRaises(RuleSyntaxError):
+            rp.parse('drop connlimit 5 burst 3')
+        # The rule which failed to parse doesn't leak into the next one
+        self.assertEqual(rp.parse('allow port 22')[0], ['-A INPUT -p tcp --dport 22 -j ACCEPT'])
+
+    def test_nft(self):
+        """Test limits are translated into nftables limit / ct count statements, with meters for per address limits"""
+        rp = pyrewall.RuleParser(emitter='nft')
+        self.assertEqual(rp.parse('allow icmp4 limit 5/s burst 10')[0],
+                         ['-A INPUT meta l4proto icmp limit rate 5/second burst 10 packets accept'])
+        v4r, v6r = rp.parse('drop port 80 connlimit above 200 per /24')
+        self.assertEqual(v6r, [])
+        self.assertRegex(v4r[0], r'^-A INPUT tcp dport 80 meter pyre-m4-[0-9a-f]{8} '
+                                 r'\{ ip saddr and 255\.255\.255\.0 ct count over 200 \} drop$')
+        self.assertIn('{ ip6 saddr and ffff:ffff:ffff:ffff:: ct count over 200 }', v4r[1])
+        with self.assertRaises(RuleSyntaxError):
+            rp.parse('allow port 22 recent ssh set')
+
+
+
+class TestLogAction(unittest.TestCase):
+    def test_log_pair(self):
+        """Test log generates a rate limited LOG rule before each verdict rule, or only the LOG rule without an action"""
+        rp = pyrewall.RuleParser()
+        self.assertEqual(rp.parse('drop port 23 from 1.2.3.4,5.6.7.8 log prefix "telnet: " rate 5/min')[0], [
+            '-A INPUT -p tcp --dport 23 -s 1.2.3.4/32 -m limit --limit 5/minute -j LOG --log-prefix "telnet: "',
+            '-A INPUT -p tcp --dport 23 -s 1.2.3.4/32 -j DROP',
+            '-A INPUT -p tcp --dport 23 -s 5.6.7.8/32 -m limit --limit 5/minute -j LOG --log-prefix "telnet: "',
+            '-A INPUT -p tcp --dport 23 -s 5.6.7.8/32 -j DROP',
+        ])
+        self.assertEqual(rp.parse('log prefix telnet port 23')[0], [
+            f'-A INPUT -p tcp --dport 23 -m limit --limit {conf.LOG_RULE_RATE} --limit-burst {conf.LOG_RULE_BURST} '
+            f'-j LOG --log-prefix "telnet "'
+        ])
+        for line in ['log prefix "this prefix is much too long for LOG"', 'log threshold 5', 'log group 70000']:
+            with self.assertRaises(RuleSyntaxError):
+                rp.parse(line)
+
+    def test_log_limits(self):
+        """Test the log rule gets its own hashlimit tables / meters, and never updates the verdict rule's recent list"""
+        rp = pyrewall.RuleParser()
+        log_rule, rule = rp.parse('drop port 80 limit 10/s per-source log')[0]
+        names = [r.split('--hashlimit-name ')[1].split()[0] for r in [log_rule, rule]]
+        self.assertNotEqual(names[0], names[1])
+        self.assertEqual(rp.parse('drop port 22 state new recent ssh update 4/60s log')[0][0],
+                         '-A INPUT -p tcp --dport 22 -m state --state NEW -m recent --name ssh --rcheck --seconds 60 '
+                         '--hitcount 4 -m limit --limit 10/minute --limit-burst 5 -j LOG')
+        log_rule, rule = rp.parse('allow port 22 recent ssh set log')[0]
+        self.assertNotIn('-m recent', log_rule)
+        self.assertIn('-m recent --name ssh --set', rule)
+        self.assertIn('-m recent --name ssh --set', rp.parse('log port 22 recent ssh set')[0][0])
+        log_rule, rule = pyrewall.RuleParser(emitter='nft').parse('drop port 80 limit 10/s per-source log')[0][::2]
+        self.assertNotEqual(log_rule.split('meter ')[1].split()[0], rule.split('meter ')[1].split()[0])
+
+    def test_nflog(self):
+        """Test nflog / group send packets to an NFLOG group with a queue threshold"""
+        rp = pyrewall.RuleParser()
+        self.assertEqual(rp.parse('reject port 25 log prefix smtp nflog group 2 threshold 50')[0][0],
+                         '-A INPUT -p tcp --dport 25 -m limit --limit 10/minute --limit-burst 5 -j NFLOG '
+                         '--nflog-group 2 --nflog-prefix "smtp" --nflog-threshold 50')
+        self.assertIn(f'--nflog-group 0 --nflog-threshold {conf.NFLOG_THRESHOLD}', rp.parse('log nflog')[0][0])
+
+    def test_nft(self):
+        """Test the nftables log rules go before the verdict, including per-source rate limits for each IP version"""
+        rp = pyrewall.RuleParser(emitter='nft')
+        self.assertEqual(rp.parse('drop port 23 log prefix "telnet: " group 3 threshold 10 rate 5/min')[0], [
+            '-A INPUT tcp dport 23 limit rate 5/minute log prefix "telnet: " group 3 queue-threshold 10',
+            '-A INPUT tcp dport 23 drop'
+        ])
+        rules = rp.parse('allow port 22 log rate 1/s per-source')[0]
+        self.assertEqual(len(rules), 3)
+        self.assertIn('{ ip saddr limit rate 1/second } log', rules[0])
+        self.assertIn('{ ip6 saddr limit rate 1/second } log', rules[1])
+        self.assertEqual(rules[2], '-A INPUT tcp dport 22 accept')
+
+
+
+class TestNAT(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = join(self.tmp.name, 'portmap.txt')
+        with open(self.path, 'w') as fh:
+            fh.write('# port(s) target\n')
+            fh.write(''.join(f'{2201 + i} 10.0.0.{i + 1}:22\n' for i in range(40)))
+            fh.write('8000-8999 10.0.0.200   # keeps the port\n443 [2a07:e00::5]:8443\nnot a mapping\n')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_keywords(self):
+        """Test forward-port / snat / masquerade compile to DNAT / SNAT / MASQUERADE for the target's IP version"""
+        rp = pyrewall.RuleParser(table='nat')
+        self.assertEqual(rp.parse('forward-port 2201 udp to 10.0.0.1:22 if-in eth0'),
+                         (['-A PREROUTING -p udp --dport 2201 -i eth0 -j DNAT --to-destination 10.0.0.1:22'], []))
+        self.assertEqual(rp.parse('forward-port 80 to [2a07:e00::5]:8080'),
+                         ([], ['-A PREROUTING -p tcp --dport 80 -j DNAT --to-destination [2a07:e00::5]:8080']))
+        self.assertEqual(rp.parse('snat from 10.0.0.0/8 to 185.1.2.3 if-out eth0')[0],
+                         ['-A POSTROUTING -s 10.0.0.0/8 -o eth0 -j SNAT --to-source 185.1.2.3'])
+        self.assertEqual(rp.parse('masquerade if-out eth0'),
+                         (['-A POSTROUTING -o eth0 -j MASQUERADE'], ['-A POSTROUTING -o eth0 -j MASQUERADE']))
+        for line in ['forward-port 80 to 10.0.0.5 from 2a07::/32', 'forward-port 80', 'snat to 10.0.0.5:x']:
+            with self.assertRaises(RuleSyntaxError):
+                rp.parse(line)
+        with self.assertRaises(RuleSyntaxError):
+            pyrewall.RuleParser().parse('masquerade')
+
+    def test_portmap_buckets(self):
+        """Test @portmap splits large lists into a chain per bucket of ports, with one jump rule per bucket"""
+        mappings = read_portmap(self.path)
+        self.assertEqual(len(mappings), 42)
+        with self.assertRaises(RuleSyntaxError):
+            read_portmap(self.path, strict=True)
+        p = pyrewall.PyreParser(table='nat')
+        v4r, v6r = p.parse_lines([f'@portmap {self.path} tcp if-in eth0'])
+        jumps = [r for r in v4r if r.startswith('-A PREROUTING')]
+        self.assertEqual(len(jumps), 3)
+        self.assertRegex(jumps[0], r'^-A PREROUTING -i eth0 -p tcp --dport 2201:2216 -j (pyre-pm-[0-9a-f]{8}-4t0)$')
+        sub = jumps[0].split(' -j ')[1]
+        self.assertIn(f':{sub} - [0:0]', v4r)
+        self.assertIn(f'-A {sub} -p tcp --dport 2201 -j DNAT --to-destination 10.0.0.1:22', v4r)
+        self.assertIn('-A PREROUTING -i eth0 -p tcp --dport 443 -j DNAT --to-destination [2a07:e00::5]:8443', v6r)
+
+    def test_nft(self):
+        """Test the nftables backend translates NAT rules, and compiles @portmap into one map lookup per protocol"""
+        rp = pyrewall.RuleParser(table='nat', emitter='nft')
+        self.assertEqual(rp.parse('forward-port 2201 udp to 10.0.0.1:22')[0],
+                         ['-A PREROUTING meta nfproto ipv4 udp dport 2201 dnat ip to 10.0.0.1:22'])
+        self.assertEqual(rp.parse('masquerade if-out eth0')[0], ['-A POSTROUTING oifname "eth0" masquerade'])
+        p = pyrewall.PyreParser(emitter='nft')
+        script, _ = p.parse_lines(['@table nat', f'@portmap {self.path}'])
+        rules = [l.strip() for l in script if 'dnat' in l]
+        self.assertEqual(len(rules), 3)
+        self.assertEqual(rules[0], 'meta nfproto ipv4 dnat ip to tcp dport map { 8000-8999 : 10.0.0.200 }')
+        self.assertTrue(rules[1].startswith('meta nfproto ipv4 dnat ip addr . port to tcp dport map { 2201 : 10.0.0.1 . 22, '))
+        self.assertEqual(rules[2], 'meta nfproto ipv6 dnat ip6 addr . port to tcp dport map { 443 : 2a07:e00::5 . 8443 }')
+
+
+class TestBalance(unittest.TestCase):
+    def test_random(self):
+        """Test balance chains -m statistic rules with each weight out of the remaining weights, last one unmatched"""
+        rp = pyrewall.RuleParser(table='nat')
+        v4r, v6r = rp.parse('balance port 443 to 10.0.0.1,10.0.0.2,10.0.0.3,10.0.0.4 weights 1,2,3,4')
+        self.assertEqual(v6r, [])
+        self.assertEqual(len(v4r), 4)
+        probs = [r.split('--probability ')[1].split()[0] for r in v4r[:3]]
+        self.assertEqual(probs, ['0.10000000000', '0.22222222222', '0.42857142857'])
+        self.assertEqual(v4r[3], '-A PREROUTING -p tcp --dport 443 -j DNAT --to-destination 10.0.0.4')
+        for line in ['balance port 80', 'balance port 80 to 10.0.0.1,10.0.0.2 weights 1', 'balance to 10.0.0.1 mode x',
+                     'balance port 80 to 10.0.0.1 weights 0']:
+            with self.assertRaises(RuleSyntaxError):
+                rp.parse(line)
+        with self.assertRaises(RuleSyntaxError):
+            pyrewall.RuleParser().parse('balance port 80 to 10.0.0.1,10.0.0.2')
+
+    def test_nth_hash(self):
+        """Test nth mode has a round robin rule per weight, and hash mode HMARKs then matches a mark per weight"""
+        rp = pyrewall.RuleParser(table='nat')
+        v4r, v6r = rp.parse('balance port 80 to 10.0.0.1,10.0.0.2,[2a07::1]:8080 weights 2,1,1 mode nth')
+        self.assertEqual(v4r, [
+            '-A PREROUTING -p tcp --dport 80 -m statistic --mode nth --every 3 --packet 0 -j DNAT --to-destination 10.0.0.1',
+            '-A PREROUTING -p tcp --dport 80 -m statistic --mode nth --every 2 --packet 0 -j DNAT --to-destination 10.0.0.1',
+            '-A PREROUTING -p tcp --dport 80 -j DNAT --to-destination 10.0.0.2',
+        ])
+        self.assertEqual(v6r, ['-A PREROUTING -p tcp --dport 80 -j DNAT --to-destination [2a07::1]:8080'])
+        v4r, _ = rp.parse('balance port 80 to 10.0.0.1,10.0.0.2 mode hash')
+        self.assertEqual(v4r, [
+            '-A PREROUTING -p tcp --dport 80 -j HMARK --hmark-tuple src --hmark-mod 2 --hmark-offset 0x10000',
+            '-A PREROUTING -p tcp --dport 80 -m mark --mark 0x10000 -j DNAT --to-destination 10.0.0.1',
+            '-A PREROUTING -p tcp --dport 80 -m mark --mark 0x10001 -j DNAT --to-destination 10.0.0.2',
+        ])
+
+    def test_nft(self):
+        """Test the nftables backend compiles balance into a single dnat map lookup per IP version"""
+        rp = pyrewall.RuleParser(table='nat', emitter='nft')
+        self.assertEqual(rp.parse('balance port 80 to 10.0.0.1:8080,10.0.0.2:8080 weights 3,1 mode hash')[0], [
+            '-A PREROUTING meta nfproto ipv4 tcp dport 80 dnat ip addr . port to jhash ip saddr mod 4 '
+            'map { 0-2 : 10.0.0.1 . 8080, 3 : 10.0.0.2 . 8080 }'
+        ])
+        self.assertEqual(rp.parse('balance port 80 to 10.0.0.1,10.0.0.2')[0], [
+            '-A PREROUTING meta nfproto ipv4 tcp dport 80 dnat ip to numgen random mod 2 map { 0 : 10.0.0.1, 1 : 10.0.0.2 }'
+        ])
+        with self.assertRaises(RuleSyntaxError):
+            rp.parse('balance port 80 to 10.0.0.1:8080,10.0.0.2')
+
+
+class TestSaveParser(unittest.TestCase):
+    save = [
+        '# Generated by iptables-save v1.8.7 on Mon Jan  1 00:00:00 2024', '*filter', ':INPUT DROP [4:240]',
+        ':FORWARD ACCEPT [0:0]', ':web - [0:0]',
+        '[12:720] -A INPUT -s 10.0.0.0/8 -p tcp -m tcp --dport 22 -j ACCEPT',
+        '[3:180] -A INPUT -m state --state RELATED,ESTABLISHED -j ACCEPT',
+        '[0:0] -A INPUT -p tcp -m multiport --dports 443,80 -m comment --comment "web traffic" -j web',
+        '[0:0] -A INPUT -p tcp -m tcp --dport 22 -m limit --limit 10/min --limit-burst 5 '
+        '-j LOG --log-prefix "ssh " --log-level 4',
+        '[0:0] -A INPUT -p tcp -m tcp --dport 23 -j REJECT --reject-with icmp-port-unreachable',
+        '[0:0] -A INPUT ! -s 192.168.1.5/32 -p tcp -m tcp --dport 23 -j DROP', 'COMMIT',
+    ]
+
+    def test_parse(self):
+        """Test parsing iptables-save output with counters into normalised SavedRule's and the chain policies"""
+        p = SaveParser()
+        res = list(p.parse_lines(self.save))
+        self.assertEqual(len(res), 6)
+        rule, counters = res[0]
+        self.assertEqual(counters, (12, 720))
+        self.assertEqual((rule.table, rule.chain, rule.protocol, rule.source, rule.dports, rule.target),
+                         ('filter', 'INPUT', 'tcp', '10.0.0.0/8', '22', '-j ACCEPT'))
+        self.assertEqual(res[1][0].matches, ('-m conntrack --ctstate ESTABLISHED,RELATED',))
+        self.assertEqual((res[2][0].dports, res[2][0].matches, res[2][0].target), ('80,443', (), '-j web'))
+        self.assertEqual(res[3][0].matches, ('-m limit --limit 10/minute',))
+        self.assertEqual(res[3][0].target, '-j LOG --log-prefix "ssh "')
+        self.assertEqual(res[4][0].target, '-j REJECT')
+        self.assertEqual(res[5][0].source, '! 192.168.1.5')
+        self.assertEqual(p.chains[('filter', 'INPUT')], ('filter', 'INPUT', 'DROP', 4, 240))
+        self.assertEqual(p.chains[('filter', 'web')].policy, '-')
+        self.assertIsNone(next(p.parse_lines(['-A INPUT -j DROP']))[1])
+
+    def test_comments(self):
+        """Test commented rules are normalised once per template (not per comment), like rules without comments"""
+        p = SaveParser()
+        lines = [
+            f'[{i}:60] -A INPUT -s 10.0.{i // 256}.{i % 256}/32 -p tcp -m tcp --dport {i % 50} '
+            f'-m comment --comment "host {i} \\"web\\"" -j ACCEPT' for i in range(2000)
+        ]
+        rules = [r for r, _ in p.parse_lines(lines)]
+        self.assertEqual(len(p._memo), 1)
+        self.assertEqual(rules[300], p.parse_rule('-A INPUT -s 10.0.1.44 -p tcp --dport 0 -j ACCEPT'))
+        r = p.parse_rule('-A INPUT -p tcp -m comment --comment "a -s 1.2.3.4" -j LOG --log-prefix "ssh \\"x\\" "')
+        self.assertEqual((r.source, r.matches, r.target), (None, (), '-j LOG --log-prefix "ssh "x" "'))
+
+    def test_pyre_equal(self):
+        """Test rules compiled by Pyre compare equal to the same rules from iptables-save, and convert back"""
+        v4r, _ = pyrewall.PyreParser().parse_lines([
+            'allow port 22 from 10.0.0.0/8', 'allow state established,related', 'reject port 23',
+            'log prefix "ssh" rate 10/minute port 22',
+        ])
+        p = SaveParser()
+        pyre_rules = [r for r, _ in p.parse_lines(v4r)]
+        self.assertEqual(len(pyre_rules), 4)
+        saved = [r for r, _ in SaveParser().parse_lines(self.save)]
+        self.assertEqual(set(pyre_rules) - set(saved), set())
+        self.assertEqual(p.parse_rule('-A INPUT -s 10.1.2.3/8 -p 6 --dport 22 -j ACCEPT'), saved[0])
+        self.assertEqual(to_builder(saved[0]).build(), ['-A INPUT -p tcp --dport 22 -s 10.0.0.0/8 -j ACCEPT'])
+        self.assertEqual(to_builder(saved[2]).build(), ['-A INPUT -p tcp -m multiport --dports 80,443 -j web'])
+        with self.assertRaises(RuleSyntaxError):
+            to_builder(p.parse_rule('-A INPUT -p tcp'))
+
+
+class TestTrace(unittest.TestCase):
+    rules = [
+        '@chain INPUT DROP', '@chain web -', 'allow state established,related', 'allow from 10.0.0.0/8 port 22',
+        'ipt4 -A INPUT -p tcp -m multiport --dports 80,443 -j web', 'ipt4 -A web -s 1.2.3.0/24 -j DROP',
+        'ipt4 -A web -p tcp --dport 443 -j ACCEPT', 'allow icmp',
+    ]
+
+    def setUp(self):
+        p = pyrewall.PyreParser()
+        p.parse_lines(self.rules)
+        self.tracer = PacketTracer.from_parser(p)
+
+    def test_parse_flow(self):
+        """Test parsing flow specs, including the protocol / state / chain defaults"""
+        f = parse_flow('1.2.3.4:5555 -> 10.0.0.1:443 in eth0')
+        self.assertEqual(tuple(f), ('tcp', '1.2.3.4', 5555, '10.0.0.1', 443, 'eth0', None, 'new', 'INPUT'))
+        self.assertEqual(parse_flow('udp 10.0.0.2 -> 10.0.0.1:53 in eth1 out eth0').chain, 'FORWARD')
+        self.assertEqual(parse_flow('icmp ::1 -> 2a07:e00::1 type 8').dport, 8)
+        for spec in ['1.2.3.4 10.0.0.1:443', 'tcp 1.2.3.4 -> 10.0.0.1:99999', 'tcp 1.2.3.4 -> 10.0.0.1 state x']:
+            with self.assertRaises(RuleSyntaxError):
+                parse_flow(spec)
+        with self.assertRaisesRegex(RuleSyntaxError, "Invalid flow destination '10.0.0.1:0'"):
+            parse_flow('tcp 1.2.3.4:1 -> 10.0.0.1:0')
+
+    def test_trace(self):
+        """Test tracing flows through user chains, back to the policy, with the Pyre line of the deciding rule"""
+        res = self.tracer.trace('tcp 1.2.3.4:5555 -> 10.0.0.1:443')
+        self.assertEqual((res.verdict, res.chains), ('DROP', ('INPUT', 'web')))
+        self.assertEqual(res.rule, '-A web -s 1.2.3.0/24 -j DROP')
+        res = self.tracer.trace('tcp 9.9.9.9:5555 -> 10.0.0.1:443')
+        self.assertEqual((res.verdict, res.source.line), ('ACCEPT', 7))
+        res = self.tracer.trace('tcp 9.9.9.9:5555 -> 10.0.0.1:80')
+        self.assertEqual((res.verdict, res.rule, res.chains), ('DROP', None, ('INPUT', 'web')))
+        self.assertEqual(self.tracer.trace('tcp 10.1.1.1 -> 10.0.0.1:22').source.text, 'allow from 10.0.0.0/8 port 22')
+        self.assertEqual(self.tracer.trace('udp 9.9.9.9 -> 10.0.0.1:53 state established').verdict, 'ACCEPT')
+        self.assertEqual(self.tracer.trace('icmp 9.9.9.9 -> 10.0.0.1 type 8').verdict, 'ACCEPT')
+
+    def test_trace_many(self):
+        """Test batch tracing flows from a CSV gives the same results as tracing them one by one"""
+        with tempfile.TemporaryDirectory() as d:
+            path = join(d, 'flows.csv')
+            with open(path, 'w') as fh:
+                fh.write('protocol,src,sport,dst,dport,state\n')
+                for i in range(50):
+                    fh.write(f'{("tcp", "udp")[i % 2]},{(1, 10)[i % 3 == 0]}.2.3.{i},{1000 + i},10.0.0.1,'
+                             f'{(22, 80, 443, 53)[i % 4]},{("new", "established")[i % 5 == 0]}\n')
+            flows = list(read_flows(path))
+        self.assertEqual(len(flows), 50)
+        expected = [self.tracer.trace(f) for f in flows]
+        self.assertEqual(self.tracer.trace_many(flows, use_numpy=False), expected)
+        if HAS_NUMPY:
+            self.assertEqual(self.tracer.trace_many(flows, use_numpy=True), expected)
+
+
+class TestCost(unittest.TestCase):
+    def setUp(self):
+        p = pyrewall.PyreParser()
+        p.parse_lines(TestTrace.rules + ['drop from 1.2.3.4,5.6.7.0/24 for 30m'])
+        self.cost = RuleCost.from_parser(p)
+
+    def test_worst_depth(self):
+        """Test the worst case / jump depth per chain, and the kernel footprint estimate"""
+        costs = {(c.ipver, c.chain): c for c in self.cost.report()}
+        self.assertEqual(costs[('v4', 'INPUT')][3:], (5, 7, None, 1))
+        self.assertEqual(costs[('v4', 'web')][3:], (2, 2, None, 0))
+        self.assertEqual(costs[('v6', 'INPUT')].worst, 2)
+        v4, v6 = self.cost.footprint(cpus=4)
+        self.assertEqual((v4.rules, v4.tables, v4.cpus), (7, 1, 4))
+        # 7 rules, the end of the 4 chains, the ERROR entry naming 'web', and the end of the table
+        self.assertEqual(v4.counters, 13 * 16 * 4)
+        self.assertEqual((v4.sets, v6.sets), (2 * (16 + 8), 0))
+        self.assertGreater(v6.blob, 0)
+        self.assertEqual(v4.total, v4.blob + v4.counters + v4.sets)
+        self.assertEqual(len(format_cost(self.cost.report(), [v4, v6])), 1 + 8 + 2)
+
+    def test_many_chains(self):
+        """Test chains reached by many jump paths are only costed once (this takes ~2^40 steps without caching)"""
+        lines = ['*filter', ':INPUT DROP [0:0]'] + [f':c{i} - [0:0]' for i in range(40)] + ['-A INPUT -j c0']
+        for i in range(39):
+            lines += [f'-A c{i} -p tcp --dport 80 -j c{i + 1}', f'-A c{i} -p tcp --dport 443 -j c{i + 1}']
+        costs = {c.chain: c for c in RuleCost(dict(v4=lines + ['-A c39 -j ACCEPT', 'COMMIT'])).report()}
+        # worst(c39) = 1, and each chain before it evaluates its 2 rules plus the worst of c(i+1) twice
+        self.assertEqual(costs['c0'].worst, 3 * 2 ** 39 - 2)
+        self.assertEqual((costs['INPUT'].worst, costs['INPUT'].depth), (1 + 3 * 2 ** 39 - 2, 40))
+
+    def test_loop_order(self):
+        """Test a chain's worst case inside a jump loop doesn't depend on which chain of the loop was costed first"""
+        lines = ['*filter', ':INPUT DROP [0:0]', ':a - [0:0]', ':b - [0:0]', '-A a -j b', '-A a -p tcp -j ACCEPT',
+                 '-A a -p udp -j ACCEPT', '-A b -j a', 'COMMIT']
+        for order in [['a', 'b'], ['b', 'a']]:
+            cost = RuleCost(dict(v4=lines))
+            with self.assertLogs('privex.pyrewall.cost', 'WARNING') as logs:
+                worst = {c: cost.worst('v4', 'filter', c) for c in order}
+            self.assertEqual(worst, dict(a=4, b=4))
+            self.assertEqual((cost.depth('v4', 'filter', 'a'), cost.depth('v4', 'filter', 'b')), (2, 2))
+            self.assertIn('jumps back into itself', logs.output[0])
+
+    def test_flow_average(self):
+        """Test the average rules evaluated per chain, weighted by a sample of flows"""
+        costs = {(c.ipver, c.chain): c.average for c in self.cost.report(flows=[
+            'tcp 1.2.3.9 -> 10.0.0.1:443', 'tcp 9.9.9.9 -> 10.0.0.1:80', 'udp 9.9.9.9 -> 10.0.0.1:53',
+        ])}
+        # 1.2.3.9 is dropped by the 1st rule of 'web', 9.9.9.9:80 falls through it, and UDP evaluates all 5 INPUT rules
+        self.assertEqual(costs[('v4', 'INPUT')], ((3 + 1) + (5 + 2) + 5) / 3)
+        self.assertEqual(costs[('v4', 'web')], 1.5)
+        self.assertIsNone(costs[('v6', 'INPUT')])
+
+    def test_counter_average(self):
+        """Test the average rules evaluated per chain, weighted by the packet counters of iptables-save -c output"""
+        saved = [
+            '*filter', ':INPUT DROP [10:600]', ':web - [0:0]',
+            '[800:1] -A INPUT -m state --state RELATED,ESTABLISHED -j ACCEPT',
+            '[100:1] -A INPUT -p tcp -m multiport --dports 443,80 -j web', '[40:1] -A web -s 1.2.3.0/24 -j DROP',
+            '[50:1] -A web -p tcp -m tcp --dport 443 -j ACCEPT', 'COMMIT',
+        ]
+        costs = {(c.ipver, c.chain): c.average for c in self.cost.report(counters=dict(v4=saved))}
+        # 10 of the 100 packets sent to 'web' return to INPUT, and are dropped by the policy after the last 2 rules
+        self.assertAlmostEqual(costs[('v4', 'web')], (100 + 60) / 100)
+        self.assertAlmostEqual(costs[('v4', 'INPUT')], (900 + 100 + (100 + 100 * 1.6) + 10 * 2) / 900)
+        self.assertIsNone(costs[('v6', 'INPUT')])
+
+
 if __name__ == '__main__':
     unittest.main()